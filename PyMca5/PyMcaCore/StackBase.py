@@ -103,6 +103,10 @@ def __init__(self):
         # the sums.
         self._dynamicLimit = 5.0E6
         self._tryNumpy = True
+        # optional in-memory cumulative sum of dynamically loaded stacks
+        # along the mca axis for fast ROI image calculation
+        self._ROICacheFlag = False
+        self._ROICumulativeSum = None
 
     def setPluginDirectoryList(self, dirlist):
         for directory in dirlist:
@@ -248,6 +252,7 @@ def stackUpdated(self):
         """
         Recalculates the different images associated to the stack
         """
+        self._ROICumulativeSum = None
         self._tryNumpy = True
         if hasattr(self._stack.data, "size"):
             if self._stack.data.size > self._dynamicLimit:
@@ -778,31 +783,11 @@ def calculateROIImages(self, index1, index2, imiddle=None, energy=None):
                         print("Case 1 ROI image calculation elapsed = %f " %\
                               (time.time() - t0))
                 else:
-                    shape = self._stack.data.shape
-                    roiImage = numpy.zeros(self._stackImageData.shape,
-                                           numpy.float)
-                    background = roiImage * 1
-                    leftImage = roiImage * 1
-                    middleImage = roiImage * 1
-                    rightImage = roiImage * 1
-                    maxImage = roiImage * 1
-                    minImage = roiImage * 1
-                    step = 1
-                    for i in range(shape[0]):
-                        tmpData = self._stack.data[i:i+step,:, i1:i2] * 1
-                        numpy.add(roiImage[i:i+step,:],
-                              numpy.sum(tmpData, axis=2,dtype=numpy.float),
-                              roiImage[i:i+step,:])
-                        numpy.add(minImage[i:i+step,:],
-                                  numpy.min(tmpData, axis=2),
-                                  minImage[i:i + step, :])
-                        numpy.add(maxImage[i:i + step, :],
-                                  numpy.max(tmpData, axis=2),
-                                  maxImage[i:i + step, :])
-                        leftImage[i:i + step, :] += tmpData[:, :, 0]
-                        middleImage[i:i + step, :] += tmpData[:, :, imiddle - i1]
-                        rightImage[i:i + step, :] += tmpData[:, :, -1]
+                    roiImage, maxImage, minImage, leftImage, middleImage,\
+                              rightImage = self._calculateDynamicROIImages(i1,
+                                                        i2, imiddle, energy)
                     background = 0.5 * (i2 - i1) * (leftImage + rightImage)
+                    isUsingSuppliedEnergyAxis = True
                     if DEBUG:
                         print("2 Dynamic ROI image calculation elapsed = %f " %\
                               (time.time() - t0))
@@ -850,46 +835,11 @@ def calculateROIImages(self, index1, index2, imiddle=None, energy=None):
                         print("Case 3 ROI image calculation elapsed = %f " %\
                               (time.time() - t0))
                 else:
-                    shape = self._stack.data.shape
-                    roiImage = numpy.zeros(self._stackImageData.shape,
-                                           numpy.float)
-                    background = roiImage * 1
-                    leftImage = roiImage * 1
-                    middleImage = roiImage * 1
-                    rightImage = roiImage * 1
-                    maxImage = numpy.zeros(roiImage.shape, numpy.int32)
-                    minImage = numpy.zeros(roiImage.shape, numpy.int32)
-                    istep = 1
-                    for i in range(i1, i2):
-                        tmpData = self._stack.data[i:i + istep]
-                        tmpData.shape = roiImage.shape
-                        if i == i1:
-                            minImageData = tmpData * 1.0
-                            maxImageData = tmpData * 1.0
-                            minImage[:,:] = i1
-                            maxImage[:,:] = i1
-                        else:
-                            tmpIndex = numpy.where(tmpData < minImageData)
-                            minImage[tmpIndex] = i
-                            minImageData[tmpIndex] = tmpData[tmpIndex]
-
-                            tmpIndex = numpy.where(tmpData > maxImageData)
-                            maxImage[tmpIndex] = i
-                            maxImageData[tmpIndex] = tmpData[tmpIndex]
-                        numpy.add(roiImage, tmpData, roiImage)
-                        if (i == i1):
-                            leftImage = tmpData
-                        elif (i == imiddle):
-                            middleImage = tmpData
-                        elif i == (i2 - 1):
-                            rightImage = tmpData
-                    # the used approach is twice slower than argmax, but it
-                    # requires much less memory
+                    roiImage, maxImage, minImage, leftImage, middleImage,\
+                              rightImage = self._calculateDynamicROIImages(i1,
+                                                        i2, imiddle, energy)
+                    background = (leftImage + rightImage) * 0.5 * (i2 - i1)
                     isUsingSuppliedEnergyAxis = True
-                    minImage = energy[minImage]
-                    maxImage = energy[maxImage]
-                    if i2 > i1:
-                        background = (leftImage + rightImage) * 0.5 * (i2 - i1)
                     if DEBUG:
                         print("Case 4 Dynamic ROI elapsed = %f" %\
                               (time.time() - t0))
@@ -911,31 +861,11 @@ def calculateROIImages(self, index1, index2, imiddle=None, energy=None):
                         print("Case 5 ROI Image elapsed = %f" %\
                               (time.time() - t0))
                 else:
-                    shape = self._stack.data.shape
-                    roiImage = numpy.zeros(self._stackImageData.shape,
-                                           numpy.float)
-                    background = roiImage * 1
-                    leftImage = roiImage * 1
-                    middleImage = roiImage * 1
-                    rightImage = roiImage * 1
-                    maxImage = roiImage * 1
-                    minImage = roiImage * 1
-                    step = 1
-                    for i in range(shape[0]):
-                        tmpData = self._stack.data[i:i+step,:, i1:i2] * 1
-                        numpy.add(roiImage[i:i+step,:],
-                              numpy.sum(tmpData, axis=2, dtype=numpy.float),
-                              roiImage[i:i+step,:])
-                        numpy.add(minImage[i:i+step,:],
-                                  numpy.min(tmpData, 2),
-                                  minImage[i:i+step,:])
-                        numpy.add(maxImage[i:i+step,:],
-                                  numpy.max(tmpData, 2),
-                                  maxImage[i:i+step,:])
-                        leftImage[i:i+step, :]   += tmpData[:, :, 0]
-                        middleImage[i:i+step, :] += tmpData[:, :, imiddle-i1]
-                        rightImage[i:i+step, :]  += tmpData[:, :,-1]
+                    roiImage, maxImage, minImage, leftImage, middleImage,\
+                              rightImage = self._calculateDynamicROIImages(i1,
+                                                        i2, imiddle, energy)
                     background = 0.5*(i2-i1)*(leftImage+rightImage)
+                    isUsingSuppliedEnergyAxis = True
                     if DEBUG:
                         print("Case 6 Dynamic ROI image calculation elapsed = %f" %\
                                           (time.time() - t0))
@@ -982,6 +912,157 @@ def calculateROIImages(self, index1, index2, imiddle=None, energy=None):
             print("ROI images calculated")
         return imageDict
 
+    def enableROIImagesCache(self, flag=True):
+        """
+        Keep in memory the cumulative sum along the mca axis of dynamically
+        loaded stacks. It is built in one pass over the data the first time
+        the ROI images are calculated. Subsequent ROI images are obtained
+        from it without reading the stack again at the cost of a double
+        precision copy of the stack.
+        """
+        self._ROICacheFlag = flag
+        if not flag:
+            self._ROICumulativeSum = None
+
+    def _getChunkStep(self, axis, sliceSize=None):
+        """
+        Number of elements along the given axis to be read at once.
+
+        The step keeps the read slabs below the dynamic limit and it is
+        a multiple of the dataset chunk size along that axis when the
+        data are chunked (HDF5).
+        """
+        shape = self._stack.data.shape
+        if sliceSize is None:
+            sliceSize = 1
+            for i in range(len(shape)):
+                if i != axis:
+                    sliceSize *= shape[i]
+        step = max(1, int(self._dynamicLimit / max(sliceSize, 1)))
+        chunks = getattr(self._stack.data, "chunks", None)
+        if chunks:
+            chunk = chunks[axis]
+            step = max(chunk, chunk * (step // chunk))
+        return min(step, shape[axis])
+
+    def _getROICumulativeSum(self):
+        """
+        Return the cached cumulative sum along the mca axis building it
+        if needed. It returns None if the cache is not enabled.
+        """
+        if not self._ROICacheFlag:
+            return None
+        if self._ROICumulativeSum is not None:
+            return self._ROICumulativeSum
+        if DEBUG:
+            t0 = time.time()
+        data = self._stack.data
+        shape = data.shape
+        imageShape = self._stackImageData.shape
+        nChannels = shape[self.mcaIndex]
+        if self.mcaIndex == 0:
+            cumulative = numpy.zeros((nChannels + 1,) + imageShape,
+                                     numpy.float64)
+            step = self._getChunkStep(0)
+            for i in range(0, nChannels, step):
+                j = min(i + step, nChannels)
+                tmpData = numpy.array(data[i:j], dtype=numpy.float64)
+                tmpData.shape = (j - i,) + imageShape
+                numpy.cumsum(tmpData, axis=0, out=tmpData)
+                numpy.add(tmpData, cumulative[i], cumulative[i + 1:j + 1])
+        else:
+            cumulative = numpy.zeros(imageShape + (nChannels + 1,),
+                                     numpy.float64)
+            step = self._getChunkStep(0)
+            for i in range(0, shape[0], step):
+                j = min(i + step, shape[0])
+                numpy.cumsum(data[i:j], axis=2, dtype=numpy.float64,
+                             out=cumulative[i:j, :, 1:])
+        self._ROICumulativeSum = cumulative
+        if DEBUG:
+            print("ROI cumulative sum calculation elapsed = %f" %\
+                  (time.time() - t0))
+        return cumulative
+
+    def _calculateDynamicROIImages(self, i1, i2, imiddle, energy):
+        """
+        Calculate the ROI images of a dynamically loaded stack in one pass.
+
+        The stack is read in slabs following the dataset chunking or taken
+        from the cumulative sum cache when enabled.
+
+        Returns the ROI, Maximum, Minimum, Left, Middle and Right images.
+        The Maximum and Minimum images contain the energy at the maximum
+        and at the minimum of the ROI.
+        """
+        data = self._stack.data
+        imageShape = self._stackImageData.shape
+        cumulative = self._getROICumulativeSum()
+        roiImage = numpy.zeros(imageShape, numpy.float)
+        if self.mcaIndex == 0:
+            if cumulative is not None:
+                roiImage[:] = cumulative[i2] - cumulative[i1]
+            maxImage = numpy.zeros(imageShape, numpy.int32)
+            minImage = numpy.zeros(imageShape, numpy.int32)
+            step = self._getChunkStep(0)
+            for i in range(i1, i2, step):
+                j = min(i + step, i2)
+                if cumulative is None:
+                    tmpData = numpy.reshape(data[i:j], (j - i,) + imageShape)
+                    numpy.add(roiImage,
+                              numpy.sum(tmpData, axis=0, dtype=numpy.float),
+                              roiImage)
+                else:
+                    tmpData = cumulative[i + 1:j + 1] - cumulative[i:j]
+                if i == i1:
+                    leftImage = tmpData[0] * 1
+                    maxImageData = tmpData.max(axis=0)
+                    minImageData = tmpData.min(axis=0)
+                    maxImage[:] = numpy.argmax(tmpData, axis=0) + i
+                    minImage[:] = numpy.argmin(tmpData, axis=0) + i
+                else:
+                    tmpImage = tmpData.max(axis=0)
+                    tmpIndex = tmpImage > maxImageData
+                    maxImageData[tmpIndex] = tmpImage[tmpIndex]
+                    maxImage[tmpIndex] = \
+                                numpy.argmax(tmpData, axis=0)[tmpIndex] + i
+                    tmpImage = tmpData.min(axis=0)
+                    tmpIndex = tmpImage < minImageData
+                    minImageData[tmpIndex] = tmpImage[tmpIndex]
+                    minImage[tmpIndex] = \
+                                numpy.argmin(tmpData, axis=0)[tmpIndex] + i
+                if i <= imiddle < j:
+                    middleImage = tmpData[imiddle - i] * 1
+                if i <= (i2 - 1) < j:
+                    rightImage = tmpData[i2 - 1 - i] * 1
+            maxImage = energy[maxImage]
+            minImage = energy[minImage]
+        else:
+            maxImage = numpy.zeros(imageShape, numpy.float)
+            minImage = numpy.zeros(imageShape, numpy.float)
+            leftImage = numpy.zeros(imageShape, numpy.float)
+            middleImage = numpy.zeros(imageShape, numpy.float)
+            rightImage = numpy.zeros(imageShape, numpy.float)
+            if cumulative is not None:
+                roiImage[:] = cumulative[:, :, i2] - cumulative[:, :, i1]
+            step = self._getChunkStep(0,
+                            sliceSize=data.shape[1] * data.shape[2])
+            for i in range(0, imageShape[0], step):
+                j = min(i + step, imageShape[0])
+                if cumulative is None:
+                    tmpData = data[i:j, :, i1:i2]
+                    roiImage[i:j] = numpy.sum(tmpData, axis=2,
+                                              dtype=numpy.float)
+                else:
+                    tmpData = cumulative[i:j, :, i1 + 1:i2 + 1] - \
+                              cumulative[i:j, :, i1:i2]
+                maxImage[i:j] = energy[numpy.argmax(tmpData, axis=2) + i1]
+                minImage[i:j] = energy[numpy.argmin(tmpData, axis=2) + i1]
+                leftImage[i:j] = tmpData[:, :, 0]
+                middleImage[i:j] = tmpData[:, :, imiddle - i1]
+                rightImage[i:j] = tmpData[:, :, -1]
+        return roiImage, maxImage, minImage, leftImage, middleImage, rightImage
+
     def setSelectionMask(self, mask):
         if DEBUG:
             print("setSelectionMask called")
@@ -59,10 +59,11 @@ def __init__(self, parent=None, options=[1, 2, 3, 4, 5, 10],
         self.methodOptions = qt.QGroupBox(self)
         self.methodOptions.setTitle('PCA Method to use')
         self.methods = ['Covariance', 'Expectation Max.',
-                        'Cov. Multiple Arrays']
+                        'Cov. Multiple Arrays', 'Randomized']
         self.functions = [PCAModule.numpyPCA,
                           PCAModule.expectationMaximizationPCA,
-                          PCAModule.multipleArrayPCA]
+                          PCAModule.multipleArrayPCA,
+                          PCAModule.randomizedPCA]
         self.methodOptions.mainLayout = qt.QGridLayout(self.methodOptions)
         self.methodOptions.mainLayout.setContentsMargins(0, 0, 0, 0)
         self.methodOptions.mainLayout.setSpacing(2)
@@ -764,6 +764,11 @@ def start(self):
             self.raise_()
             return
 
+        # with a single configuration the fit is shared among a pool of
+        # processes by a single batch, otherwise the file list is split
+        useProcessPool = self.__splitBox.isChecked() and \
+                         (not self.__roiBox.isChecked()) and \
+                         (type(self.configFile) != type([]))
         if self.__splitBox.isChecked():
             if sys.platform == 'darwin':
                 if ".app" in os.path.dirname(__file__):
@@ -772,7 +777,7 @@ def start(self):
                     qt.QMessageBox.critical(self, "ERROR",text)
                     self.raise_()
                     return
-            if len(self.fileList) == 1:
+            if (len(self.fileList) == 1) and (not useProcessPool):
                 if int(qt.safe_str(self.__splitSpin.text())) > 1:
                     allowSingleFileSplitProcesses = False
                     if HDF5SUPPORT:
@@ -836,7 +841,7 @@ def start(self):
             filestep = 1
             mcastep = 1
             if len(self.fileList) == 1:
-                if self.__splitBox.isChecked():
+                if self.__splitBox.isChecked() and (not useProcessPool):
                     nbatches = int(qt.safe_str(self.__splitSpin.text()))
                     mcastep = nbatches
 
@@ -995,12 +1000,15 @@ def pause():
                                                                     html,htmlindex,
                                                                     listfile,concentrations,
                                                                     table, fitfiles, selectionFlag)
+            if useProcessPool:
+                cmd += " --nprocesses=%d" % \
+                       int(qt.safe_str(self.__splitSpin.text()))
             self.hide()
             qApp = qt.QApplication.instance()
             qApp.processEvents()
             if DEBUG:
                 print("cmd = %s" % cmd)
-            if self.__splitBox.isChecked():
+            if self.__splitBox.isChecked() and (not useProcessPool):
                 nbatches = int(qt.safe_str(self.__splitSpin.text()))
                 if len(self.fileList) > 1:
                     filechunk = int(len(self.fileList)/nbatches)
@@ -1126,9 +1134,12 @@ def pause():
                                                     self.outputDir, overwrite,
                                                     filestep, mcastep, html, htmlindex,
                                                     listfile, concentrations, table, fitfiles, selectionFlag)
+            if useProcessPool:
+                cmd = cmd.replace("&", "--nprocesses=%d &" % \
+                                  int(qt.safe_str(self.__splitSpin.text())))
             if DEBUG:
                 print("cmd = %s" % cmd)
-            if self.__splitBox.isChecked():
+            if self.__splitBox.isChecked() and (not useProcessPool):
                 qApp = qt.QApplication.instance()
                 qApp.processEvents()
                 nbatches = int(qt.safe_str(self.__splitSpin.text()))
@@ -1248,7 +1259,7 @@ def __init__(self, parent, configfile, filelist=None, outputdir = None,
                      filestep=1, mcastep=1, concentrations=0,
                      fitfiles=0, filebeginoffset=0, fileendoffset=0,
                      mcaoffset=0, chunk=None,
-                     selection=None, lock=None):
+                     selection=None, lock=None, nprocesses=None):
         McaAdvancedFitBatch.McaAdvancedFitBatch.__init__(self, configfile, filelist, outputdir,
                                                          roifit=roifit, roiwidth=roiwidth,
                                                          overwrite=overwrite, filestep=filestep,
@@ -1260,7 +1271,8 @@ def __init__(self, parent, configfile, filelist=None, outputdir = None,
                                                          mcaoffset  = mcaoffset,
                                                          chunk=chunk,
                                                          selection=selection,
-                                                         lock=lock)
+                                                         lock=lock,
+                                                         nprocesses=nprocesses)
         qt.QThread.__init__(self)
         self.parent = parent
         self.pleasePause = 0
@@ -1720,7 +1732,8 @@ def main():
                    'overwrite=', 'filestep=', 'mcastep=', 'html=','htmlindex=',
                    'listfile=','cfglistfile=', 'concentrations=', 'table=', 'fitfiles=',
                    'filebeginoffset=','fileendoffset=','mcaoffset=', 'chunk=',
-                   'nativefiledialogs=','selection=', 'exitonend=']
+                   'nativefiledialogs=','selection=', 'exitonend=',
+                   'nprocesses=']
     filelist = None
     outdir   = None
     cfg      = None
@@ -1742,6 +1755,7 @@ def main():
     mcaoffset = 0
     chunk = None
     exitonend = False
+    nprocesses = 1
     opts, args = getopt.getopt(
                     sys.argv[1:],
                     options,
@@ -1796,6 +1810,8 @@ def main():
                 PyMcaDirs.nativeFileDialogs = False
         elif opt in ('--exitonend'):
             exitonend = int(arg)
+        elif opt in ('--nprocesses'):
+            nprocesses = int(arg)
 
     if listfile is None:
         filelist=[]
@@ -1846,7 +1862,8 @@ def main():
                      overwrite = overwrite, filestep=filestep, mcastep=mcastep,
                       concentrations=concentrations, fitfiles=fitfiles,
                       filebeginoffset=filebeginoffset,fileendoffset=fileendoffset,
-                      mcaoffset=mcaoffset, chunk=chunk, selection=selection)
+                      mcaoffset=mcaoffset, chunk=chunk, selection=selection,
+                      nprocesses=nprocesses)
         except:
             if exitonend:
                 print("Error: " % sys.exc_info()[1])
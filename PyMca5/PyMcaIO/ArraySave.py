@@ -31,8 +31,14 @@
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import os
+import sys
 import numpy
 import time
+import threading
+if sys.version < '3.0':
+    import Queue as queue
+else:
+    import queue
 
 try:
     from PyMca5.PyMcaIO import EdfFile
@@ -51,6 +57,9 @@
 
 DEBUG = 0
 
+# default chunk size in bytes (the default HDF5 chunk cache is 1 MB)
+CHUNK_SIZE = 1024 * 1024
+
 
 def getDate():
     localtime = time.localtime()
@@ -270,6 +279,226 @@ def openHDF5File(name, mode='a', **kwargs):
     return h5file
 
 
+def getChunkShape(shape, dtype, interpretation="image", chunksize=None):
+    """
+    Return a chunk shape matching the way the dataset is going to be read.
+
+    :param shape: Shape of the dataset
+    :param dtype: Data type of the dataset
+    :param interpretation: "image" if the last two dimensions are read
+        together (stack of images), "spectrum" if the last one is read
+        together (stack of spectra)
+    :param chunksize: Approximate chunk size in bytes (default CHUNK_SIZE)
+    :return: Tuple with the chunk shape
+    """
+    if chunksize is None:
+        chunksize = CHUNK_SIZE
+    shape = [max(1, int(x)) for x in shape]
+    ndim = len(shape)
+    if interpretation in ["spectrum", "spectrum".encode('utf-8')]:
+        nKept = 1
+    else:
+        nKept = 2
+    nKept = min(nKept, ndim)
+    chunks = [1] * (ndim - nKept) + shape[ndim - nKept:]
+    itemsize = numpy.dtype(dtype).itemsize
+    def nbytes():
+        n = itemsize
+        for item in chunks:
+            n *= item
+        return n
+    # halve the largest of the dimensions read together until it fits
+    while nbytes() > chunksize:
+        i = ndim - nKept + \
+            int(numpy.argmax(chunks[ndim - nKept:]))
+        if chunks[i] == 1:
+            break
+        chunks[i] = (chunks[i] + 1) // 2
+    # group several images or spectra per chunk if they are small
+    for i in range(ndim - nKept - 1, -1, -1):
+        factor = int(chunksize // nbytes())
+        if factor < 2:
+            break
+        chunks[i] = min(shape[i], factor)
+    return tuple(chunks)
+
+
+def getCompressionFilters(compression):
+    """
+    Return the keyword arguments to be passed to h5py to compress a dataset.
+
+    :param compression: None or False for no compression, True or an
+        integer from 1 to 9 for gzip (at that level), or a filter name
+        supported by h5py ("gzip", "lzf", "szip").
+    """
+    if compression in [None, False, 0]:
+        return {}
+    if compression is True:
+        compression = "gzip"
+    if isinstance(compression, int):
+        return {'compression': "gzip",
+                'compression_opts': compression,
+                'shuffle': True}
+    # the byte shuffle improves the compression ratio of numeric data
+    return {'compression': compression,
+            'shuffle': True}
+
+
+def createHDF5Dataset(group, name, shape, dtype,
+                      interpretation="image", compression=None,
+                      chunks=None, maxshape=None, chunksize=None):
+    """
+    Create (or return if already existing) a dataset whose chunk shape is
+    adapted to its access pattern and, if requested, compressed.
+
+    Give None as first element of maxshape to be able to append to it
+    with an HDF5Writer instance.
+    """
+    if name in group:
+        return group[name]
+    if (chunks is None) and (compression or (maxshape is not None)):
+        chunkShape = list(shape)
+        if maxshape is not None:
+            # the initial size of a growing dataset is not representative
+            for i in range(len(shape)):
+                if maxshape[i] is None:
+                    chunkShape[i] = max(chunkShape[i], 1024)
+        chunks = getChunkShape(chunkShape, dtype,
+                               interpretation=interpretation,
+                               chunksize=chunksize)
+    if DEBUG:
+        print("Dataset %s shape = %s chunks = %s" % (name, shape, chunks))
+    return group.create_dataset(name,
+                                shape=shape,
+                                dtype=dtype,
+                                chunks=chunks,
+                                maxshape=maxshape,
+                                **getCompressionFilters(compression))
+
+
+class HDF5Writer(object):
+    """
+    Write data into HDF5 datasets from a background thread.
+
+    The calling thread only queues a copy of the data and it continues
+    working. Writes are performed in the order they were requested. A
+    failing write does not prevent the following ones. The first error
+    found while writing is raised on the next call to write, append,
+    flush or close.
+
+    Usage::
+
+        with HDF5Writer() as writer:
+            for i in range(nRows):
+                writer.write(dataset, i, calculateRow(i))
+    """
+    def __init__(self, maxqueue=32):
+        """
+        :param maxqueue: Maximum number of blocks waiting to be written.
+            Callers block when the limit is reached.
+        """
+        self._queue = queue.Queue(maxqueue)
+        self._thread = None
+        self._error = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                function, args = item
+                function(*args)
+            except:
+                if self._error is None:
+                    self._error = sys.exc_info()[1]
+                if DEBUG:
+                    print("HDF5Writer error: %s" % sys.exc_info()[1])
+            finally:
+                self._queue.task_done()
+
+    def _put(self, function, args):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        # the data are queued even if a previous write failed
+        self._queue.put((function, args))
+        self._checkError()
+
+    def _checkError(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def _write(self, dataset, selection, data):
+        if selection is None:
+            dataset[()] = data
+        else:
+            dataset[selection] = data
+
+    def _append(self, dataset, data, axis):
+        n = dataset.shape[axis]
+        dataset.resize(n + data.shape[axis], axis=axis)
+        selection = [slice(None)] * len(dataset.shape)
+        selection[axis] = slice(n, n + data.shape[axis])
+        dataset[tuple(selection)] = data
+
+    def write(self, dataset, selection, data):
+        """
+        Queue the writing of data into dataset[selection].
+
+        :param dataset: h5py dataset
+        :param selection: Index or tuple of slices (None for the whole dataset)
+        :param data: Array to be written. A copy is kept until written.
+        """
+        self._put(self._write, (dataset, selection, numpy.array(data)))
+
+    def append(self, dataset, data, axis=0):
+        """
+        Queue the addition of data at the end of a dataset along the
+        given axis. The dataset must have been created with an unlimited
+        maxshape along that axis.
+        """
+        data = numpy.array(data)
+        if data.ndim < len(dataset.shape):
+            # a single row
+            data = numpy.expand_dims(data, axis)
+        self._put(self._append, (dataset, data, axis))
+
+    def flush(self):
+        """
+        Wait until all the queued data are written.
+        """
+        if self._thread is not None:
+            self._queue.join()
+        self._checkError()
+
+    def close(self):
+        """
+        Write the pending data and stop the writing thread.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._checkError()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+            return
+        # the pending data are written without hiding the original exception
+        try:
+            self.close()
+        except:
+            print("HDF5Writer error: %s" % sys.exc_info()[1])
+
+
 def getHDF5FileInstanceAndBuffer(filename, shape,
                                  buffername="data",
                                  dtype=numpy.float32,
@@ -304,25 +533,12 @@ def getHDF5FileInstanceAndBuffer(filename, shape,
     if compression:
         if DEBUG:
             print("Saving compressed and chunked dataset")
-        chunk1 = int(shape[1] / 10)
-        if chunk1 == 0:
-            chunk1 = shape[1]
-        for i in [11, 10, 8, 7, 5, 4]:
-            if (shape[1] % i) == 0:
-                chunk1 = int(shape[1] / i)
-                break
-        chunk2 = int(shape[2] / 10)
-        if chunk2 == 0:
-            chunk2 = shape[2]
-        for i in [11, 10, 8, 7, 5, 4]:
-            if (shape[2] % i) == 0:
-                chunk2 = int(shape[2] / i)
-                break
         data = nxData.require_dataset(buffername,
                            shape=shape,
                            dtype=dtype,
-                           chunks=(1, chunk1, chunk2),
-                           compression=compression)
+                           chunks=getChunkShape(shape, dtype,
+                                        interpretation=interpretation),
+                           **getCompressionFilters(compression))
     else:
         #no chunking
         if DEBUG:
@@ -446,24 +662,12 @@ def save3DArrayAsHDF5(data, filename, axes=None, labels=None, dtype=None, mode='
                 if compression:
                     if DEBUG:
                         print("Saving compressed and chunked dataset")
-                    #risk of taking a 10 % more space in disk
-                    chunk1 = int(shape[1] / 10)
-                    if chunk1 == 0:
-                        chunk1 = shape[1]
-                    for i in [11, 10, 8, 7, 5, 4]:
-                        if (shape[1] % i) == 0:
-                            chunk1 = int(shape[1] / i)
-                            break
-                    chunk2 = int(shape[2] / 10)
-                    for i in [11, 10, 8, 7, 5, 4]:
-                        if (shape[2] % i) == 0:
-                            chunk2 = int(shape[2] / i)
-                            break
                     dset = nxData.require_dataset('data',
                                        shape=shape,
                                        dtype=dtype,
-                                       chunks=(1, chunk1, chunk2),
-                                       compression=compression)
+                                       chunks=getChunkShape(shape, dtype,
+                                                    interpretation="image"),
+                                       **getCompressionFilters(compression))
                 else:
                     if DEBUG:
                         print("Saving not compressed and not chunked dataset")
@@ -511,7 +715,7 @@ def save3DArrayAsHDF5(data, filename, axes=None, labels=None, dtype=None, mode='
                                shape=shape,
                                dtype=dtype,
                                chunks=(shape[0], shape[1], 1),
-                               compression=compression)
+                               **getCompressionFilters(compression))
                 else:
                     if DEBUG:
                         print("Saving not compressed and not chunked dataset")
@@ -524,30 +728,21 @@ def save3DArrayAsHDF5(data, filename, axes=None, labels=None, dtype=None, mode='
                     tmp.shape = shape[0], shape[1], 1
                     dset[:, :, i:i + 1] = tmp
         else:
+            step = 1
             if compression:
                 if DEBUG:
                     print("Saving compressed and chunked dataset")
-                chunk1 = int(shape[1] / 10)
-                if chunk1 == 0:
-                    chunk1 = shape[1]
-                for i in [11, 10, 8, 7, 5, 4]:
-                    if (shape[1] % i) == 0:
-                        chunk1 = int(shape[1] / i)
-                        break
-                chunk2 = int(shape[2] / 10)
-                if chunk2 == 0:
-                    chunk2 = shape[2]
-                for i in [11, 10, 8, 7, 5, 4]:
-                    if (shape[2] % i) == 0:
-                        chunk2 = int(shape[2] / i)
-                        break
+                chunks = getChunkShape(shape, dtype,
+                                       interpretation=interpretation)
                 if DEBUG:
-                    print("Used chunk size = (1, %d, %d)" % (chunk1, chunk2))
+                    print("Used chunk size = %s" % (chunks,))
                 dset = nxData.require_dataset('data',
                                shape=shape,
                                dtype=dtype,
-                               chunks=(1, chunk1, chunk2),
-                               compression=compression)
+                               chunks=chunks,
+                               **getCompressionFilters(compression))
+                # write complete chunks to avoid compressing them twice
+                step = chunks[0]
             else:
                 if DEBUG:
                     print("Saving not compressed and notchunked dataset")
@@ -555,12 +750,10 @@ def save3DArrayAsHDF5(data, filename, axes=None, labels=None, dtype=None, mode='
                                shape=shape,
                                dtype=dtype,
                                compression=None)
-            tmpData = numpy.zeros((1, data.shape[1], data.shape[2]),
-                                  data.dtype)
-            for i in range(data.shape[0]):
-                tmpData[0:1] = data[i:i + 1]
-                dset[i:i + 1] = tmpData[0:1]
-                print("Saved item %d of %d" % (i + 1, data.shape[0]))
+            for i in range(0, data.shape[0], step):
+                dset[i:i + step] = data[i:i + step]
+                print("Saved item %d of %d" % (min(i + step, data.shape[0]),
+                                               data.shape[0]))
 
         dset.attrs['signal'] = "1".encode('utf-8')
         if interpretation is not None:
@@ -610,8 +803,9 @@ def save3DArrayAsHDF5(data, filename, axes=None, labels=None, dtype=None, mode='
                            shape=shape,
                            dtype=dtype,
                            data=data,
-                           chunks=(1, shape[1], shape[2]),
-                           compression=compression)
+                           chunks=getChunkShape(shape, dtype,
+                                        interpretation=interpretation),
+                           **getCompressionFilters(compression))
         else:
             hdf.require_dataset('data',
                            shape=shape,
@@ -32,6 +32,7 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 from PyMca5.PyMcaCore import DataObject
 from PyMca5.PyMcaIO import EdfFile
+from PyMca5.PyMcaIO import LazyArray
 from PyMca5.PyMcaCore import EdfFileDataSource
 from PyMca5.PyMcaMisc import PhysicalMemory
 import numpy
@@ -51,6 +52,9 @@
 SOURCE_TYPE = "EdfFileStack"
 DEBUG = 0
 
+# image stacks with more files than this are not read at loading time
+LAZY_NUMBER_OF_FILES = 1000
+
 X_AXIS=0
 Y_AXIS=1
 Z_AXIS=2
@@ -73,7 +77,7 @@ def __init__(self, filelist = None, imagestack=None, dtype=None):
             else:
                 self.loadFileList(filelist)
 
-    def loadFileList(self, filelist, fileindex=0):
+    def loadFileList(self, filelist, fileindex=0, dynamic=False):
         if type(filelist) == type(''):filelist = [filelist]
         self.__keyList = []
         self.sourceName = filelist
@@ -111,7 +115,32 @@ def loadFileList(self, filelist, fileindex=0):
         self.onBegin(self.nbFiles)
         singleImageShape = arrRet.shape
         actualImageStack = False
-        if (fileindex == 2) or (self.__imageStack):
+        if (nImages == 1) and (len(singleImageShape) == 2) and \
+           (fileindex != 1) and (not self.__isID24(filelist)):
+            if not dynamic:
+                if ((fileindex == 2) or (self.__imageStack)) and \
+                   (self.nbFiles > LAZY_NUMBER_OF_FILES):
+                    dynamic = True
+                else:
+                    dynamic = not self.__isMemoryAvailable(singleImageShape)
+        else:
+            dynamic = False
+        if dynamic:
+            # the images are only read when accessed
+            if (fileindex == 2) or (self.__imageStack):
+                self.__imageStack = True
+                actualImageStack = True
+            def readImage(index):
+                edf = EdfFile.EdfFile(filelist[index], 'rb',
+                                      mmap=True)
+                return edf.GetData(0)
+            self.data = LazyArray.LazyArray(readImage,
+                                            self.nbFiles,
+                                            singleImageShape,
+                                            self.__dtype)
+            self.incrProgressBar = self.nbFiles
+            self.onEnd()
+        elif (fileindex == 2) or (self.__imageStack):
             self.__imageStack = True
             if len(singleImageShape) == 1:
                 #single line
@@ -124,7 +153,7 @@ def loadFileList(self, filelist, fileindex=0):
                                            self.__dtype)
                 self.incrProgressBar=0
                 for tempEdfFileName in filelist:
-                    tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
+                    tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb', mmap=True)
                     for i in range(nImages):
                         pieceOfStack=tempEdf.GetData(i)
                         self.data[:,i, self.incrProgressBar] = pieceOfStack[:]
@@ -145,7 +174,7 @@ def loadFileList(self, filelist, fileindex=0):
                                                self.__dtype)
                     self.incrProgressBar=0
                     for tempEdfFileName in filelist:
-                        tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
+                        tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb', mmap=True)
                         for i in range(nImages):
                             pieceOfStack=tempEdf.GetData(i)
                             self.data[:,:,
@@ -175,7 +204,7 @@ def loadFileList(self, filelist, fileindex=0):
                                                      self.__dtype)
                             self.incrProgressBar=0
                             for tempEdfFileName in filelist:
-                                tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
+                                tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb', mmap=True)
                                 pieceOfStack=tempEdf.GetData(0)
                                 self.data[self.incrProgressBar] = pieceOfStack
                                 self.incrProgressBar += 1
@@ -188,7 +217,7 @@ def loadFileList(self, filelist, fileindex=0):
                                                      self.__dtype)
                             self.incrProgressBar=0
                             for tempEdfFileName in filelist:
-                                tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
+                                tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb', mmap=True)
                                 pieceOfStack=tempEdf.GetData(0)
                                 self.data[:,:, self.incrProgressBar] = pieceOfStack
                                 self.incrProgressBar += 1
@@ -219,7 +248,7 @@ def loadFileList(self, filelist, fileindex=0):
                                                arrRet.shape[1]))
                                 self.incrProgressBar=0
                                 for tempEdfFileName in filelist:
-                                    tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
+                                    tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb', mmap=True)
                                     pieceOfStack=tempEdf.GetData(0)
                                     self.data[self.incrProgressBar,:,:] = pieceOfStack[:,:]
                                     hdf.flush()
@@ -245,7 +274,7 @@ def loadFileList(self, filelist, fileindex=0):
                                     i += 1
                             self.incrProgressBar=0
                             for tempEdfFileName in filelist:
-                                tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
+                                tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb', mmap=True)
                                 pieceOfStack=tempEdf.GetData(0)
                                 self.data[:,:, self.incrProgressBar] = pieceOfStack[
                                                             ::samplingStep,::samplingStep]
@@ -264,7 +293,7 @@ def loadFileList(self, filelist, fileindex=0):
                                            self.__dtype)
                 self.incrProgressBar=0
                 for tempEdfFileName in filelist:
-                    tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
+                    tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb', mmap=True)
                     for i in range(nImages):
                         pieceOfStack=tempEdf.GetData(i)
                         self.data[self.incrProgressBar, :,i] = pieceOfStack[:]
@@ -288,7 +317,7 @@ def loadFileList(self, filelist, fileindex=0):
                                                self.__dtype)
                             self.incrProgressBar=0
                             for tempEdfFileName in filelist:
-                                tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
+                                tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb', mmap=True)
                                 for i in range(nImages):
                                     pieceOfStack=tempEdf.GetData(i)
                                     self.data[self.incrProgressBar, i,:] = \
@@ -302,7 +331,7 @@ def loadFileList(self, filelist, fileindex=0):
                                                self.__dtype)
                             self.incrProgressBar=0
                             for tempEdfFileName in filelist:
-                                tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
+                                tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb', mmap=True)
                                 for i in range(nImages):
                                     pieceOfStack=tempEdf.GetData(i)
                                     self.data[self.incrProgressBar, i,:] = \
@@ -316,7 +345,7 @@ def loadFileList(self, filelist, fileindex=0):
                                                self.__dtype)
                         self.incrProgressBar=0
                         for tempEdfFileName in filelist:
-                            tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
+                            tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb', mmap=True)
                             for i in range(nImages):
                                 pieceOfStack=tempEdf.GetData(i)
                                 self.data[nImages*self.incrProgressBar+i,
@@ -406,7 +435,7 @@ def loadFileList(self, filelist, fileindex=0):
                     self.incrProgressBar=0
                     if fileindex == 1:
                         for tempEdfFileName in filelist:
-                            tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
+                            tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb', mmap=True)
                             pieceOfStack=tempEdf.GetData(0)
                             self.data[:,self.incrProgressBar,:] = pieceOfStack[:,:]
                             self.incrProgressBar += 1
@@ -426,7 +455,7 @@ def loadFileList(self, filelist, fileindex=0):
                                     i0End = EdfFile.EdfFile(i0EndFile, 'rb').GetData(0)
                                     i0Slope = (i0End-i0Start)/len(filelist)
                         for tempEdfFileName in filelist:
-                            tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
+                            tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb', mmap=True)
                             if ID24:
                                 pieceOfStack=-numpy.log(tempEdf.GetData(0)/(i0Start[0,:] + id24idx * i0Slope))
                                 pieceOfStack[numpy.isfinite(pieceOfStack) == False] = 1
@@ -454,7 +483,7 @@ def loadFileList(self, filelist, fileindex=0):
         for i in range(len(shape)):
             key = 'Dim_%d' % (i+1,)
             self.info[key] = shape[i]
-        if not isinstance(self.data, numpy.ndarray):
+        if not isinstance(self.data, (numpy.ndarray, LazyArray.LazyArray)):
             hdf.flush()
             self.info["SourceType"] = "HDF5Stack1D"
             if self.__imageStack:
@@ -481,6 +510,22 @@ def loadFileList(self, filelist, fileindex=0):
             self.info["Size"] = self.__nFiles * self.__nImagesPerFile
 
 
+    def __isMemoryAvailable(self, imageShape):
+        needed_ = self.nbFiles * imageShape[0] * imageShape[1] * \
+                  numpy.dtype(self.__dtype).itemsize
+        physicalMemory = PhysicalMemory.getPhysicalMemoryOrNone()
+        if physicalMemory is None:
+            return True
+        # spare 5% of memory
+        return physicalMemory >= (1.05 * needed_)
+
+    def __isID24(self, filelist):
+        if "_sample_" in filelist[0]:
+            i0StartFile = filelist[0].replace("_sample_", "_I0start_")
+            if os.path.exists(i0StartFile):
+                return True
+        return False
+
     def onBegin(self, n):
         pass
 
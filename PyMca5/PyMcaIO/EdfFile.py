@@ -95,6 +95,8 @@ def GetData(self,Index, DataType="",Pos=None,Size=None):
 DEBUG = 0
 ################################################################################
 import sys
+import re
+import json
 import numpy
 import os.path #, tempfile, shutil
 try:
@@ -133,6 +135,15 @@ def GetData(self,Index, DataType="",Pos=None,Size=None):
 ################################################################################
 # constants
 HEADER_BLOCK_SIZE = 1024
+HEADER_START = re.compile(b"{\r?\n")
+HEADER_END = re.compile(b"}[\r\n]")
+# persistent image index stored next to multi-image EDF files.
+# It is only used if requested, either by setting USE_INDEX to True
+# or by passing index=True to EdfFile.
+USE_INDEX = False
+INDEX_EXTENSION = ".pymcaidx"
+INDEX_MIN_IMAGES = 100
+INDEX_VERSION = 1
 STATIC_HEADER_ELEMENTS = ("HeaderID", "Image", "ByteOrder", "DataType",
                         "Dim_1", "Dim_2", "Dim_3",
                         "Offset_1", "Offset_2", "Offset_3",
@@ -174,7 +185,8 @@ class  EdfFile(object):
     """
     ############################################################################
     #Interface
-    def __init__(self, FileName, access=None, fastedf=None):
+    def __init__(self, FileName, access=None, fastedf=None, mmap=None,
+                 index=None):
         """ Constructor
 
         @param  FileName:   Name of the file (either existing or to be created)
@@ -184,6 +196,13 @@ def __init__(self, FileName, access=None, fastedf=None):
         @type access: string
         @type fastedf= True to use the fastedf module
         @param fastedf= boolean
+        @type mmap= True to return read-only memory mapped views of the
+                    image data of uncompressed EDF files
+        @param mmap= boolean
+        @type index= True to use (and create) a persistent index of the
+                     images of files with many images. The index is written
+                     next to the file. Default is given by USE_INDEX.
+        @param index= boolean
         """
         self.Images = []
         self.NumImages = 0
@@ -192,6 +211,12 @@ def __init__(self, FileName, access=None, fastedf=None):
         if fastedf is None:
             fastedf = 0
         self.fastedf = fastedf
+        if mmap is None:
+            mmap = False
+        self.mmap = mmap
+        if index is None:
+            index = USE_INDEX
+        self.__useIndex = index
         self.ADSC = False
         self.MARCCD = False
         self.TIFF = False
@@ -312,97 +337,12 @@ def __init__(self, FileName, access=None, fastedf=None):
             self.File.close()
             return
 
-        Index = 0
-        line = self.File.readline()
-        selectedLines = [""]
-        if sys.version > '2.6':
-            selectedLines.append(eval('b""'))
-        parsingHeader = False
-        while line not in selectedLines:
-            #decode to make sure I have character string
-            #str to make sure python 2.x sees it as string and not unicode
-            if sys.version < '3.0':
-                if type(line) != type(str("")):
-                    line = "%s" % line
-            else:
-                try:
-                    line = str(line.decode())
-                except UnicodeDecodeError:
-                    try:
-                        line = str(line.decode('utf-8'))
-                    except UnicodeDecodeError:
-                        try:
-                            line = str(line.decode('latin-1'))
-                        except UnicodeDecodeError:
-                            line = "%s" % line
-            if (line.count("{\n") >= 1) or (line.count("{\r\n") >= 1):
-                parsingHeader = True
-                Index = self.NumImages
-                self.NumImages = self.NumImages + 1
-                self.Images.append(Image())
-#            Position = self.File.tell()
-
-            if line.count("=") >= 1:
-                listItems = line.split("=", 1)
-                typeItem = listItems[0].strip()
-                listItems = listItems[1].split(";", 1)
-                valueItem = listItems[0].strip()
-                if (typeItem == "HEADER_BYTES") and (Index == 0):
-                    self.ADSC = True
-                    break
-
-                #if typeItem in self.Images[Index].StaticHeader.keys():
-                if typeItem.upper() in STATIC_HEADER_ELEMENTS_CAPS:
-                    self.Images[Index].StaticHeader[typeItem] = valueItem
-                else:
-                    self.Images[Index].Header[typeItem] = valueItem
-            if ((line.count("}\n") >= 1) or (line.count("}\r") >= 1)) and (parsingHeader):
-                parsingHeader = False
-                #for i in STATIC_HEADER_ELEMENTS_CAPS:
-                #    if self.Images[Index].StaticHeader[i]=="":
-                #        raise "Bad File Format"
-                self.Images[Index].DataPosition = self.File.tell()
-                #self.File.seek(int(self.Images[Index].StaticHeader["Size"]), 1)
-                StaticPar = SetDictCase(self.Images[Index].StaticHeader, UPPER_CASE, KEYS)
-                if "SIZE" in StaticPar.keys():
-                    self.Images[Index].Size = int(StaticPar["SIZE"])
-                    if self.Images[Index].Size <= 0:
-                        self.NumImages = Index
-                        line = self.File.readline()
-                        continue
-                else:
-                    raise TypeError("EdfFile: Image doesn't have size information")
-                if "DIM_1" in StaticPar.keys():
-                    self.Images[Index].Dim1 = int(StaticPar["DIM_1"])
-                    self.Images[Index].Offset1 = int(\
-                                            StaticPar.get("Offset_1", "0"))
-                else:
-                    raise TypeError("EdfFile: Image doesn't have dimension information")
-                if "DIM_2" in StaticPar.keys():
-                    self.Images[Index].NumDim = 2
-                    self.Images[Index].Dim2 = int(StaticPar["DIM_2"])
-                    self.Images[Index].Offset2 = int(\
-                                            StaticPar.get("Offset_2", "0"))
-                if "DIM_3" in StaticPar.keys():
-                    self.Images[Index].NumDim = 3
-                    self.Images[Index].Dim3 = int(StaticPar["DIM_3"])
-                    self.Images[Index].Offset3 = int(\
-                                            StaticPar.get("Offset_3", "0"))
-                if "DATATYPE" in StaticPar.keys():
-                    self.Images[Index].DataType = StaticPar["DATATYPE"]
-                else:
-                    raise TypeError("EdfFile: Image doesn't have datatype information")
-                if "BYTEORDER" in StaticPar.keys():
-                    self.Images[Index].ByteOrder = StaticPar["BYTEORDER"]
-                else:
-                    raise TypeError("EdfFile: Image doesn't have byteorder information")
-
-
-
-                self.File.seek(self.Images[Index].Size, 1)
-
-            line = self.File.readline()
+        if not (self.__useIndex and self.__readIndex()):
+            self.__scanHeaders()
+            if self.__useIndex:
+                self.__writeIndex()
 
+        Index = 0
         if self.ADSC:
             self.File.seek(0, 0)
             self.NumImages = 1
@@ -464,6 +404,168 @@ def __init__(self, FileName, access=None, fastedf=None):
 
         self.__makeSureFileIsClosed()
 
+    def __scanHeaders(self):
+        """ Internal method: finds the images present in the file.
+
+        Each header is read in blocks and parsed at once. The data are
+        skipped according to the image size.
+        """
+        infile = self.File
+        infile.seek(0, 0)
+        offset = 0
+        buffer = infile.read(HEADER_BLOCK_SIZE)
+        while len(buffer):
+            match = HEADER_START.search(buffer)
+            if match is None:
+                block = infile.read(HEADER_BLOCK_SIZE)
+                if not len(block):
+                    break
+                # keep the end in case the header start is split
+                offset += max(len(buffer) - 2, 0)
+                buffer = buffer[-2:] + block
+                continue
+            end = HEADER_END.search(buffer, match.end())
+            while (end is None) or (buffer.find(b"\n", end.start()) < 0):
+                block = infile.read(HEADER_BLOCK_SIZE)
+                if not len(block):
+                    break
+                buffer += block
+                end = HEADER_END.search(buffer, match.end())
+            if end is None:
+                # truncated header
+                break
+            dataStart = buffer.find(b"\n", end.start()) + 1
+            if dataStart < 1:
+                break
+            header = buffer[match.start():dataStart]
+            if sys.version >= '3.0':
+                try:
+                    header = str(header.decode())
+                except UnicodeDecodeError:
+                    try:
+                        header = str(header.decode('utf-8'))
+                    except UnicodeDecodeError:
+                        header = str(header.decode('latin-1'))
+            Index = self.NumImages
+            image = Image()
+            image.HeaderPosition = offset + match.start()
+            image.DataPosition = offset + dataStart
+            for line in header.splitlines():
+                if line.count("=") < 1:
+                    continue
+                listItems = line.split("=", 1)
+                typeItem = listItems[0].strip()
+                listItems = listItems[1].split(";", 1)
+                valueItem = listItems[0].strip()
+                if (typeItem == "HEADER_BYTES") and (Index == 0):
+                    self.ADSC = True
+                    self.NumImages = 1
+                    self.Images = [image]
+                    return
+                if typeItem.upper() in STATIC_HEADER_ELEMENTS_CAPS:
+                    image.StaticHeader[typeItem] = valueItem
+                else:
+                    image.Header[typeItem] = valueItem
+            StaticPar = SetDictCase(image.StaticHeader, UPPER_CASE, KEYS)
+            if "SIZE" in StaticPar.keys():
+                image.Size = int(StaticPar["SIZE"])
+                if image.Size <= 0:
+                    # ignore the image and look for the next header
+                    offset += dataStart
+                    buffer = buffer[dataStart:]
+                    continue
+            else:
+                raise TypeError("EdfFile: Image doesn't have size information")
+            if "DIM_1" in StaticPar.keys():
+                image.Dim1 = int(StaticPar["DIM_1"])
+                image.Offset1 = int(StaticPar.get("Offset_1", "0"))
+            else:
+                raise TypeError("EdfFile: Image doesn't have dimension information")
+            if "DIM_2" in StaticPar.keys():
+                image.NumDim = 2
+                image.Dim2 = int(StaticPar["DIM_2"])
+                image.Offset2 = int(StaticPar.get("Offset_2", "0"))
+            if "DIM_3" in StaticPar.keys():
+                image.NumDim = 3
+                image.Dim3 = int(StaticPar["DIM_3"])
+                image.Offset3 = int(StaticPar.get("Offset_3", "0"))
+            if "DATATYPE" in StaticPar.keys():
+                image.DataType = StaticPar["DATATYPE"]
+            else:
+                raise TypeError("EdfFile: Image doesn't have datatype information")
+            if "BYTEORDER" in StaticPar.keys():
+                image.ByteOrder = StaticPar["BYTEORDER"]
+            else:
+                raise TypeError("EdfFile: Image doesn't have byteorder information")
+            self.Images.append(image)
+            self.NumImages += 1
+
+            # jump to the end of the data
+            offset = image.DataPosition + image.Size
+            infile.seek(offset, 0)
+            buffer = infile.read(HEADER_BLOCK_SIZE)
+
+    def __getIndexFileName(self):
+        return self.FileName + INDEX_EXTENSION
+
+    def __readIndex(self):
+        """ Internal method: restores the images from the persistent index.
+        It returns True if the index exists and matches the file.
+        """
+        if not self.__ownedOpen:
+            return False
+        indexFile = self.__getIndexFileName()
+        if not os.path.exists(indexFile):
+            return False
+        try:
+            stat = os.stat(self.FileName)
+            infile = open(indexFile, "r")
+            try:
+                ddict = json.load(infile)
+            finally:
+                infile.close()
+            if (ddict["version"] != INDEX_VERSION) or\
+               (ddict["path"] != os.path.abspath(self.FileName)) or\
+               (ddict["size"] != stat.st_size) or\
+               (ddict["mtime"] != stat.st_mtime):
+                return False
+            images = []
+            for item in ddict["images"]:
+                image = Image()
+                image.__dict__.update(item)
+                images.append(image)
+        except:
+            if DEBUG:
+                print("EdfFile: Cannot use index %s" % indexFile)
+            return False
+        self.Images = images
+        self.NumImages = len(images)
+        return True
+
+    def __writeIndex(self):
+        """ Internal method: stores the images in the persistent index.
+        Errors (read only directories, ...) are ignored.
+        """
+        if (not self.__ownedOpen) or self.ADSC or\
+           (self.NumImages < INDEX_MIN_IMAGES):
+            return
+        indexFile = self.__getIndexFileName()
+        try:
+            stat = os.stat(self.FileName)
+            ddict = {"version": INDEX_VERSION,
+                     "path": os.path.abspath(self.FileName),
+                     "size": stat.st_size,
+                     "mtime": stat.st_mtime,
+                     "images": [image.__dict__ for image in self.Images]}
+            outfile = open(indexFile, "w")
+            try:
+                json.dump(ddict, outfile)
+            finally:
+                outfile.close()
+        except:
+            if DEBUG:
+                print("EdfFile: Cannot write index %s" % indexFile)
+
     def _wrapTIFF(self):
         self._wrappedInstance = TiffIO.TiffIO(self.File, cache_length = 0, mono_output=True)
         self.NumImages = self._wrappedInstance.getNumberOfImages()
@@ -618,6 +720,12 @@ def _GetData(self, Index, DataType="", Pos=None, Size=None):
         if Index < 0 or Index >= self.NumImages:
             raise ValueError("EdfFile: Index out of limit")
         if fastedf is None:fastedf = 0
+        if self.mmap and self.__ownedOpen and not (self.ADSC or self.MARCCD or\
+                        self.TIFF or self.PILATUS_CBF or self.SPE):
+            Data = self.__GetMemoryMappedData(Index, Pos, Size)
+            if DataType != "":
+                Data = self.__SetDataType__ (Data, DataType)
+            return Data
         if Pos is None and Size is None:
             if self.ADSC or self.MARCCD or self.PILATUS_CBF or self.SPE:
                 return self.__data
@@ -757,6 +865,41 @@ def _GetData(self, Index, DataType="", Pos=None, Size=None):
 
 
 
+    def __GetMemoryMappedData(self, Index, Pos=None, Size=None):
+        """ Internal method: returns a read-only numpy.memmap view of the
+            image data. The byte order of the file is kept in the data type
+            of the view, so no byte swapping is performed on access.
+        """
+        image = self.Images[Index]
+        datatype = numpy.dtype(self.__GetDefaultNumpyType__(image.DataType,
+                                                            index=Index))
+        if image.ByteOrder.upper() == "HIGHBYTEFIRST":
+            datatype = datatype.newbyteorder(">")
+        else:
+            datatype = datatype.newbyteorder("<")
+        if image.NumDim == 3:
+            shape = (image.Dim3, image.Dim2, image.Dim1)
+        elif image.NumDim == 2:
+            shape = (image.Dim2, image.Dim1)
+        else:
+            shape = (image.Dim1,)
+        Data = numpy.memmap(self.FileName, dtype=datatype, mode='r',
+                            offset=image.DataPosition, shape=shape)
+        if Pos is None and Size is None:
+            return Data
+        if Pos is None:
+            Pos = (0,) * len(shape)
+        if Size is None:
+            Size = (0,) * len(shape)
+        # Pos and Size are given as (x, y, z)
+        selection = []
+        for i in range(len(shape)):
+            if Size[i] == 0:
+                selection.insert(0, slice(Pos[i], shape[-1 - i]))
+            else:
+                selection.insert(0, slice(Pos[i], Pos[i] + Size[i]))
+        return Data[tuple(selection)]
+
     def GetPixel(self, Index, Position):
         """ Returns double value of the pixel, regardless the format of the array
             Index:      The zero-based index of the image in the file
@@ -30,29 +30,95 @@
 __contact__ = "sole@esrf.fr"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import sys
+import os
 import posixpath
+import ctypes
+import multiprocessing
 import numpy
 import h5py
 try:
     from PyMca5.PyMcaCore import DataObject
     from PyMca5.PyMcaMisc import PhysicalMemory
+    from PyMca5.PyMcaMisc import ParallelTools
 except ImportError:
     print("HDF5Stack1D importing DataObject from local directory!")
     import DataObject
     import PhysicalMemory
+    import ParallelTools
 try:
     from PyMca5.PyMcaCore import NexusDataSource
 except ImportError:
     print("HDF5Stack1D importing NexusDataSource from local directory!")
     import NexusDataSource
 
+if sys.version > '2.9':
+    basestring = str
+
 DEBUG = 0
 SOURCE_TYPE = "HDF5Stack1D"
+# processes reading the files of a multiple file stack
+# (None means number of cpus, 1 to read them sequentially)
+NUMBER_OF_PROCESSES = None
+
+# stack buffer shared with the reading processes
+_SHARED_DATA = None
+
+def _initReadingProcess(buffer, dtype, mcaDim):
+    global _SHARED_DATA
+    _SHARED_DATA = numpy.frombuffer(buffer, dtype=dtype)
+    _SHARED_DATA.shape = -1, mcaDim
+
+def _readFileSpectra(args):
+    """
+    Read the selected spectra of one file into the shared stack buffer.
+
+    The spectra of the scan number s of the file number f are stored from
+    the row (f * nScans + s) * nSpectra of the buffer.
+    """
+    fileIndex, filename, scanlist, justKeys, ySelection, mSelection, \
+               nSpectra = args
+    mcaDim = _SHARED_DATA.shape[1]
+    h5 = h5py.File(filename, "r")
+    try:
+        if justKeys:
+            goodEntryNames = []
+            for entry in h5["/"].keys():
+                if hasattr(h5["/" + entry], "keys"):
+                    goodEntryNames.append(entry)
+        for scanIndex, scan in enumerate(scanlist):
+            if justKeys:
+                entryName = goodEntryNames[int(scan.split(".")[-1])-1]
+            else:
+                entryName = scan
+            yDataset = h5[entryName + ySelection]
+            if (yDataset.size != (nSpectra * mcaDim)) or \
+               (yDataset.shape[-1] != mcaDim):
+                raise ValueError("Unexpected shape %s of %s in file %s" % \
+                                 (yDataset.shape, yDataset.name, filename))
+            first = (fileIndex * len(scanlist) + scanIndex) * nSpectra
+            output = _SHARED_DATA[first:(first + nSpectra)]
+            # the HDF5 library converts the data type if needed
+            yDataset.read_direct(output.reshape(yDataset.shape))
+            if mSelection is not None:
+                mDataset = h5[entryName + mSelection][()]
+                if mDataset.size == nSpectra:
+                    mDataset.shape = nSpectra, 1
+                elif mDataset.size == (nSpectra * mcaDim):
+                    mDataset.shape = nSpectra, mcaDim
+                else:
+                    raise ValueError(\
+                        "I do not know how to handle this monitor data")
+                output[:] = output / mDataset
+    finally:
+        h5.close()
+    return fileIndex
 
 class HDF5Stack1D(DataObject.DataObject):
     def __init__(self, filelist, selection,
                        scanlist=None,
-                       dtype=None):
+                       dtype=None,
+                       virtual=None):
         DataObject.DataObject.__init__(self)
 
         #the data type of the generated stack
@@ -61,9 +127,10 @@ def __init__(self, filelist, selection,
 
         if filelist is not None:
             if selection is not None:
-                self.loadFileList(filelist, selection, scanlist)
+                self.loadFileList(filelist, selection, scanlist,
+                                  virtual=virtual)
 
-    def loadFileList(self, filelist, selection, scanlist=None):
+    def loadFileList(self, filelist, selection, scanlist=None, virtual=None):
         """
         loadFileList(self, filelist, y, scanlist=None, monitor=None, x=None)
         filelist is the list of file names belonging to the stack
@@ -79,13 +146,21 @@ def loadFileList(self, filelist, selection, scanlist=None):
                  /whatever1/whatever2/counts
                  That means scanlist = ["/whatever1"]
                  and               selection['y'] = "/whatever2/counts"
+        virtual  if True, the stack is an HDF5 virtual dataset mapping the
+                 selected datasets of all the files instead of a copy of
+                 them in memory. If it is a file name, the virtual dataset
+                 is saved into that file as /entry/data to be opened later
+                 as a single file. The data are not normalized, so no
+                 monitor can be selected, and the spectra have to be in
+                 the last dimension of the selected datasets.
         """
         if DEBUG:
             print("filelist = ", filelist)
             print("selection = ", selection)
             print("scanlist = ", scanlist)
-        # all the files in the same source
-        hdfStack = NexusDataSource.NexusDataSource(filelist)
+        # the first file gives the structure, the other ones are only
+        # opened if they are read sequentially
+        hdfStack = NexusDataSource.NexusDataSource([filelist[0]])
 
         #if there is more than one file, it is assumed all the files have
         #the same structure.
@@ -245,64 +320,99 @@ def loadFileList(self, filelist, selection, scanlist=None):
         if DEBUG:
             print("mcaIndex = %d" % mcaIndex)
         considerAsImages = False
+        sharedBuffer = None
         dim0, dim1, mcaDim = self.getDimensions(nFiles, nScans, shape,
                                                 index=mcaIndex)
-        try:
-            if self.__dtype in [numpy.float32, numpy.int32]:
-                bytefactor = 4
-            elif self.__dtype in [numpy.int16, numpy.uint16]:
-                bytefactor = 2
-            elif self.__dtype in [numpy.int8, numpy.uint8]:
-                bytefactor = 1
-            else:
-                bytefactor = 8
+        if virtual not in [None, False]:
+            # the data stay in the files
+            if mSelection is not None:
+                raise ValueError(\
+                    "Monitor normalization not supported with virtual datasets")
+            if mcaIndex != (len(shape) - 1):
+                raise ValueError(\
+                    "Virtual datasets require the spectra in the last dimension")
+            self._loadVirtualStack(filelist, scanlist, JUST_KEYS,
+                                   ySelection, shape, dim0, dim1, virtual)
+            if xSelection is not None:
+                xDataset = tmpHdf[xpath][()]
+            mcaIndex = 2
+            DONE = True
+        else:
+            try:
+                if self.__dtype in [numpy.float32, numpy.int32]:
+                    bytefactor = 4
+                elif self.__dtype in [numpy.int16, numpy.uint16]:
+                    bytefactor = 2
+                elif self.__dtype in [numpy.int8, numpy.uint8]:
+                    bytefactor = 1
+                else:
+                    bytefactor = 8
 
-            neededMegaBytes = nFiles * dim0 * dim1 * (mcaDim * bytefactor/(1024*1024.))
-            physicalMemory = PhysicalMemory.getPhysicalMemoryOrNone()
-            if physicalMemory is None:
-                # 5 Gigabytes should be a good compromise
-                physicalMemory = 6000
-            else:
-                physicalMemory /= (1024*1024.)
-            if (neededMegaBytes > (0.95*physicalMemory))\
-               and (nFiles == 1) and (len(shape) == 3):
-                if self.__dtype0 is None:
-                    if (bytefactor == 8) and (neededMegaBytes < (2*physicalMemory)):
-                        #try reading as float32
-                        self.__dtype = numpy.float32
+                neededMegaBytes = nFiles * dim0 * dim1 * (mcaDim * bytefactor/(1024*1024.))
+                physicalMemory = PhysicalMemory.getPhysicalMemoryOrNone()
+                if physicalMemory is None:
+                    # 5 Gigabytes should be a good compromise
+                    physicalMemory = 6000
+                else:
+                    physicalMemory /= (1024*1024.)
+                if (neededMegaBytes > (0.95*physicalMemory))\
+                   and (nFiles == 1) and (len(shape) == 3):
+                    if self.__dtype0 is None:
+                        if (bytefactor == 8) and (neededMegaBytes < (2*physicalMemory)):
+                            #try reading as float32
+                            self.__dtype = numpy.float32
+                        else:
+                            raise MemoryError("Force dynamic loading")
                     else:
                         raise MemoryError("Force dynamic loading")
+                if (mcaIndex == 0) and ( nFiles == 1) and (nScans == 1):
+                    #keep the original arrangement but in memory
+                    self.data = numpy.zeros(yDataset.shape, self.__dtype)
+                    considerAsImages = True
                 else:
-                    raise MemoryError("Force dynamic loading")
-            if (mcaIndex == 0) and ( nFiles == 1) and (nScans == 1):
-                #keep the original arrangement but in memory
-                self.data = numpy.zeros(yDataset.shape, self.__dtype)
-                considerAsImages = True
-            else:
-                # force arrangement as spectra
-                self.data = numpy.zeros((dim0, dim1, mcaDim), self.__dtype)
-            DONE = False
-        except (MemoryError, ValueError):
-            #some versions report ValueError instead of MemoryError
-            if (nFiles == 1) and (len(shape) == 3):
-                print("Attempting dynamic loading")
-                self.data = yDataset
-                if mSelection is not None:
-                    mDataset = tmpHdf[mpath].value
-                    self.monitor = [mDataset]
-                if xSelection is not None:
-                    xDataset = tmpHdf[xpath].value
-                    self.x = [xDataset]
-                if h5py.version.version < '2.0':
-                    #prevent automatic closing keeping a reference
-                    #to the open file
-                    self._fileReference = hdfStack
-                DONE = True
-            else:
-                #what to do if the number of dimensions is only 2?
-                raise
+                    # force arrangement as spectra
+                    nSpectra = int(yDataset.size / mcaDim)
+                    if (mcaIndex == (len(shape) - 1)) and \
+                       ((dim0 * dim1) == (nFiles * nScans * nSpectra)) and \
+                       self._canLoadFileListInParallel(filelist):
+                        # the reading processes fill the stack directly
+                        sharedBuffer, self.data = self._getSharedStack( \
+                                        (dim0, dim1, mcaDim), self.__dtype)
+                    else:
+                        self.data = numpy.zeros((dim0, dim1, mcaDim),
+                                                self.__dtype)
+                DONE = False
+            except (MemoryError, ValueError):
+                #some versions report ValueError instead of MemoryError
+                if (nFiles == 1) and (len(shape) == 3):
+                    print("Attempting dynamic loading")
+                    self.data = yDataset
+                    if mSelection is not None:
+                        mDataset = tmpHdf[mpath].value
+                        self.monitor = [mDataset]
+                    if xSelection is not None:
+                        xDataset = tmpHdf[xpath].value
+                        self.x = [xDataset]
+                    if h5py.version.version < '2.0':
+                        #prevent automatic closing keeping a reference
+                        #to the open file
+                        self._fileReference = hdfStack
+                    DONE = True
+                else:
+                    #what to do if the number of dimensions is only 2?
+                    raise
 
-        if (not DONE) and (not considerAsImages):
+        nSpectra = int(yDataset.size / mcaDim)
+        if (not DONE) and (sharedBuffer is not None) and \
+           self._loadFileListInParallel(sharedBuffer, filelist, scanlist,
+                                        JUST_KEYS, ySelection, mSelection,
+                                        nSpectra):
+            self.info["McaIndex"] = 2
+            if xSelection is not None:
+                xDataset = tmpHdf[xpath][()]
+        elif (not DONE) and (not considerAsImages):
+            if len(hdfStack._sourceObjectList) < nFiles:
+                hdfStack = NexusDataSource.NexusDataSource(filelist)
             self.info["McaIndex"] = 2
             n = 0
 
@@ -559,6 +669,165 @@ def loadFileList(self, filelist, selection, scanlist=None):
                 print("Ignoring xSelection")
 
 
+    def _canLoadFileListInParallel(self, filelist):
+        if min(ParallelTools.getNumberOfWorkers(NUMBER_OF_PROCESSES),
+               len(filelist)) < 2:
+            return False
+        for name in filelist:
+            # phynx instances and file families are read sequentially
+            if (not isinstance(name, basestring)) or ("%" in name):
+                return False
+        return True
+
+    def _getSharedStack(self, shape, dtype):
+        """
+        Allocate the stack in a buffer to be shared with the reading
+        processes. Returns the buffer and the stack array using it.
+        """
+        dtype = numpy.dtype(dtype)
+        nBytes = dtype.itemsize
+        for item in shape:
+            nBytes *= item
+        # the buffer is initialized to zero
+        buffer = multiprocessing.RawArray(ctypes.c_char, nBytes)
+        data = numpy.frombuffer(buffer, dtype=dtype)
+        data.shape = shape
+        return buffer, data
+
+    def _loadFileListInParallel(self, buffer, filelist, scanlist, justKeys,
+                                ySelection, mSelection, nSpectra):
+        """
+        Read the files into the stack buffer shared by several processes,
+        each dataset being read directly into its place in the stack.
+
+        Returns False if the files have to be read sequentially.
+        """
+        nFiles = len(filelist)
+        nProcesses = min(ParallelTools.getNumberOfWorkers(NUMBER_OF_PROCESSES),
+                         nFiles)
+        shape = self.data.shape
+        dtype = self.data.dtype
+        pool = None
+        try:
+            pool = multiprocessing.Pool(nProcesses,
+                                        _initReadingProcess,
+                                        (buffer, dtype.str, shape[-1]))
+            tasks = [(i, filelist[i], scanlist, justKeys,
+                      ySelection, mSelection, nSpectra) \
+                     for i in range(nFiles)]
+            self.onBegin(nFiles)
+            chunksize = max(1, int(nFiles / (4 * nProcesses)))
+            nDone = 0
+            for fileIndex in pool.imap_unordered(_readFileSpectra,
+                                                 tasks, chunksize):
+                nDone += 1
+                self.onProgress(nDone)
+            pool.close()
+        except (IOError, OSError, KeyError, IndexError,
+                TypeError, ValueError, MemoryError):
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            # the sequential reading overwrites the whole stack
+            print("Parallel reading failed, reading files sequentially: %s" % \
+                  (sys.exc_info()[1],))
+            return False
+        except:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            raise
+        pool.join()
+        self.onEnd()
+        return True
+
+    def _loadVirtualStack(self, filelist, scanlist, justKeys,
+                          ySelection, shape, dim0, dim1, virtual):
+        """
+        Map the spectra of each file and scan into a virtual dataset of
+        shape (dim0, dim1, nChannels) used as dynamic stack data.
+        The spectra have to be in the last dimension of the datasets.
+        """
+        if not hasattr(h5py, "VirtualLayout"):
+            raise ValueError("Virtual datasets require h5py 2.9 or later")
+        mcaDim = shape[-1]
+        nSpectra = 1
+        for item in shape[:-1]:
+            nSpectra *= item
+        nScans = len(scanlist)
+        layout = None
+        for fileIndex, filename in enumerate(filelist):
+            h5 = h5py.File(os.path.abspath(filename), "r")
+            try:
+                if justKeys:
+                    goodEntryNames = []
+                    for entry in h5["/"].keys():
+                        if hasattr(h5["/" + entry], "keys"):
+                            goodEntryNames.append(entry)
+                for scanIndex, scan in enumerate(scanlist):
+                    if justKeys:
+                        entryName = goodEntryNames[int(scan.split(".")[-1])-1]
+                    else:
+                        entryName = scan
+                    yDataset = h5[entryName + ySelection]
+                    if yDataset.shape != shape:
+                        raise ValueError(\
+                            "Shape %s of %s in file %s different from %s" % \
+                            (yDataset.shape, yDataset.name, filename, shape))
+                    if layout is None:
+                        dtype = self.__dtype0
+                        if dtype is None:
+                            dtype = yDataset.dtype
+                        layout = h5py.VirtualLayout((dim0, dim1, mcaDim),
+                                                    dtype)
+                    first = (fileIndex * nScans + scanIndex) * nSpectra
+                    rows, columns = self._getVirtualSelection(first,
+                                                              nSpectra,
+                                                              dim1)
+                    layout[rows, columns, :] = h5py.VirtualSource(yDataset)
+            finally:
+                h5.close()
+        if virtual is True:
+            # the virtual dataset is kept in memory
+            name = "%s_%d" % (SOURCE_TYPE, id(self))
+            vds = h5py.File(name, "w", driver="core", backing_store=False)
+        else:
+            vds = h5py.File(virtual, "w")
+        entry = vds.create_group("entry")
+        entry.attrs["NX_class"] = "NXentry"
+        entry.create_virtual_dataset("data", layout)
+        # the source files are opened with the access mode of the
+        # virtual dataset file, it has to be reopened read only
+        if virtual is True:
+            vds.flush()
+            image = vds.id.get_file_image()
+            vds.close()
+            fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+            fapl.set_fapl_core(backing_store=False)
+            fapl.set_file_image(image)
+            vds = h5py.File(h5py.h5f.open(name.encode("utf-8"),
+                                          h5py.h5f.ACC_RDONLY,
+                                          fapl=fapl))
+        else:
+            vds.close()
+            vds = h5py.File(virtual, "r")
+        # prevent the file from being closed
+        self._fileReference = vds
+        self.data = vds["/entry/data"]
+
+    def _getVirtualSelection(self, first, nSpectra, dim1):
+        """
+        Returns the rows and columns of the stack receiving the nSpectra
+        spectra starting at the spectrum number first
+        """
+        row = int(first / dim1)
+        column = first % dim1
+        if (column == 0) and ((nSpectra % dim1) == 0):
+            return slice(row, row + int(nSpectra / dim1)), slice(0, dim1)
+        if (column + nSpectra) <= dim1:
+            return slice(row, row + 1), slice(column, column + nSpectra)
+        raise ValueError("Spectra do not fill a rectangle of the stack")
+
     def getDimensions(self, nFiles, nScans, shape, index=None):
         #some body may want to overwrite this
         """
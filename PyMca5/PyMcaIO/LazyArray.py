@@ -0,0 +1,405 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+"""
+Read only 3D array whose images (frames) are only read when accessed.
+
+A LazyArray is built from a function returning a frame given its index.
+It keeps the most recently used frames in a cache and it reads the
+frames following the last accessed one on a pool of threads. Indexing
+follows the h5py conventions: each index is applied independently to
+its own axis (integers, slices, lists or boolean arrays) as opposed to
+numpy fancy indexing. If a function returning a range of rows of a frame
+is supplied, selections of a few rows of frames not in the cache only
+read those rows.
+"""
+import sys
+import threading
+import numpy
+from multiprocessing.pool import ThreadPool
+if sys.version > '2.9':
+    long = int
+
+DEBUG = 0
+
+
+class LazyArray(object):
+    def __init__(self, reader, nframes, frameshape, dtype, axis=0,
+                 cachesize=None, prefetch=8, nthreads=4, rowreader=None):
+        """
+        :param reader: Function returning the frame given its index
+        :param nframes: Number of frames
+        :param frameshape: Shape of each frame
+        :param dtype: Data type of the returned data
+        :param axis: Axis of the frames in the array (0 or 2)
+        :param cachesize: Megabytes of decoded frames kept (default 256)
+        :param prefetch: Number of frames read in advance (0 to disable)
+        :param nthreads: Number of reading threads
+        :param rowreader: Optional function returning the rows rowMin to rowMax
+                          (both included) of a frame given the frame index,
+                          rowMin and rowMax
+        """
+        if axis < 0:
+            axis += len(frameshape) + 1
+        if axis not in [0, len(frameshape)]:
+            raise ValueError("Frame axis must be the first or the last one")
+        self._reader = reader
+        self._rowReader = rowreader
+        self._nFrames = nframes
+        self._frameShape = tuple(frameshape)
+        self._dtype = numpy.dtype(dtype)
+        self._axis = axis
+        if axis == 0:
+            self._shape = (nframes,) + self._frameShape
+        else:
+            self._shape = self._frameShape + (nframes,)
+        if cachesize is None:
+            cachesize = 256
+        frameBytes = self._dtype.itemsize
+        for item in self._frameShape:
+            frameBytes *= item
+        self._cacheFrames = max(1, prefetch + 1,
+                                int(cachesize * 1024 * 1024 / max(frameBytes, 1)))
+        self._prefetch = max(0, int(prefetch))
+        self._nThreads = max(1, int(nthreads))
+        self._cache = {}
+        self._cacheOrder = []
+        self._pending = {}
+        self._lastFrame = -1
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _getPool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self._nThreads)
+        return self._pool
+
+    def _readFrame(self, index):
+        return self._fitFrame(index, self._reader(index), self._frameShape)
+
+    def _readRows(self, index, rowMin, rowMax):
+        shape = (rowMax - rowMin + 1,) + self._frameShape[1:]
+        return self._fitFrame(index,
+                              self._rowReader(index, rowMin, rowMax),
+                              shape)
+
+    def _fitFrame(self, index, frame, shape):
+        frame = numpy.asarray(frame)
+        if frame.shape != shape:
+            # missing data assumed to be at the end
+            if DEBUG:
+                print("Frame %d has shape %s" % (index, frame.shape))
+            output = numpy.zeros(shape, dtype=self._dtype)
+            r = min(frame.shape[0], shape[0])
+            if len(shape) > 1:
+                c = min(frame.shape[1], shape[1])
+                output[:r, :c] = frame[:r, :c]
+            else:
+                output[:r] = frame[:r]
+            return output
+        return numpy.array(frame, dtype=self._dtype)
+
+    def _store(self, index, frame):
+        # to be called with the lock acquired
+        if index in self._cache:
+            self._cacheOrder.remove(index)
+        self._cache[index] = frame
+        self._cacheOrder.append(index)
+        while len(self._cacheOrder) > self._cacheFrames:
+            del self._cache[self._cacheOrder.pop(0)]
+
+    def _requestFrames(self, indices):
+        # to be called with the lock acquired
+        pool = None
+        for index in indices:
+            if (index in self._cache) or (index in self._pending):
+                continue
+            if pool is None:
+                pool = self._getPool()
+            self._pending[index] = pool.apply_async(self._readFrame, (index,))
+
+    def _getFrames(self, indices):
+        """
+        Return the list of frames associated to the given frame indices.
+
+        Missing frames are read in parallel when more than one is needed.
+        """
+        output = [None] * len(indices)
+        self._lock.acquire()
+        try:
+            missing = []
+            for i, index in enumerate(indices):
+                if index in self._cache:
+                    self._cacheOrder.remove(index)
+                    self._cacheOrder.append(index)
+                    output[i] = self._cache[index]
+                elif (index not in self._pending) and (index not in missing):
+                    missing.append(index)
+            if len(missing) > 1:
+                self._requestFrames(missing)
+        finally:
+            self._lock.release()
+        for i, index in enumerate(indices):
+            if output[i] is not None:
+                continue
+            self._lock.acquire()
+            try:
+                frame = self._cache.get(index, None)
+                result = self._pending.pop(index, None)
+            finally:
+                self._lock.release()
+            if frame is None:
+                if result is None:
+                    frame = self._readFrame(index)
+                else:
+                    frame = result.get()
+                self._lock.acquire()
+                try:
+                    self._store(index, frame)
+                finally:
+                    self._lock.release()
+            output[i] = frame
+        self._prefetchFrames(indices)
+        return output
+
+    def _getFrameRows(self, indices, rowMin, rowMax):
+        """
+        Return the list of the rows rowMin to rowMax of the given frames.
+
+        Frames not in the cache are partially read and not cached.
+        """
+        output = [None] * len(indices)
+        missing = []
+        pool = None
+        self._lock.acquire()
+        try:
+            for i, index in enumerate(indices):
+                frame = self._cache.get(index, None)
+                if frame is None:
+                    missing.append(index)
+                else:
+                    output[i] = frame[rowMin:(rowMax + 1)]
+            if len(missing) > 1:
+                pool = self._getPool()
+        finally:
+            self._lock.release()
+        if not len(missing):
+            return output
+        readRows = lambda index: self._readRows(index, rowMin, rowMax)
+        if pool is None:
+            frames = [readRows(missing[0])]
+        else:
+            frames = pool.map(readRows, missing)
+        frames = iter(frames)
+        for i in range(len(output)):
+            if output[i] is None:
+                output[i] = next(frames)
+        return output
+
+    def _getRowRange(self, key):
+        """
+        Return the first and last rows selected by key together with the
+        key to be applied to those rows, or None if all rows are needed.
+        """
+        if self._rowReader is None:
+            return None
+        nRows = self._frameShape[0]
+        if isinstance(key, int):
+            return key, key, 0
+        rows = numpy.arange(nRows)[key]
+        if not rows.size:
+            return None
+        rowMin = int(rows.min())
+        rowMax = int(rows.max())
+        if (rowMin == 0) and (rowMax == (nRows - 1)):
+            return None
+        return rowMin, rowMax, rows - rowMin
+
+    def _prefetchFrames(self, indices):
+        if (not self._prefetch) or (not len(indices)):
+            return
+        last = indices[-1]
+        if (len(indices) > 1 and indices[-1] < indices[0]) or \
+           (len(indices) == 1 and last < self._lastFrame):
+            step = -1
+        else:
+            step = 1
+        self._lastFrame = last
+        prefetch = []
+        for i in range(1, self._prefetch + 1):
+            index = last + i * step
+            if (index < 0) or (index >= self._nFrames):
+                break
+            prefetch.append(index)
+        self._lock.acquire()
+        try:
+            self._collect()
+            self._requestFrames(prefetch)
+        finally:
+            self._lock.release()
+
+    def _collect(self):
+        # move the finished prefetched frames into the cache
+        # to be called with the lock acquired
+        for index in list(self._pending.keys()):
+            result = self._pending[index]
+            if result.ready():
+                del self._pending[index]
+                if result.successful():
+                    self._store(index, result.get())
+
+    def _normalizeKey(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        ndim = len(self._shape)
+        for i, item in enumerate(key):
+            if item is Ellipsis:
+                fill = (slice(None),) * (ndim - len(key) + 1)
+                key = key[:i] + fill + key[i + 1:]
+                break
+        if len(key) > ndim:
+            raise IndexError("Too many indices")
+        key = key + (slice(None),) * (ndim - len(key))
+        output = []
+        for axis, item in enumerate(key):
+            if isinstance(item, (int, long, numpy.integer)):
+                item = int(item)
+                if item < 0:
+                    item += self._shape[axis]
+                if (item < 0) or (item >= self._shape[axis]):
+                    raise IndexError("Index %d out of range for axis %d" % \
+                                     (key[axis], axis))
+            elif not isinstance(item, slice):
+                item = numpy.asarray(item)
+                if item.dtype == numpy.bool_:
+                    item = numpy.nonzero(item)[0]
+                elif item.ndim != 1:
+                    raise IndexError("Only one dimensional lists are supported")
+                else:
+                    item = item.astype(numpy.int64)
+                    item[item < 0] += self._shape[axis]
+            output.append(item)
+        return output
+
+    def __getitem__(self, key):
+        key = self._normalizeKey(key)
+        frameKey = key[self._axis]
+        if self._axis == 0:
+            imageKey = key[1:]
+        else:
+            imageKey = key[:-1]
+        scalar = isinstance(frameKey, int)
+        if scalar:
+            indices = [frameKey]
+        else:
+            indices = [int(x) for x in numpy.arange(self._nFrames)[frameKey]]
+        frameShape = self._frameShape
+        rowRange = self._getRowRange(imageKey[0])
+        if rowRange is None:
+            frames = self._getFrames(indices)
+        else:
+            rowMin, rowMax, rowKey = rowRange
+            frames = self._getFrameRows(indices, rowMin, rowMax)
+            frameShape = (rowMax - rowMin + 1,) + frameShape[1:]
+            imageKey = [rowKey] + list(imageKey[1:])
+        if scalar:
+            return self._applyKey(frames[0], imageKey).copy()
+        imageShape = self._applyKey(numpy.empty(frameShape, dtype=numpy.bool_),
+                                    imageKey).shape
+        if self._axis == 0:
+            output = numpy.empty((len(indices),) + imageShape, dtype=self._dtype)
+            for i, frame in enumerate(frames):
+                output[i] = self._applyKey(frame, imageKey)
+        else:
+            output = numpy.empty(imageShape + (len(indices),), dtype=self._dtype)
+            for i, frame in enumerate(frames):
+                output[..., i] = self._applyKey(frame, imageKey)
+        return output
+
+    def _applyKey(self, frame, key):
+        # apply each index to its own axis
+        axis = 0
+        for item in key:
+            index = [slice(None)] * frame.ndim
+            index[axis] = item
+            frame = frame[tuple(index)]
+            if not isinstance(item, int):
+                axis += 1
+        return frame
+
+    def __len__(self):
+        return self._shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self[...]
+        return self[...].astype(dtype)
+
+    def __del__(self):
+        if self._pool is not None:
+            self._pool.terminate()
+
+    def close(self):
+        """
+        Stop the reading threads and empty the cache.
+        """
+        self._lock.acquire()
+        try:
+            pool = self._pool
+            self._pool = None
+            self._pending = {}
+            self._cache = {}
+            self._cacheOrder = []
+        finally:
+            self._lock.release()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    def getShape(self):
+        return self._shape
+    shape = property(getShape)
+
+    def getDtype(self):
+        return self._dtype
+    dtype = property(getDtype)
+
+    def getSize(self):
+        s = 1
+        for item in self._shape:
+            s *= item
+        return s
+    size = property(getSize)
+
+    def getNdim(self):
+        return len(self._shape)
+    ndim = property(getNdim)
@@ -147,56 +147,6 @@ def _readbinary_byte_offset(self, inStream):
         @return: a linear numpy array without shape and dtype set
         @rtype: numpy array
         """
-
-        def analyse(stream):
-            """
-            Analyze a stream of char with any length of exception (2,4, or 8 bytes integers)
-
-            @return list of NParrays
-            """
-            listnpa = []
-            if sys.version < '3.0' or\
-               isinstance(stream, str):
-                key16 = "\x80"
-                key32 = "\x00\x80"
-                key64 = "\x00\x00\x00\x80"
-            else:
-                # I avoid the b"..." syntax to try to keep python 2.5 compatibility
-                # encoding with utf-8 does not work
-                key16 = "\x80".encode('latin-1')
-                key32 = "\x00\x80".encode('latin-1')
-                key64 = "\x00\x040\x00\x80".encode('latin-1')
-#            idx = 0
-            shift = 1
-#            position = 0
-            while True:
-#                lns = len(stream)
-                idx = stream.find(key16)
-                if idx == -1:
-                    listnpa.append(np.fromstring(stream, dtype="int8"))
-                    break
-                listnpa.append(np.fromstring(stream[:idx], dtype="int8"))
-#                position += listnpa[-1].size
-
-                if stream[idx + 1:idx + 3] == key32:
-                    if stream[idx + 3:idx + 7] == key64:
-                        listnpa.append(np.fromstring(stream[idx + 7:idx + 15], dtype="int64"))
-#                        position += 1
-#                        print "loop64 x=%4i y=%4i in idx %4i lns %4i value=%s" % ((position % 2463), (position // 2463), idx, lns, listnpa[-1])
-                        shift = 15
-                    else: #32 bit int
-                        listnpa.append(np.fromstring(stream[idx + 3:idx + 7], dtype="int32"))
-#                        position += 1
-#                        print "loop32 x=%4i y=%4i in idx %4i lns %4i value=%s" % ((position % 2463), (position // 2463), idx, lns, listnpa[-1])
-                        shift = 7
-                else: #int16
-                    listnpa.append(np.fromstring(stream[idx + 1:idx + 3], dtype="int16"))
-#                    position += 1
-#                    print "loop16 x=%4i y=%4i in idx %4i lns %4i value=%s" % ((position % 2463), (position // 2463), idx, lns, listnpa[-1])
-                    shift = 3
-                stream = stream[idx + shift:]
-            return  listnpa
-
         if sys.version < '3.0' or\
             isinstance(inStream, str):
             starter = "\x0c\x1a\x04\xd5"
@@ -206,7 +156,7 @@ def analyse(stream):
             starter = "\x0c\x1a\x04\xd5".encode('latin-1')
         startPos = inStream.find(starter) + 4
         data = inStream[ startPos: startPos + int(self.__header["X-Binary-Size"])]
-        myData = np.hstack(analyse(data)).cumsum()
+        myData = decompressByteOffset(data)
 
         assert len(myData) == self.dim1 * self.dim2
         return myData
@@ -234,7 +184,7 @@ def read(self, fname):
             raise Exception(IOError, "CBF file %s is corrupt, no dimensions in it" % fname)
         try:
             bytecode = DATA_TYPES[self.__header['X-Binary-Element-Type']]
-            self.bpp = len(np.array(0, bytecode).tostring())
+            self.bpp = np.dtype(bytecode).itemsize
         except KeyError:
             bytecode = np.int32
             self.bpp = 32
@@ -246,6 +196,101 @@ def read(self, fname):
             raise Exception(IOError, "Compression scheme not yet supported, please contact FABIO development team")
         self.__info = self.__header
 
+def decompressByteOffset(stream):
+    """
+    Decompress a x-CBF_BYTE_OFFSET stream of any length of exceptions
+    (2, 4 or 8 bytes integers) without looping over the exceptions.
+
+    @param stream: the compressed binary data
+    @type stream: python string
+    @return: a linear int64 numpy array
+    @rtype: numpy array
+    """
+    if not isinstance(stream, bytes):
+        stream = stream.encode('latin-1')
+    nBytes = len(stream)
+    # pad to safely look at the bytes following an exception marker
+    raw = np.zeros((nBytes + 16,), dtype=np.uint8)
+    raw[:nBytes] = np.frombuffer(stream, dtype=np.uint8)
+    values = raw[:nBytes].view(np.int8).astype(np.int64)
+    candidates = np.nonzero(raw[:nBytes] == 0x80)[0]
+    if not len(candidates):
+        return values.cumsum()
+
+    # the value and the length of each candidate if it were an exception
+    def readInteger(offset, nbytes, dtype):
+        output = np.zeros((len(candidates),), dtype=np.uint64)
+        for i in range(nbytes):
+            output |= raw[candidates + offset + i].astype(np.uint64) << \
+                      np.uint64(8 * i)
+        return output.astype(dtype)
+    wide = readInteger(1, 2, np.uint16).view(np.int16).astype(np.int64)
+    length = np.zeros((len(candidates),), dtype=np.int64) + 3
+    idx32 = np.nonzero(wide == -32768)[0]
+    if len(idx32):
+        value32 = readInteger(3, 4, np.uint32).view(np.int32)
+        wide[idx32] = value32[idx32]
+        length[idx32] = 7
+        idx64 = idx32[value32[idx32] == -2147483648]
+        if len(idx64):
+            wide[idx64] = readInteger(7, 8, np.uint64).view(np.int64)[idx64]
+            length[idx64] = 15
+    ends = candidates + length
+
+    # a candidate is an exception unless it lies inside a previous
+    # exception. Only the previous 14 candidates can contain it and
+    # the first candidate is always an exception.
+    escape = np.ones((len(candidates),), dtype=np.bool_)
+    while True:
+        covered = np.zeros((len(candidates),), dtype=np.bool_)
+        for k in range(1, min(15, len(candidates))):
+            covered[k:] |= escape[:-k] & (ends[:-k] > candidates[k:])
+        if (escape != covered).all():
+            break
+        escape = ~covered
+
+    # the bytes belonging to the exceptions, except the marker itself,
+    # do not contribute to the output
+    starts = candidates[escape]
+    counter = np.bincount(starts + 1, minlength=nBytes + 16) - \
+              np.bincount(ends[escape], minlength=nBytes + 16)
+    used = counter.cumsum()[:nBytes] == 0
+    values[starts] = wide[escape]
+    return values[used].cumsum()
+
+def readFileList(filelist, nthreads=None):
+    """
+    Read the data of a list of CBF files in parallel.
+
+    @param filelist: the list of file names
+    @param nthreads: the number of reading threads (default: number of cpus)
+    @return: a 3D array with one image per file
+    @rtype: numpy array
+    """
+    from multiprocessing.pool import ThreadPool
+    from PyMca5.PyMcaMisc import ParallelTools
+    nthreads = ParallelTools.getNumberOfWorkers(nthreads)
+    def readData(filename):
+        return PilatusCBF(filename).getData()
+    if nthreads > 1 and len(filelist) > 1:
+        pool = ThreadPool(min(nthreads, len(filelist)))
+        try:
+            dataList = pool.map(readData, filelist)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        dataList = [readData(filename) for filename in filelist]
+    shape = dataList[0].shape
+    for i in range(len(dataList)):
+        if dataList[i].shape != shape:
+            raise ValueError("File %s does not have the same shape" % \
+                             filelist[i])
+    output = np.zeros((len(dataList),) + shape, dtype=dataList[0].dtype)
+    for i in range(len(dataList)):
+        output[i] = dataList[i]
+    return output
+
 class CIF(dict):
     """
     This is the CIF class, it represents the CIF dictionnary as a a python dictionnary thus inherits from the dict built in class.
@@ -49,6 +49,7 @@ static struct module_state _state;
 
 static PyObject *PyMcaIOHelper_fillSupaVisio(PyObject *dummy, PyObject *args);
 static PyObject *PyMcaIOHelper_readAifira(PyObject *dummy, PyObject *args);
+static PyObject *PyMcaIOHelper_decodeLZW(PyObject *dummy, PyObject *args);
 
 /* Functions */
 
@@ -189,11 +190,146 @@ PyMcaIOHelper_readAifira(PyObject *self, PyObject *args)
     return PyArray_Return(outputArray);
 }
 
+/* TIFF LZW decoding (MSB first codes of 9 to 12 bits with early change) */
+
+static PyObject *
+PyMcaIOHelper_decodeLZW(PyObject *self, PyObject *args)
+{
+    Py_buffer input;
+    Py_ssize_t outputSize;
+    PyArrayObject *outputArray;
+    npy_intp dimensions[1];
+    unsigned char *in, *out;
+    Py_ssize_t inSize, inPos, outPos, k;
+    unsigned short prefix[4096];
+    unsigned char suffix[4096];
+    unsigned char first[4096];
+    int length[4096];
+    unsigned long accumulator;
+    int nAccumulated, nBits, next, old, code, c, i;
+    struct module_state *st = GETSTATE(self);
+
+    if (!PyArg_ParseTuple(args, "s*n", &input, &outputSize))
+    {
+        PyErr_SetString(st->error, "Error parsing input arguments");
+        return NULL;
+    }
+    if (outputSize < 0)
+    {
+        PyBuffer_Release(&input);
+        PyErr_SetString(st->error, "Output size must be positive");
+        return NULL;
+    }
+    dimensions[0] = outputSize;
+    outputArray = (PyArrayObject *) PyArray_SimpleNew(1, dimensions, NPY_UINT8);
+    if (outputArray == NULL)
+    {
+        PyBuffer_Release(&input);
+        return NULL;
+    }
+    PyArray_FILLWBYTE(outputArray, 0);
+
+    in = (unsigned char *) input.buf;
+    inSize = input.len;
+    out = (unsigned char *) PyArray_DATA(outputArray);
+
+    Py_BEGIN_ALLOW_THREADS
+    for (i = 0; i < 256; i++)
+    {
+        prefix[i] = 0;
+        suffix[i] = (unsigned char) i;
+        first[i] = (unsigned char) i;
+        length[i] = 1;
+    }
+    accumulator = 0;
+    nAccumulated = 0;
+    nBits = 9;
+    next = 258;
+    old = -1;
+    inPos = 0;
+    outPos = 0;
+    while (outPos < outputSize)
+    {
+        while ((nAccumulated < nBits) && (inPos < inSize))
+        {
+            accumulator = ((accumulator << 8) | in[inPos++]) & 0xFFFFFF;
+            nAccumulated += 8;
+        }
+        if (nAccumulated < nBits)
+            break;
+        code = (int) ((accumulator >> (nAccumulated - nBits)) & ((1 << nBits) - 1));
+        nAccumulated -= nBits;
+        if (code == 257)
+            /* end of information */
+            break;
+        if (code == 256)
+        {
+            /* clear code */
+            nBits = 9;
+            next = 258;
+            old = -1;
+            continue;
+        }
+        if (old == -1)
+        {
+            if (code > 255)
+                break;
+            out[outPos++] = (unsigned char) code;
+            old = code;
+            continue;
+        }
+        if (code > next)
+            /* corrupted stream */
+            break;
+        if (next < 4096)
+        {
+            prefix[next] = (unsigned short) old;
+            first[next] = first[old];
+            suffix[next] = (code == next) ? first[old] : first[code];
+            length[next] = length[old] + 1;
+            next++;
+            if ((next >= ((1 << nBits) - 1)) && (nBits < 12))
+                nBits++;
+        }
+        /* write the string associated to the code from its end */
+        c = code;
+        for (k = length[code] - 1; k >= 0; k--)
+        {
+            if ((outPos + k) < outputSize)
+                out[outPos + k] = suffix[c];
+            c = prefix[c];
+        }
+        outPos += length[code];
+        old = code;
+    }
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&input);
+    if (outPos < outputSize)
+    {
+        /* truncated stream, return the decoded bytes only */
+        PyArray_Dims newShape;
+        PyObject *result;
+        dimensions[0] = outPos;
+        newShape.ptr = dimensions;
+        newShape.len = 1;
+        result = PyArray_Resize(outputArray, &newShape, 0, NPY_CORDER);
+        if (result == NULL)
+        {
+            Py_DECREF(outputArray);
+            return NULL;
+        }
+        Py_DECREF(result);
+    }
+    return PyArray_Return(outputArray);
+}
+
 /* Module methods */
 
 static PyMethodDef PyMcaIOHelper_methods[] = {
     {"fillSupaVisio", PyMcaIOHelper_fillSupaVisio, METH_VARARGS},
     {"readAifira", PyMcaIOHelper_readAifira, METH_VARARGS},
+    {"decodeLZW", PyMcaIOHelper_decodeLZW, METH_VARARGS},
 	{NULL, NULL}
 };
 
@@ -36,6 +36,7 @@
 from PyMca5.PyMcaCore import DataObject
 from PyMca5.PyMcaIO import specfilewrapper as specfile
 from PyMca5.PyMcaCore import SpecFileDataSource
+from PyMca5.PyMcaMisc import ParallelTools
 
 HDF5 = False
 try:
@@ -45,6 +46,8 @@
     pass
 SOURCE_TYPE = "SpecFileStack"
 DEBUG = 0
+# threads used to convert the mca spectra (None means number of cpus)
+NUMBER_OF_THREADS = None
 
 X_AXIS=0
 Y_AXIS=1
@@ -80,11 +83,14 @@ def loadFileList(self, filelist, fileindex=0, shape=None):
         nscans = len(keylist)        #that is the number of scans
         nmca = 0
         numberofdetectors = 0
-        for key in keylist:
+        # file indices of the scans with mca
+        mcaScanIndices = []
+        for scanIndex, key in enumerate(keylist):
             info = tempInstance.getKeyInfo(key)
             numberofmca       = info['NbMca']
             if numberofmca > 0:
                 numberofdetectors = info['NbMcaDet']
+                mcaScanIndices.append(scanIndex)
             scantype          = info["ScanType"]
             if numberofmca:
                 nmca += numberofmca
@@ -115,6 +121,18 @@ def loadFileList(self, filelist, fileindex=0, shape=None):
                                    arrRet.dtype.char)
             filecounter         = 0
             for tempFileName in filelist:
+                sf = specfile.Specfile(tempFileName)
+                if hasattr(sf, "mcablock"):
+                    # last mca of each scan converted in one call
+                    sf.mcablock(self.data[filecounter],
+                                mcaScanIndices, -1,
+                                ParallelTools.getNumberOfWorkers( \
+                                                        NUMBER_OF_THREADS))
+                    self.incrProgressBar += len(mcaScanIndices) * \
+                                            len(iterlist)
+                    self.onProgress(self.incrProgressBar)
+                    filecounter += 1
+                    continue
                 tempInstance=SpecFileDataSource.SpecFileDataSource(tempFileName)
                 mca_number = -1
                 for keyindex in keylist:
@@ -149,6 +167,14 @@ def loadFileList(self, filelist, fileindex=0, shape=None):
                 #scan = tempInstance.select(keylist[-1])
                 scan = tempInstance[-1]
                 iterationList = range(scan.nbmca())
+                if hasattr(scan, "mcablock"):
+                    # all the spectra converted in one call
+                    n = scan.mcablock(self.data[0], 1, 1,
+                                      ParallelTools.getNumberOfWorkers( \
+                                                        NUMBER_OF_THREADS))
+                    self.incrProgressBar += n
+                    self.onProgress(self.incrProgressBar)
+                    iterationList = []
                 for i in iterationList:
                     #mcadata = scan_obj.mca(i)
                     self.data[0,
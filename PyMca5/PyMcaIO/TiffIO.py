@@ -34,10 +34,18 @@
 import sys
 import os
 import struct
+import zlib
 import numpy
+try:
+    from PyMca5.PyMcaIO import PyMcaIOHelper
+except ImportError:
+    PyMcaIOHelper = None
 
 DEBUG = 0
 ALLOW_MULTIPLE_STRIPS = False
+# threads decoding the strips or tiles of compressed images
+NUMBER_OF_THREADS = None
+_THREAD_POOL = None
 
 TAG_ID  = { 256:"NumberOfColumns",           # S or L ImageWidth
             257:"NumberOfRows",              # S or L ImageHeight
@@ -51,7 +59,12 @@
             279:"StripByteCounts",           # S or L, The number of bytes in the strip AFTER any compression
             305:"Software",                  # ASCII
             306:"Date",                      # ASCII
+            317:"Predictor",                 # SHORT (1 - None, 2 - Horizontal differencing, 3 - Floating point)
             320:"Colormap",                  # Colormap of Palette-color Images
+            322:"TileWidth",                 # S or L, number of columns in each tile
+            323:"TileLength",                # S or L, number of rows in each tile
+            324:"TileOffsets",               # L, for each tile, the byte offset of the tile
+            325:"TileByteCounts",            # S or L, The number of bytes in the tile AFTER any compression
             339:"SampleFormat",              # SHORT Interpretation of data in each pixel
             }
 
@@ -68,9 +81,29 @@
 TAG_STRIP_BYTE_COUNTS  = 279
 TAG_SOFTWARE           = 305
 TAG_DATE               = 306
+TAG_PREDICTOR          = 317
 TAG_COLORMAP           = 320
+TAG_TILE_WIDTH         = 322
+TAG_TILE_LENGTH        = 323
+TAG_TILE_OFFSETS       = 324
+TAG_TILE_BYTE_COUNTS   = 325
 TAG_SAMPLE_FORMAT      = 339
 
+COMPRESSION_NONE           = 1
+COMPRESSION_LZW            = 5
+COMPRESSION_ADOBE_DEFLATE  = 8
+COMPRESSION_PACKBITS       = 32773
+COMPRESSION_DEFLATE        = 32946
+SUPPORTED_COMPRESSIONS = [COMPRESSION_NONE,
+                          COMPRESSION_LZW,
+                          COMPRESSION_ADOBE_DEFLATE,
+                          COMPRESSION_PACKBITS,
+                          COMPRESSION_DEFLATE]
+
+PREDICTOR_NONE           = 1
+PREDICTOR_HORIZONTAL     = 2
+PREDICTOR_FLOATING_POINT = 3
+
 FIELD_TYPE  = {1:('BYTE', "B"),
                2:('ASCII', "s"), #string ending with binary zero
                3:('SHORT', "H"),
@@ -104,7 +137,78 @@
 SAMPLE_FORMAT_COMPLEXINT    = 5
 SAMPLE_FORMAT_COMPLEXIEEEFP = 6
 
-
+def _getThreadPool():
+    global _THREAD_POOL
+    if _THREAD_POOL is None:
+        from multiprocessing.pool import ThreadPool
+        from PyMca5.PyMcaMisc import ParallelTools
+        _THREAD_POOL = ThreadPool( \
+                            ParallelTools.getNumberOfWorkers(NUMBER_OF_THREADS))
+    return _THREAD_POOL
+
+def _decodePackBits(data, size):
+    output = []
+    readBytes = 0
+    nBytes = len(data)
+    while readBytes < nBytes:
+        n = struct.unpack('b', data[readBytes:(readBytes+1)])[0]
+        readBytes += 1
+        if n >= 0:
+            output.append(data[readBytes:readBytes+(n+1)])
+            readBytes += (n+1)
+        elif n > -128:
+            output.append((-n+1) * data[readBytes:(readBytes+1)])
+            readBytes += 1
+        #if read -128 ignore the byte
+    return numpy.frombuffer(data[0:0].join(output), numpy.uint8)
+
+def _decodeLZW(data, size):
+    """
+    Decode a TIFF LZW stream into an array of size bytes at most.
+    """
+    if PyMcaIOHelper is not None:
+        if hasattr(PyMcaIOHelper, "decodeLZW"):
+            return PyMcaIOHelper.decodeLZW(data, size)
+    inBuffer = bytearray(data) + bytearray(3)
+    nInputBits = 8 * len(data)
+    table = [data[0:0] + struct.pack('B', i) for i in range(256)] + [None, None]
+    output = []
+    outputLength = 0
+    bitPosition = 0
+    nBits = 9
+    old = None
+    while (outputLength < size) and ((bitPosition + nBits) <= nInputBits):
+        i = bitPosition >> 3
+        code = ((inBuffer[i] << 16) | (inBuffer[i + 1] << 8) | inBuffer[i + 2])
+        code = (code >> (24 - (bitPosition & 7) - nBits)) & ((1 << nBits) - 1)
+        bitPosition += nBits
+        if code == 257:
+            # end of information
+            break
+        if code == 256:
+            # clear code
+            del table[258:]
+            nBits = 9
+            old = None
+            continue
+        if old is None:
+            string = table[code]
+        elif code < len(table):
+            string = table[code]
+            if len(table) < 4096:
+                table.append(old + string[:1])
+        elif code == len(table):
+            string = old + old[:1]
+            table.append(string)
+        else:
+            # corrupted stream
+            break
+        output.append(string)
+        outputLength += len(string)
+        old = string
+        if (len(table) >= ((1 << nBits) - 1)) and (nBits < 12):
+            nBits += 1
+    return numpy.frombuffer(data[0:0].join(output)[:size], numpy.uint8)
 
 class TiffIO(object):
     def __init__(self, filename, mode=None, cache_length=20, mono_output=False):
@@ -308,7 +412,12 @@ def _readIFDEntry(self, tag, tagIDList, fieldTypeList, nValuesList, valueOffsetL
         if nValues ==  1:
             output.append(valueOffsetList[idx])
         elif requestedBytes < 5:
-            output.append(valueOffsetList[idx])
+            if ftype == 'ASCII':
+                output.append(valueOffsetList[idx])
+            else:
+                # several values fitting in the offset field
+                output = list(struct.unpack(vfmt,
+                                valueOffsetList[idx][0:requestedBytes]))
         else:
             fd.seek(struct.unpack(st+"I", valueOffsetList[idx])[0])
             output = struct.unpack(vfmt, fd.read(requestedBytes))
@@ -386,6 +495,11 @@ def _readInfo(self, nImage, close=True):
             else:
                 compression = True
 
+        #predictor
+        predictor = PREDICTOR_NONE
+        if TAG_PREDICTOR in tagIDList:
+            predictor = valueOffsetList[tagIDList.index(TAG_PREDICTOR)]
+
         #photometric interpretation
         interpretation = 1
         if TAG_PHOTOMETRIC_INTERPRETATION in tagIDList:
@@ -438,16 +552,38 @@ def _readInfo(self, nImage, close=True):
         else:
             date = "Unknown Date"
 
-        stripOffsets = self._readIFDEntry(TAG_STRIP_OFFSETS,
+        if TAG_TILE_OFFSETS in tagIDList:
+            #tiled image
+            tileWidth = self._readIFDEntry(TAG_TILE_WIDTH,
+                        tagIDList, fieldTypeList, nValuesList, valueOffsetList)[0]
+            tileLength = self._readIFDEntry(TAG_TILE_LENGTH,
+                        tagIDList, fieldTypeList, nValuesList, valueOffsetList)[0]
+            tileOffsets = self._readIFDEntry(TAG_TILE_OFFSETS,
+                        tagIDList, fieldTypeList, nValuesList, valueOffsetList)
+            tileByteCounts = self._readIFDEntry(TAG_TILE_BYTE_COUNTS,
                         tagIDList, fieldTypeList, nValuesList, valueOffsetList)
+        else:
+            tileWidth = None
+            tileLength = None
+            tileOffsets = None
+            tileByteCounts = None
+
+        if TAG_STRIP_OFFSETS in tagIDList:
+            stripOffsets = self._readIFDEntry(TAG_STRIP_OFFSETS,
+                        tagIDList, fieldTypeList, nValuesList, valueOffsetList)
+        else:
+            stripOffsets = []
         if TAG_ROWS_PER_STRIP in tagIDList:
             rowsPerStrip = self._readIFDEntry(TAG_ROWS_PER_STRIP,
                         tagIDList, fieldTypeList, nValuesList, valueOffsetList)[0]
         else:
             rowsPerStrip = nRows
-            print("WARNING: Non standard TIFF. Rows per strip TAG missing")
+            if tileOffsets is None:
+                print("WARNING: Non standard TIFF. Rows per strip TAG missing")
 
-        if TAG_STRIP_BYTE_COUNTS in tagIDList:
+        if tileOffsets is not None:
+            stripByteCounts = []
+        elif TAG_STRIP_BYTE_COUNTS in tagIDList:
             stripByteCounts = self._readIFDEntry(TAG_STRIP_BYTE_COUNTS,
                         tagIDList, fieldTypeList, nValuesList, valueOffsetList)
         else:
@@ -482,10 +618,15 @@ def _readInfo(self, nImage, close=True):
         info["nBits"] = nBits
         info["compression"] = compression
         info["compression_type"] = compression_type
+        info["predictor"] = predictor
         info["imageDescription"] = imageDescription
         info["stripOffsets"] = stripOffsets #This contains the file offsets to the data positions
         info["rowsPerStrip"] = rowsPerStrip
-        info["stripByteCounts"] = stripByteCounts #bytes in strip since I do not support compression
+        info["stripByteCounts"] = stripByteCounts #bytes in strip after compression
+        info["tileWidth"] = tileWidth
+        info["tileLength"] = tileLength
+        info["tileOffsets"] = tileOffsets
+        info["tileByteCounts"] = tileByteCounts
         info["software"] = software
         info["date"] = date
         info["colormap"] = colormap
@@ -549,12 +690,10 @@ def _readImage(self, nImage, **kw):
         compression = info['compression']
         compression_type = info['compression_type']
         if compression:
-            if compression_type != 32773:
-                raise IOError("Compressed TIFF images not supported except packbits")
-            else:
-                #PackBits compression
-                if DEBUG:
-                    print("Using PackBits compression")
+            if compression_type not in SUPPORTED_COMPRESSIONS:
+                raise IOError("Compressed TIFF images only supported with LZW, Deflate or PackBits")
+            if DEBUG:
+                print("Using compression %d" % compression_type)
 
         interpretation = info["photometricInterpretation"]
         if interpretation == 2:
@@ -637,107 +776,76 @@ def _readImage(self, nImage, **kw):
             image = numpy.zeros((nRows, nColumns), dtype=dtype)
 
         fd = self.fd
-        st = self._structChar
-        stripOffsets = info["stripOffsets"] #This contains the file offsets to the data positions
-        rowsPerStrip = info["rowsPerStrip"]
-        stripByteCounts = info["stripByteCounts"] #bytes in strip since I do not support compression
-
-        rowStart = 0
-        if len(stripOffsets) == 1:
-            bytesPerRow = int(stripByteCounts[0]/rowsPerStrip)
-            fd.seek(stripOffsets[0] + rowMin * bytesPerRow)
-            nBytes = (rowMax-rowMin+1) * bytesPerRow
-            if self._swap:
-                readout = numpy.fromstring(fd.read(nBytes), dtype).byteswap()
-            else:
-                readout = numpy.fromstring(fd.read(nBytes), dtype)
-            if hasattr(nBits, 'index'):
-                readout.shape = -1, nColumns, len(nBits)
-            elif info['colormap'] is not None:
-                readout = colormap[readout]
-            else:
-                readout.shape = -1, nColumns
-            image[rowMin:rowMax+1, :] = readout
+        if hasattr(nBits, 'index'):
+            nSamples = len(nBits)
         else:
-            for i in range(len(stripOffsets)):
-                #the amount of rows
-                nRowsToRead = rowsPerStrip
-                rowEnd = int(min(rowStart+nRowsToRead, nRows))
-                if rowEnd < rowMin:
-                    rowStart += nRowsToRead
+            nSamples = 1
+        itemSize = numpy.dtype(dtype).itemsize
+
+        # the blocks (strips or tiles) containing the requested rows as
+        # (file offset, bytes, first row, first column, rows, columns)
+        blockList = []
+        if info["tileOffsets"] is not None:
+            tileWidth = info["tileWidth"]
+            tileLength = info["tileLength"]
+            tilesAcross = int((nColumns + tileWidth - 1) / tileWidth)
+            tileByteCounts = info["tileByteCounts"]
+            for i, offset in enumerate(info["tileOffsets"]):
+                rowStart = int(i / tilesAcross) * tileLength
+                if (rowStart + tileLength <= rowMin) or (rowStart > rowMax):
                     continue
-                if (rowStart > rowMax):
-                    break
-                #we are in position
-                fd.seek(stripOffsets[i])
-                #the amount of bytes to read
-                nBytes = stripByteCounts[i]
-                if compression_type == 32773:
-                    try:
-                        bufferBytes = bytes()
-                    except:
-                        #python 2.5 ...
-                        bufferBytes = ""
-                    #packBits
-                    readBytes = 0
-                    #intermediate buffer
-                    tmpBuffer = fd.read(nBytes)
-                    while readBytes < nBytes:
-                        n = struct.unpack('b', tmpBuffer[readBytes:(readBytes+1)])[0]
-                        readBytes += 1
-                        if n >= 0:
-                            #should I prevent reading more than the
-                            #length of the chain? Let's python raise
-                            #the exception...
-                            bufferBytes +=  tmpBuffer[readBytes:\
-                                                      readBytes+(n+1)]
-                            readBytes += (n+1)
-                        elif n > -128:
-                            bufferBytes += (-n+1) * tmpBuffer[readBytes:(readBytes+1)]
-                            readBytes += 1
-                        else:
-                            #if read -128 ignore the byte
-                            continue
-                    if self._swap:
-                        readout = numpy.fromstring(bufferBytes, dtype).byteswap()
-                    else:
-                        readout = numpy.fromstring(bufferBytes, dtype)
-                    if hasattr(nBits, 'index'):
-                        readout.shape = -1, nColumns, len(nBits)
-                    elif info['colormap'] is not None:
-                        readout = colormap[readout]
-                        readout.shape = -1, nColumns, 3
-                    else:
-                        readout.shape = -1, nColumns
-                    image[rowStart:rowEnd, :] = readout
-                else:
-                    if 1:
-                        #use numpy
-                        if self._swap:
-                            readout = numpy.fromstring(fd.read(nBytes), dtype).byteswap()
-                        else:
-                            readout = numpy.fromstring(fd.read(nBytes), dtype)
-                        if hasattr(nBits, 'index'):
-                            readout.shape = -1, nColumns, len(nBits)
-                        elif colormap is not None:
-                            readout = colormap[readout]
-                            readout.shape = -1, nColumns, 3
-                        else:
-                            readout.shape = -1, nColumns
-                        image[rowStart:rowEnd, :] = readout
+                blockList.append((offset, tileByteCounts[i],
+                                  rowStart, (i % tilesAcross) * tileWidth,
+                                  tileLength, tileWidth))
+        else:
+            stripOffsets = info["stripOffsets"] #This contains the file offsets to the data positions
+            rowsPerStrip = info["rowsPerStrip"]
+            stripByteCounts = info["stripByteCounts"] #bytes in strip after compression
+            bytesPerRow = nColumns * nSamples * itemSize
+            rowStart = 0
+            for i in range(len(stripOffsets)):
+                rowEnd = int(min(rowStart + rowsPerStrip, nRows))
+                if (rowEnd > rowMin) and (rowStart <= rowMax):
+                    if compression:
+                        blockList.append((stripOffsets[i], stripByteCounts[i],
+                                          rowStart, 0, rowEnd - rowStart,
+                                          nColumns))
                     else:
-                        #using struct
-                        readout = numpy.array(struct.unpack(st+"%df" % int(nBytes/4), fd.read(nBytes)),
-                                              dtype=dtype)
-                        if hasattr(nBits, 'index'):
-                            readout.shape = -1, nColumns, len(nBits)
-                        elif colormap is not None:
-                            readout = colormap[readout]
-                            readout.shape = -1, nColumns, 3
-                        else:
-                            readout.shape = -1, nColumns
-                        image[rowStart:rowEnd, :] = readout
-                rowStart += nRowsToRead
+                        # read only the requested rows
+                        first = max(rowStart, rowMin)
+                        last = min(rowEnd, rowMax + 1)
+                        blockList.append((stripOffsets[i] + \
+                                          (first - rowStart) * bytesPerRow,
+                                          (last - first) * bytesPerRow,
+                                          first, 0, last - first,
+                                          nColumns))
+                rowStart += rowsPerStrip
+
+        rawList = []
+        for block in blockList:
+            fd.seek(block[0])
+            rawList.append(fd.read(block[1]))
+
+        def decode(i):
+            block = blockList[i]
+            return self._decodeBlock(rawList[i], block[4], block[5],
+                                     nSamples, dtype, compression_type,
+                                     info["predictor"])
+        if compression and (compression_type != COMPRESSION_PACKBITS) and \
+           (len(blockList) > 1):
+            readoutList = _getThreadPool().map(decode, range(len(blockList)))
+        else:
+            readoutList = [decode(i) for i in range(len(blockList))]
+        rawList = None
+
+        for block, readout in zip(blockList, readoutList):
+            rowStart, colStart = block[2], block[3]
+            rowEnd = min(rowStart + readout.shape[0], nRows)
+            colEnd = min(colStart + readout.shape[1], nColumns)
+            readout = readout[:rowEnd - rowStart, :colEnd - colStart]
+            if colormap is not None:
+                readout = colormap[readout]
+            image[rowStart:rowEnd, colStart:colEnd] = readout
         if close:
             self.__makeSureFileIsClosed()
 
@@ -758,6 +866,43 @@ def _readImage(self, nImage, **kw):
 
         return image
 
+    def _decodeBlock(self, data, nRows, nColumns, nSamples, dtype,
+                     compression_type, predictor):
+        """
+        Decompress a strip or a tile returning an array of nRows rows at most.
+        """
+        dtype = numpy.dtype(dtype)
+        size = nRows * nColumns * nSamples * dtype.itemsize
+        if compression_type in [COMPRESSION_ADOBE_DEFLATE, COMPRESSION_DEFLATE]:
+            readout = numpy.frombuffer(zlib.decompress(data), numpy.uint8)
+        elif compression_type == COMPRESSION_LZW:
+            readout = _decodeLZW(data, size)
+        elif compression_type == COMPRESSION_PACKBITS:
+            readout = _decodePackBits(data, size)
+        else:
+            readout = numpy.frombuffer(data, numpy.uint8)
+        bytesPerRow = nColumns * nSamples * dtype.itemsize
+        nRows = min(nRows, int(readout.size / bytesPerRow))
+        readout = readout[:nRows * bytesPerRow]
+        if predictor == PREDICTOR_FLOATING_POINT:
+            # bytes of the row grouped by significance, most significant first
+            readout = numpy.cumsum(readout.reshape(nRows, bytesPerRow),
+                                   axis=1, dtype=numpy.uint8)
+            readout = readout.reshape(nRows, dtype.itemsize, -1)
+            readout = numpy.ascontiguousarray(readout.transpose(0, 2, 1))
+            readout = readout.view(dtype.newbyteorder('>')).astype(dtype)
+        else:
+            readout = readout.view(dtype)
+            if self._swap:
+                readout = readout.byteswap()
+        if nSamples > 1:
+            readout = readout.reshape(nRows, nColumns, nSamples)
+        else:
+            readout = readout.reshape(nRows, nColumns)
+        if predictor == PREDICTOR_HORIZONTAL:
+            readout = numpy.cumsum(readout, axis=1, dtype=dtype)
+        return readout
+
     def writeImage(self, image0, info=None, software=None, date=None):
         if software is None:
             software = 'PyMca.TiffIO'
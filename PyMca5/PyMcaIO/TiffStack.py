@@ -30,159 +30,92 @@
 __contact__ = "sole@esrf.fr"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-import sys
 import os
+import threading
 import numpy
 from PyMca5 import DataObject
 from PyMca5.PyMcaIO import TiffIO
-if sys.version > '2.9':
-    long = int
+from PyMca5.PyMcaIO import LazyArray
+from PyMca5.PyMcaMisc import PhysicalMemory
 
 SOURCE_TYPE = "TiffStack"
 
-class TiffArray(object):
+class TiffArray(LazyArray.LazyArray):
     def __init__(self, filelist, shape, dtype, imagestack=True):
         self.__fileList    = filelist
-        self.__shape       = shape
-        self.__dtype       = dtype
         self.__imageStack  = imagestack
         if imagestack:
-            self.__nImagesPerFile = int(shape[0]/len(filelist))
+            nImages = shape[0]
+            imageShape = shape[1:]
+            axis = 0
         else:
-            self.__nImagesPerFile = int(shape[-1]/len(filelist))
-        self.__oldFileNumber = -1
-
-    def __getitem__(self, args0):
-        standardSlice = True
-        indices = []
-        outputShape = []
-        scalarArgs = []
-        args = []
-        if not hasattr(args0, "__len__"):
-            args0 = [args0]
-        for i in range(len(self.__shape)):
-            if i < len(args0):
-                args.append(args0[i])
-            else:
-                args.append(slice(None, None, None))
-        for i in range(len(args)):
-            if isinstance(args[i], slice):
-                start = args[i].start
-                stop  = args[i].stop
-                step  = args[i].step
-                if start is None:
-                    start = 0
-                if stop is None:
-                    stop = self.__shape[i]
-                if step is None:
-                    step = 1
-                if step < 1:
-                    raise ValueError("Step must be >= 1 (got %d)" % step)
-                if start is None:
-                    start = 0
-                if start < 0:
-                    start = self.__shape[i]-start
-                if stop < 0:
-                    stop = self.__shape[i]-stop
-                if stop == start:
-                    raise ValueError("Zero-length selections are not allowed")
-                indices.append(list(range(start, stop, step)))
-            elif type(args[i]) == type([]):
-                if len(args[i]):
-                    indices.append([int(x) for x in args[i]])
-                else:
-                    standardSlice = False
-            elif type(args[i]) in [type(1), type(long(1))]:
-                start = args[i]
-                if start < 0:
-                    start = self.__shape[i] - start
-                stop = start + 1
-                step = 1
-                start = args[i]
-                args[i] = slice(start, stop, step)
-                indices.append(list(range(start, stop, step)))
-                scalarArgs.append(i)
-            else:
-                standardSlice = False
-
-        if not standardSlice:
-            print("args = ", args)
-            raise NotImplemented("__getitem__(self, args) only works on slices")
-
-        if len(indices) < 3:
-            print("input args = ", args0)
-            print("working args = ", args)
-            print("indices = ", indices)
-            raise NotImplemented("__getitem__(self, args) only works on slices")
-        outputShape = [len(indices[0]), len(indices[1]), len(indices[2])]
-        outputArray = numpy.zeros(outputShape, dtype=self.__dtype)
-        # nbFiles = len(self.__fileList)
-        nImagesPerFile = self.__nImagesPerFile
-
-        if self.__imageStack:
-            i = 0
-            rowMin = min(indices[1])
-            rowMax = max(indices[1])
-            for imageIndex in indices[0]:
-                fileNumber = int(imageIndex/nImagesPerFile)
-                if fileNumber != self.__oldFileNumber:
-                    self.__tmpInstance = TiffIO.TiffIO(self.__fileList[fileNumber],
-                                                       mode='rb+')
-                    self.__oldFileNumber = fileNumber
-                imageNumber = imageIndex % nImagesPerFile
-                imageData = self.__tmpInstance.getData(imageNumber,
-                                                       rowMin=rowMin,
-                                                       rowMax=rowMax)
-                try:
-                    outputArray[i,:,:] = imageData[args[1],args[2]]
-                except:
-                    print("outputArray[i,:,:].shape =",outputArray[i,:,:].shape)
-                    print("imageData[args[1],args[2]].shape = " , imageData[args[1],args[2]].shape)
-                    print("input args = ", args0)
-                    print("working args = ", args)
-                    print("indices = ", indices)
-                    print("scalarArgs = ", scalarArgs)
-                    raise
-                i += 1
-        else:
-            i = 0
-            rowMin = min(indices[0])
-            rowMax = max(indices[0])
-            for imageIndex in indices[-1]:
-                fileNumber = int(imageIndex/nImagesPerFile)
-                if fileNumber != self.__oldFileNumber:
-                    self.__tmpInstance = TiffIO.TiffIO(self.__fileList[fileNumber],
-                                                       mode='rb+')
-                    self.__oldFileNumber = fileNumber
-                imageNumber = imageIndex % nImagesPerFile
-                imageData = self.__tmpInstance.getData(imageNumber,
-                                                       rowMin=rowMin,
-                                                       rowMax=rowMax)
-                outputArray[:,:, i] = imageData[args[0],args[1]]
-                i += 1
-        if len(scalarArgs):
-            finalShape = []
-            for i in range(len(outputShape)):
-                if i in scalarArgs:
-                    continue
-                finalShape.append(outputShape[i])
-            outputArray.shape = finalShape
-        return outputArray
-
-    def getShape(self):
-        return self.__shape
-    shape = property(getShape)
-
-    def getDtype(self):
-        return self.__dtype
-    dtype = property(getDtype)
-
-    def getSize(self):
-        s = 1
-        for item in self.__shape:
-            s *= item
-        return s
-    size = property(getSize)
+            nImages = shape[-1]
+            imageShape = shape[:-1]
+            axis = -1
+        self.__nImagesPerFile = int(nImages/len(filelist))
+        # one file instance per reading thread
+        self.__readers = {}
+        self.__readersLock = threading.Lock()
+        LazyArray.LazyArray.__init__(self, self._readImage,
+                                     nImages,
+                                     imageShape,
+                                     dtype,
+                                     axis=axis,
+                                     rowreader=self._readRows)
+
+    def _getReader(self, imageIndex):
+        fileNumber = int(imageIndex/self.__nImagesPerFile)
+        key = threading.current_thread().ident
+        self.__readersLock.acquire()
+        try:
+            reader = self.__readers.get(key, None)
+        finally:
+            self.__readersLock.release()
+        if (reader is None) or (reader[0] != fileNumber):
+            if reader is not None:
+                reader[1].close()
+            # the decoded images are already cached by the array
+            reader = (fileNumber,
+                      TiffIO.TiffIO(self.__fileList[fileNumber],
+                                    mode='rb',
+                                    cache_length=0))
+            self.__readersLock.acquire()
+            try:
+                self.__readers[key] = reader
+            finally:
+                self.__readersLock.release()
+        return reader[1], imageIndex % self.__nImagesPerFile
+
+    def _readImage(self, imageIndex):
+        instance, imageNumber = self._getReader(imageIndex)
+        return instance.getImage(imageNumber)
+
+    def _readRows(self, imageIndex, rowMin, rowMax):
+        instance, imageNumber = self._getReader(imageIndex)
+        # only those rows of the full size image are decoded
+        image = instance.getData(imageNumber, rowMin=rowMin, rowMax=rowMax)
+        return image[rowMin:(rowMax + 1)]
+
+    def _closeReaders(self):
+        self.__readersLock.acquire()
+        try:
+            readers = list(self.__readers.values())
+            self.__readers = {}
+        finally:
+            self.__readersLock.release()
+        for fileNumber, instance in readers:
+            instance.close()
+
+    def __del__(self):
+        LazyArray.LazyArray.__del__(self)
+        self._closeReaders()
+
+    def close(self):
+        """
+        Stop the reading threads and close the files.
+        """
+        LazyArray.LazyArray.close(self)
+        self._closeReaders()
 
 class TiffStack(DataObject.DataObject):
     def __init__(self, filelist=None, imagestack=None, dtype=None):
@@ -231,6 +164,15 @@ def loadFileList(self, filelist, dynamic=False, fileindex=0):
             shape = (nRows, nCols, nbFiles * nImagesPerFile)
 
         #we can create the stack
+        if not dynamic:
+            needed_ = numpy.dtype(self.__dtype).itemsize
+            for item in shape:
+                needed_ *= item
+            physicalMemory = PhysicalMemory.getPhysicalMemoryOrNone()
+            if physicalMemory is not None:
+                # spare 5% of memory
+                if physicalMemory < (1.05 * needed_):
+                    dynamic = True
         if not dynamic:
             try:
                 data = numpy.zeros(shape,
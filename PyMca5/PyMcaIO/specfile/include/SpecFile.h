@@ -133,6 +133,12 @@ typedef struct _SpecFile{
   long           *data_info;
   SfCursor        cursor;
   short           updating;
+  long            size;          /* file size when last indexed */
+  ObjectList    **scans;         /* scans in file order */
+  long            no_entries;    /* number of entries in scans */
+  long           *scantable;     /* scan number and order hash table */
+  long            scantablesize;
+  short           useindex;      /* keep a persistent index file */
 } SpecFile;
 
 typedef struct _SpecFileOut{
@@ -249,6 +255,10 @@ DllExport extern int  SfGetMca  ( SpecFile *sf, long index, long mcano,
                                           double **retdata, int *error );
 DllExport extern long SfMcaCalib ( SpecFile *sf, long index, double **calib,
                                           int *error );
+DllExport extern long SfMcaOffsets ( SpecFile *sf, long index, long **offsets,
+                                          long **lengths, int *error );
+DllExport extern long SfParseMca ( char *from, long length, double *data,
+                                          long nchannels );
 
   /*
    * Write and write related functions
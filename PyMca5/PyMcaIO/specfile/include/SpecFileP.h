@@ -59,12 +59,22 @@
 #define   SF_TEMPERATURE     'X'
 #define   SF_MCA_DATA        '@'
 
+/*
+ * Slot of a scan number and order in the scan hash table
+ */
+#define   SF_SCAN_HASH(number, order, mask) \
+          ((((unsigned long) (number)) * 2654435761UL + \
+            ((unsigned long) (order)) * 40503UL) & (mask))
+
 /*
  * Library internal functions
  */
 extern  int        sfSetCurrent    ( SpecFile *sf,   long index, int *error);
 extern ObjectList *findScanByIndex ( ListHeader *list, long index );
 extern ObjectList *findScanByNo    ( ListHeader *list, long scan_no, long order );
+extern ObjectList *sfScanByIndex   ( SpecFile *sf, long index );
+extern ObjectList *sfScanByNo      ( SpecFile *sf, long scan_no, long order );
+extern ObjectList *sfFirstInFile   ( SpecFile *sf, long file_offset );
 extern void        freeArr         ( void ***ptr, long lines );
 extern void        freeAllData     ( SpecFile *sf );
 extern long        mulstrtod       ( char *str, double **arr, int *error );
@@ -215,7 +215,7 @@ SfIndex( SpecFile *sf, long number, long order )
 {
      ObjectList		*ptr;
 
-     ptr = findScanByNo( &(sf->list), number, order );
+     ptr = sfScanByNo( sf, number, order );
      if ( ptr != (ObjectList *)NULL )
         return( ((SpecScan *)(ptr->contents))->index );
 
@@ -362,7 +362,7 @@ SfNumberOrder( SpecFile *sf, long index, long *number, long *order )
      /*
       * Find scan .
       */
-     list = findScanByIndex( &(sf->list), index );
+     list = sfScanByIndex( sf, index );
      if ( list == (ObjectList *)NULL ) return( -1 );
 
      *number = ((SpecScan *)list->contents)->scan_no;
@@ -393,7 +393,7 @@ SfNumber( SpecFile *sf, long index  )
      /*
       * Find scan .
       */
-     list = findScanByIndex( &(sf->list), index );
+     list = sfScanByIndex( sf, index );
      if ( list == (ObjectList *)NULL ) return( -1 );
 
      return( ((SpecScan *)list->contents)->scan_no );
@@ -422,7 +422,7 @@ SfOrder( SpecFile *sf, long index  )
      /*
       * Find scan .
       */
-     list = findScanByIndex( &(sf->list), index );
+     list = sfScanByIndex( sf, index );
      if ( list == (ObjectList *)NULL ) return( -1 );
 
      return( ((SpecScan *)list->contents)->order );
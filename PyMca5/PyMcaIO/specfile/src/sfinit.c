@@ -120,6 +120,23 @@
 
 #define SF_ISFX      ".sfI"
 
+/*
+ * The persistent index file is written next to the spec file, therefore
+ * it is only used on request: the SPECFILE_INDEX_MINSIZE environment
+ * variable gives the minimum size of the files getting an index file
+ * (for instance 67108864 for files of 64 MB or more). A negative value,
+ * the default, disables it.
+ */
+#ifndef SPECFILE_INDEX_MINSIZE
+#define SPECFILE_INDEX_MINSIZE   (-1)
+#endif
+
+#ifdef _WINDOWS
+#define SF_INDEXFLAG O_CREAT | O_WRONLY | O_BINARY
+#else
+#define SF_INDEXFLAG O_CREAT | O_WRONLY
+#endif
+
 #define SF_INIT      0
 #define SF_READY     1
 #define SF_MODIFIED  2
@@ -135,11 +152,23 @@ DllExport short      SfUpdate ( SpecFile *sf, int *error);
 DllExport char     * SfError  ( int error);
 
 
-#ifdef linux
-char SF_SIGNATURE[] =  "Linux 2ruru Sf2.0";
-#else
-char SF_SIGNATURE[] =  "2ruru Sf2.0";
-#endif
+char SF_SIGNATURE[] =  "2ruru Sf3.0";
+
+/*
+ * Index file header. It is followed by the SpecScan structures of
+ * the scan list. The structures are written as they are in memory
+ * and their sizes are checked when reading.
+ */
+typedef struct _SfIndexHeader {
+    char      signature[32];
+    long      scansize;
+    long      cursorsize;
+    long      filesize;
+    long      m_time;
+    long      no_scans;
+    long      no_entries;
+    SfCursor  cursor;
+} SfIndexHeader;
 
 /*
  * Internal functions
@@ -153,11 +182,11 @@ static void  sfSaveScan    ( SpecFile *sf, SfCursor *cursor, int *error);
 static void  sfAssignScanNumbers (SpecFile *sf);
 static void  sfReadFile    ( SpecFile *sf, SfCursor *cursor, int *error);
 static void  sfResumeRead  ( SpecFile *sf, SfCursor *cursor, int *error);
-#ifdef SPECFILE_USE_INDEX_FILE
-static short sfOpenIndex   ( SpecFile *sf, SfCursor *cursor, int *error);
-static short sfReadIndex   ( int sfi, SpecFile *sf, SfCursor *cursor, int *error);
-static void  sfWriteIndex  ( SpecFile *sf, SfCursor *cursor, int *error);
-#endif
+static short sfIndexEnabled( SpecFile *sf);
+static char *sfIndexName   ( SpecFile *sf);
+static short sfOpenIndex   ( SpecFile *sf, SfCursor *cursor, long *nentries, int *error);
+static short sfReadIndex   ( int sfi, SpecFile *sf, SfCursor *cursor, long *nentries, int *error);
+static void  sfWriteIndex  ( SpecFile *sf, SfCursor *cursor, long first, int *error);
 
 /*
  * errors
@@ -251,6 +280,7 @@ SfOpen2(int fd, char *name,int *error) {
    short       idxret;
    SfCursor      cursor;
    struct stat mystat;
+   long        nentries = 0;
 
    if ( fd == -1 ) {
       *error = SF_ERR_FILE_OPEN;
@@ -271,6 +301,7 @@ SfOpen2(int fd, char *name,int *error) {
 
    sf->fd     = fd;
    sf->m_time = mystat.st_mtime;
+   sf->size   = mystat.st_size;
    sf->sfname = (char *)strdup(name);
 
    sf->list.first      = (ObjectList *)NULL;
@@ -291,6 +322,11 @@ SfOpen2(int fd, char *name,int *error) {
    sf->data            = (double **)NULL;
    sf->data_info       = (long *)NULL;
    sf->updating        = 0;
+   sf->scans           = (ObjectList **)NULL;
+   sf->no_entries      = 0;
+   sf->scantable       = (long *)NULL;
+   sf->scantablesize   = 0;
+   sf->useindex        = sfIndexEnabled(sf);
 
   /*
    * Init cursor
@@ -306,15 +342,15 @@ SfOpen2(int fd, char *name,int *error) {
    cursor.file_header  = 0;
 
 
-#ifdef SPECFILE_USE_INDEX_FILE
   /*
    * Check if index file
    *   open it and continue from there
    */
-   idxret = sfOpenIndex(sf,&cursor,error);
-#else
-   idxret = SF_INIT;
-#endif
+   if (sf->useindex) {
+       idxret = sfOpenIndex(sf,&cursor,&nentries,error);
+   } else {
+       idxret = SF_INIT;
+   }
 
    switch(idxret) {
       case SF_MODIFIED:
@@ -340,9 +376,12 @@ SfOpen2(int fd, char *name,int *error) {
    */
    sfAssignScanNumbers(sf);
 
-#ifdef SPECFILE_USE_INDEX_FILE
-   if (idxret != SF_READY) sfWriteIndex(sf,&cursor,error);
-#endif
+   if (sf->useindex && idxret != SF_READY) {
+       /*
+        * only the scans found after the indexed ones are written
+        */
+       sfWriteIndex(sf,&cursor,nentries > 0 ? nentries - 1 : 0,error);
+   }
    return(sf);
 }
 
@@ -378,6 +417,10 @@ SfClose( SpecFile *sf )
      }
 
      free ((char *)sf->sfname);
+     if (sf->scans != NULL)
+        free ((ObjectList **)sf->scans);
+     if (sf->scantable != NULL)
+        free ((long *)sf->scantable);
      if (sf->scanbuffer != NULL)
         free ((char *)sf->scanbuffer);
 
@@ -421,21 +464,30 @@ SfUpdate ( SpecFile *sf, int *error )
 {
     struct stat mystat;
     long   mtime;
+    long   nentries;
    /*printf("In SfUpdate\n");
    __asm("int3");*/
     stat(sf->sfname,&mystat);
 
     mtime = mystat.st_mtime;
 
-    if (sf->m_time != mtime)  {
+    if ((sf->m_time != mtime) || (sf->size != (long) mystat.st_size))  {
+      /*
+       * Only the last scan and the new ones are read
+       */
+       nentries = sf->no_entries;
        sfResumeRead (sf,&(sf->cursor),error);
        sfReadFile   (sf,&(sf->cursor),error);
 
        sf->m_time = mtime;
+       sf->size   = mystat.st_size;
        sfAssignScanNumbers(sf);
-#ifdef SPECFILE_USE_INDEX_FILE
-       sfWriteIndex (sf,&(sf->cursor),error);
-#endif
+       if (sf->useindex) {
+          sfWriteIndex (sf,&(sf->cursor),nentries > 0 ? nentries - 1 : 0,error);
+       } else if (sfIndexEnabled(sf)) {
+          sf->useindex = 1;
+          sfWriteIndex (sf,&(sf->cursor),0,error);
+       }
        return(1);
     }else{
        return(0);
@@ -541,104 +593,191 @@ sfResumeRead  ( SpecFile *sf, SfCursor *cursor, int *error) {
 }
 
 
-#ifdef SPECFILE_USE_INDEX_FILE
+/*********************************************************************
+ *
+ *   Function:          short sfIndexEnabled( sf )
+ *
+ *   Description:       Tells if a persistent index file has been
+ *                      requested and the file is big enough to keep it.
+ *
+ *********************************************************************/
 static short
-sfOpenIndex ( SpecFile *sf, SfCursor *cursor, int *error) {
+sfIndexEnabled ( SpecFile *sf ) {
+    char *env;
+    long  minsize;
+
+    minsize = SPECFILE_INDEX_MINSIZE;
+    env = getenv("SPECFILE_INDEX_MINSIZE");
+    if (env != NULL) minsize = atol(env);
+
+    return((minsize >= 0) && (sf->size >= minsize));
+}
+
+
+static char *
+sfIndexName ( SpecFile *sf ) {
     char *idxname;
-    short namelength;
-    int   sfi;
 
-    namelength = strlen(sf->sfname) + strlen(SF_ISFX) + 1;
+    idxname = (char *)malloc(sizeof(char) *
+                             (strlen(sf->sfname) + strlen(SF_ISFX) + 1));
+    if (idxname != NULL)
+        sprintf(idxname,"%s%s",sf->sfname,SF_ISFX);
+    return(idxname);
+}
 
-    idxname = (char *)malloc(sizeof(char) * namelength);
 
-    sprintf(idxname,"%s%s",sf->sfname,SF_ISFX);
+static short
+sfOpenIndex ( SpecFile *sf, SfCursor *cursor, long *nentries, int *error) {
+    char *idxname;
+    int   sfi;
+    short ret;
 
-    if ((sfi = open(idxname,SF_OPENFLAG)) == -1) {
-        free(idxname);
-        return(SF_INIT);
-    } else {
-        free(idxname);
-        return(sfReadIndex(sfi,sf,cursor,error));
-    }
+    if ((idxname = sfIndexName(sf)) == NULL) return(SF_INIT);
+
+    sfi = open(idxname,SF_OPENFLAG);
+    free(idxname);
+    if (sfi == -1) return(SF_INIT);
+
+    ret = sfReadIndex(sfi,sf,cursor,nentries,error);
+    close(sfi);
+    return(ret);
 }
 
-
+
+/*********************************************************************
+ *
+ *   Function:          short sfReadIndex( sfi, sf, cursor, nentries, error )
+ *
+ *   Description:       Reads the scan list from an index file.
+ *
+ *   Returns:
+ *                      SF_READY    => The file did not change
+ *                      SF_MODIFIED => The file grew. Reading has to
+ *                                     be resumed from the last scan.
+ *                      SF_INIT     => The index cannot be used
+ *
+ *********************************************************************/
 static short
-sfReadIndex   ( int sfi, SpecFile *sf, SfCursor *cursor, int *error) {
-    SfCursor   filecurs;
-    char       buffer[200];
-    long       bytesread,i=0;
-    SpecScan   scan;
-    short      modif = 0;
-    long       mtime;
+sfReadIndex   ( int sfi, SpecFile *sf, SfCursor *cursor, long *nentries, int *error) {
+    SfIndexHeader  header;
+    SpecScan      *scans;
+    char           start[2];
+    long           i, nbytes;
 
    /*
-    * read signature
+    * read and check header
     */
-    bytesread = read(sfi,buffer,sizeof(SF_SIGNATURE));
-    if (strcmp(buffer,SF_SIGNATURE) || bytesread == 0 ) {
+    if (read(sfi,&header,sizeof(SfIndexHeader)) != sizeof(SfIndexHeader))
+        return(SF_INIT);
+    header.signature[sizeof(header.signature) - 1] = '\0';
+    if (strcmp(header.signature,SF_SIGNATURE) ||
+        header.scansize   != (long) sizeof(SpecScan) ||
+        header.cursorsize != (long) sizeof(SfCursor) ||
+        header.no_entries < 0)
         return(SF_INIT);
-    }
 
    /*
-    * read cursor and specfile structure
+    * the index is valid if the file is the same or if data were appended
     */
-    if ( read(sfi,&mtime,   sizeof(long)) == 0)   return(SF_INIT);
-    if ( read(sfi,&filecurs, sizeof(SfCursor)) == 0) return(SF_INIT);
-
-    if (sf->m_time != mtime)  modif = 1;
+    if (header.filesize > sf->size) return(SF_INIT);
+    if (header.filesize == sf->size && header.m_time != sf->m_time)
+        return(SF_INIT);
+    if (header.filesize < sf->size && header.cursor.scanno > 0) {
+        /*
+         * reading is resumed at the last scan, it has to be there
+         */
+        lseek(sf->fd,header.cursor.cursor,SEEK_SET);
+        nbytes = read(sf->fd,start,2);
+        lseek(sf->fd,0,SEEK_SET);
+        if (nbytes != 2 || start[0] != '#' || start[1] != 'S')
+            return(SF_INIT);
+    }
 
-    while(read(sfi,&scan, sizeof(SpecScan))) {
-        addToList(&(sf->list), (void *)&scan, (long)sizeof(SpecScan));
-        i++;
+   /*
+    * read the scans
+    */
+    nbytes = header.no_entries * sizeof(SpecScan);
+    scans = (SpecScan *) malloc(nbytes > 0 ? nbytes : 1);
+    if (scans == NULL) return(SF_INIT);
+    if (read(sfi,scans,nbytes) != nbytes) {
+        free(scans);
+        return(SF_INIT);
     }
-    sf->no_scans = i;
+    for (i = 0; i < header.no_entries; i++) {
+        addToList(&(sf->list), (void *)&scans[i], (long)sizeof(SpecScan));
+    }
+    free(scans);
 
-    memcpy(cursor,&filecurs,sizeof(SfCursor));
+    sf->no_scans = header.no_scans;
+    *nentries = header.no_entries;
+    memcpy(cursor,&(header.cursor),sizeof(SfCursor));
 
-    if (modif) return(SF_MODIFIED);
+    if (header.filesize != sf->size) return(SF_MODIFIED);
 
     return(SF_READY);
 }
 
-
-static void
-sfWriteIndex  ( SpecFile *sf, SfCursor *cursor, int *error) {
 
-    int         fdi;
-    char       *idxname;
-    short       namelength;
-    ObjectList *obj;
-    long        mtime;
+/*********************************************************************
+ *
+ *   Function:          void sfWriteIndex( sf, cursor, first, error )
+ *
+ *   Description:       Writes the index file. Only the scans from
+ *                      list entry 'first' on are written, the previous
+ *                      ones are supposed to be already in the file.
+ *                      Errors are ignored, the index is just not kept.
+ *
+ *********************************************************************/
+static void
+sfWriteIndex  ( SpecFile *sf, SfCursor *cursor, long first, int *error) {
 
-    namelength = strlen(sf->sfname) + strlen(SF_ISFX) + 1;
+    int            fdi;
+    char          *idxname;
+    long           i;
+    SfIndexHeader  header;
 
-    idxname = (char *)malloc(sizeof(char) * namelength);
+    if (sf->scans == NULL) return;
 
-    sprintf(idxname,"%s%s",sf->sfname,SF_ISFX);
+    if ((idxname = sfIndexName(sf)) == NULL) return;
 
-    /* if ((fdi = open(idxname,SF_WRITEFLAG,SF_UMASK)) == -1) { */
-    if ((fdi = open(idxname,O_CREAT | O_WRONLY,SF_UMASK)) == -1) {
-        printf("    - cannot open. Error: (%d)\n",errno);
-        free(idxname);
-        return;
+    if (first == 0) {
+        fdi = open(idxname,SF_INDEXFLAG | O_TRUNC,SF_UMASK);
     } else {
-        mtime = sf->m_time;
-        write(fdi,SF_SIGNATURE,sizeof(SF_SIGNATURE));
- /*
-  * Swap bytes for linux
-  */
-        write(fdi, (void *) &mtime, sizeof(long));
-        write(fdi, (void *) cursor, sizeof(SfCursor));
-        for( obj = sf->list.first; obj ; obj = obj->next)
-           write(fdi,(void *) obj->contents, sizeof(SpecScan));
-        close(fdi);
-        free(idxname);
+        fdi = open(idxname,SF_INDEXFLAG,SF_UMASK);
+    }
+    free(idxname);
+    if (fdi == -1) {
+        sf->useindex = 0;
         return;
     }
+
+    memset(&header,0,sizeof(SfIndexHeader));
+    strncpy(header.signature,SF_SIGNATURE,sizeof(header.signature) - 1);
+    header.scansize   = sizeof(SpecScan);
+    header.cursorsize = sizeof(SfCursor);
+    header.filesize   = sf->size;
+    header.m_time     = sf->m_time;
+    header.no_scans   = sf->no_scans;
+    header.no_entries = sf->no_entries;
+    memcpy(&(header.cursor),cursor,sizeof(SfCursor));
+
+   /*
+    * scans first and header last: an interrupted write leaves an index
+    * describing a smaller file that will be completed when reading it
+    */
+    lseek(fdi,sizeof(SfIndexHeader) + first * sizeof(SpecScan),SEEK_SET);
+    for (i = first; i < sf->no_entries; i++) {
+        if (write(fdi,(void *) sf->scans[i]->contents,sizeof(SpecScan)) !=
+                                                      sizeof(SpecScan)) {
+            close(fdi);
+            return;
+        }
+    }
+    lseek(fdi,0,SEEK_SET);
+    write(fdi,(void *) &header,sizeof(SfIndexHeader));
+    close(fdi);
+    return;
 }
-#endif
 
 
 /*****************************************************************************
@@ -763,6 +902,8 @@ sfSaveScan(SpecFile *sf, SfCursor *cursor,int *error) {
     scan.hdafter_offset        = cursor->hdafoffset;
     scan.mcaspectra            = cursor->mcaspectra;
     scan.file_header           = cursor->file_header;
+    scan.scan_no               = -1;
+    scan.order                 = 0;
 
     if(sf->updating == 1){
         ptr = sf->list.last;
@@ -775,6 +916,7 @@ sfSaveScan(SpecFile *sf, SfCursor *cursor,int *error) {
         oldscan->hdafter_offset=scan.hdafter_offset;
         oldscan->mcaspectra=scan.mcaspectra;
         oldscan->file_header=scan.file_header;
+        oldscan->order=0;
         sf->updating=0;
     }else{
         addToList( &(sf->list), (void *)&scan, (long) sizeof(SpecScan));
@@ -782,10 +924,23 @@ sfSaveScan(SpecFile *sf, SfCursor *cursor,int *error) {
 }
 
 
+/*********************************************************************
+ *
+ *   Function:          void sfAssignScanNumbers( sf )
+ *
+ *   Description:       Reads the number of the scans not having one
+ *                      yet and assigns the scan orders. It builds the
+ *                      array of scans and the hash table giving the
+ *                      scan from its number and order, therefore the
+ *                      time needed does not grow with the square of
+ *                      the number of scans.
+ *
+ *********************************************************************/
 static void
 sfAssignScanNumbers(SpecFile *sf) {
 
   int                    size,i;
+  long                   nbytes,n;
   char                  *buffer,*ptr;
 
   char   buffer2[50];
@@ -794,28 +949,92 @@ sfAssignScanNumbers(SpecFile *sf) {
                         *object2;
   SpecScan              *scan,
                         *scan2;
+  long                  *last;
+  unsigned long          mask,slot,tablesize;
 
   size = 50;
   buffer = (char *) malloc(size);
 
+  n = 0;
   for ( object = (sf->list).first; object; object=object->next) {
+        n++;
         scan = (SpecScan *) object->contents;
+        if (scan->order > 0) continue;
 
         lseek(sf->fd,scan->offset,SEEK_SET);
-        read(sf->fd,buffer,size);
+        nbytes = read(sf->fd,buffer,size);
+        if (nbytes < 3) nbytes = 3;
         buffer[49] = '\0';
 
-        for ( ptr = buffer+3,i=0; *ptr != ' ';ptr++,i++) buffer2[i] = *ptr;
+        for ( ptr = buffer+3,i=0; ptr < buffer + nbytes && *ptr != ' ' && i < 49;
+                                                      ptr++,i++) buffer2[i] = *ptr;
 
         buffer2[i] = '\0';
 
         scan->scan_no = atol(buffer2);
+  }
+  free(buffer);
+
+  /*
+   * array of scans and hash table with at least twice the entries
+   */
+  if (sf->scans != NULL) free(sf->scans);
+  if (sf->scantable != NULL) free(sf->scantable);
+  sf->no_entries    = n;
+  sf->scantablesize = 0;
+  for (tablesize = 16; tablesize < 2 * (unsigned long) n; tablesize *= 2);
+  sf->scans     = (ObjectList **) malloc((n > 0 ? n : 1) * sizeof(ObjectList *));
+  sf->scantable = (long *) calloc(tablesize, sizeof(long));
+  last          = (long *) calloc(tablesize, sizeof(long));
+
+  if (sf->scans == NULL || sf->scantable == NULL || last == NULL) {
+     /*
+      * not enough memory, use the lists
+      */
+     if (sf->scans != NULL) free(sf->scans);
+     if (sf->scantable != NULL) free(sf->scantable);
+     if (last != NULL) free(last);
+     sf->scans      = (ObjectList **)NULL;
+     sf->scantable  = (long *)NULL;
+     sf->no_entries = 0;
+     for ( object = (sf->list).first; object; object=object->next) {
+        scan = (SpecScan *) object->contents;
         scan->order   = 1;
         for ( object2 = (sf->list).first; object2 != object; object2=object2->next) {
             scan2 = (SpecScan *) object2->contents;
             if (scan2->scan_no == scan->scan_no) scan->order++;
         }
+     }
+     return;
+  }
+  sf->scantablesize = tablesize;
+  mask = tablesize - 1;
+
+  n = 0;
+  for ( object = (sf->list).first; object; object=object->next, n++) {
+        sf->scans[n] = object;
+        scan = (SpecScan *) object->contents;
+
+       /*
+        * last scan with the same number gives the order
+        */
+        for (slot = SF_SCAN_HASH(scan->scan_no, 0, mask); last[slot];
+                                                  slot = (slot + 1) & mask) {
+            scan2 = (SpecScan *) sf->scans[last[slot] - 1]->contents;
+            if (scan2->scan_no == scan->scan_no) break;
+        }
+        if (last[slot]) {
+            scan->order = ((SpecScan *) sf->scans[last[slot] - 1]->contents)->order + 1;
+        } else {
+            scan->order = 1;
+        }
+        last[slot] = n + 1;
+
+        for (slot = SF_SCAN_HASH(scan->scan_no, scan->order, mask);
+                       sf->scantable[slot]; slot = (slot + 1) & mask);
+        sf->scantable[slot] = n + 1;
   }
+  free(last);
 }
 
 void
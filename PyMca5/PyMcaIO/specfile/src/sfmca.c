@@ -60,6 +60,8 @@
 
 #include <ctype.h>
 #include <stdlib.h>
+#include <string.h>
+#include <locale.h>
 /*
  * Define macro
  */
@@ -79,6 +81,10 @@ DllExport int  SfGetMca   ( SpecFile *sf, long index, long mcano,
                                           double **retdata, int *error );
 DllExport long SfMcaCalib ( SpecFile *sf, long index, double **calib,
                                           int *error );
+DllExport long SfMcaOffsets ( SpecFile *sf, long index, long **offsets,
+                                          long **lengths, int *error );
+DllExport long SfParseMca ( char *from, long length, double *data,
+                                          long nchannels );
 
 
 /*********************************************************************
@@ -334,3 +340,217 @@ SfMcaCalib ( SpecFile *sf, long index, double **calib, int *error )
      *calib = retdata;
      return(0);
 }
+
+
+/*********************************************************************
+ *   Function:        long SfMcaOffsets( sf, index, offsets, lengths, error )
+ *
+ *   Description:    Locates all the mca spectra of a scan in one pass.
+ *   Parameters:
+ *        Input :    (1) File pointer
+ *            (2) Index
+ *        Output:
+ *            (3) Offset of each spectrum from the beginning of the scan
+ *                (the current scan buffer)
+ *            (4) Number of characters of each spectrum, including
+ *                continuation lines
+ *            (5) error number
+ *   Returns:
+ *            Number of spectra ,
+ *            ( -1 ) => errors.
+ *   Possible errors:
+ *            SF_ERR_MEMORY_ALLOC
+ *            SF_ERR_SCAN_NOT_FOUND
+ *
+ *   Remark:  The memory allocated should be freed by the application
+ *
+ *********************************************************************/
+DllExport long
+SfMcaOffsets( SpecFile *sf, long index, long **offsets, long **lengths,
+                                                          int *error )
+{
+     long     headersize, nmca, n;
+     char    *ptr, *from, *to;
+     long    *off, *len;
+
+     *offsets = (long *)NULL;
+     *lengths = (long *)NULL;
+
+     if (sfSetCurrent(sf,index,error) == -1 )
+             return(-1);
+
+     nmca = ((SpecScan *)sf->current->contents)->mcaspectra;
+     headersize = ((SpecScan *)sf->current->contents)->data_offset
+                - ((SpecScan *)sf->current->contents)->offset;
+     from = sf->scanbuffer + headersize;
+     to   = sf->scanbuffer + ((SpecScan *)sf->current->contents)->size;
+
+     off = (long *)malloc(sizeof(long) * (nmca > 0 ? nmca : 1));
+     len = (long *)malloc(sizeof(long) * (nmca > 0 ? nmca : 1));
+     if (off == (long *)NULL || len == (long *)NULL) {
+         if (off != (long *)NULL) free(off);
+         if (len != (long *)NULL) free(len);
+         *error = SF_ERR_MEMORY_ALLOC;
+         return(-1);
+     }
+
+    /*
+     * same counting of '@' characters as SfGetMca
+     */
+     n = 0;
+     for (ptr = from; ptr < to && n < nmca; ptr++) {
+         if (*ptr != '@') continue;
+        /*
+         * skip the '@' and the following character
+         */
+         off[n] = (long) (ptr + 2 - sf->scanbuffer);
+         if (off[n] > (long) (to - sf->scanbuffer))
+             off[n] = (long) (to - sf->scanbuffer);
+         for (ptr = sf->scanbuffer + off[n]; ptr < to; ptr++) {
+             if (*ptr == '\n' && *(ptr-1) != MCA_CONT) break;
+         }
+         len[n] = (long) (ptr - sf->scanbuffer) - off[n];
+         n++;
+         if (ptr == to) break;
+     }
+
+     *offsets = off;
+     *lengths = len;
+     return(n);
+}
+
+
+/*
+ * Powers of ten exactly represented as doubles
+ */
+static const double sfPow10[] = {
+     1e0,  1e1,  1e2,  1e3,  1e4,  1e5,  1e6,  1e7,  1e8,  1e9, 1e10,
+    1e11, 1e12, 1e13, 1e14, 1e15, 1e16, 1e17, 1e18, 1e19, 1e20, 1e21, 1e22};
+
+
+static double
+sfMcaStrtod( const char *str )
+{
+     char        buffer[100];
+     char       *ptr;
+     const char *point;
+
+     point = localeconv()->decimal_point;
+     if (point == NULL || *point == '.' || *point == '\0' ||
+                                      strlen(str) >= sizeof(buffer))
+         return(strtod(str, NULL));
+     strcpy(buffer, str);
+     for (ptr = buffer; *ptr; ptr++)
+         if (*ptr == '.') *ptr = *point;
+     return(strtod(buffer, NULL));
+}
+
+
+/*********************************************************************
+ *   Function:        double sfMcaAtof( str )
+ *
+ *   Description:    Locale independent version of atof that does not
+ *                   change the locale, therefore it can be used from
+ *                   several threads. Numbers with up to 15 significant
+ *                   digits and exponents up to 22 (the usual mca data)
+ *                   are converted directly, the other ones by strtod
+ *                   after replacing the decimal point by the one of the
+ *                   current locale.
+ *
+ *********************************************************************/
+static double
+sfMcaAtof( const char *str )
+{
+     const char *ptr = str, *exppos;
+     double      mantissa = 0.0;
+     int         negative = 0, ndigits = 0, exponent = 0;
+     int         expvalue = 0, expnegative = 0;
+
+     if (*ptr == '-') {
+         negative = 1;
+         ptr++;
+     } else if (*ptr == '+') {
+         ptr++;
+     }
+     for ( ; isdigit(*ptr); ptr++) {
+         mantissa = mantissa * 10 + (*ptr - '0');
+         if (ndigits || *ptr != '0') ndigits++;
+     }
+     if (*ptr == '.') {
+         for (ptr++; isdigit(*ptr); ptr++) {
+             mantissa = mantissa * 10 + (*ptr - '0');
+             if (ndigits || *ptr != '0') ndigits++;
+             exponent--;
+         }
+     }
+     if (*ptr == 'e' || *ptr == 'E') {
+         exppos = ptr + 1;
+         if (*exppos == '-') {
+             expnegative = 1;
+             exppos++;
+         } else if (*exppos == '+') {
+             exppos++;
+         }
+         for ( ; isdigit(*exppos); exppos++)
+             if (expvalue < 10000)
+                 expvalue = expvalue * 10 + (*exppos - '0');
+         exponent += expnegative ? -expvalue : expvalue;
+     }
+     if (ndigits > 15 || exponent > 22 || exponent < -22) {
+         return(sfMcaStrtod(str));
+     }
+     if (exponent < 0) {
+         mantissa /= sfPow10[-exponent];
+     } else {
+         mantissa *= sfPow10[exponent];
+     }
+     return(negative ? -mantissa : mantissa);
+}
+
+
+/*********************************************************************
+ *   Function:        long SfParseMca( from, length, data, nchannels )
+ *
+ *   Description:    Converts the text of one mca spectrum as located
+ *                   by SfMcaOffsets. It does not use the SpecFile
+ *                   structure, therefore several spectra can be
+ *                   converted at the same time from different threads.
+ *   Parameters:
+ *        Input :    (1) Beginning of the spectrum values
+ *            (2) Number of characters
+ *            (4) Size of the data array
+ *        Output:
+ *            (3) Data array. Values beyond its size are not stored.
+ *   Returns:
+ *            Number of values found.
+ *
+ *********************************************************************/
+DllExport long
+SfParseMca( char *from, long length, double *data, long nchannels )
+{
+     char    strval[100];
+     char   *ptr, *to;
+     int     i = 0;
+     long    vals = 0;
+
+    /*
+     * same separators as SfGetMca, other characters are ignored
+     */
+     to = from + length;
+     for (ptr = from; ptr <= to; ptr++) {
+         if (ptr == to || *ptr == ' ' || *ptr == '\t' || *ptr == MCA_CONT
+                                                        || *ptr == '\n') {
+             if ( i ) {
+                 strval[i] = '\0';
+                 i = 0;
+                 if (vals < nchannels)
+                     data[vals] = sfMcaAtof(strval);
+                 vals++;
+             }
+         } else if (isnumber(*ptr) && i < 99) {
+             strval[i] = *ptr;
+             i++;
+         }
+     }
+     return(vals);
+}
@@ -82,6 +82,9 @@ int         findFirst       ( void *scan,   void *file_offset );
 ObjectList *findScanByIndex ( ListHeader *list, long index );
 ObjectList *findFirstInFile ( ListHeader *list, long file_offset );
 ObjectList *findScanByNo    ( ListHeader *list, long scan_no, long order );
+ObjectList *sfScanByIndex   ( SpecFile *sf, long index );
+ObjectList *sfScanByNo      ( SpecFile *sf, long scan_no, long order );
+ObjectList *sfFirstInFile   ( SpecFile *sf, long file_offset );
 
 long        mulstrtod       ( char *str,        double **arr, int *error );
 void        freeAllData     ( SpecFile *sf );
@@ -124,7 +127,7 @@ sfSetCurrent( SpecFile *sf, long index,int *error )
     /*
      * Find scan
      */
-     list = findScanByIndex(&(sf->list),index);
+     list = sfScanByIndex(sf,index);
 
      if (list == (ObjectList *)NULL) {
          *error = SF_ERR_SCAN_NOT_FOUND;
@@ -165,7 +168,7 @@ sfSetCurrent( SpecFile *sf, long index,int *error )
         if (sf->filebuffer != ( char * ) NULL) free(sf->filebuffer);
 
         start        = scan->file_header;
-        flist        = findFirstInFile(&(sf->list),scan->file_header);
+        flist        = sfFirstInFile(sf,scan->file_header);
         fscan        = flist->contents;
         fileheadsize = fscan->offset - start;
 
@@ -432,6 +435,106 @@ findFirstInFile( ListHeader *list, long file_offset )
      return findInList( list, findFirst, (void *)&file_offset );
 }
 
+
+/*********************************************************************
+ *   Function:		ObjectList *sfScanByIndex( sf, index )
+ *
+ *   Description:	Looks for a scan using the array of scans.
+ *
+ *   Parameters:
+ *		Input:	(1) SpecFile pointer
+ *			(2) scan index
+ *   Returns:
+ *			ObjectList pointer if found ,
+ *			NULL if not.
+ *
+ *********************************************************************/
+ObjectList *
+sfScanByIndex( SpecFile *sf, long index )
+{
+     ObjectList *ptr;
+
+     if ( sf->scans != (ObjectList **)NULL &&
+                               index > 0 && index <= sf->no_entries ) {
+          ptr = sf->scans[index-1];
+          if ( ((SpecScan *)ptr->contents)->index == index )
+               return( ptr );
+     }
+     return( findScanByIndex( &(sf->list), index ) );
+}
+
+
+/*********************************************************************
+ *   Function:		ObjectList *sfScanByNo( sf, scan_no, order )
+ *
+ *   Description:	Looks for a scan using the scan hash table.
+ *
+ *   Parameters:
+ *		Input:	(1) SpecFile pointer
+ *			(2) scan number
+ *			(3) scan order
+ *   Returns:
+ *			ObjectList pointer if found ,
+ *			NULL if not.
+ *
+ *********************************************************************/
+ObjectList *
+sfScanByNo( SpecFile *sf, long scan_no, long order )
+{
+     ObjectList    *ptr;
+     SpecScan      *scan;
+     unsigned long  mask, i;
+
+     if ( sf->scantable == (long *)NULL )
+          return( findScanByNo( &(sf->list), scan_no, order ) );
+
+     mask = sf->scantablesize - 1;
+     for ( i = SF_SCAN_HASH(scan_no, order, mask); sf->scantable[i];
+                                                   i = (i + 1) & mask ) {
+          ptr  = sf->scans[sf->scantable[i] - 1];
+          scan = (SpecScan *)ptr->contents;
+          if ( scan->scan_no == scan_no && scan->order == order )
+               return( ptr );
+     }
+     return( (ObjectList *)NULL );
+}
+
+
+/*********************************************************************
+ *   Function:		ObjectList *sfFirstInFile( sf, file_offset )
+ *
+ *   Description:	Looks for the first scan after a file offset
+ *			by bisection of the array of scans.
+ *
+ *   Parameters:
+ *		Input:	(1) SpecFile pointer
+ *			(2) file offset
+ *   Returns:
+ *			ObjectList pointer if found ,
+ *			NULL if not.
+ *
+ *********************************************************************/
+ObjectList *
+sfFirstInFile( SpecFile *sf, long file_offset )
+{
+     long  low, high, middle;
+
+     if ( sf->scans == (ObjectList **)NULL )
+          return( findFirstInFile( &(sf->list), file_offset ) );
+
+     low  = 0;
+     high = sf->no_entries;
+     while ( low < high ) {
+          middle = (low + high) / 2;
+          if ( ((SpecScan *)sf->scans[middle]->contents)->offset > file_offset )
+               high = middle;
+          else
+               low  = middle + 1;
+     }
+     if ( low == sf->no_entries ) return( (ObjectList *)NULL );
+     return( sf->scans[low] );
+}
+
 
 /*********************************************************************
  *   Function:        long mulstrtod( str, arr, error )
@@ -124,6 +124,12 @@ PERFORMANCE OF THIS SOFTWARE.
 
 #include <numpy/arrayobject.h>
 #include <SpecFile.h>
+#include <pythread.h>
+
+/*
+ * value returned by PyThread_start_new_thread on failure
+ */
+#define MCABLOCK_NO_THREAD ((unsigned long) -1)
 
 /*
  * Specfile exceptions
@@ -166,6 +172,9 @@ staticforward PyTypeObject Scandatatype;
     */
 
 static char           * compList(long *nolist,long howmany);
+static int              mcaBlockCheck(PyObject *out);
+static void             mcaBlockFill(char **from, long *length,
+                                 PyArrayObject *out, long nrows, int nthreads);
 
    /*
     * Specfile methods
@@ -180,6 +189,7 @@ static PyObject  * specfile_update    (PyObject *self,PyObject *args);
 static PyObject  * specfile_scanno    (PyObject *self,PyObject *args);
 static PyObject  * specfile_select    (PyObject *self,PyObject *args);
 static PyObject  * specfile_show      (PyObject *self,PyObject *args);
+static PyObject  * specfile_mcablock  (PyObject *self,PyObject *args);
 
 static struct PyMethodDef  specfile_methods[] =
 {
@@ -193,6 +203,7 @@ static struct PyMethodDef  specfile_methods[] =
    {"scanno",    specfile_scanno,    1},
    {"select",    specfile_select,    1},
    {"show",      specfile_show,      1},
+   {"mcablock",  specfile_mcablock,  1},
    { NULL, NULL}
 };
 
@@ -230,6 +241,7 @@ static PyObject   * scandata_header       (PyObject *self,PyObject *args);
 static PyObject   * scandata_fileheader   (PyObject *self,PyObject *args);
 static PyObject   * scandata_nbmca        (PyObject *self,PyObject *args);
 static PyObject   * scandata_mca          (PyObject *self,PyObject *args);
+static PyObject   * scandata_mcablock     (PyObject *self,PyObject *args);
 static PyObject   * scandata_show         (PyObject *self,PyObject *args);
 
 static struct PyMethodDef  scandata_methods[] = {
@@ -251,6 +263,7 @@ static struct PyMethodDef  scandata_methods[] = {
    {"fileheader",  scandata_fileheader,  1},
    {"nbmca",       scandata_nbmca,       1},
    {"mca",         scandata_mca,         1},
+   {"mcablock",    scandata_mcablock,    1},
    {"show",        scandata_show,        1},
    { NULL, NULL}
 };
@@ -509,6 +522,99 @@ specfile_show(PyObject *self,PyObject *args)
     return (Py_BuildValue("l",0));
 }
 
+static PyObject *
+specfile_mcablock(PyObject *self,PyObject *args)
+{
+    int       error, nthreads = 1;
+    long      mcano = 1, nrows, nmca, total, index, no, i;
+    long     *offsets, *lengths, *sizes = NULL;
+    char     *buffer = NULL, *text, **from = NULL;
+    PyObject *out, *indices, *item;
+    specfileobject *f = (specfileobject *)self;
+
+    if (!PyArg_ParseTuple(args,"OO|li",&out,&indices,&mcano,&nthreads))
+        return NULL;
+    if (mcaBlockCheck(out))
+        return NULL;
+    if (mcano == 0)
+        onError("mca numbering starts at 1");
+    indices = PySequence_Fast(indices, "Scan indices must be a sequence");
+    if (indices == NULL)
+        return NULL;
+
+    nrows = (long) PySequence_Fast_GET_SIZE(indices);
+    if (nrows > (long) PyArray_DIM((PyArrayObject *) out, 0))
+        nrows = (long) PyArray_DIM((PyArrayObject *) out, 0);
+
+    from = (char **) malloc(sizeof(char *) * (nrows > 0 ? nrows : 1));
+    sizes = (long *) malloc(sizeof(long) * (nrows > 0 ? nrows : 1));
+    if (from == NULL || sizes == NULL) {
+        PyErr_NoMemory();
+        goto fail;
+    }
+
+    /*
+     * collect a copy of the text of the requested spectra
+     */
+    total = 0;
+    for (i = 0; i < nrows; i++) {
+        item = PySequence_Fast_GET_ITEM(indices, i);
+        index = PyLong_AsLong(item);
+        if (index == -1 && PyErr_Occurred())
+            goto fail;
+        if (index < 0 || index >= f->length) {
+            PyErr_SetString(PyExc_IndexError,"scan out of bounds");
+            goto fail;
+        }
+        nmca = SfMcaOffsets(f->sf,index+1,&offsets,&lengths,&error);
+        if (nmca == -1) {
+            PyErr_SetString(ErrorObject, "cannot get mca for scan");
+            goto fail;
+        }
+        no = (mcano > 0) ? mcano - 1 : nmca + mcano;
+        if (no < 0 || no >= nmca) {
+            free(offsets);
+            free(lengths);
+            PyErr_SetString(ErrorObject, "mca not found in scan");
+            goto fail;
+        }
+        sizes[i] = lengths[no];
+        text = (char *) realloc(buffer, total + sizes[i] + 1);
+        if (text == NULL) {
+            free(offsets);
+            free(lengths);
+            PyErr_NoMemory();
+            goto fail;
+        }
+        buffer = text;
+        memcpy(buffer + total, f->sf->scanbuffer + offsets[no], sizes[i]);
+        total += sizes[i];
+        free(offsets);
+        free(lengths);
+    }
+    total = 0;
+    for (i = 0; i < nrows; i++) {
+        from[i] = buffer + total;
+        total += sizes[i];
+    }
+
+    mcaBlockFill(from, sizes, (PyArrayObject *) out, nrows, nthreads);
+
+    free(from);
+    free(sizes);
+    if (buffer != NULL)
+        free(buffer);
+    Py_DECREF(indices);
+    return Py_BuildValue("l",nrows);
+
+fail:
+    if (from != NULL) free(from);
+    if (sizes != NULL) free(sizes);
+    if (buffer != NULL) free(buffer);
+    Py_DECREF(indices);
+    return NULL;
+}
+
 
   /*
    * Basic specfiletype operations
@@ -1198,6 +1304,82 @@ scandata_mca      (PyObject *self,PyObject *args)
      */
 }
 
+static PyObject   *
+scandata_mcablock (PyObject *self,PyObject *args)
+{
+    int       error, nthreads = 1;
+    long      idx, first = 1, step = 1;
+    long      nmca, nrows, i, no, begin, end;
+    long     *offsets = NULL, *lengths = NULL;
+    char     *buffer, **from;
+    PyObject *out;
+
+    SpecFile *sf;
+
+    scandataobject *s = (scandataobject *) self;
+
+    if (!PyArg_ParseTuple(args,"O|lli",&out,&first,&step,&nthreads))
+        return NULL;
+    if (mcaBlockCheck(out))
+        return NULL;
+    if (first < 1 || step < 1)
+        onError("mca numbering starts at 1");
+
+    idx = s->index;
+    if (idx == -1 ) {
+        onError("empty scan data");
+    }
+
+    sf  = (s->file)->sf;
+
+    nmca = SfMcaOffsets(sf,idx,&offsets,&lengths,&error);
+    if (nmca == -1)
+        onError("cannot get mca for scan");
+
+    nrows = (long) PyArray_DIM((PyArrayObject *) out, 0);
+    if (first > nmca) {
+        nrows = 0;
+    } else if ((nmca - first) / step + 1 < nrows) {
+        nrows = (nmca - first) / step + 1;
+    }
+    if (nrows < 1) {
+        free(offsets);
+        free(lengths);
+        return Py_BuildValue("l",0L);
+    }
+
+    /*
+     * work on a copy of the text, the scan buffer can be
+     * replaced by other threads while the GIL is released
+     */
+    begin = offsets[first - 1];
+    no    = first - 1 + (nrows - 1) * step;
+    end   = offsets[no] + lengths[no];
+    buffer = (char *) malloc(end - begin + 1);
+    from = (char **) malloc(sizeof(char *) * nrows);
+    if (buffer == NULL || from == NULL) {
+        if (buffer != NULL) free(buffer);
+        if (from != NULL) free(from);
+        free(offsets);
+        free(lengths);
+        return PyErr_NoMemory();
+    }
+    memcpy(buffer, sf->scanbuffer + begin, end - begin);
+    for (i = 0; i < nrows; i++) {
+        no = first - 1 + i * step;
+        from[i] = buffer + offsets[no] - begin;
+        lengths[i] = lengths[no];
+    }
+    free(offsets);
+
+    mcaBlockFill(from, lengths, (PyArrayObject *) out, nrows, nthreads);
+
+    free(from);
+    free(lengths);
+    free(buffer);
+    return Py_BuildValue("l",nrows);
+}
+
 static PyObject   *
 scandata_show      (PyObject *self,PyObject *args)
 {
@@ -1543,3 +1725,156 @@ compList(long *nolist, long howmany)
      retstr = (char *)strdup(str);
      return(retstr);
 }
+
+/*
+ * Conversion of a block of mca spectra
+ */
+typedef struct {
+    char             **from;      /* text of each spectrum            */
+    long              *length;    /* number of characters of each one */
+    char              *out;       /* first row of the output array    */
+    npy_intp           stride;    /* bytes between output rows        */
+    int                type_num;  /* NPY_DOUBLE or NPY_FLOAT          */
+    long               nchannels;
+    long               first;     /* rows converted by this task      */
+    long               last;
+    PyThread_type_lock done;
+} mcablocktask;
+
+static void
+mcaBlockTask(void *arg)
+{
+    mcablocktask *task = (mcablocktask *) arg;
+    double *buffer = NULL;
+    double *data;
+    float  *fdata;
+    long    row, i, n;
+
+    if (task->type_num == NPY_FLOAT)
+        buffer = (double *) malloc(sizeof(double) * task->nchannels);
+    for (row = task->first; row < task->last; row++) {
+        if (task->type_num == NPY_DOUBLE) {
+            data = (double *) (task->out + row * task->stride);
+        } else if (buffer != NULL) {
+            data = buffer;
+        } else {
+            break;
+        }
+        n = SfParseMca(task->from[row], task->length[row], data,
+                                                     task->nchannels);
+        for (i = n; i < task->nchannels; i++)
+            data[i] = 0.0;
+        if (task->type_num == NPY_FLOAT) {
+            fdata = (float *) (task->out + row * task->stride);
+            for (i = 0; i < task->nchannels; i++)
+                fdata[i] = (float) data[i];
+        }
+    }
+    if (buffer != NULL)
+        free(buffer);
+    if (task->done != NULL)
+        PyThread_release_lock(task->done);
+}
+
+static int
+mcaBlockCheck(PyObject *out)
+{
+    PyArrayObject *array;
+
+    if (!PyArray_Check(out)) {
+        PyErr_SetString(PyExc_TypeError, "Output must be a numpy array");
+        return -1;
+    }
+    array = (PyArrayObject *) out;
+    if ((PyArray_NDIM(array) != 2) ||
+        ((PyArray_TYPE(array) != NPY_DOUBLE) &&
+         (PyArray_TYPE(array) != NPY_FLOAT)) ||
+        (PyArray_STRIDE(array, 1) != PyArray_ITEMSIZE(array)) ||
+        (!PyArray_ISWRITEABLE(array)) || (!PyArray_ISALIGNED(array))) {
+        PyErr_SetString(PyExc_ValueError,
+            "Output must be a writeable 2D float64 or float32 array with contiguous rows");
+        return -1;
+    }
+    return 0;
+}
+
+/*
+ * Fill the first nrows rows of out with the spectra. The GIL is released
+ * and the rows are distributed among nthreads threads.
+ */
+static void
+mcaBlockFill(char **from, long *length, PyArrayObject *out, long nrows,
+                                                              int nthreads)
+{
+    mcablocktask *tasks;
+    long  i, chunk;
+    int   started;
+
+    if (nrows < 1)
+        return;
+    if (nthreads > nrows)
+        nthreads = (int) nrows;
+    if (nthreads < 1)
+        nthreads = 1;
+    tasks = (mcablocktask *) malloc(sizeof(mcablocktask) * nthreads);
+    if (tasks == NULL)
+        nthreads = 0;
+    chunk = (nthreads > 0) ? (nrows + nthreads - 1) / nthreads : nrows;
+
+    Py_BEGIN_ALLOW_THREADS
+    if (nthreads == 0) {
+        mcablocktask single;
+        single.from = from;
+        single.length = length;
+        single.out = PyArray_BYTES(out);
+        single.stride = PyArray_STRIDE(out, 0);
+        single.type_num = PyArray_TYPE(out);
+        single.nchannels = (long) PyArray_DIM(out, 1);
+        single.first = 0;
+        single.last = nrows;
+        single.done = NULL;
+        mcaBlockTask(&single);
+    } else {
+        for (i = 0; i < nthreads; i++) {
+            tasks[i].from = from;
+            tasks[i].length = length;
+            tasks[i].out = PyArray_BYTES(out);
+            tasks[i].stride = PyArray_STRIDE(out, 0);
+            tasks[i].type_num = PyArray_TYPE(out);
+            tasks[i].nchannels = (long) PyArray_DIM(out, 1);
+            tasks[i].first = i * chunk;
+            tasks[i].last = (i + 1) * chunk;
+            if (tasks[i].last > nrows)
+                tasks[i].last = nrows;
+            tasks[i].done = NULL;
+            started = 0;
+            /* the calling thread takes the last block */
+            if (i < (nthreads - 1)) {
+                tasks[i].done = PyThread_allocate_lock();
+                if (tasks[i].done != NULL) {
+                    PyThread_acquire_lock(tasks[i].done, WAIT_LOCK);
+                    if (PyThread_start_new_thread(mcaBlockTask,
+                                          (void *) &tasks[i]) != MCABLOCK_NO_THREAD) {
+                        started = 1;
+                    } else {
+                        PyThread_release_lock(tasks[i].done);
+                        PyThread_free_lock(tasks[i].done);
+                        tasks[i].done = NULL;
+                    }
+                }
+            }
+            if (!started)
+                mcaBlockTask(&tasks[i]);
+        }
+        for (i = 0; i < nthreads; i++) {
+            if (tasks[i].done != NULL) {
+                PyThread_acquire_lock(tasks[i].done, WAIT_LOCK);
+                PyThread_release_lock(tasks[i].done);
+                PyThread_free_lock(tasks[i].done);
+            }
+        }
+    }
+    Py_END_ALLOW_THREADS
+    if (tasks != NULL)
+        free(tasks);
+}
@@ -35,8 +35,12 @@
 __doc__ = "This is a python module to measure image offsets"
 
 import os, time
+from multiprocessing.pool import ThreadPool
 import numpy
-from numpy.fft import fft2, ifft2, fftshift, ifftshift
+from numpy.fft import fft2, ifft2, rfft2, irfft2, fftshift, ifftshift
+from PyMca5.PyMcaMisc import ParallelTools
+# None means as many threads as CPUs
+NUMBER_OF_THREADS = None
 PYMCA = False
 SCIPY = False
 try:
@@ -214,3 +218,199 @@ def get_crop_indices(shape, shifts0, shifts1):
     d1_end = min(shape[1], numpy.floor(shape[1] + shifts1_min))
     return d0_start, d0_end, d1_start, d1_end
 
+
+def _get_frames(data, index, start, end, region=None):
+    """
+    Read the frames [start:end] of a stack as a [n_frames, d0, d1] array
+    :param data: 3D array like object (numpy array, h5py dataset, ...)
+    :param index: Index of the frames dimension (0 or 2)
+    :param region: Optional couple of slices to read only part of the frames
+    """
+    if region is None:
+        region = slice(None), slice(None)
+    if index == 0:
+        frames = data[start:end, region[0], region[1]]
+    else:
+        frames = numpy.transpose(data[region[0], region[1], start:end],
+                                 (2, 0, 1))
+    return numpy.array(frames, dtype=numpy.float64)
+
+def _get_blocks(nframes, frame_size, chunksize=None):
+    # limits of the blocks of frames processed at once by each thread
+    if chunksize is None:
+        chunksize = ParallelTools.CHUNK_SIZE
+    step = max(1, int(chunksize // (8 * max(frame_size, 1))))
+    return [(i, min(i + step, nframes)) for i in range(0, nframes, step)]
+
+def _map_blocks(function, blocks, nthreads=None, progress_callback=None):
+    # the FFTs release the GIL, so the blocks are shared among threads
+    if nthreads is None:
+        nthreads = ParallelTools.getNumberOfWorkers(NUMBER_OF_THREADS)
+    nthreads = max(1, min(nthreads, len(blocks)))
+    if nthreads > 1:
+        pool = ThreadPool(nthreads)
+        results = pool.imap(function, blocks)
+    else:
+        pool = None
+        results = (function(block) for block in blocks)
+    output = []
+    try:
+        for i, result in enumerate(results):
+            output.append(result)
+            if progress_callback is not None:
+                progress_callback((100. * (i + 1)) / len(blocks))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return output
+
+def measure_offsets_from_rffts(ref_rfft2, rffts2, shape):
+    """
+    Batched version of measure_offset_from_ffts taking real input FFTs.
+    :param ref_rfft2: rfft2 of the reference image
+    :param rffts2: [n_frames, d0, d1 // 2 + 1] array with the rfft2 of the frames
+    :param shape: Shape of the images
+    :return: [n_frames, 2] array with the offsets of the frames respect to the reference
+    """
+    absf0 = abs(ref_rfft2)
+    absf0[absf0 < 1.0e-20] = 1.0
+    absf1 = abs(rffts2)
+    absf1[absf1 < 1.0e-20] = 1.0
+    cross = (ref_rfft2 * rffts2.conjugate()) / (absf0 * absf1)
+    res = abs(fftshift(irfft2(cross, s=shape), axes=(-2, -1)))
+    nframes = res.shape[0]
+    frames = numpy.arange(nframes)
+    a = numpy.argmax(res.reshape(nframes, -1), axis=1)
+    a0 = a // shape[1]
+    a1 = a % shape[1]
+    resmax = res[frames, a0, a1]
+
+    # refine a bit the position
+    w = numpy.arange(-3, 4)
+    i = a0.reshape(-1, 1) + w
+    j = a1.reshape(-1, 1) + w
+    valid = ((i >= 0) & (i < shape[0]))[:, :, None] & \
+            ((j >= 0) & (j < shape[1]))[:, None, :]
+    i = numpy.clip(i, 0, shape[0] - 1)[:, :, None]
+    j = numpy.clip(j, 0, shape[1] - 1)[:, None, :]
+    tmp = res[frames.reshape(-1, 1, 1), i, j]
+    tmp = tmp * (valid & (tmp > 0.1 * resmax.reshape(-1, 1, 1)))
+    total = tmp.sum(axis=(1, 2))
+    offsets = numpy.zeros((nframes, 2), numpy.float64)
+    offsets[:, 0] = shape[0] // 2 - (tmp * i).sum(axis=(1, 2)) / total
+    offsets[:, 1] = shape[1] // 2 - (tmp * j).sum(axis=(1, 2)) / total
+    return offsets
+
+class StackRegistration(object):
+    def __init__(self, reference, offsets=None, widths=None, window=None):
+        """
+        Measure the offsets of the frames of a stack respect to a reference.
+        The reference FFT is calculated once and kept.
+        :param reference: 2D array, reference image
+        :param offsets: Origin of the region of the images to be used
+        :param widths: Size of the region of the images to be used
+        :param window: Apodization window of the size of the region. The default
+                       sets a margin of 10 pixels to zero.
+        """
+        if offsets is None:
+            offsets = [0, 0]
+        if widths is None:
+            widths = [reference.shape[0] - offsets[0],
+                      reference.shape[1] - offsets[1]]
+        self.region = (slice(int(offsets[0]), int(offsets[0] + widths[0])),
+                       slice(int(offsets[1]), int(offsets[1] + widths[1])))
+        image = numpy.array(reference[self.region[0], self.region[1]],
+                            dtype=numpy.float64)
+        self.shape = image.shape
+        if window is None:
+            apo = [10, 10]
+            window = numpy.zeros(self.shape, dtype=numpy.float64)
+            window[apo[0]:self.shape[0] - apo[0],
+                   apo[1]:self.shape[1] - apo[1]] = 1
+        self.window = window
+        self.referenceFFT = rfft2(image * window)
+
+    def calculate_shifts(self, data, index=0, nthreads=None, chunksize=None,
+                         progress_callback=None):
+        """
+        Measure the offsets of all the frames of a stack
+        :param data: 3D array like object (numpy array, h5py dataset, ...)
+        :param index: Index of the frames dimension (0 or 2)
+        :param nthreads: Number of threads. Default is the number of CPUs.
+        :param chunksize: Number of bytes of frames read at once
+        :param progress_callback: Function called with the progress percentage
+        :return: [n_frames, 2] array of offsets
+        """
+        if index < 0:
+            index += len(data.shape)
+        if index not in [0, 2]:
+            raise IndexError("Only stacks of images supported. Index should be 0 or 2")
+        def measure(block):
+            frames = _get_frames(data, index, block[0], block[1], self.region)
+            frames *= self.window
+            return measure_offsets_from_rffts(self.referenceFFT,
+                                              rfft2(frames),
+                                              self.shape)
+        blocks = _get_blocks(data.shape[index],
+                             self.shape[0] * self.shape[1],
+                             chunksize=chunksize)
+        shifts = _map_blocks(measure, blocks, nthreads=nthreads,
+                             progress_callback=progress_callback)
+        return numpy.concatenate(shifts, axis=0)
+
+def shift_stack(data, shifts, index=0, output=None, crop_window=True,
+                nthreads=None, chunksize=None, progress_callback=None):
+    """
+    Shift all the frames of a stack in the Fourier domain.
+    Each frame is shifted like shiftBilinear does.
+    :param data: 3D array like object (numpy array, h5py dataset, ...)
+    :param shifts: [n_frames, 2] array of shifts
+    :param index: Index of the frames dimension (0 or 2)
+    :param output: Optional [n_frames, d0, d1] array or dataset receiving the shifted
+                   frames. By default the stack itself is modified.
+    :param crop_window: Set to zero the region not covered by all the shifted frames
+    :param nthreads: Number of threads. Default is the number of CPUs.
+    :param chunksize: Number of bytes of frames processed at once
+    :param progress_callback: Function called with the progress percentage
+    """
+    if index < 0:
+        index += len(data.shape)
+    if index not in [0, 2]:
+        raise IndexError("Only stacks of images supported. Index should be 0 or 2")
+    shifts = numpy.asarray(shifts, dtype=numpy.float64)
+    if index == 0:
+        shape = data.shape[1], data.shape[2]
+    else:
+        shape = data.shape[0], data.shape[1]
+    if output is None:
+        output = data
+        outputIndex = index
+    else:
+        outputIndex = 0
+    window = None
+    if crop_window:
+        d0_start, d0_end, d1_start, d1_end = \
+                  get_crop_indices(shape, shifts[:, 0], shifts[:, 1])
+        window = numpy.zeros(shape, numpy.float64)
+        window[int(d0_start):int(d0_end), int(d1_start):int(d1_end)] = 1.0
+    f0 = numpy.fft.fftfreq(shape[0]).reshape(1, -1, 1)
+    f1 = numpy.fft.rfftfreq(shape[1]).reshape(1, 1, -1)
+    def shift(block):
+        start, end = block
+        frames = rfft2(_get_frames(data, index, start, end))
+        v0 = shifts[start:end, 0].reshape(-1, 1, 1)
+        v1 = shifts[start:end, 1].reshape(-1, 1, 1)
+        frames *= numpy.exp(2j * numpy.pi * (v0 * f0 + v1 * f1))
+        frames = irfft2(frames, s=shape)
+        if window is not None:
+            frames *= window
+        if outputIndex == 0:
+            output[start:end] = frames
+        else:
+            output[:, :, start:end] = numpy.transpose(frames, (1, 2, 0))
+    blocks = _get_blocks(data.shape[index], shape[0] * shape[1],
+                         chunksize=chunksize)
+    _map_blocks(shift, blocks, nthreads=nthreads,
+                progress_callback=progress_callback)
+    return output
@@ -30,8 +30,13 @@
 __contact__ = "sole@esrf.fr"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import threading
 import numpy
 from PyMca5 import SpecfitFuns
+from PyMca5.PyMcaMisc import ParallelTools
+
+# None means as many threads as CPUs
+NUMBER_OF_THREADS = None
 
 snip1d = SpecfitFuns.snip1d
 snip2d = SpecfitFuns.snip2d
@@ -48,75 +53,191 @@ def getSpectrumBackground(spectrum, width, roi_min=None, roi_max=None, smoothing
 
 getSnip1DBackground = getSpectrumBackground
 
-def subtractSnip1DBackgroundFromStack(stack, width, roi_min=None, roi_max=None,  smoothing=1):
-    if roi_min is None:
-        roi_min = 0
-    if roi_max is None:
-        roi_max = len(spectrum)
-    mcaIndex = -1
-    if hasattr(stack, "info") and hasattr(stack, "data"):
-        data = stack.data
-        mcaIndex = stack.info.get('McaIndex', -1)
+def _getMultipleSpectraBackground(spectra, width, anchorslist, filterwidth):
+    # spectra is a C-contiguous [n_spectra, n_channels] array of doubles
+    if filterwidth:
+        background = SpecfitFuns.SavitskyGolay(spectra, filterwidth)
     else:
-        data = stack
-    if not isinstance(data, numpy.ndarray):
-        raise TypeError("This Plugin only supports numpy arrays")
-    oldShape = data.shape
-    if mcaIndex in [-1, len(data.shape)-1]:
-        data.shape = -1, oldShape[-1]
-        if roi_min > 0:
-            data[:, 0:roi_min] = 0
-        if roi_max < oldShape[-1]:
-            data[:, roi_max:] = 0
-        for i in range(data.shape[0]):
-            data[i,roi_min:roi_max] -= snip1d(data[i,roi_min:roi_max],
-                                              width, smoothing)
-        data.shape = oldShape
+        background = spectra.copy()
+    nChannels = background.shape[-1]
+    lastAnchor = 0
+    if anchorslist is not None:
+        for anchor in anchorslist:
+            if (anchor > lastAnchor) and (anchor < nChannels):
+                background[:, lastAnchor:anchor] = \
+                        snip1d(background[:, lastAnchor:anchor], width, 0)
+                lastAnchor = anchor
+    if lastAnchor < nChannels:
+        background[:, lastAnchor:] = \
+                        snip1d(background[:, lastAnchor:], width, 0)
+    return background
+
+def getMultipleSpectraBackground(spectra, width, anchorslist=None,
+                                 filterwidth=None, mcaIndex=-1, nthreads=None):
+    """
+    Calculate the SNIP background of a set of spectra in one go.
 
+    :param spectra: 2D array of spectra
+    :param width: SNIP width
+    :param anchorslist: Optional list of channel indices acting as anchors
+    :param filterwidth: Optional Savitsky-Golay width applied prior to SNIP
+    :param mcaIndex: 0 for [n_channels, n_spectra] or -1 for [n_spectra, n_channels]
+    :param nthreads: Number of threads to share the spectra among. Default 1.
+    :return: Array of doubles with the same shape as the input spectra.
+    """
+    if len(spectra.shape) != 2:
+        raise ValueError("Expected a two dimensional array of spectra")
+    if mcaIndex in [-1, 1]:
+        data = numpy.ascontiguousarray(spectra, dtype=numpy.float64)
     elif mcaIndex == 0:
-        data.shape = oldShape[0], -1
-        for i in range(data.shape[-1]):
-            data[roi_min:roi_max, i] -= snip1d(data[roi_min:roi_max, i],
-                                               width, smoothing)
-        data.shape = oldShape
+        data = numpy.ascontiguousarray(spectra.T, dtype=numpy.float64)
     else:
         raise ValueError("Invalid 1D index %d" % mcaIndex)
-    return
+    if anchorslist is not None:
+        anchorslist = sorted(anchorslist)
+    nSpectra = data.shape[0]
+    if nthreads is None:
+        nthreads = 1
+    nthreads = max(1, min(int(nthreads), nSpectra))
+    if nthreads == 1:
+        background = _getMultipleSpectraBackground(data, width,
+                                                   anchorslist, filterwidth)
+    else:
+        # the C routines release the GIL, so threads do run concurrently
+        background = numpy.empty(data.shape, numpy.float64)
+        limits = numpy.linspace(0, nSpectra, nthreads + 1).astype(numpy.int64)
+        def worker(start, end):
+            background[start:end] = _getMultipleSpectraBackground( \
+                            data[start:end], width, anchorslist, filterwidth)
+        threadList = []
+        for i in range(nthreads):
+            t = threading.Thread(target=worker, args=(limits[i], limits[i + 1]))
+            t.start()
+            threadList.append(t)
+        for t in threadList:
+            t.join()
+    if mcaIndex == 0:
+        return background.T
+    return background
 
-def replaceStackWithSnip1DBackground(stack, width, roi_min=None, roi_max=None,  smoothing=1):
-    if roi_min is None:
-        roi_min = 0
-    if roi_max is None:
-        roi_max = len(spectrum)
+def _processSnip1DStack(stack, width, roi_min, roi_max, smoothing, replace,
+                        output=None, nthreads=None, chunksize=None):
     mcaIndex = -1
-    if hasattr(stack, "info") and hasattr(stack, "data"):
+    dataObject = hasattr(stack, "info") and hasattr(stack, "data")
+    if dataObject:
         data = stack.data
         mcaIndex = stack.info.get('McaIndex', -1)
     else:
         data = stack
-    if not isinstance(data, numpy.ndarray):
-        raise TypeError("This Plugin only supports numpy arrays")
-    oldShape = data.shape
-    if mcaIndex in [-1, len(data.shape)-1]:
-        data.shape = -1, oldShape[-1]
-        if roi_min > 0:
-            data[:, 0:roi_min] = 0
-        if roi_max < oldShape[-1]:
-            data[:, roi_max:] = 0
-        for i in range(data.shape[0]):
-            data[i,roi_min:roi_max] = snip1d(data[i,roi_min:roi_max],
-                                              width, smoothing)
-        data.shape = oldShape
+    shape = data.shape
+    ndim = len(shape)
+    if ndim < 2:
+        raise ValueError("Expected at least a two dimensional stack")
+    if mcaIndex < 0:
+        mcaIndex += ndim
+    if mcaIndex not in [0, ndim - 1]:
+        raise ValueError("Invalid 1D index %d" % mcaIndex)
+    nChannels = shape[mcaIndex]
+    if roi_min is None:
+        roi_min = 0
+    if roi_max is None:
+        roi_max = nChannels
+    if output is None:
+        inPlace = isinstance(data, numpy.ndarray) and \
+                  (not numpy.issubdtype(data.dtype, numpy.integer))
+        if inPlace:
+            output = data
+        elif dataObject or (not isinstance(data, numpy.ndarray)):
+            # dynamically loaded or integer stack, the result is kept
+            # in memory as floating point values
+            output = numpy.empty(shape,
+                            dtype=numpy.result_type(data.dtype, numpy.float32))
+            if dataObject:
+                stack.data = output
+        else:
+            raise TypeError("Integer stacks cannot hold the result, " + \
+                            "please give an output array")
+    elif tuple(output.shape) != tuple(shape):
+        raise ValueError("Output shape %s does not match stack shape %s" % \
+                         (output.shape, shape))
+    if nthreads is None:
+        nthreads = ParallelTools.getNumberOfWorkers(NUMBER_OF_THREADS)
+    if chunksize is None:
+        chunksize = ParallelTools.CHUNK_SIZE
 
-    elif mcaIndex == 0:
-        data.shape = oldShape[0], -1
-        for i in range(data.shape[-1]):
-            data[roi_min:roi_max, i] = snip1d(data[roi_min:roi_max, i],
-                                               width, smoothing)
-        data.shape = oldShape
+    # work on blocks of rows of the first spatial dimension
+    if mcaIndex == 0:
+        rowIndex = 1
     else:
-        raise ValueError("Invalid 1D index %d" % mcaIndex)
-    return
+        rowIndex = 0
+    nRows = shape[rowIndex]
+    rowSize = 8 * nChannels
+    for i in range(ndim):
+        if i not in [mcaIndex, rowIndex]:
+            rowSize *= shape[i]
+    step = max(1, int(chunksize // rowSize))
+    for start in range(0, nRows, step):
+        end = min(start + step, nRows)
+        if mcaIndex == 0:
+            block = numpy.asarray(data[:, start:end])
+            blockShape = block.shape
+            # one transposition per block instead of strided column access
+            spectra = numpy.ascontiguousarray( \
+                        block.reshape(nChannels, -1).T, dtype=numpy.float64)
+        else:
+            block = numpy.asarray(data[start:end])
+            blockShape = block.shape
+            spectra = numpy.array(block.reshape(-1, nChannels),
+                                  dtype=numpy.float64)
+        del block
+        background = snip1d(spectra[:, roi_min:roi_max], width,
+                            smoothing, 0, nthreads)
+        if replace:
+            spectra[:, roi_min:roi_max] = background
+        else:
+            spectra[:, roi_min:roi_max] -= background
+        if roi_min > 0:
+            spectra[:, 0:roi_min] = 0
+        if roi_max < nChannels:
+            spectra[:, roi_max:] = 0
+        if mcaIndex == 0:
+            output[:, start:end] = spectra.T.reshape(blockShape)
+        else:
+            output[start:end] = spectra.reshape(blockShape)
+    return output
+
+def subtractSnip1DBackgroundFromStack(stack, width, roi_min=None, roi_max=None,
+                                      smoothing=1, output=None, nthreads=None):
+    """
+    Subtract the SNIP background from all the spectra of a stack.
+
+    The stack is processed in blocks of (n_pixels, n_channels) spectra.
+
+    :param stack: DataObject or array. numpy arrays, memmaps and h5py datasets are supported.
+    :param width: SNIP width
+    :param roi_min: First channel considered. Channels below it are set to zero.
+    :param roi_max: Last channel considered. Channels above it are set to zero.
+    :param smoothing: Number of smoothing iterations
+    :param output: Optional array-like of the stack shape (memmap, h5py dataset, ...)
+                   receiving the result. By default floating point numpy stacks are
+                   modified in place. The data of DataObject stacks of integers are
+                   replaced by a floating point result, other integer arrays require
+                   an output.
+    :param nthreads: Number of threads to use. Default is the number of CPUs.
+    :return: The array containing the result
+    """
+    return _processSnip1DStack(stack, width, roi_min, roi_max, smoothing,
+                               False, output=output, nthreads=nthreads)
+
+def replaceStackWithSnip1DBackground(stack, width, roi_min=None, roi_max=None,
+                                     smoothing=1, output=None, nthreads=None):
+    """
+    Replace all the spectra of a stack by their SNIP background.
+
+    The arguments are the same as in subtractSnip1DBackgroundFromStack.
+    """
+    return _processSnip1DStack(stack, width, roi_min, roi_max, smoothing,
+                               True, output=output, nthreads=nthreads)
 
 
 def getImageBackground(image, width, roi_min=None, roi_max=None, smoothing=1):
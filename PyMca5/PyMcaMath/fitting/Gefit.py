@@ -47,7 +47,8 @@
 
 def LeastSquaresFit(model, parameters0, data=None, maxiter = 100,constrains=None,
                         weightflag = 0,model_deriv=None,deltachi=None,fulloutput=0,
-                        xdata=None,ydata=None,sigmadata=None,linear=None):
+                        xdata=None,ydata=None,sigmadata=None,linear=None,
+                        model_jacobian=None):
     """
     Typical use:
 
@@ -96,6 +97,10 @@ def LeastSquaresFit(model, parameters0, data=None, maxiter = 100,constrains=None
                       of the fitting parameters, index is the fitting parameter index of which the the derivative has
                       to be provided in the supplied array of x points.
 
+        model_jacobian - function providing all the derivatives at once. If given, it is used instead of
+                      model_deriv in non-linear fits. It will be called as model_jacobian(parameters, free_index, x)
+                      and it has to return an array of shape (len(free_index), len(x)).
+
         linear - Flag to indicate a linear fit instead of a non-linear. Default is non-linear fit (=false)
 
         maxiter - Maximum number of iterations (default is 100)
@@ -146,7 +151,8 @@ def LeastSquaresFit(model, parameters0, data=None, maxiter = 100,constrains=None
                                     fulloutput=fulloutput,
                                     xdata=xdata,
                                     ydata=ydata,
-                                    sigmadata=sigmadata)
+                                    sigmadata=sigmadata,
+                                    model_jacobian=model_jacobian)
         except TypeError:
             print("You should reconsider how to write your function")
             raise TypeError("You should reconsider how to write your function")
@@ -158,7 +164,8 @@ def LeastSquaresFit(model, parameters0, data=None, maxiter = 100,constrains=None
                                 fulloutput=fulloutput,
                                 xdata=xdata,
                                 ydata=ydata,
-                                sigmadata=sigmadata)
+                                sigmadata=sigmadata,
+                                model_jacobian=model_jacobian)
 
 def LinearLeastSquaresFit(model0,parameters0,data0,maxiter,
                                 constrains0,weightflag,model_deriv=None,deltachi=0.01,fulloutput=0,
@@ -286,7 +293,8 @@ def RestreinedLeastSquaresFit(model0,parameters0,data0,maxiter,
                 constrains0,weightflag,model_deriv=None,deltachi=0.01,fulloutput=0,
                                     xdata=None,
                                     ydata=None,
-                                    sigmadata=None):
+                                    sigmadata=None,
+                                    model_jacobian=None):
     #get the codes:
     # 0 = Free       1 = Positive     2 = Quoted
     # 3 = Fixed      4 = Factor       5 = Delta
@@ -387,7 +395,8 @@ def RestreinedLeastSquaresFit(model0,parameters0,data0,maxiter,
         chisq0, alpha0, beta,\
         n_free, free_index, noigno, fitparam, derivfactor  =ChisqAlphaBeta(
                                                  model,fittedpar,
-                                                 x,y,weight,constrains,model_deriv=model_deriv)
+                                                 x,y,weight,constrains,model_deriv=model_deriv,
+                                                 model_jacobian=model_jacobian)
         nr, nc = alpha0.shape
         flag = 0
         lastdeltachi = chisq0
@@ -463,7 +472,8 @@ def RestreinedLeastSquaresFit(model0,parameters0,data0,maxiter,
     else:
         return fittedpar.tolist(), chisq/(len(yfit)-len(sigma0)), sigmapar.tolist(),niter,lastdeltachi
 
-def ChisqAlphaBeta(model0, parameters, x,y,weight, constrains,model_deriv=None,linear=None):
+def ChisqAlphaBeta(model0, parameters, x,y,weight, constrains,model_deriv=None,linear=None,
+                   model_jacobian=None):
     if linear is None:linear=0
     model = model0
     #nr0, nc = data.shape
@@ -525,31 +535,36 @@ def ChisqAlphaBeta(model0, parameters, x,y,weight, constrains,model_deriv=None,l
     newpar = numpy.take(newpar,noigno)
     if n_free == 0:
         raise ValueError("No free parameters to fit")
-    for i in range(n_free):
-        if model_deriv is None:
-            #pwork = parameters.__copy__()
-            pwork [free_index[i]] = fitparam [i] + delta [i]
-            newpar = getparameters(pwork.tolist(),constrains)
-            newpar=numpy.take(newpar,noigno)
-            f1 = model(newpar, x)
-            pwork [free_index[i]] = fitparam [i] - delta [i]
-            newpar = getparameters(pwork.tolist(),constrains)
-            newpar=numpy.take(newpar,noigno)
-            f2 = model(newpar, x)
-            help0 = (f1-f2) / (2.0 * delta [i])
-            help0 = help0 * derivfactor[i]
-            pwork [free_index[i]] = fitparam [i]
-            #removed I resize outside the loop:
-            #help0 = numpy.resize(help0,(1,nr))
-        else:
-            newpar = getparameters(pwork.tolist(),constrains)
-            help0=model_deriv(pwork,free_index[i],x)
-            help0 = help0 * derivfactor[i]
+    if model_jacobian is not None:
+        newpar = getparameters(pwork.tolist(),constrains)
+        deriv = numpy.array(model_jacobian(pwork, free_index, x), numpy.float)
+        deriv = deriv * numpy.array(derivfactor).reshape(-1, 1)
+    else:
+        for i in range(n_free):
+            if model_deriv is None:
+                #pwork = parameters.__copy__()
+                pwork [free_index[i]] = fitparam [i] + delta [i]
+                newpar = getparameters(pwork.tolist(),constrains)
+                newpar=numpy.take(newpar,noigno)
+                f1 = model(newpar, x)
+                pwork [free_index[i]] = fitparam [i] - delta [i]
+                newpar = getparameters(pwork.tolist(),constrains)
+                newpar=numpy.take(newpar,noigno)
+                f2 = model(newpar, x)
+                help0 = (f1-f2) / (2.0 * delta [i])
+                help0 = help0 * derivfactor[i]
+                pwork [free_index[i]] = fitparam [i]
+                #removed I resize outside the loop:
+                #help0 = numpy.resize(help0,(1,nr))
+            else:
+                newpar = getparameters(pwork.tolist(),constrains)
+                help0=model_deriv(pwork,free_index[i],x)
+                help0 = help0 * derivfactor[i]
 
-        if i == 0 :
-            deriv = help0
-        else:
-            deriv = numpy.concatenate((deriv,help0), 0)
+            if i == 0 :
+                deriv = help0
+            else:
+                deriv = numpy.concatenate((deriv,help0), 0)
     #line added to resize outside the loop
     deriv=numpy.resize(deriv,(n_free,nr))
     if linear:
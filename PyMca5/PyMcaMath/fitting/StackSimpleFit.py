@@ -32,19 +32,150 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import sys
 import os
+import copy
+import multiprocessing
 import numpy
 from PyMca5.PyMcaIO import ConfigDict
 from . import SimpleFitModule
 from PyMca5.PyMcaIO import ArraySave
 from PyMca5 import PyMcaDirs
+from PyMca5.PyMcaMisc import ParallelTools
 
 DEBUG = 0
 
+# Number of processes used when none is given to StackSimpleFit.
+# Only one by default, None means as many processes as CPUs.
+NUMBER_OF_PROCESSES = 1
+
+# number of image rows fitted by a worker process in one go
+PROCESS_BLOCK_ROWS = 4
+
+_WORKER = {}
+
+def _initWorker(configuration):
+    # the fit is configured once per worker process
+    fit = SimpleFitModule.SimpleFit()
+    fit.setConfiguration(configuration, try_import=True)
+    _WORKER['fit'] = fit
+
+def _fitRowBlock(args):
+    return _fitBlock(_WORKER['fit'], *args)
+
+def _setStartValues(paramlist, values):
+    for param, value in zip(paramlist, values):
+        if param['code'] != 'IGNORE':
+            param['estimation'] = value
+
+def _fitBlock(fit, firstRow, x, y, sigma, xmin, xmax, mask, paramlist,
+              alwaysestimate=False, warmstart=False):
+    """
+    Fit the spectra of a block of rows y[row, column, :] and return the
+    first row, the fitted values, their uncertainties and the chi square.
+
+    Unless estimating every spectrum, the fit of the first spectrum starts
+    from the values of paramlist.
+    """
+    nRows, nColumns = y.shape[:2]
+    nParameters = len([param for param in paramlist \
+                       if param['code'] != 'IGNORE'])
+    values = numpy.zeros((nParameters, nRows, nColumns), numpy.float32)
+    sigmas = numpy.zeros((nParameters, nRows, nColumns), numpy.float32)
+    chisq = numpy.zeros((nRows, nColumns), numpy.float32)
+    warmStart = _WarmStart()
+    estimated = False
+    for row in range(nRows):
+        for column in range(nColumns):
+            if not mask[row, column]:
+                continue
+            if len(x.shape) == 1:
+                xPixel = x
+            else:
+                xPixel = x[row, column]
+            if sigma is None:
+                sigmaPixel = None
+            elif len(sigma.shape) == 1:
+                sigmaPixel = sigma
+            else:
+                sigmaPixel = sigma[row, column]
+            try:
+                fit.setData(xPixel, y[row, column], sigma=sigmaPixel,
+                            xmin=xmin, xmax=xmax)
+                if alwaysestimate or (not estimated):
+                    fit.estimate()
+                    estimated = True
+                    if not alwaysestimate:
+                        # every block starts from the same estimation
+                        fit.paramlist = copy.deepcopy(paramlist)
+                if (not alwaysestimate) and warmstart:
+                    startValues = warmStart.getValues(row)
+                    if startValues is not None:
+                        _setStartValues(fit.paramlist, startValues)
+                fit.startFit()
+            except:
+                print("Error %s processing row = %d column = %d" %\
+                        (sys.exc_info()[1], firstRow + row, column))
+                if DEBUG:
+                    raise
+                continue
+            fitted = [param for param in fit.paramlist \
+                      if param['code'] != 'IGNORE']
+            if len(fitted) != nParameters:
+                print("Inconsistent number of parameters row = %d column = %d" %\
+                        (firstRow + row, column))
+                continue
+            for i in range(nParameters):
+                values[i, row, column] = fitted[i]['fitresult']
+                sigmas[i, row, column] = fitted[i]['sigma']
+            chisq[row, column] = fit.getResult()['result']['chisq']
+            warmStart.update(row, fit.paramlist)
+    return firstRow, values, sigmas, chisq
+
+class _WarmStart(object):
+    """
+    Values to start a fit from: the solution of the left neighbour or, at
+    the beginning of a row, the one of the first fitted pixel of the row
+    above.
+    """
+    def __init__(self):
+        self._row = None
+        self._left = None
+        self._rowStart = None
+        self._above = None
+
+    def _newRow(self, row):
+        if row != self._row:
+            self._row = row
+            if self._rowStart is not None:
+                self._above = self._rowStart
+            self._left = None
+            self._rowStart = None
+
+    def getValues(self, row):
+        self._newRow(row)
+        if self._left is not None:
+            return self._left
+        return self._above
+
+    def update(self, row, paramlist):
+        self._newRow(row)
+        values = [param['fitresult'] for param in paramlist]
+        if self._left is None:
+            self._rowStart = values
+        self._left = values
+
 class StackSimpleFit(object):
-    def __init__(self, fit=None):
+    def __init__(self, fit=None, nprocesses=None):
         if fit is None:
             fit = SimpleFitModule.SimpleFit()
         self.fit = fit
+        # None means NUMBER_OF_PROCESSES. With more than one process the
+        # spectra are fitted in blocks by a pool of processes and the
+        # aboutToGetStackData, estimateFinished and fitFinished methods
+        # are not called.
+        self.nProcesses = nprocesses
+        # if set, start each fit from the solution of a neighbour pixel
+        # unless the configuration asks to estimate always
+        self.warmStart = False
         self.stack_y = None
         self.outputDir = PyMcaDirs.outputDir
         self.outputFile = None
@@ -52,6 +183,7 @@ def __init__(self, fit=None):
         self._progress = 0.0
         self._status = "Ready"
         self.progressCallback = None
+        self._specfileBuffer = None
         self.dataIndex = None
         # optimization variables
         self.mask = None
@@ -166,10 +298,22 @@ def processStack(self, mask=None):
 
         # initialize control variables
         self._parameters = None
+        self._warmStart = _WarmStart()
+        self._specfileBuffer = []
         self._row = 0
         self._column = -1
         self._progress = 0
         self._status = "Fitting"
+        nProcesses = self.nProcesses
+        if nProcesses is None:
+            nProcesses = ParallelTools.getNumberOfWorkers(NUMBER_OF_PROCESSES)
+        if self.fixedLenghtOutput and (nProcesses > 1):
+            self._processStackInBlocks(data, nProcesses)
+            self.onProcessStackFinished()
+            self._status = "Ready"
+            if self.progressCallback is not None:
+                self.progressCallback(nPixels, nPixels)
+            return
         for i in range(nPixels):
             self._progress = (i * 100.)/ nPixels
             if (self._column+1) == self._nColumns:
@@ -202,10 +346,128 @@ def processStackData(self, i):
             if DEBUG:
                 print("Estimation due to settings")
             self.fit.estimate()
+        elif self.warmStart:
+            startValues = self._warmStart.getValues(self._row)
+            if startValues is not None:
+                _setStartValues(self.fit.paramlist, startValues)
         self.estimateFinished()
         values, chisq, sigma, niter, lastdeltachi = self.fit.startFit()
+        self._warmStart.update(self._row, self.fit.paramlist)
         self.fitFinished()
 
+    def _processStackInBlocks(self, data, nProcesses):
+        """
+        Fit blocks of PROCESS_BLOCK_ROWS rows in a pool of processes and
+        store the results in the output images.
+
+        The fits are performed by the processes, therefore the methods
+        aboutToGetStackData, estimateFinished and fitFinished are not
+        called and reimplementing them has no effect.
+        """
+        rows, columns = numpy.nonzero(self.mask)
+        # the initial estimation is the one of the first pixel that can be
+        # fitted, the pixels failing to be fitted are skipped as when fitting
+        # one spectrum after the other
+        paramlist = None
+        for self._row, self._column in zip(rows, columns):
+            index = self._row * self._nColumns + self._column
+            try:
+                x, y, sigma, xmin, xmax = self.getFitInputValues(index)
+                self.fit.setData(x, y, sigma=sigma, xmin=xmin, xmax=xmax)
+                self.fit.estimate()
+                estimation = copy.deepcopy(self.fit.paramlist)
+                self.fit.startFit()
+                paramlist = estimation
+                break
+            except:
+                print("Error %s processing index = %d, row = %d column = %d" %\
+                        (sys.exc_info()[1], index, self._row, self._column))
+                if DEBUG:
+                    raise
+        if paramlist is None:
+            return
+        self._initOutputImages([param['name'] for param in paramlist \
+                                if param['code'] != 'IGNORE'])
+
+        data_index = self.stackDataIndexList[0]
+        stack_x = self.stack_x
+        if stack_x is None:
+            stack_x = numpy.arange(float(data.shape[data_index]))
+
+        # no need to send the widgets to the processes
+        configuration = self.fit.getConfiguration()
+        for key in configuration['functions']:
+            configuration['functions'][key]['widget'] = None
+        pool = multiprocessing.Pool(nProcesses,
+                                    initializer=_initWorker,
+                                    initargs=(configuration,))
+        try:
+            submittedList = []
+            for firstRow in range(0, self._nRows, PROCESS_BLOCK_ROWS):
+                lastRow = min(firstRow + PROCESS_BLOCK_ROWS, self._nRows)
+                mask = self.mask[firstRow:lastRow]
+                if not mask.any():
+                    continue
+                args = (firstRow,
+                        self._getBlockValues(stack_x, data.shape,
+                                             firstRow, lastRow),
+                        self._getRowBlock(data, firstRow, lastRow),
+                        self._getBlockValues(self.stack_sigma, data.shape,
+                                             firstRow, lastRow),
+                        self.xMin, self.xMax, mask, paramlist,
+                        self.__ALWAYS_ESTIMATE, self.warmStart)
+                submittedList.append(pool.apply_async(_fitRowBlock, (args,)))
+                # limit the number of blocks kept in memory
+                while len(submittedList) > (2 * nProcesses):
+                    self._storeBlockResult(submittedList.pop(0).get())
+            while len(submittedList):
+                self._storeBlockResult(submittedList.pop(0).get())
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def _getRowBlock(self, stack, firstRow, lastRow):
+        # spectra of the given rows as a (rows, columns, channels) array
+        data_index = self.stackDataIndexList[0]
+        if len(stack.shape) == 2:
+            block = numpy.asarray(stack[firstRow:lastRow])
+            block = block.reshape(block.shape[0], 1, block.shape[1])
+        elif data_index == 0:
+            block = numpy.asarray(stack[:, firstRow:lastRow, :])
+            block = block.transpose(1, 2, 0)
+        elif data_index == 1:
+            block = numpy.asarray(stack[firstRow:lastRow, :, :])
+            block = block.transpose(0, 2, 1)
+        else:
+            block = numpy.asarray(stack[firstRow:lastRow])
+        return numpy.ascontiguousarray(block)
+
+    def _getBlockValues(self, values, yShape, firstRow, lastRow):
+        # x or sigma values of a block, one for each spectrum or common
+        if values is None:
+            return None
+        if values.shape == yShape:
+            return self._getRowBlock(values, firstRow, lastRow)
+        nValues = yShape[self.stackDataIndexList[0]]
+        if values.size == nValues:
+            return numpy.array(values, copy=True).reshape(-1)
+        raise ValueError("Cannot handle incompatible values and y values")
+
+    def _storeBlockResult(self, result):
+        firstRow, values, sigmas, chisq = result
+        lastRow = firstRow + chisq.shape[0]
+        for i, parameter in enumerate(self._parameters):
+            self._images[parameter][firstRow:lastRow] = values[i]
+            self._sigmas[parameter][firstRow:lastRow] = sigmas[i]
+        self._images['chisq'][firstRow:lastRow] = chisq
+        nPixels = self._nRows * self._nColumns
+        self._progress = (lastRow * self._nColumns * 100.) / nPixels
+        if self.progressCallback is not None:
+            self.progressCallback(lastRow * self._nColumns, nPixels)
+
     def getFitInputValues(self, index):
         """
         Returns the fit parameters x, y, sigma, xmin, xmax
@@ -327,27 +589,7 @@ def fitFinished(self):
 
         if self.fixedLenghtOutput and (self._parameters is None):
             #If it is the first fit, initialize results array
-            imgdir = os.path.join(self.outputDir, "IMAGES")
-            if not os.path.exists(imgdir):
-                os.mkdir(imgdir)
-            if not os.path.isdir(imgdir):
-                msg= "%s does not seem to be a valid directory" % imgdir
-                raise IOError(msg)
-            self.imgDir = imgdir
-            self._parameters  = []
-            self._images      = {}
-            self._sigmas      = {}
-            for parameter in result['parameters']:
-                self._parameters.append(parameter)
-                self._images[parameter] = numpy.zeros((self._nRows,
-                                                       self._nColumns),
-                                                       numpy.float32)
-                self._sigmas[parameter] = numpy.zeros((self._nRows,
-                                                       self._nColumns),
-                                                       numpy.float32)
-            self._images['chisq'] = numpy.zeros((self._nRows,
-                                                       self._nColumns),
-                                                       numpy.float32)
+            self._initOutputImages(result['parameters'])
 
         if self.fixedLenghtOutput:
             i = 0
@@ -363,6 +605,29 @@ def fitFinished(self):
             specfile = self.getOutputFileNames()['specfile']
             self._appendOneResultToSpecfile(specfile, result=fitOutput)
 
+    def _initOutputImages(self, parameters):
+        imgdir = os.path.join(self.outputDir, "IMAGES")
+        if not os.path.exists(imgdir):
+            os.mkdir(imgdir)
+        if not os.path.isdir(imgdir):
+            msg= "%s does not seem to be a valid directory" % imgdir
+            raise IOError(msg)
+        self.imgDir = imgdir
+        self._parameters  = []
+        self._images      = {}
+        self._sigmas      = {}
+        for parameter in parameters:
+            self._parameters.append(parameter)
+            self._images[parameter] = numpy.zeros((self._nRows,
+                                                   self._nColumns),
+                                                   numpy.float32)
+            self._sigmas[parameter] = numpy.zeros((self._nRows,
+                                                   self._nColumns),
+                                                   numpy.float32)
+        self._images['chisq'] = numpy.zeros((self._nRows,
+                                                   self._nColumns),
+                                                   numpy.float32)
+
     def _appendOneResultToSpecfile(self, filename, result=None):
         if result is None:
             result = self.fit.getResult(configuration=False)
@@ -384,7 +649,11 @@ def _appendOneResultToSpecfile(self, filename, result=None):
         for parValue in fittedValues:
             text += "% .7E" % parValue
         text += "\n"
-        sf = open(filename, 'ab')
+        if self._specfileBuffer is not None:
+            # written at once when the stack is processed
+            self._specfileBuffer.append(text)
+            return
+        sf = open(filename, 'a')
         sf.write(text)
         sf.close()
 
@@ -399,12 +668,19 @@ def getOutputFileNames(self):
         ddict['specfile'] = specfile
         ddict['csv'] = csv
         ddict['edf'] = edf
+        if ArraySave.HDF5:
+            ddict['h5'] = filename + ".h5"
         return ddict
 
     def onProcessStackFinished(self):
         if DEBUG:
             print("Stack proccessed")
         self._status = "Stack Fitting finished"
+        if self._specfileBuffer:
+            sf = open(self.getOutputFileNames()['specfile'], 'a')
+            sf.write("".join(self._specfileBuffer))
+            sf.close()
+        self._specfileBuffer = None
         if self.fixedLenghtOutput:
             self._status = "Writing output files"
             nParameters = len(self._parameters)
@@ -430,6 +706,28 @@ def onProcessStackFinished(self):
                                            edfName,
                                            labels = labels,
                                            dtype=numpy.float32)
+            if 'h5' in filenames:
+                self._saveOutputAsHDF5(filenames['h5'])
+
+    def _saveOutputAsHDF5(self, filename):
+        # one dataset of each kind with the parameters as first dimension
+        nParameters = len(self._parameters)
+        shape = (nParameters, self._nRows, self._nColumns)
+        h5 = ArraySave.openHDF5File(filename, 'w')
+        try:
+            parameters = ArraySave.createHDF5Dataset(h5, "parameters",
+                                                     shape, numpy.float32)
+            uncertainties = ArraySave.createHDF5Dataset(h5, "uncertainties",
+                                                        shape, numpy.float32)
+            for i in range(nParameters):
+                parameter = self._parameters[i]
+                parameters[i] = self._images[parameter]
+                uncertainties[i] = self._sigmas[parameter]
+            h5["chisq"] = self._images['chisq']
+            h5["names"] = numpy.array([parameter.encode('utf-8') \
+                                       for parameter in self._parameters])
+        finally:
+            h5.close()
 
 def test():
     import numpy
@@ -32,6 +32,7 @@
 */
 #include <./numpy/arrayobject.h>
 #include <math.h>
+#include <pythread.h>
 
 #ifndef NPY_ARRAY_ENSURECOPY
 #define NPY_ARRAY_ENSURECOPY NPY_ENSURECOPY
@@ -76,8 +77,138 @@ void smooth2d(double *data, int size0, int size1);
 void smooth3d(double *data, int size0, int size1, int size2);
 /* end of SNIP related functions */
 
+double fastexp(double x);
+
 /* --------------------------------------------------------------------- */
 
+/*
+ * Threaded processing of independent rows (spectra or points)
+ */
+
+/* value returned by PyThread_start_new_thread on failure */
+#define SPECFIT_NO_THREAD ((unsigned long) -1)
+
+typedef struct {
+    void  (*function)(void *, npy_intp, npy_intp);
+    void   *arg;
+    npy_intp first;     /* rows handled by this task */
+    npy_intp last;
+    PyThread_type_lock done;
+} specfittask;
+
+static void
+specfitTask(void *arg)
+{
+    specfittask *task = (specfittask *) arg;
+
+    task->function(task->arg, task->first, task->last);
+    if (task->done != NULL)
+        PyThread_release_lock(task->done);
+}
+
+/*
+ * Call function(arg, first, last) on blocks of the nrows rows distributed
+ * among nthreads threads. It has to be called with the GIL released. The
+ * calling thread takes the last block and any block that could not be
+ * given to a new thread.
+ */
+static void
+specfitThreads(void (*function)(void *, npy_intp, npy_intp), void *arg,
+               npy_intp nrows, int nthreads)
+{
+    specfittask *tasks;
+    npy_intp chunk;
+    int i, started;
+
+    if (nrows < 1)
+        return;
+    if (nthreads > nrows)
+        nthreads = (int) nrows;
+    tasks = NULL;
+    if (nthreads > 1)
+        tasks = (specfittask *) malloc(sizeof(specfittask) * nthreads);
+    if (tasks == NULL){
+        function(arg, 0, nrows);
+        return;
+    }
+    chunk = (nrows + nthreads - 1) / nthreads;
+    for (i = 0; i < nthreads; i++){
+        tasks[i].function = function;
+        tasks[i].arg = arg;
+        tasks[i].first = MIN(i * chunk, nrows);
+        tasks[i].last = MIN((i + 1) * chunk, nrows);
+        tasks[i].done = NULL;
+        started = 0;
+        if (i < (nthreads - 1)){
+            tasks[i].done = PyThread_allocate_lock();
+            if (tasks[i].done != NULL){
+                PyThread_acquire_lock(tasks[i].done, WAIT_LOCK);
+                if (PyThread_start_new_thread(specfitTask,
+                                    (void *) &tasks[i]) != SPECFIT_NO_THREAD){
+                    started = 1;
+                }else{
+                    PyThread_release_lock(tasks[i].done);
+                    PyThread_free_lock(tasks[i].done);
+                    tasks[i].done = NULL;
+                }
+            }
+        }
+        if (!started)
+            specfitTask(&tasks[i]);
+    }
+    for (i = 0; i < nthreads; i++){
+        if (tasks[i].done != NULL){
+            PyThread_acquire_lock(tasks[i].done, WAIT_LOCK);
+            PyThread_release_lock(tasks[i].done);
+            PyThread_free_lock(tasks[i].done);
+        }
+    }
+    free(tasks);
+}
+
+/* --------------------------------------------------------------------- */
+
+typedef struct {
+    double *data;
+    int n_channels;
+    int width;
+    int smooth_iterations;
+    int llsflag;
+} snip1dtask;
+
+static void
+snip1dRows(void *arg, npy_intp first, npy_intp last)
+{
+    snip1dtask *task = (snip1dtask *) arg;
+    double *doublePointer;
+    npy_intp n;
+    int i;
+
+    for (n = first; n < last; n++)
+    {
+        doublePointer = task->data + n * task->n_channels;
+        for (i=0; i<task->smooth_iterations; i++)
+        {
+            smooth1d(doublePointer, task->n_channels);
+        }
+        if (task->llsflag)
+        {
+            lls(doublePointer, task->n_channels);
+        }
+    }
+
+    snip1d_multiple(task->data + first * task->n_channels, task->n_channels,
+                    task->width, (int) (last - first));
+
+    if (task->llsflag)
+    {
+        for (n = first; n < last; n++)
+        {
+            lls_inv(task->data + n * task->n_channels, task->n_channels);
+        }
+    }
+}
+
 static PyObject *
 SpecfitFuns_snip1d(PyObject *self, PyObject *args)
 {
@@ -85,11 +216,13 @@ SpecfitFuns_snip1d(PyObject *self, PyObject *args)
     double width0 = 50.;
     int smooth_iterations = 0;
     int llsflag = 0;
+    int nthreads = 1;
     PyArrayObject   *ret;
-    double *doublePointer;
-    int i, n, n_channels, n_spectra, width;
+    snip1dtask task;
+    int n_channels, n_spectra;
 
-    if (!PyArg_ParseTuple(args, "Od|ii", &input, &width0, &smooth_iterations, &llsflag))
+    if (!PyArg_ParseTuple(args, "Od|iii", &input, &width0, &smooth_iterations,
+                          &llsflag, &nthreads))
         return NULL;
 
     ret = (PyArrayObject *)
@@ -111,33 +244,16 @@ SpecfitFuns_snip1d(PyObject *self, PyObject *args)
         n_channels = (int) (PyArray_DIMS(ret)[1]);
     }
 
-    width = (int )width0;
-
-    for (n = 0; n < n_spectra; n++)
-    {
-        for (i=0; i<smooth_iterations; i++)
-        {
-            doublePointer = (double *) PyArray_DATA(ret);
-            smooth1d(&(doublePointer[n*n_channels]), n_channels);
-        }
-        if (llsflag)
-        {
-            doublePointer = (double *) PyArray_DATA(ret);
-            lls(&(doublePointer[n*n_channels]), n_channels);
-        }
-    }
+    task.data = (double *) PyArray_DATA(ret);
+    task.n_channels = n_channels;
+    task.width = (int) width0;
+    task.smooth_iterations = smooth_iterations;
+    task.llsflag = llsflag;
 
-
-    snip1d_multiple((double *) PyArray_DATA(ret), n_channels, width, n_spectra);
-
-    for (n = 0; n < n_spectra; n++)
-    {
-        if (llsflag)
-        {
-            doublePointer = (double *) PyArray_DATA(ret);
-            lls_inv(&(doublePointer[n*n_channels]), n_channels);
-        }
-    }
+    /* the spectra of a 2D input are shared among nthreads threads */
+    Py_BEGIN_ALLOW_THREADS
+    specfitThreads(snip1dRows, &task, n_spectra, nthreads);
+    Py_END_ALLOW_THREADS
 
     return PyArray_Return(ret);
 }
@@ -1074,11 +1190,57 @@ SpecfitFuns_splitgauss(PyObject *self, PyObject *args)
     return PyArray_Return(ret);
 }
 
+typedef struct {
+    double *px;
+    double *pret;
+    double *param;
+    int     npeaks;
+    int     tails;
+} peaktask;
+
+static void
+apvoigtRows(void *arg, npy_intp first, npy_intp last)
+{
+    peaktask *task = (peaktask *) arg;
+    double *ppvoigt;
+    double dhelp, sigma, tosigma, sqrt2PI;
+    npy_intp j;
+    int i;
+
+    sqrt2PI= sqrt(2.0*M_PI);
+    tosigma=1.0/(2.0*sqrt(2.0*0.69314718055994529));
+    for (j=first;j<last;j++){
+        /* area, centroid, fwhm, eta for each peak */
+        task->pret[j] = 0;
+        ppvoigt = task->param;
+        for (i=0;i<task->npeaks;i++){
+            dhelp = (task->px[j] - ppvoigt[1]) / (0.5 * ppvoigt[2]);
+            dhelp = 1.0 + (dhelp * dhelp);
+            task->pret[j] += ppvoigt[3] * \
+                (ppvoigt[0] / (0.5 * M_PI * ppvoigt[2] * dhelp));
+            ppvoigt += 4;
+        }
+        ppvoigt = task->param;
+        for (i=0;i<task->npeaks;i++){
+            sigma = ppvoigt[2] * tosigma;
+            dhelp = (task->px[j] - ppvoigt[1])/sigma;
+            if (dhelp <= 35) {
+                task->pret[j] += (1.0 - ppvoigt[3]) * \
+                    (ppvoigt[0]/(sigma*sqrt2PI)) \
+                    * exp (-0.5 * dhelp * dhelp);
+            }
+            ppvoigt += 4;
+        }
+    }
+}
+
 static PyObject *
 SpecfitFuns_apvoigt(PyObject *self, PyObject *args)
 {
     PyObject *input1, *input2;
     int debug=0;
+    int nthreads=1;
+    peaktask task;
     PyArrayObject   *param, *x;
     PyArrayObject   *ret;
     int nd_param, nd_x, npars;
@@ -1096,7 +1258,7 @@ SpecfitFuns_apvoigt(PyObject *self, PyObject *args)
     pvoigtian *ppvoigt;
 
     /** statements **/
-    if (!PyArg_ParseTuple(args, "OO|i", &input1,&input2,&debug))
+    if (!PyArg_ParseTuple(args, "OO|ii", &input1,&input2,&debug,&nthreads))
         return NULL;
 
     param = (PyArrayObject *)
@@ -1177,37 +1339,11 @@ SpecfitFuns_apvoigt(PyObject *self, PyObject *args)
             *pret += ppvoigt[i].eta * \
                 (ppvoigt[i].area / (0.5 * M_PI * ppvoigt[i].fwhm * dhelp));
         }
-    }else{
-        k = 1;
-        for (j=0;j<nd_x;j++){
-            k = (int) (dim_x [j] * k);
-        }
-        for (j=0;j<k;j++){
-            *pret = 0;
-            ppvoigt = (pvoigtian *) PyArray_DATA(param);
-            for (i=0;i<(npars/4);i++){
-            dhelp = (*px - ppvoigt[i].centroid) / (0.5 * ppvoigt[i].fwhm);
-            dhelp = 1.0 + (dhelp * dhelp);
-            *pret += ppvoigt[i].eta * \
-                (ppvoigt[i].area / (0.5 * M_PI * ppvoigt[i].fwhm * dhelp));
-            }
-            pret++;
-            px++;
-        }
-    }
 
-    /* The lorentzian term is calculated */
-    /* Now it has to calculate the gaussian term */
-    log2 = 0.69314718055994529;
-    sqrt2PI= sqrt(2.0*M_PI);
-    tosigma=1.0/(2.0*sqrt(2.0*log2));
-
-    /* the pointer to the starting position of par data */
-    px = (double *) PyArray_DATA(x);
-    pret = (double *) PyArray_DATA(ret);
-
-    if (nd_x == 0){
-        ppvoigt = (pvoigtian *) PyArray_DATA(param);
+        /* The gaussian term */
+        log2 = 0.69314718055994529;
+        sqrt2PI= sqrt(2.0*M_PI);
+        tosigma=1.0/(2.0*sqrt(2.0*log2));
         for (i=0;i<(npars/4);i++){
             sigma = ppvoigt[i].fwhm * tosigma;
             dhelp = (*px - ppvoigt[i].centroid)/sigma;
@@ -1222,24 +1358,16 @@ SpecfitFuns_apvoigt(PyObject *self, PyObject *args)
         for (j=0;j<nd_x;j++){
             k = (int) (dim_x [j] * k);
         }
-        for (j=0;j<k;j++){
-            ppvoigt = (pvoigtian *) PyArray_DATA(param);
-            for (i=0;i<(npars/4);i++){
-                sigma = ppvoigt[i].fwhm * tosigma;
-                dhelp = (*px - ppvoigt[i].centroid)/sigma;
-                if (dhelp <= 35) {
-                    *pret += (1.0 - ppvoigt[i].eta) * \
-                        (ppvoigt[i].area/(sigma*sqrt2PI)) \
-                        * exp (-0.5 * dhelp * dhelp);
-                }
-        }
-            pret++;
-            px++;
-        }
+        task.px = px;
+        task.pret = pret;
+        task.param = (double *) PyArray_DATA(param);
+        task.npeaks = npars/4;
+        task.tails = 0;
+        Py_BEGIN_ALLOW_THREADS
+        specfitThreads(apvoigtRows, &task, k, nthreads);
+        Py_END_ALLOW_THREADS
     }
 
-
-
     /* word done */
     Py_DECREF(param);
     Py_DECREF(x);
@@ -2848,13 +2976,93 @@ int i;
 }
 
 
+static void
+fastahypermetRows(void *arg, npy_intp first, npy_intp last)
+{
+    peaktask *task = (peaktask *) arg;
+    double erfc(double);
+    int g_term_flag, st_term_flag, lt_term_flag, step_term_flag;
+    double *phyper;
+    double sqrt2PI, tosigma, dhelp;
+    double x1, x2, x3, x4, x5, x6, x7, x8;
+    double z0, z1, z2;
+    npy_intp j;
+    int i;
+
+    g_term_flag    = task->tails & 1;
+    st_term_flag   = (task->tails>>1) & 1;
+    lt_term_flag   = (task->tails>>2) & 1;
+    step_term_flag = (task->tails>>3) & 1;
+    sqrt2PI= sqrt(2.0*M_PI);
+    tosigma=1.0/(2.0*sqrt(2.0*0.69314718055994529));
+
+    for (j=first;j<last;j++){
+        phyper = task->param;
+        for (i=0;i<task->npeaks;i++){
+            /* area, position, fwhm, st_area_r, st_slope_r, lt_area_r,
+               lt_slope_r, step_height_r for each peak */
+            x1 = phyper[0];
+            x2 = phyper[1];
+            x3 = phyper[2] * tosigma;
+            x4 = phyper[3];
+            x5 = phyper[4];
+            x6 = phyper[5];
+            x7 = phyper[6];
+            x8 = phyper[7];
+            phyper += 8;
+            z1 = x3 * 1.4142135623730950488;
+            z0 = task->px[j] - x2;
+            /* sigma = 0 already checked by the caller */
+            z2 = (0.5 * z0 * z0) / (x3 * x3);
+            if (z2 < 100){
+            if (g_term_flag){
+                    task->pret[j] += fastexp (-z2) * (x1/(x3*sqrt2PI));
+            }
+            }
+            /*include the short tail in the test is not a good idea */
+            if (st_term_flag){
+                if ((x5 != 0) && (x4 != 0)){
+                    dhelp = (z0/z1) + 0.5 * z1/x5;
+                    if (dhelp < 10){
+                        dhelp = x4 * 0.5 * erfc(dhelp);
+                        if (dhelp > 0){
+                        if (fabs(z0/x5) <= 612){
+                  task->pret[j] += ((x1 * dhelp)/x5) * fastexp(0.5 * (x3/x5) * (x3/x5) + (z0/x5));
+                        }
+                        }
+                    }
+                }
+            }
+            if (lt_term_flag){
+                if ((x7 != 0) && (x6 != 0)){
+                    dhelp = (z0/z1) + 0.5 * z1/x7;
+                    if (dhelp < 10){
+                        dhelp = x6 * 0.5 * erfc(dhelp);
+                    if (dhelp > 0){
+                        if (fabs(z0/x7) <= 612){
+                task->pret[j] += ((x1 * dhelp)/x7) * fastexp(0.5 * (x3/x7) * (x3/x7)+(z0/x7));
+                        }
+                    }
+                    }
+                }
+            }
+            if (step_term_flag){
+                if ((x8 != 0) && (x3 != 0)){
+                task->pret[j] +=  x8 * (x1/(x3*sqrt2PI)) * 0.5 * erfc(z0/z1);
+                }
+            }
+        }
+    }
+}
+
 static PyObject *
 SpecfitFuns_fastahypermet(PyObject *self, PyObject *args)
 {
     double erfc(double);
-    double fastexp(double);
     PyObject *input1, *input2;
     int debug=0;
+    int nthreads=1;
+    peaktask task;
     int tails=15;
     int expected_pars;
     int g_term_flag, st_term_flag, lt_term_flag, step_term_flag;
@@ -2882,7 +3090,7 @@ SpecfitFuns_fastahypermet(PyObject *self, PyObject *args)
     hypermet *phyper;
 
     /** statements **/
-    if (!PyArg_ParseTuple(args, "OO|ii", &input1,&input2,&tails,&debug))
+    if (!PyArg_ParseTuple(args, "OO|iii", &input1,&input2,&tails,&debug,&nthreads))
         return NULL;
 
     param = (PyArrayObject *)
@@ -3054,32 +3262,12 @@ printf("LT_Area=%f,LT_Slope=%f\n",phyper[i].lt_area_r,phyper[i].lt_slope_r);
             k = (int) (dim_x [j] * k);
         }
         phyper = (hypermet *) PyArray_DATA(param);
-        for (i=0;i<(npars/expected_pars);i++){
-          if (i == 0){
-                *pret = 0;
-          }else{
-            px = (double *) PyArray_DATA(x);
-            pret = (double *) PyArray_DATA(ret);
-          }
-          x1 = phyper[i].area;
-          x2 = phyper[i].position;
-          x3 = phyper[i].fwhm * tosigma;
-          x4 = phyper[i].st_area_r;
-          x5 = phyper[i].st_slope_r;
-          x6 = phyper[i].lt_area_r;
-          x7 = phyper[i].lt_slope_r;
-          x8 = phyper[i].step_height_r;
-          z1 = x3 * 1.4142135623730950488;
-          for (j=0;j<k;j++){
-            /* some intermediate variables */
-            z0 = *px - x2;
-            /*I should check for sigma = 0 */
-            if (x3 != 0) {
-                z2 = (0.5 * z0 * z0) / (x3 * x3);
-            }else{
+        /* sigma = 0 is checked before releasing the GIL */
+        for (i=0;(k > 0) && (i<(npars/expected_pars));i++){
+            if (phyper[i].fwhm * tosigma == 0) {
                 /* I should raise an exception */
                 printf("Linear Algebra Error: Division by zero\n");
-printf("Area=%f,Position=%f,FWHM=%f\n",x1,x2,phyper[i].fwhm);
+printf("Area=%f,Position=%f,FWHM=%f\n",phyper[i].area,phyper[i].position,phyper[i].fwhm);
 printf("ST_Area=%f,ST_Slope=%f\n",phyper[i].st_area_r,phyper[i].st_slope_r);
 printf("LT_Area=%f,LT_Slope=%f\n",phyper[i].lt_area_r,phyper[i].lt_slope_r);
                 Py_DECREF(param);
@@ -3087,49 +3275,15 @@ printf("LT_Area=%f,LT_Slope=%f\n",phyper[i].lt_area_r,phyper[i].lt_slope_r);
                 Py_DECREF(ret);
                 return NULL;
             }
-            if (z2 < 100){
-            if (g_term_flag){
-                   /* *pret += exp (-z2) * (x1/(x3*sqrt2PI));*/
-                    *pret += fastexp (-z2) * (x1/(x3*sqrt2PI));
-            }
-            }
-            /*include the short tail in the test is not a good idea */
-            if (st_term_flag){
-                if ((x5 != 0) && (x4 != 0)){
-                    dhelp = (z0/z1) + 0.5 * z1/x5;
-                    if (dhelp < 10){
-                        dhelp = x4 * 0.5 * erfc(dhelp);
-                        if (dhelp > 0){
-                        if (fabs(z0/x5) <= 612){
-                  *pret += ((x1 * dhelp)/x5) * fastexp(0.5 * (x3/x5) * (x3/x5) + (z0/x5));
-                        }
-                        }
-                    }
-                }
-            }
-            if (lt_term_flag){
-                if ((x7 != 0) && (x6 != 0)){
-                    dhelp = (z0/z1) + 0.5 * z1/x7;
-                    if (dhelp < 10){
-                        dhelp = x6 * 0.5 * erfc(dhelp);
-                    if (dhelp > 0){
-                        if (fabs(z0/x7) <= 612){
-                *pret += ((x1 * dhelp)/x7) * fastexp(0.5 * (x3/x7) * (x3/x7)+(z0/x7));
-                        }
-                    }
-                    }
-                }
-            }
-            if (step_term_flag){
-                if ((x8 != 0) && (x3 != 0)){
-                *pret +=  x8 * (x1/(x3*sqrt2PI)) * 0.5 * erfc(z0/z1);
-                }
-            }
-
-            pret++;
-            px++;
-         }
         }
+        task.px = px;
+        task.pret = pret;
+        task.param = (double *) PyArray_DATA(param);
+        task.npeaks = npars/expected_pars;
+        task.tails = tails;
+        Py_BEGIN_ALLOW_THREADS
+        specfitThreads(fastahypermetRows, &task, k, nthreads);
+        Py_END_ALLOW_THREADS
     }
 
     Py_DECREF(param);
@@ -3502,6 +3656,150 @@ double fasterf(double z)
     }
 }
 
+typedef struct {
+    PyArrayObject **xdata;
+    PyArrayObject  *ydata;
+    PyArrayObject  *result;
+    double         *xinter;
+    npy_intp        nd_y;
+    double          dummy;
+    int             error;
+} interpoltask;
+
+static void
+interpolRows(void *arg, npy_intp first, npy_intp last)
+{
+    interpoltask *task = (interpoltask *) arg;
+    PyArrayObject **xdata = task->xdata;
+    PyArrayObject *ydata = task->ydata;
+    PyArrayObject *result = task->result;
+    npy_intp nd_y = task->nd_y;
+    double dummy = task->dummy;
+    npy_intp i, j, k, l, jl, ju, offset, badpoint;
+    double  value, *nvalue, *x1, *x2, *factors;
+    double  dhelp, yresult;
+    npy_intp    index1, *points, *indices, max_points;
+    double *helppointer;
+
+    max_points = 1;
+    for (j=0; j< nd_y; j++){
+        max_points = max_points * 2;
+    }
+    points  = malloc(max_points * nd_y * sizeof(npy_intp));
+    indices = malloc(nd_y * sizeof(npy_intp));
+    factors = malloc(nd_y * sizeof(double));
+    if ((points == NULL) || (indices == NULL) || (factors == NULL)){
+        task->error = 1;
+        if (points != NULL) free(points);
+        if (indices != NULL) free(indices);
+        if (factors != NULL) free(factors);
+        return;
+    }
+    for (i=0;i<nd_y;i++){
+        indices[i] = -1;
+    }
+    helppointer = task->xinter + first * nd_y;
+
+    for (i=first;i<last;i++){
+        badpoint = 0;
+        for (j=0; j< nd_y; j++){
+            index1 = -1;
+            if (badpoint == 0){
+                value = *helppointer++;
+                k=PyArray_DIMS(xdata[j])[0] - 1;
+                nvalue = (double *) (PyArray_BYTES(xdata[j]) + k * (PyArray_STRIDES(xdata[j])[0]));
+                /* test against other version
+                valueold = PyFloat_AsDouble(
+                    PySequence_Fast_GET_ITEM(PySequence_Fast_GET_ITEM(xinter0,i),j));
+                if ( fabs(valueold-value) > 0.00001){
+                    printf("i = %d, j= %d, oldvalue = %.5f, newvalue = %.5f\n",i,j,valueold, value);
+                }
+                */
+                if (value > *nvalue){
+                    badpoint = 1;
+                }else{
+                    nvalue = (double *) (PyArray_DATA(xdata[j]));
+                    if (value < *nvalue){
+                         badpoint = 1;
+                    }
+                }
+                if (badpoint == 0){
+                    if (1){
+                        k = PyArray_DIMS(xdata[j])[0];
+                        jl = -1;
+                        ju = k-1;
+                        if (badpoint == 0){
+                            while((ju-jl) > 1){
+                                k = (ju+jl)/2;
+                                nvalue = (double *) (PyArray_BYTES(xdata[j]) + k * (PyArray_STRIDES(xdata[j])[0]));
+                                if (value >= *nvalue){
+                                    jl=k;
+                                }else{
+                                    ju=k;
+                                }
+                            }
+                            index1=jl;
+                        }
+                    }
+                    if (index1 < 0){
+                        badpoint = 1;
+                    }else{
+                        x1 = (double *) (PyArray_BYTES(xdata[j])+ index1 * (PyArray_STRIDES(xdata[j])[0]));
+                        x2 = (double *) (PyArray_BYTES(xdata[j])+(index1+1) * (PyArray_STRIDES(xdata[j])[0]));
+                        factors[j] = (value - *x1) / (*x2 - *x1);
+                        indices[j] = index1;
+                    }
+                }
+            }else{
+                helppointer++;
+            }
+        }
+        if (badpoint == 1){
+            yresult = dummy;
+        }else{
+          for (k=0;k<(max_points * nd_y);k++){
+                j = k % nd_y;
+                if (nd_y > 1){
+                    l = k /(2 * (nd_y - j) );
+                }else{
+                    l = k;
+                }
+                if ( (l % 2 ) == 0){
+                    points[k] = indices[j];
+                }else{
+                    points[k] = indices[j] + 1;
+                }
+             /*   printf("l = %d ,points[%d] = %d\n",l,k,points[k]);*/
+          }
+        /* the points to interpolate */
+          yresult = 0.0;
+          for (k=0;k<max_points;k++){
+            dhelp =1.0;
+            offset = 0;
+            for (j=0;j<nd_y;j++){
+                if (nd_y > 1){
+                    l = ((nd_y * k) + j) /(2 * (nd_y - j) );
+                }else{
+                    l = ((nd_y * k) + j);
+                }
+                offset += points[(nd_y * k) + j] * (PyArray_STRIDES(ydata)[j]);
+                /*printf("factors[%d] = %g\n",j,factors[j]);*/
+                if ((l % 2) == 0){
+                    dhelp = (1.0 - factors[j]) * dhelp;
+                }else{
+                    dhelp =  factors[j] * dhelp;
+                }
+            }
+            yresult += *((double *) (PyArray_BYTES(ydata) + offset)) * dhelp;
+          }
+        }
+       *((double *) (PyArray_BYTES(result) + i*PyArray_STRIDES(result)[0])) =  yresult;
+    }
+    free(points);
+    free(indices);
+    free(factors);
+}
+
 static PyObject *
 SpecfitFuns_interpol(PyObject *self, PyObject *args)
 {
@@ -3512,19 +3810,18 @@ SpecfitFuns_interpol(PyObject *self, PyObject *args)
 
     /* local variables */
     PyArrayObject    *ydata, *result, **xdata, *xinter;
-    npy_intp i, j, k, l, jl, ju, offset, badpoint;
-    double  value, *nvalue, *x1, *x2, *factors;
-    double  dhelp, yresult;
+    npy_intp i, j;
     double  dummy = -1.0;
-    npy_intp    nd_y, nd_x, index1, *points, *indices, max_points;
+    int     nthreads = 1;
+    interpoltask task;
+    npy_intp    nd_y, nd_x;
     /*int         dimensions[1];*/
     npy_intp npoints;
     npy_intp dimensions[2];
     npy_intp dim_xinter[2];
-    double *helppointer;
 
     /* statements */
-    if (!PyArg_ParseTuple(args, "OOO|d", &xinput, &yinput,&xinter0,&dummy)){
+    if (!PyArg_ParseTuple(args, "OOO|di", &xinput, &yinput,&xinter0,&dummy,&nthreads)){
         printf("Parsing error\n");
         return NULL;
     }
@@ -3631,124 +3928,26 @@ SpecfitFuns_interpol(PyObject *self, PyObject *args)
     }
 
     npoints = PyArray_DIMS(xinter)[0];
-    helppointer = (double *) PyArray_DATA(xinter);
-/*    printf("npoints = %d\n",npoints);
-    printf("ndimensions y  = %d\n",nd_y);
-*/
-    /* Parse the points to interpolate */
-    /* find the points to interpolate */
-    max_points = 1;
-    for (j=0; j< nd_y; j++){
-        max_points = max_points * 2;
-    }
-    points  = malloc(max_points * nd_y * sizeof(npy_intp));
-    indices = malloc(nd_y * sizeof(npy_intp));
-    for (i=0;i<nd_y;i++){
-        indices[i] = -1;
-    }
-    factors = malloc(nd_y * sizeof(double));
     dimensions [0] = npoints;
 
     result = (PyArrayObject *) PyArray_SimpleNew(1,dimensions,NPY_DOUBLE);
-
-    for (i=0;i<npoints;i++){
-        badpoint = 0;
-        for (j=0; j< nd_y; j++){
-            index1 = -1;
-            if (badpoint == 0){
-                value = *helppointer++;
-                k=PyArray_DIMS(xdata[j])[0] - 1;
-                nvalue = (double *) (PyArray_BYTES(xdata[j]) + k * (PyArray_STRIDES(xdata[j])[0]));
-                /* test against other version
-                valueold = PyFloat_AsDouble(
-                    PySequence_Fast_GET_ITEM(PySequence_Fast_GET_ITEM(xinter0,i),j));
-                if ( fabs(valueold-value) > 0.00001){
-                    printf("i = %d, j= %d, oldvalue = %.5f, newvalue = %.5f\n",i,j,valueold, value);
-                }
-                */
-                if (value > *nvalue){
-                    badpoint = 1;
-                }else{
-                    nvalue = (double *) (PyArray_DATA(xdata[j]));
-                    if (value < *nvalue){
-                         badpoint = 1;
-                    }
-                }
-                if (badpoint == 0){
-                    if (1){
-                        k = PyArray_DIMS(xdata[j])[0];
-                        jl = -1;
-                        ju = k-1;
-                        if (badpoint == 0){
-                            while((ju-jl) > 1){
-                                k = (ju+jl)/2;
-                                nvalue = (double *) (PyArray_BYTES(xdata[j]) + k * (PyArray_STRIDES(xdata[j])[0]));
-                                if (value >= *nvalue){
-                                    jl=k;
-                                }else{
-                                    ju=k;
-                                }
-                            }
-                            index1=jl;
-                        }
-                    }
-                    if (index1 < 0){
-                        badpoint = 1;
-                    }else{
-                        x1 = (double *) (PyArray_BYTES(xdata[j])+ index1 * (PyArray_STRIDES(xdata[j])[0]));
-                        x2 = (double *) (PyArray_BYTES(xdata[j])+(index1+1) * (PyArray_STRIDES(xdata[j])[0]));
-                        factors[j] = (value - *x1) / (*x2 - *x1);
-                        indices[j] = index1;
-                    }
-                }
-            }else{
-                helppointer++;
-            }
-        }
-        if (badpoint == 1){
-            yresult = dummy;
-        }else{
-          for (k=0;k<(max_points * nd_y);k++){
-                j = k % nd_y;
-                if (nd_y > 1){
-                    l = k /(2 * (nd_y - j) );
-                }else{
-                    l = k;
-                }
-                if ( (l % 2 ) == 0){
-                    points[k] = indices[j];
-                }else{
-                    points[k] = indices[j] + 1;
-                }
-             /*   printf("l = %d ,points[%d] = %d\n",l,k,points[k]);*/
-          }
-        /* the points to interpolate */
-          yresult = 0.0;
-          for (k=0;k<max_points;k++){
-            dhelp =1.0;
-            offset = 0;
-            for (j=0;j<nd_y;j++){
-                if (nd_y > 1){
-                    l = ((nd_y * k) + j) /(2 * (nd_y - j) );
-                }else{
-                    l = ((nd_y * k) + j);
-                }
-                offset += points[(nd_y * k) + j] * (PyArray_STRIDES(ydata)[j]);
-                /*printf("factors[%d] = %g\n",j,factors[j]);*/
-                if ((l % 2) == 0){
-                    dhelp = (1.0 - factors[j]) * dhelp;
-                }else{
-                    dhelp =  factors[j] * dhelp;
-                }
-            }
-            yresult += *((double *) (PyArray_BYTES(ydata) + offset)) * dhelp;
-          }
+    if (result != NULL){
+        /* the points are shared among nthreads threads */
+        task.xdata = xdata;
+        task.ydata = ydata;
+        task.result = result;
+        task.xinter = (double *) PyArray_DATA(xinter);
+        task.nd_y = nd_y;
+        task.dummy = dummy;
+        task.error = 0;
+        Py_BEGIN_ALLOW_THREADS
+        specfitThreads(interpolRows, &task, npoints, nthreads);
+        Py_END_ALLOW_THREADS
+        if (task.error){
+            Py_DECREF(result);
+            result = (PyArrayObject *) PyErr_NoMemory();
         }
-       *((double *) (PyArray_BYTES(result) + i*PyArray_STRIDES(result)[0])) =  yresult;
     }
-    free(points);
-    free(indices);
-    free(factors);
     for (i=0;i<nd_y;i++){
         Py_DECREF(xdata[i]);
     }
@@ -3925,6 +4124,7 @@ SpecfitFuns_voxelize(PyObject *self, PyObject *args)
     grid_pointerd = (double *) PyArray_DATA(grid);
     hits_pointer = (int *) PyArray_DATA(hits);
 
+    Py_BEGIN_ALLOW_THREADS
     for (i=0;i<npoints;i++){
         if (use_datathreshold){
             if ((double) (*(data_pointer+i)) <= data_threshold)
@@ -3955,6 +4155,7 @@ SpecfitFuns_voxelize(PyObject *self, PyObject *args)
             *(hits_pointer+grid_position) += 1;
         }
     }
+    Py_END_ALLOW_THREADS
     Py_DECREF(grid);
     Py_DECREF(hits);
     Py_DECREF(ydata);
@@ -4025,6 +4226,7 @@ SpecfitFuns_pileup(PyObject *self, PyObject *args)
     px = (double *) PyArray_DATA(x);
     pret = (double *) PyArray_DATA(ret);
 
+    Py_BEGIN_ALLOW_THREADS
     if(1){
         *pret = 0;
         k = (int )(zero/gain);
@@ -4042,41 +4244,117 @@ SpecfitFuns_pileup(PyObject *self, PyObject *args)
             px++;
         }
     }
+    Py_END_ALLOW_THREADS
 
     Py_DECREF(x);
     return PyArray_Return(ret);
 }
 
 
+typedef struct {
+    double *data;
+    double *coeff;
+    double den;
+    int n;
+    int npoints;
+    int error;
+} savitskygolaytask;
+
+static void
+SavitskyGolayRows(void *arg, npy_intp first, npy_intp last)
+{
+    savitskygolaytask *task = (savitskygolaytask *) arg;
+    int n = task->n;
+    int npoints = task->npoints;
+    int m = (int) (npoints/2);
+    int i, j;
+    npy_intp k;
+    double  dhelp;
+    double  *data;
+    double  *output;
+
+    /*one does not need the whole spectrum buffer, but code is clearer */
+    data = (double *) malloc(n * sizeof(double));
+    if (data == NULL)
+    {
+        task->error = 1;
+        return;
+    }
+
+    for (k = first; k < last; k++)
+    {
+        /* do the job */
+        output = task->data + k * n;
+
+        /* simple smoothing at the beginning */
+        for (j=0; j<=(int)(npoints/3); j++)
+        {
+            smooth1d(output, m);
+        }
+
+        /* simple smoothing at the end */
+        for (j=0; j<=(int)(npoints/3); j++)
+        {
+            smooth1d((output+n-m-1), m);
+        }
+
+        memcpy(data, output, n * sizeof(double));
+
+        /* the actual SG smoothing in the middle */
+        for (i=m; i<(n-m); i++){
+            dhelp = 0;
+            for (j=-m;j<=m;j++) {
+                dhelp += task->coeff[m+j] * (*(data+i+j));
+            }
+            if(dhelp > 0.0){
+                *(output+i) = dhelp / task->den;
+            }
+        }
+    }
+    free(data);
+}
+
 static PyObject *
 SpecfitFuns_SavitskyGolay(PyObject *self, PyObject *args)
 {
     PyObject *input;
     PyArrayObject *ret;
     int n, npoints;
+    int n_spectra;
+    int nthreads = 1;
     double dpoints = 5.;
     double coeff[MAX_SAVITSKY_GOLAY_WIDTH];
-    int i, j, m;
-    double  dhelp, den;
-    double  *data;
-    double  *output;
+    int i, m;
+    double  den;
+    savitskygolaytask task;
 
-    if (!PyArg_ParseTuple(args, "O|d", &input, &dpoints))
+    if (!PyArg_ParseTuple(args, "O|di", &input, &dpoints, &nthreads))
         return NULL;
 
     ret = (PyArrayObject *)
-             PyArray_FROMANY(input, NPY_DOUBLE, 1, 1, NPY_ARRAY_ENSURECOPY);
+             PyArray_FROMANY(input, NPY_DOUBLE, 1, 2, NPY_ARRAY_ENSURECOPY);
 
     if (ret == NULL){
-        printf("Cannot create 1D array from input\n");
+        printf("Cannot create 1D or 2D array from input\n");
         return NULL;
     }
     npoints = (int )  dpoints;
     if (!(npoints % 2)) npoints +=1;
 
-    n = (int) PyArray_DIMS(ret)[0];
+    /* a 2D input is treated as a set of spectra [n_spectra, n_channels] */
+    if (PyArray_NDIM(ret) == 1)
+    {
+        n_spectra = 1;
+        n = (int) PyArray_DIMS(ret)[0];
+    }
+    else
+    {
+        n_spectra = (int) PyArray_DIMS(ret)[0];
+        n = (int) PyArray_DIMS(ret)[1];
+    }
 
-    if((npoints < MIN_SAVITSKY_GOLAY_WIDTH) ||  (n < npoints))
+    if((npoints < MIN_SAVITSKY_GOLAY_WIDTH) ||  (n < npoints) || \
+       (npoints > MAX_SAVITSKY_GOLAY_WIDTH))
     {
         /* do not smooth data */
         return PyArray_Return(ret);
@@ -4090,36 +4368,22 @@ SpecfitFuns_SavitskyGolay(PyObject *self, PyObject *args)
         coeff[m-i] = coeff[m+i];
     }
 
-    /* do the job */
-    output = (double *) PyArray_DATA(ret);
-
-    /* simple smoothing at the beginning */
-    for (j=0; j<=(int)(npoints/3); j++)
-    {
-        smooth1d(output, m);
-    }
+    task.data = (double *) PyArray_DATA(ret);
+    task.coeff = coeff;
+    task.den = den;
+    task.n = n;
+    task.npoints = npoints;
+    task.error = 0;
 
-    /* simple smoothing at the end */
-    for (j=0; j<=(int)(npoints/3); j++)
+    /* the spectra of a 2D input are shared among nthreads threads */
+    Py_BEGIN_ALLOW_THREADS
+    specfitThreads(SavitskyGolayRows, &task, n_spectra, nthreads);
+    Py_END_ALLOW_THREADS
+    if (task.error)
     {
-        smooth1d((output+n-m-1), m);
+        Py_DECREF(ret);
+        return PyErr_NoMemory();
     }
-
-    /*one does not need the whole spectrum buffer, but code is clearer */
-    data = (double *) malloc(n * sizeof(double));
-    memcpy(data, output, n * sizeof(double));
-
-    /* the actual SG smoothing in the middle */
-    for (i=m; i<(n-m); i++){
-        dhelp = 0;
-        for (j=-m;j<=m;j++) {
-            dhelp += coeff[m+j] * (*(data+i+j));
-        }
-        if(dhelp > 0.0){
-            *(output+i) = dhelp / den;
-        }
-    }
-    free(data);
     return PyArray_Return(ret);
 
 }
@@ -4218,6 +4482,9 @@ initSpecfitFuns(void)
     }
     import_array();
 
+    /* fill the fastexp table before any thread can use it */
+    fastexp(0.0);
+
 #if PY_MAJOR_VERSION >= 3
     return module;
 #endif
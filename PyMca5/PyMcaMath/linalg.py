@@ -30,6 +30,7 @@
 __contact__ = "sole@esrf.fr"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import sys
 import numpy
 __doc__ = """
 Similar function to the numpy lstsq function with a more rigorous uncertainty
@@ -41,7 +42,7 @@
 
 def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
           uncertainties=True, covariances=False, digested_output=False, svd=True,
-          last_svd=None):
+          last_svd=None, chisq=False):
     """
     Return the least-squares solution to a linear matrix equation.
 
@@ -85,6 +86,9 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
 
     digested_output: If True, returns a dictionnary with explicit keys
 
+    chisq: If True, the reduced chi-square of each fitted column of `b` is
+           returned under the key 'chisq' of the digested output.
+
     Returns
     -------
     x : ndarray, shape (N,) or (N, K)
@@ -230,8 +234,7 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
         # it could be made by the calling routine, because it is equivalent to supplying a
         # different model and different independent values ...
         # That way one could avoid calculating U, s, V each time
-        A = a / weight
-        b = b / weight
+        A = a / w.reshape(-1, 1)
         # get the SVD decomposition of the A matrix
         if last_svd is not None:
             U, s, V = last_svd
@@ -247,7 +250,7 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
         # and get the parameters
         s.shape = -1
         dummy = numpy.dot(V.T, numpy.eye(n)*(1./s))
-        parameters = numpy.dot(dummy, numpy.dot(U.T, b))
+        parameters = numpy.dot(dummy, numpy.dot(U.T, b / w.reshape(-1, 1)))
         parameters.shape = n, b.shape[1]
         if uncertainties or covariances:
             _covariance = numpy.dot(dummy, dummy.T)
@@ -281,29 +284,33 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
                     if covariances:
                         covarianceMatrix[i] = _covariance
         elif 1:
-            # Pure matrix inversion (faster than SVD)
-            # I do not seem to gain anything by re-using the storage
-            #alpha = numpy.empty((n, n), numpy.float)
-            #beta = numpy.empty((n, 1), numpy.float)
-            for i in range(b_shape[1]):
-                tmpWeight = w[:, i:i+1]
-                A = a / tmpWeight
-                tmpData =  b[:, i:i+1] / tmpWeight
-                #numpy.dot(A.T, A, alpha)
-                #numpy.dot(A.T, tmpData, beta)
-                alpha = numpy.dot(A.T, A)
-                beta = numpy.dot(A.T, tmpData)
+            # Pure matrix inversion (faster than SVD) solving the normal
+            # equations of a block of spectra at once. The products A^T W A
+            # of the whole block are obtained with a single BLAS call.
+            blockSize = max(1, int(4000000 / (m * n)))
+            for start in range(0, b_shape[1], blockSize):
+                end = min(start + blockSize, b_shape[1])
+                tmpWeight = 1.0 / (w[:, start:end] * w[:, start:end])
+                A = a[:, None, :] * tmpWeight[:, :, None]
+                alpha = numpy.tensordot(A, a, axes=([0], [0]))
+                beta = numpy.einsum("mki,mk->ki", A, b[:, start:end])
                 try:
                     _covariance = numpy.linalg.inv(alpha)
-                except:
-                    print("Exception")
-                    print("Exception", sys.exc_info()[1])
-                    continue
-                parameters[:, i:i+1] = numpy.dot(_covariance, beta)
+                except numpy.linalg.LinAlgError:
+                    # singular matrices are left with zero parameters
+                    _covariance = numpy.zeros(alpha.shape, numpy.float)
+                    for i in range(end - start):
+                        try:
+                            _covariance[i] = numpy.linalg.inv(alpha[i])
+                        except numpy.linalg.LinAlgError:
+                            print("Exception", sys.exc_info()[1])
+                parameters[:, start:end] = numpy.einsum("kij,kj->ik",
+                                                        _covariance, beta)
                 if uncertainties:
-                    sigmapar[:, i] = numpy.sqrt(numpy.diag(_covariance))
+                    sigmapar[:, start:end] = numpy.sqrt( \
+                        numpy.diagonal(_covariance, axis1=1, axis2=2)).T
                 if covariances:
-                    covarianceMatrix[i] = covariance
+                    covarianceMatrix[start:end] = _covariance
         else:
             # Matrix inversion with buffers does not improve
             bufferProduct = numpy.empty((n, n + 1), numpy.float)
@@ -328,7 +335,10 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
                 if uncertainties:
                     sigmapar[:, i] = numpy.sqrt(numpy.diag(_covariance))
                 if covariances:
-                    covarianceMatrix[i] = covariance
+                    covarianceMatrix[i] = _covariance
+    if chisq:
+        residuals = (b - numpy.dot(a, parameters)) / w.reshape(b_shape[0], -1)
+        chisqValues = (residuals * residuals).sum(axis=0) / max(1, m - n)
     if len(original) == 1:
         parameters.shape = -1
     if covariances:
@@ -351,6 +361,8 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
             ddict['covariances'] = result[2]
         if svd or fastest:
             ddict['svd'] = (U, s, V)
+        if chisq:
+            ddict['chisq'] = chisqValues
         return ddict
     else:
         return result
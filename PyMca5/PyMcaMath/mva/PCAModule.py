@@ -34,6 +34,7 @@
 import time
 import numpy
 import numpy.linalg
+from multiprocessing.pool import ThreadPool
 try:
     import numpy.core._dotblas as dotblas
 except ImportError:
@@ -418,6 +419,174 @@ def numpyPCA(stack, ncomponents=10, binning=None, **kw):
                              binning=binning,
                              **kw)
 
+def randomizedPCA(stack, ncomponents=10, binning=None, mask=None,
+                  spectral_mask=None, oversampling=10, iterations=2,
+                  memory_limit=None, nthreads=None, **kw):
+    """
+    Randomized PCA streaming blocks of pixels of the stack.
+
+    Neither the whole stack nor its covariance matrix are kept in memory.
+    The data are read in blocks of pixels and only iterations + 3 passes
+    over the data are needed. This is suitable for dynamically loaded
+    (HDF5) stacks larger than the available memory.
+
+    :param oversampling: Number of random vectors in excess of ncomponents
+    :param iterations: Number of power iterations
+    :param memory_limit: Approximate megabytes used by the blocks (default 256)
+    :param nthreads: Number of threads processing the blocks (default 1)
+    """
+    if DEBUG:
+        print("randomizedPCA")
+        t0 = time.time()
+    if binning is None:
+        binning = 1
+    if memory_limit is None:
+        memory_limit = 256
+    if nthreads is None:
+        nthreads = 1
+
+    if hasattr(stack, "info") and hasattr(stack, "data"):
+        data = stack.data
+        index = stack.info.get('McaIndex', -1)
+    else:
+        data = stack
+        index = kw.get("index", -1)
+
+    shape = data.shape
+    if index < 0:
+        index = len(shape) + index
+    if index not in [0, len(shape) - 1]:
+        raise IndexError("1D index must be one of 0, -1 or %d, got %d" %\
+                         (len(shape) - 1, index))
+    if index == 0:
+        spatialShape = shape[1:]
+    else:
+        spatialShape = shape[:-1]
+    N = shape[index]
+    nChannels = int(N / binning)
+    if ncomponents > nChannels:
+        raise ValueError("Number of components too high.")
+
+    # the blocks are taken along the first spatial dimension
+    nRows = spatialShape[0]
+    rowPixels = 1
+    for item in spatialShape[1:]:
+        rowPixels *= item
+    nPixels = nRows * rowPixels
+    step = int(memory_limit * 1024 * 1024 / (8.0 * rowPixels * N * nthreads))
+    step = min(max(step, 1), nRows)
+    blockList = [(i, min(i + step, nRows)) for i in range(0, nRows, step)]
+
+    weights = None
+    binnedWeights = None
+    if spectral_mask is not None:
+        weights = numpy.array(spectral_mask, dtype=numpy.float64).reshape(-1)
+        if (binning > 1) and (weights.size == nChannels):
+            # mask already given at the binned resolution
+            binnedWeights = weights
+            weights = None
+        elif weights.size == N:
+            # applied prior to binning, as the data
+            weights = weights[:nChannels * binning]
+        else:
+            raise ValueError("Spectral mask size %d does not match %d channels" % \
+                             (weights.size, N))
+
+    if mask is not None:
+        spatialMask = numpy.array(mask).reshape(nPixels) > 0
+        usedPixels = int(spatialMask.sum())
+    else:
+        spatialMask = None
+        usedPixels = nPixels
+
+    def getBlock(block):
+        i0, i1 = block
+        if index == 0:
+            tmpData = numpy.array(data[:, i0:i1], dtype=numpy.float64)
+            tmpData = tmpData.reshape(N, -1).T
+        else:
+            tmpData = numpy.array(data[i0:i1], dtype=numpy.float64)
+            tmpData = tmpData.reshape(-1, N)
+        if binning > 1:
+            tmpData = tmpData[:, :nChannels * binning]
+            if weights is not None:
+                tmpData *= weights
+            tmpData = tmpData.reshape(-1, nChannels, binning).sum(axis=-1)
+            if binnedWeights is not None:
+                tmpData *= binnedWeights
+        elif weights is not None:
+            tmpData *= weights
+        if spatialMask is not None:
+            tmpData[~spatialMask[i0 * rowPixels:i1 * rowPixels]] = 0
+        return tmpData
+
+    def covarianceProduct(vectors):
+        # (data - average).T * (data - average) * vectors and sum spectrum
+        def work(block):
+            tmpData = getBlock(block)
+            return dotblas.dot(tmpData.T, dotblas.dot(tmpData, vectors)),\
+                   tmpData.sum(axis=0)
+        if pool is None:
+            resultList = map(work, blockList)
+        else:
+            resultList = pool.imap(work, blockList)
+        product = numpy.zeros(vectors.shape, numpy.float64)
+        sumSpectrum = numpy.zeros((nChannels,), numpy.float64)
+        for blockProduct, blockSum in resultList:
+            product += blockProduct
+            sumSpectrum += blockSum
+        product -= numpy.outer(sumSpectrum,
+                               dotblas.dot(sumSpectrum, vectors) / usedPixels)
+        return product, sumSpectrum
+
+    nVectors = min(ncomponents + oversampling, nChannels)
+    if nthreads > 1:
+        pool = ThreadPool(nthreads)
+    else:
+        pool = None
+    try:
+        # range finder with power iterations
+        q = numpy.random.standard_normal((nChannels, nVectors))
+        for i in range(iterations + 1):
+            q = numpy.linalg.qr(covarianceProduct(q)[0])[0]
+        product, sumSpectrum = covarianceProduct(q)
+
+        # eigen decomposition of the projected covariance matrix
+        projectedCovariance = dotblas.dot(q.T, product) / (usedPixels - 1)
+        projectedCovariance = 0.5 * (projectedCovariance +
+                                     projectedCovariance.T)
+        evalues, evectors = numpy.linalg.eigh(projectedCovariance)
+        idx = numpy.argsort(evalues)[::-1][:ncomponents]
+        vectors = dotblas.dot(q, evectors[:, idx])
+        average = sumSpectrum / usedPixels
+
+        # the projections
+        images = numpy.zeros((ncomponents, nPixels), numpy.float32)
+        def project(block):
+            tmpData = getBlock(block)
+            tmpData -= average
+            return block, dotblas.dot(tmpData, vectors)
+        if pool is None:
+            resultList = map(project, blockList)
+        else:
+            resultList = pool.imap(project, blockList)
+        for block, projection in resultList:
+            images[:, block[0] * rowPixels:block[1] * rowPixels] = \
+                                                            projection.T
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    if spatialMask is not None:
+        images[:, ~spatialMask] = 0
+    images.shape = (ncomponents,) + tuple(spatialShape)
+    eigenvalues = evalues[idx].astype(numpy.float32)
+    eigenvectors = vectors.T.astype(numpy.float32)
+    if DEBUG:
+        print("randomizedPCA elapsed = %f" % (time.time() - t0))
+    return images, eigenvalues, eigenvectors
+
+
 def mdpPCASVDFloat32(stack, ncomponents=10, binning=None,
                      mask=None, spectral_mask=None, **kw):
     return mdpPCA(stack, ncomponents, binning=binning, dtype='float32',
@@ -39,6 +39,7 @@
 from PyMca5.PyMcaMath.fitting import SpecfitFuns
 from PyMca5.PyMcaMath import SGModule
 from PyMca5.PyMcaMath.fitting.Gefit import LeastSquaresFit
+from PyMca5.PyMcaMisc import ParallelTools
 DEBUG = 0
 if DEBUG:
     from pylab import *
@@ -381,6 +382,341 @@ def XASVictoreenNormalization(spectrum,
         show()
     return energy, normalizedSpectrum, edge
 
+def _getEdgeFunctionOrder(order):
+    if order in [0, 'Constant']:
+        return 0
+    elif order in [1, 'Linear']:
+        return 1
+    elif order in [2, 'Parabolic']:
+        return 2
+    elif order in [3, 'Cubic']:
+        return 3
+    elif order in [-1, 'Victoreen']:
+        return -1
+    elif order in [-2, 'Modif. Victoreen']:
+        return -2
+    # case of arriving with a 4th order polynom, for instance
+    return int(order)
+
+def _getEdgeFunctionBasis(order, x, scale):
+    # the columns of the linear model evaluated at x
+    # a scaled variable keeps the normal equations well conditioned
+    if order == -1:
+        t = x / scale[1]
+        return numpy.array([pow(t, -3), pow(t, -4)]).T
+    elif order == -2:
+        t = x / scale[1]
+        return numpy.array([pow(t, -3), numpy.ones(t.shape)]).T
+    t = (x - scale[0]) / scale[1]
+    return numpy.array([pow(t, i) for i in range(order + 1)]).T
+
+def _getRegionsWeights(energy, regions, edges):
+    # number of times each channel is used by the regions of each spectrum
+    weights = numpy.zeros((len(edges), len(energy)), numpy.float64)
+    for region in regions:
+        xmin = (region[0] + edges).reshape(-1, 1)
+        xmax = (region[1] + edges).reshape(-1, 1)
+        weights += (energy >= xmin) & (energy <= xmax)
+    return weights
+
+def _fitEdgeFunction(basis, spectra, weights):
+    """
+    Linear least squares fit of all the spectra at once.
+
+    basis - [n_channels, n_parameters] array of the model columns
+    spectra, weights - [n_spectra, n_channels] arrays
+    Returns the [n_spectra, n_parameters] parameters and the failed fits.
+    """
+    nChannels, nParameters = basis.shape
+    products = (basis[:, :, None] * basis[:, None, :]).reshape(nChannels, -1)
+    alpha = numpy.dot(weights, products).reshape(-1, nParameters, nParameters)
+    beta = numpy.dot(weights * spectra, basis)
+    errors = numpy.zeros(len(spectra), numpy.bool_)
+    try:
+        parameters = numpy.linalg.solve(alpha, beta[:, :, None])[:, :, 0]
+    except numpy.linalg.LinAlgError:
+        # at least one singular system, solve them one by one
+        parameters = numpy.zeros(beta.shape, numpy.float64)
+        for i in range(len(spectra)):
+            try:
+                parameters[i] = numpy.linalg.solve(alpha[i], beta[i])
+            except numpy.linalg.LinAlgError:
+                errors[i] = True
+    return parameters, errors
+
+def estimateXANESEdges(spectra, energy=None):
+    """
+    Estimate the edges of a set of spectra sharing the same energy axis.
+
+    spectra - [n_spectra, n_channels] array
+    energy - 1D array of n_channels values
+    The edge is the center of mass of the first derivative around its
+    maximum, as in estimateXANESEdge, but all the spectra are treated at once.
+    """
+    y = numpy.asarray(spectra, dtype=numpy.float64)
+    if len(y.shape) == 1:
+        y = y.reshape(1, -1)
+    if energy is None:
+        x = numpy.arange(y.shape[-1]).astype(numpy.float64)
+    else:
+        x = numpy.array(energy, dtype=numpy.float64).reshape(-1)
+    nChannels = len(x)
+
+    # make sure data are sorted
+    idx = x.argsort(kind='mergesort')
+    x = numpy.take(x, idx)
+    y = numpy.take(y, idx, axis=1)
+
+    # make sure data are strictly increasing
+    delta = x[1:] - x[:-1]
+    dmin = delta.min()
+    dmax = delta.max()
+    if dmin <= 1.0e-10:
+        idx = numpy.nonzero(delta > 0)[0]
+        x = numpy.take(x, idx)
+        y = numpy.take(y, idx, axis=1)
+
+    # use a regularly spaced spectrum
+    if dmax != dmin:
+        xi = numpy.linspace(x[1], x[-2], 2 * nChannels)
+        i1 = numpy.clip(numpy.searchsorted(x, xi), 1, len(x) - 1)
+        i0 = i1 - 1
+        w = (xi - x[i0]) / (x[i1] - x[i0])
+        y = y[:, i0] * (1.0 - w) + y[:, i1] * w
+        x = xi
+
+    # take the first derivative
+    npoints = 7
+    coeff = SGModule.calc_coeff(npoints, 2, 1)
+    n = y.shape[1]
+    yPrime = numpy.zeros(y.shape, numpy.float64)
+    for k in range(2 * npoints + 1):
+        yPrime[:, npoints:n - npoints] += \
+                        coeff[2 * npoints - k] * y[:, k:n - 2 * npoints + k]
+
+    # get the center of mass around the maximum of each derivative
+    w = 2 * npoints
+    iMax = numpy.argmax(yPrime, axis=1)
+    idx = iMax.reshape(-1, 1) + numpy.arange(-w, w + 1)
+    valid = (idx >= 0) & (idx < n)
+    idx = numpy.clip(idx, 0, n - 1)
+    selection = yPrime[numpy.arange(len(y)).reshape(-1, 1), idx] * valid
+    return (selection * x[idx]).sum(axis=1) / selection.sum(axis=1)
+
+def XASSpectraNormalization(spectra,
+                            energy=None,
+                            edge=None,
+                            pre_edge_regions=None,
+                            post_edge_regions=None,
+                            algorithm='polynomial',
+                            algorithm_parameters=None):
+    """
+    Normalize a set of spectra sharing the same energy axis at once.
+
+    spectra - [n_spectra, n_channels] array
+    The other arguments are those of XASNormalization. The edge can be
+    None or 'Auto' to estimate it for each spectrum, a single energy or
+    an array of n_spectra energies.
+    Returns the normalized spectra, the edges, the jumps and an array
+    flagging the spectra that could not be normalized.
+    """
+    if algorithm not in SUPPORTED_ALGORITHMS:
+        raise ValueError("Unsupported algorithm %s" % algorithm)
+    y = numpy.array(spectra, dtype=numpy.float64, ndmin=2)
+    nSpectra, nChannels = y.shape
+    if energy is None:
+        energy = numpy.arange(nChannels).astype(numpy.float64)
+    else:
+        energy = numpy.array(energy, dtype=numpy.float64).reshape(-1)
+    if algorithm_parameters is None:
+        algorithm_parameters = {}
+    if isinstance(edge, str) or (edge is None):
+        edges = estimateXANESEdges(y, energy=energy)
+    else:
+        edges = numpy.zeros(nSpectra, numpy.float64) + edge
+
+    kev = edges < 200
+    if pre_edge_regions is None:
+        pre_edge_regions = [[numpy.where(kev, -0.4, -400.),
+                             numpy.where(kev, -0.05, -50.)]]
+    if post_edge_regions is None:
+        post_edge_regions = [[numpy.where(kev, 0.020, 20.),
+                              energy.max() - edges]]
+
+    if algorithm == 'victoreen':
+        # regions are absolute energies
+        regionsEdges = numpy.zeros(nSpectra, numpy.float64)
+        pre_edge_order = algorithm_parameters.get('pre_edge_order', 1)
+        post_edge_order = algorithm_parameters.get('post_edge_order', 1)
+        if pre_edge_order in [1, -1, 'Victoreen']:
+            pre_edge_order = -1
+        else:
+            pre_edge_order = -2
+        if post_edge_order in [1, -1, 'Victoreen']:
+            post_edge_order = -1
+        else:
+            post_edge_order = -2
+    else:
+        regionsEdges = edges
+        pre_edge_order = _getEdgeFunctionOrder( \
+                        algorithm_parameters.get('pre_edge_order', 1))
+        post_edge_order = _getEdgeFunctionOrder( \
+                        algorithm_parameters.get('post_edge_order', 3))
+
+    emin = energy.min()
+    emax = energy.max()
+    if pre_edge_order < 0 or post_edge_order < 0:
+        scale = 0.0, max(abs(emin), abs(emax))
+    else:
+        scale = 0.5 * (emin + emax), 0.5 * (emax - emin)
+    if scale[1] == 0:
+        scale = scale[0], 1.0
+
+    # pre-edge
+    preBasis = _getEdgeFunctionBasis(pre_edge_order, energy, scale)
+    weights = _getRegionsWeights(energy, pre_edge_regions, regionsEdges)
+    preParameters, errors = _fitEdgeFunction(preBasis, y, weights)
+    y -= numpy.dot(preParameters, preBasis.T)
+
+    # post-edge
+    postBasis = _getEdgeFunctionBasis(post_edge_order, energy, scale)
+    weights = _getRegionsWeights(energy, post_edge_regions, regionsEdges)
+    postParameters, postErrors = _fitEdgeFunction(postBasis, y, weights)
+    errors |= postErrors
+    y /= numpy.dot(postParameters, postBasis.T)
+    jumps = (_getEdgeFunctionBasis(post_edge_order, edges, scale) * \
+             postParameters).sum(axis=1)
+
+    errors |= ~(numpy.isfinite(y).all(axis=1) & numpy.isfinite(jumps))
+    y[errors] = 0.0
+    jumps[errors] = 0.0
+    edges[errors] = 0.0
+    return y, edges, jumps, errors
+
+def XASStackNormalization(stack,
+                          energy=None,
+                          edge=None,
+                          pre_edge_regions=None,
+                          post_edge_regions=None,
+                          algorithm='polynomial',
+                          algorithm_parameters=None,
+                          mcaIndex=None,
+                          output=None,
+                          chunksize=None,
+                          progress_callback=None):
+    """
+    Normalize all the spectra of a stack.
+
+    The stack (DataObject, numpy array, memmap or h5py dataset) is read in
+    blocks of spectra that are normalized at once by XASSpectraNormalization.
+    The output (by default the stack itself if it is a floating point numpy
+    array, integer arrays require it) receives the normalized spectra. Channels outside the pre-edge and post-edge
+    limits are set to zero, as well as the spectra that could not be
+    normalized or whose jump is negative or whose range exceeds 10.
+    progress_callback is called with the percentage of spectra processed.
+    Returns the edges, jumps and errors with the shape of the stack images.
+    """
+    dataObject = hasattr(stack, "info") and hasattr(stack, "data")
+    if dataObject:
+        data = stack.data
+        if mcaIndex is None:
+            mcaIndex = stack.info.get('McaIndex', -1)
+    else:
+        data = stack
+    if mcaIndex is None:
+        mcaIndex = -1
+    shape = data.shape
+    ndim = len(shape)
+    if mcaIndex < 0:
+        mcaIndex += ndim
+    if (ndim < 2) or (mcaIndex not in [0, ndim - 1]):
+        raise ValueError("Unsupported 1D index %d" % mcaIndex)
+    nChannels = shape[mcaIndex]
+    if energy is None:
+        energy = numpy.arange(nChannels).astype(numpy.float64)
+    else:
+        energy = numpy.array(energy, dtype=numpy.float64).reshape(-1)
+    if output is None:
+        inPlace = isinstance(data, numpy.ndarray) and \
+                  (not numpy.issubdtype(data.dtype, numpy.integer))
+        if inPlace:
+            output = data
+        elif dataObject or (not isinstance(data, numpy.ndarray)):
+            # dynamically loaded or integer stack, the result is kept
+            # in memory as floating point values
+            output = numpy.empty(shape,
+                            dtype=numpy.result_type(data.dtype, numpy.float32))
+            if dataObject:
+                stack.data = output
+        else:
+            raise TypeError("Integer stacks cannot hold the result, " + \
+                            "please give an output array")
+    elif tuple(output.shape) != tuple(shape):
+        raise ValueError("Output shape %s does not match stack shape %s" % \
+                         (output.shape, shape))
+    if chunksize is None:
+        chunksize = ParallelTools.CHUNK_SIZE
+    if mcaIndex == 0:
+        imageShape = shape[1:]
+    else:
+        imageShape = shape[:-1]
+    nRows = imageShape[0]
+    rowSize = 8 * nChannels
+    for item in imageShape[1:]:
+        rowSize *= item
+    step = max(1, int(chunksize // rowSize))
+
+    edges = numpy.zeros(imageShape, numpy.float32).reshape(nRows, -1)
+    jumps = numpy.zeros(edges.shape, numpy.float32)
+    errors = numpy.zeros(edges.shape, numpy.float32)
+    for start in range(0, nRows, step):
+        end = min(start + step, nRows)
+        if mcaIndex == 0:
+            block = numpy.asarray(data[:, start:end])
+            blockShape = block.shape
+            spectra = block.reshape(nChannels, -1).T
+        else:
+            block = numpy.asarray(data[start:end])
+            blockShape = block.shape
+            spectra = block.reshape(-1, nChannels)
+        del block
+        spectra, ed, jmp, err = XASSpectraNormalization(spectra,
+                                    energy=energy,
+                                    edge=edge,
+                                    pre_edge_regions=pre_edge_regions,
+                                    post_edge_regions=post_edge_regions,
+                                    algorithm=algorithm,
+                                    algorithm_parameters=algorithm_parameters)
+        # reject meaningless results
+        rejected = err | (jmp < 0) | \
+                   ((spectra.max(axis=1) - spectra.min(axis=1)) > 10.)
+        spectra[rejected] = 0.0
+        ed[rejected] = 0.0
+        jmp[rejected] = 0.0
+        # it seems more appropriate to set the channels below and above
+        # the limits to 0 than to the corresponding limits of the regions
+        if algorithm == 'victoreen':
+            offset = numpy.zeros((len(spectra), 1), numpy.float64)
+        else:
+            offset = ed.reshape(-1, 1)
+        if pre_edge_regions is not None:
+            spectra[energy < (offset + pre_edge_regions[0][0])] = 0.0
+        if post_edge_regions is not None:
+            spectra[energy > (offset + post_edge_regions[-1][1])] = 0.0
+        if mcaIndex == 0:
+            output[:, start:end] = spectra.T.reshape(blockShape)
+        else:
+            output[start:end] = spectra.reshape(blockShape)
+        edges[start:end] = ed.reshape(end - start, -1)
+        jumps[start:end] = jmp.reshape(end - start, -1)
+        errors[start:end] = err.reshape(end - start, -1)
+        if progress_callback is not None:
+            progress_callback((100. * end) / nRows)
+    edges.shape = imageShape
+    jumps.shape = imageShape
+    errors.shape = imageShape
+    return edges, jumps, errors
+
 SUPPORTED_ALGORITHMS = {"polynomial":XASPolynomialNormalization,
                         "victoreen": XASVictoreenNormalization}
 
@@ -34,6 +34,8 @@
 import sys
 import numpy
 import copy
+import hashlib
+import pickle
 from .Strategies import STRATEGIES
 from . import ConcentrationsTool
 FISX = ConcentrationsTool.FISX
@@ -43,12 +45,122 @@
 from PyMca5.PyMcaMath.fitting import SpecfitFuns
 from PyMca5.PyMcaIO import ConfigDict
 from PyMca5.PyMcaMath.fitting import Gefit
+import PyMca5
 from PyMca5 import PyMcaDataDir
 DEBUG = 0
 #"python ClassMcaTheory.py -s1.1 --file=03novs060sum.mca --pkm=McaTheory.dat --continuum=0 --strip=1 --sumflag=1 --maxiter=4"
 CONTINUUM_LIST = [None,'Constant','Linear','Parabolic','Linear Polynomial','Exp. Polynomial']
 OLDESCAPE = 0
 MAX_ATTENUATION = 1.0E-300
+
+# Building the description of the peaks (rates, escape peaks, matrix effects)
+# is the expensive part of the configuration. It is kept in a small cache
+# keyed on the configuration parameters it depends on. Setting
+# CACHE_DIRECTORY keeps a copy on disk to be shared among sessions. The
+# key includes the PyMca version and the state of the data files in order
+# not to use descriptions obtained with other versions of the database.
+CACHE_SIZE = 10
+CACHE_DIRECTORY = None
+_CONFIGURATION_CACHE = []
+_DATA_VERSION = None
+_CACHE_FIT_KEYS = ['energy', 'energyweight', 'energyflag', 'energyscatter',
+                   'escapeflag', 'fitfunction', 'hypermetflag', 'scatterflag',
+                   'deltaonepeak']
+_CACHE_SECTIONS = ['attenuators', 'multilayer', 'materials', 'peaks',
+                   'detector', 'concentrations']
+
+def _toHashable(obj):
+    if isinstance(obj, dict):
+        return [(str(key), _toHashable(obj[key])) for key in sorted(obj.keys())]
+    if isinstance(obj, (list, tuple)):
+        return [_toHashable(item) for item in obj]
+    if isinstance(obj, numpy.ndarray):
+        return _toHashable(obj.tolist())
+    if isinstance(obj, numpy.generic):
+        return obj.item()
+    return obj
+
+def _getDataVersion():
+    global _DATA_VERSION
+    if _DATA_VERSION is None:
+        files = []
+        dirname = PyMcaDataDir.PYMCA_DATA_DIR
+        for subdir in ["", "attdata"]:
+            path = os.path.join(dirname, subdir)
+            if not os.path.isdir(path):
+                continue
+            for fname in sorted(os.listdir(path)):
+                if os.path.splitext(fname)[-1] not in [".dat", ".dict",
+                                                       ".mat"]:
+                    continue
+                stat = os.stat(os.path.join(path, fname))
+                files.append((subdir, fname, stat.st_size,
+                              int(stat.st_mtime)))
+        _DATA_VERSION = (PyMca5.version(), files)
+    return _DATA_VERSION
+
+def _getConfigurationKey(config, attflag):
+    ddict = {}
+    for section in _CACHE_SECTIONS:
+        ddict[section] = config.get(section, {})
+    ddict['fit'] = {}
+    for key in _CACHE_FIT_KEYS:
+        ddict['fit'][key] = config['fit'].get(key, None)
+    ddict['attflag'] = attflag
+    ddict['version'] = _getDataVersion()
+    # the detector section includes the energy calibration
+    text = repr(_toHashable(ddict))
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+def _getCachedConfiguration(key):
+    for i in range(len(_CONFIGURATION_CACHE)):
+        if _CONFIGURATION_CACHE[i][0] == key:
+            item = _CONFIGURATION_CACHE.pop(i)
+            _CONFIGURATION_CACHE.append(item)
+            return copy.deepcopy(item[1])
+    if CACHE_DIRECTORY is None:
+        return None
+    fname = os.path.join(CACHE_DIRECTORY, "McaTheory_%s.pickle" % key)
+    if not os.path.exists(fname):
+        return None
+    try:
+        f = open(fname, "rb")
+        value = pickle.load(f)
+        f.close()
+    except:
+        if DEBUG:
+            print("Error reading cache file %s" % fname)
+        return None
+    _addToCache(key, value)
+    return copy.deepcopy(value)
+
+def _setCachedConfiguration(key, peaksDescription, fluoRates, fisx):
+    value = copy.deepcopy((peaksDescription, fluoRates, fisx))
+    _addToCache(key, value)
+    if CACHE_DIRECTORY is None:
+        return
+    fname = os.path.join(CACHE_DIRECTORY, "McaTheory_%s.pickle" % key)
+    try:
+        f = open(fname, "wb")
+        pickle.dump(value, f, 2)
+        f.close()
+    except:
+        if DEBUG:
+            print("Error writing cache file %s" % fname)
+
+def _addToCache(key, value):
+    _CONFIGURATION_CACHE.append((key, value))
+    while len(_CONFIGURATION_CACHE) > CACHE_SIZE:
+        del _CONFIGURATION_CACHE[0]
+
+def clearConfigurationCache():
+    """
+    Forget the peak descriptions of previous configurations. Needed when
+    the Elements module has been modified by other means than the fit
+    configuration.
+    """
+    del _CONFIGURATION_CACHE[:]
+
 class McaTheory(object):
     def __init__(self, initdict=None, filelist=None, **kw):
         self.ydata0  = None
@@ -202,6 +314,9 @@ def __configure(self):
             self.config['fit']['energyscatter']   = [1]
         maxenergy = None
         energylist= None
+        energyweight  = None
+        energyflag    = None
+        energyscatter = None
         if self.config['fit']['energy'] is not None:
           if max(self.config['fit']['energyflag']) == 0:
               energylist = None
@@ -236,8 +351,6 @@ def __configure(self):
         self.config['fit']['stripiterations'] = int(self.config['fit'].get('stripiterations',20000))
         self.config['fit']['stripanchorsflag']= int(self.config['fit'].get('stripanchorsflag',0))
         self.config['fit']['stripanchorslist']= self.config['fit'].get('stripanchorslist',[0,0,0,0])
-        deltaonepeak = self.config['fit']['deltaonepeak']
-        detele       = self.config['detector']['detele']
         detene       = self.config['detector'].get('detene', 1.7420)
         self.config['detector']['detene'] = detene
         ethreshold   = self.config['detector'].get('ethreshold', 0.020)
@@ -246,6 +359,161 @@ def __configure(self):
         self.config['detector']['ethreshold'] = ethreshold
         self.config['detector']['ithreshold'] = ithreshold
         self.config['detector']['nthreshold'] = nthreshold
+        data, PEAKS0, PEAKS0NAMES, PEAKS0ESCAPE, PEAKSW, HYPERMET = \
+                        self.__getCachedPeaksDescription(maxenergy, energylist,
+                                                         energyweight,
+                                                         energyflag,
+                                                         energyscatter)
+#########
+        PARAMETERS=['Zero','Gain','Noise','Fano','Sum']
+        CONTINUUM    = self.config['fit']['continuum']
+
+        #CONTINUUM_LIST = [None,'Constant','Linear','Parabolic',
+        #                    'Linear Polynomial','Exp. Polynomial']
+        if CONTINUUM < CONTINUUM_LIST.index('Linear Polynomial'):
+            PARAMETERS.append('Constant')
+            PARAMETERS.append('1st Order')
+            if CONTINUUM >2:
+                PARAMETERS.append('2nd Order')
+        elif CONTINUUM == CONTINUUM_LIST.index('Linear Polynomial'):
+            for i in range(self.config['fit']['linpolorder']+1):
+                PARAMETERS.append('A%d'  % i)
+        elif CONTINUUM == CONTINUUM_LIST.index('Exp. Polynomial'):
+            for i in range(self.config['fit']['exppolorder']+1):
+                PARAMETERS.append('A%d'  % i)
+        if HYPERMET:
+            PARAMETERS.append('ST AreaR')
+            PARAMETERS.append('ST SlopeR')
+            PARAMETERS.append('LT AreaR')
+            PARAMETERS.append('LT SlopeR')
+            PARAMETERS.append('STEP HeightR')
+        else:
+            PARAMETERS.append('Eta Factor')
+        NGLOBAL   = len(PARAMETERS)
+        for item in data:
+            PARAMETERS.append(item[1]+" "+item[2])
+        if energylist is not None:
+            if len(energylist) and \
+               (self.config['fit']['scatterflag']):
+                for scatterindex in range(len(energylist)):
+                    if energyscatter[scatterindex]:
+                        ene = energylist[scatterindex]
+                        #print "ene = ",ene,"scatterindex = ",scatterindex
+                        #print "scatter for first energy"
+                        if ene > 0.2:
+                            PARAMETERS.append("Scatter Peak%03d" % scatterindex)
+                            PARAMETERS.append("Scatter Compton%03d" % scatterindex)
+                            #PARAMETERS.append("Scatter Peak")
+                            #PARAMETERS.append("Scatter Compton")
+
+        self.PEAKS0     = PEAKS0
+        self.PEAKS0ESCAPE = PEAKS0ESCAPE
+        #for i in range(len(PEAKS0)):
+        #    print self.PEAKS0[i]
+        #    print self.PEAKS0ESCAPE[i]
+        self.PEAKS0NAMES= PEAKS0NAMES
+        self.PEAKSW     = PEAKSW
+        self.FASTER     = 1
+        self.__HYPERMET   = HYPERMET
+        self.NGLOBAL    = NGLOBAL
+        self.PARAMETERS = PARAMETERS
+        self.ESCAPE     = self.config['fit']['escapeflag']
+        self.__SUM        = self.config['fit']['sumflag']
+        self.__CONTINUUM     = CONTINUUM
+        self.MAXITER    = self.config['fit']['maxiter']
+        self.STRIP      = self.config['fit']['stripflag']
+        self.__buildPeakTable()
+        #if self.laststrip is not None:
+        self.__mycounter = 0
+        calculateStrip = False
+        if (self.STRIP != self.laststrip) or \
+           (self.config['fit']['stripalgorithm'] != self.laststripalgorithm) or \
+           (self.config['fit']['stripfilterwidth'] != self.laststripfilterwidth) or \
+           (self.config['fit']['stripanchorsflag'] != self.laststripanchorsflag) or \
+           (self.config['fit']['stripanchorslist'] != self.laststripanchorslist):
+            calculateStrip = True
+        if not calculateStrip:
+            if self.config['fit']['stripalgorithm'] == 1:
+                #checking if needed to calculate SNIP
+                if (self.config['fit']['snipwidth'] != self.lastsnipwidth):
+                    calculateStrip = True
+            else:
+                #checking if needed to calculate strip
+                if (self.config['fit']['stripiterations'] != self.laststripiterations) or \
+                   (self.config['fit']['stripwidth'] != self.laststripwidth) or \
+                   (self.config['fit']['stripconstant'] != self.laststripconstant):
+                    calculateStrip = True
+        if (self.lastxmin != self.config['fit']['xmin']) or\
+           (self.lastxmax != self.config['fit']['xmax']):
+            if self.ydata0 is not None:
+                if DEBUG:
+                    print("Limits changed")
+                self.setData(x=self.xdata0,
+                             y=self.ydata0,
+                             sigmay=self.sigmay0,
+                             xmin = self.config['fit']['xmin'],
+                             xmax = self.config['fit']['xmax'],
+                             time = self.__lastTime)
+                return
+
+        if hasattr(self, "xdata"):
+            if self.STRIP:
+                if calculateStrip:
+                    if DEBUG:
+                        print("Calling to calculate non analytical background in config")
+                    self.__getselfzz()
+                else:
+                    if DEBUG:
+                        print("Using previous non analytical background in config")
+                self.datatofit = numpy.concatenate((self.xdata,
+                                self.ydata-self.zz, self.sigmay),1)
+                self.laststrip = 1
+            else:
+                if DEBUG:
+                    print("Using previous data")
+                self.datatofit = numpy.concatenate((self.xdata,
+                                self.ydata, self.sigmay),1)
+                self.laststrip = 0
+
+    def __getCachedPeaksDescription(self, maxenergy, energylist,
+                                    energyweight, energyflag, energyscatter):
+        """
+        Return the description of the peaks to be fitted, reusing the one
+        of any previous configuration sharing the same physical setup.
+        """
+        key = _getConfigurationKey(self.config, self.attflag)
+        cached = _getCachedConfiguration(key)
+        if cached is None:
+            peaksDescription = self.__getPeaksDescription(maxenergy,
+                                                          energylist,
+                                                          energyweight,
+                                                          energyflag,
+                                                          energyscatter)
+            if self._fluoRates is None:
+                fisx = None
+            else:
+                fisx = self.config['fisx']
+            _setCachedConfiguration(key, peaksDescription,
+                                    self._fluoRates, fisx)
+            return peaksDescription
+        if DEBUG:
+            print("Using cached peaks description")
+        peaksDescription, self._fluoRates, fisx = cached
+        if fisx is not None:
+            self.config['fisx'] = fisx
+        # keep the Elements module in the same state as without the cache
+        for item in peaksDescription[0]:
+            if maxenergy != Elements.Element[item[1]]['buildparameters']['energy']:
+                Elements.updateDict(energy=maxenergy)
+        return peaksDescription
+
+    def __getPeaksDescription(self, maxenergy, energylist,
+                              energyweight, energyflag, energyscatter):
+        deltaonepeak = self.config['fit']['deltaonepeak']
+        detele       = self.config['detector']['detele']
+        ethreshold   = self.config['detector']['ethreshold']
+        ithreshold   = self.config['detector']['ithreshold']
+        nthreshold   = self.config['detector']['nthreshold']
         usematrix = 0
         attenuatorlist =[]
         filterlist = []
@@ -837,115 +1105,75 @@ def __configure(self):
                                                                         numpy.float))
                                     else:
                                         PEAKSW.append(numpy.ones((r,3+5),numpy.float))
-#########
-        PARAMETERS=['Zero','Gain','Noise','Fano','Sum']
-        CONTINUUM    = self.config['fit']['continuum']
+        return data, PEAKS0, PEAKS0NAMES, PEAKS0ESCAPE, PEAKSW, HYPERMET
 
-        #CONTINUUM_LIST = [None,'Constant','Linear','Parabolic',
-        #                    'Linear Polynomial','Exp. Polynomial']
-        if CONTINUUM < CONTINUUM_LIST.index('Linear Polynomial'):
-            PARAMETERS.append('Constant')
-            PARAMETERS.append('1st Order')
-            if CONTINUUM >2:
-                PARAMETERS.append('2nd Order')
-        elif CONTINUUM == CONTINUUM_LIST.index('Linear Polynomial'):
-            for i in range(self.config['fit']['linpolorder']+1):
-                PARAMETERS.append('A%d'  % i)
-        elif CONTINUUM == CONTINUUM_LIST.index('Exp. Polynomial'):
-            for i in range(self.config['fit']['exppolorder']+1):
-                PARAMETERS.append('A%d'  % i)
-        if HYPERMET:
-            PARAMETERS.append('ST AreaR')
-            PARAMETERS.append('ST SlopeR')
-            PARAMETERS.append('LT AreaR')
-            PARAMETERS.append('LT SlopeR')
-            PARAMETERS.append('STEP HeightR')
+    def __buildPeakTable(self):
+        """
+        Flatten the description of the peaks into arrays with one entry per
+        line (escape lines included) in order to evaluate all of them at once.
+        """
+        group = []
+        rate = []
+        energy = []
+        escape = []
+        self._peakLimits = [0]
+        for i in range(len(self.PEAKS0)):
+            peaks = self.PEAKS0[i]
+            r = peaks.shape[0]
+            group.extend([i] * r)
+            rate.extend(peaks[:, 0].tolist())
+            energy.extend(peaks[:, 1].tolist())
+            escape.extend([0] * r)
+            if self.ESCAPE:
+                if OLDESCAPE:
+                    group.extend([i] * r)
+                    rate.extend((peaks[:, 0] * peaks[:, 3]).tolist())
+                    energy.extend((peaks[:, 1] - \
+                                   self.config['detector']['detene']).tolist())
+                    escape.extend([1] * r)
+                else:
+                    for ii in range(len(self.PEAKS0ESCAPE[i])):
+                        for esc_line in self.PEAKS0ESCAPE[i][ii]:
+                            group.append(i)
+                            rate.append(peaks[ii, 0] * esc_line[1])
+                            energy.append(esc_line[0] * 1.0)
+                            escape.append(1)
+            self._peakLimits.append(len(group))
+        self._peakGroup = numpy.array(group, numpy.int32)
+        self._peakRate = numpy.array(rate, numpy.float)
+        self._peakEnergy = numpy.array(energy, numpy.float)
+        # tails are neglected in the escape peaks
+        self._peakMain = 1.0 - numpy.array(escape, numpy.float)
+        if self.__HYPERMET:
+            self._peakColumns = 3 + 5
         else:
-            PARAMETERS.append('Eta Factor')
-        NGLOBAL   = len(PARAMETERS)
-        for item in data:
-            PARAMETERS.append(item[1]+" "+item[2])
-        if energylist is not None:
-            if len(energylist) and \
-               (self.config['fit']['scatterflag']):
-                for scatterindex in range(len(energylist)):
-                    if energyscatter[scatterindex]:
-                        ene = energylist[scatterindex]
-                        #print "ene = ",ene,"scatterindex = ",scatterindex
-                        #print "scatter for first energy"
-                        if ene > 0.2:
-                            PARAMETERS.append("Scatter Peak%03d" % scatterindex)
-                            PARAMETERS.append("Scatter Compton%03d" % scatterindex)
-                            #PARAMETERS.append("Scatter Peak")
-                            #PARAMETERS.append("Scatter Compton")
+            self._peakColumns = 3 + 1
 
-        self.PEAKS0     = PEAKS0
-        self.PEAKS0ESCAPE = PEAKS0ESCAPE
-        #for i in range(len(PEAKS0)):
-        #    print self.PEAKS0[i]
-        #    print self.PEAKS0ESCAPE[i]
-        self.PEAKS0NAMES= PEAKS0NAMES
-        self.PEAKSW     = PEAKSW
-        self.FASTER     = 1
-        self.__HYPERMET   = HYPERMET
-        self.NGLOBAL    = NGLOBAL
-        self.PARAMETERS = PARAMETERS
-        self.ESCAPE     = self.config['fit']['escapeflag']
-        self.__SUM        = self.config['fit']['sumflag']
-        self.__CONTINUUM     = CONTINUUM
-        self.MAXITER    = self.config['fit']['maxiter']
-        self.STRIP      = self.config['fit']['stripflag']
-        #if self.laststrip is not None:
-        self.__mycounter = 0
-        calculateStrip = False
-        if (self.STRIP != self.laststrip) or \
-           (self.config['fit']['stripalgorithm'] != self.laststripalgorithm) or \
-           (self.config['fit']['stripfilterwidth'] != self.laststripfilterwidth) or \
-           (self.config['fit']['stripanchorsflag'] != self.laststripanchorsflag) or \
-           (self.config['fit']['stripanchorslist'] != self.laststripanchorslist):
-            calculateStrip = True
-        if not calculateStrip:
-            if self.config['fit']['stripalgorithm'] == 1:
-                #checking if needed to calculate SNIP
-                if (self.config['fit']['snipwidth'] != self.lastsnipwidth):
-                    calculateStrip = True
-            else:
-                #checking if needed to calculate strip
-                if (self.config['fit']['stripiterations'] != self.laststripiterations) or \
-                   (self.config['fit']['stripwidth'] != self.laststripwidth) or \
-                   (self.config['fit']['stripconstant'] != self.laststripconstant):
-                    calculateStrip = True
-        if (self.lastxmin != self.config['fit']['xmin']) or\
-           (self.lastxmax != self.config['fit']['xmax']):
-            if self.ydata0 is not None:
-                if DEBUG:
-                    print("Limits changed")
-                self.setData(x=self.xdata0,
-                             y=self.ydata0,
-                             sigmay=self.sigmay0,
-                             xmin = self.config['fit']['xmin'],
-                             xmax = self.config['fit']['xmax'],
-                             time = self.__lastTime)
-                return
-
-        if hasattr(self, "xdata"):
-            if self.STRIP:
-                if calculateStrip:
-                    if DEBUG:
-                        print("Calling to calculate non analytical background in config")
-                    self.__getselfzz()
-                else:
-                    if DEBUG:
-                        print("Using previous non analytical background in config")
-                self.datatofit = numpy.concatenate((self.xdata,
-                                self.ydata-self.zz, self.sigmay),1)
-                self.laststrip = 1
-            else:
-                if DEBUG:
-                    print("Using previous data")
-                self.datatofit = numpy.concatenate((self.xdata,
-                                self.ydata, self.sigmay),1)
-                self.laststrip = 0
+    def __getPeakArray(self, param, hypermet):
+        """
+        Fill the (height, position, fwhm, shape parameters) array expected by
+        SpecfitFuns for all the lines of all the peak groups.
+        """
+        gain = param[1]
+        noise= param[2] * param[2]
+        fano = param[3] * 2.3548*2.3548*0.00385
+        PARAMETERS = self.PARAMETERS
+        energy = self._peakEnergy
+        a = numpy.zeros((len(energy), self._peakColumns), numpy.float)
+        a[:, 0] = self._peakRate * \
+                  numpy.take(param[self.NGLOBAL:], self._peakGroup) * gain
+        a[:, 1] = energy
+        a[:, 2] = numpy.sqrt(noise + (energy > 0) * energy * fano)
+        if hypermet:
+            main = self._peakMain
+            a[:, 3] = param[PARAMETERS.index('ST AreaR')] * main
+            a[:, 4] = param[PARAMETERS.index('ST SlopeR')]
+            a[:, 5] = param[PARAMETERS.index('LT AreaR')] * main
+            a[:, 6] = param[PARAMETERS.index('LT SlopeR')]
+            a[:, 7] = param[PARAMETERS.index('STEP HeightR')] * main
+        else:
+            a[:, 3] = param[PARAMETERS.index('Eta Factor')]
+        return a
 
     def setdata(self, *var, **kw):
         print("ClassMcaTheory.setdata deprecated, please use setData")
@@ -1212,7 +1440,7 @@ def __getselfzz(self):
     def getPeakMatrixContribution(self,param0,t0=None,hypermet=None,
                                   continuum=None,summing=None):
         """
-        For the time being a huge copy paste from mcatheory
+        Return the unit area contribution of each peak group
         """
         if continuum is None:
             continuum = self.__CONTINUUM
@@ -1221,7 +1449,6 @@ def getPeakMatrixContribution(self,param0,t0=None,hypermet=None,
         if summing is None:
             summing  = self.__SUM
         param= numpy.array(param0)
-        #param= numpy.ones(param.shape, numpy.float)
         if t0 is None:t0 = self.xdata
         x    = numpy.array(t0)
         matrix = numpy.zeros((len(x),len(param)-self.NGLOBAL)).astype(numpy.float)
@@ -1230,104 +1457,16 @@ def getPeakMatrixContribution(self,param0,t0=None,hypermet=None,
         zero = param[0]
         gain = param[1]
         energy=zero + gain * x
-        #print energy
-        noise= param[2] * param[2]
-        fano = param[3] * 2.3548*2.3548*0.00385
-        #t=time.time()
-        PEAKS0 = self.PEAKS0
-        PEAKS0ESCAPE = self.PEAKS0ESCAPE
-        PEAKSW = self.PEAKSW
-        PARAMETERS = self.PARAMETERS
-        FASTER = 0
+        # unit areas
+        a = self.__getPeakArray(param, hypermet)
+        a[:, 0] = self._peakRate * gain
+        limits = self._peakLimits
         for i in range(len(param[self.NGLOBAL:])):
-            result = 0 * energy
-            if self.ESCAPE:
-                #area = param[NGLOBAL+i]
-                (r,c) = (PEAKS0[i]).shape
-                PEAKSW[i][0:r,0] = PEAKS0[i][:,0] * 1 * gain
-                PEAKSW[i][0:r,1] = PEAKS0[i][:,1] * 1.0
-                PEAKSW[i][0:r,2] = numpy.sqrt(noise + PEAKS0[i][:,1] * fano)
-                #escape
-                if OLDESCAPE:
-                    PEAKSW[i][r:,0] = PEAKSW[i][0:r,0] * PEAKS0[i][:,3]
-                    PEAKSW[i][r:,1] = PEAKS0[i][:,1] - self.config['detector']['detene']
-                    PEAKSW[i][r:,2] = numpy.sqrt(noise + \
-                                        (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
-                else:
-                    ii=0
-                    j=0
-                    for esc_group in PEAKS0ESCAPE[i]:
-                        for esc_line in esc_group:
-                            esc_ene  = esc_line[0] * 1.0
-                            esc_rate = esc_line[1]
-                            PEAKSW[i][j+r,0] =  PEAKSW[i][ii,0] * esc_rate
-                            PEAKSW[i][j+r,1] =  esc_ene
-                            j = j + 1
-                        ii = ii + 1
-                    PEAKSW[i][r:, 2] = numpy.sqrt(noise + \
-                                    (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
-                (rw,cw) = (PEAKSW[i]).shape
-                if 0 and self.PARAMETERS[self.NGLOBAL+i] =='Fe K':
-                  for ii in range(rw):
-                    if ii < r:
-                        print(self.PARAMETERS[self.NGLOBAL+i],"PEAK ",ii,PEAKSW[i][ii])
-                    else:
-                        print(self.PARAMETERS[self.NGLOBAL+i],"PEAKesc ",ii,PEAKSW[i][ii])
-                #print PARAMETERS[self.NGLOBAL+i]
-                #print PEAKSW[i][:,1]
-                #print PEAKS0ESCAPE[i]
-                #for j in range(PEAKSW[i].shape[0]):
-                #    print "H = ", PEAKSW[i][j*r,0],"E = ",PEAKSW[i][j*r,1]
-
-                #if HYPERMET:
-                if hypermet:
-                    PEAKSW[i] [0:r,3] = param[PARAMETERS.index('ST AreaR')]
-                    PEAKSW[i] [:,4] = param[PARAMETERS.index('ST SlopeR')]
-                    PEAKSW[i] [0:r,5] = param[PARAMETERS.index('LT AreaR')]
-                    PEAKSW[i] [:,6] = param[PARAMETERS.index('LT SlopeR')]
-                    PEAKSW[i] [0:r,7] = param[PARAMETERS.index('STEP HeightR')]
-                    #neglect tails in escape peaks
-                    PEAKSW[i] [r:,3] = 0.0
-                    PEAKSW[i] [r:,5] = 0.0
-                    PEAKSW[i] [r:,7] = 0.0
-                if not FASTER:
-                    #if HYPERMET:
-                    if hypermet:
-                        if i == 0:
-                            result = SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                        else:
-                            result += SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                    else:
-                        if i == 0:
-                            result = SpecfitFuns.apvoigt(PEAKSW[i],energy)
-                        else:
-                            result += SpecfitFuns.apvoigt(PEAKSW[i],energy)
+            if hypermet:
+                result = SpecfitFuns.ahypermet(a[limits[i]:limits[i+1]],
+                                               energy, hypermet)
             else:
-                PEAKSW[i][:,0] = PEAKS0[i][:,0] * param[self.NGLOBAL+i] * gain
-                PEAKSW[i][:,1] = PEAKS0[i][:,1] * 1.0
-                PEAKSW[i][:,2] = numpy.sqrt(noise + PEAKS0[i][:,1] * fano)
-                if hypermet:
-                    PEAKSW[i] [:,3] = param[PARAMETERS.index('ST AreaR')]
-                    PEAKSW[i] [:,4] = param[PARAMETERS.index('ST SlopeR')]
-                    PEAKSW[i] [:,5] = param[PARAMETERS.index('LT AreaR')]
-                    PEAKSW[i] [:,6] = param[PARAMETERS.index('LT SlopeR')]
-                    PEAKSW[i] [:,7] = param[PARAMETERS.index('STEP HeightR')]
-                else:
-                    #pseudo voigt
-                    PEAKSW[i] [:,3] = param[PARAMETERS.index('Eta Factor')]
-                if not FASTER:
-                    if hypermet:
-                        if i == 0:
-                            result = SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                        else:
-                            result += SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                    else:
-                        if i == 0:
-                            result = SpecfitFuns.apvoigt(PEAKSW[i],energy)
-                        else:
-                            result += SpecfitFuns.apvoigt(PEAKSW[i],energy)
-            #print "shape = ",result.shape
-            #print "matrix = ",matrix.shape
+                result = SpecfitFuns.apvoigt(a[limits[i]:limits[i+1]], energy)
             matrix[:,i] = result[:,0]
         return matrix
 
@@ -1367,125 +1506,15 @@ def mcatheory(self,param0,t0,hypermet=None,continuum=None,summing=None):
         zero = param[0]
         gain = param[1]
         energy=zero + gain * x
-        #print energy
-        noise= param[2] * param[2]
-        fano = param[3] * 2.3548*2.3548*0.00385
-        #t=time.time()
-        PEAKS0 = self.PEAKS0
-        PEAKS0ESCAPE = self.PEAKS0ESCAPE
-        PEAKSW = self.PEAKSW
-        PARAMETERS = self.PARAMETERS
-        FASTER = self.FASTER
-        for i in range(len(param[self.NGLOBAL:])):
-            if self.ESCAPE:
-                #area = param[NGLOBAL+i]
-                (r,c) = (PEAKS0[i]).shape
-                PEAKSW[i][0:r,0] = PEAKS0[i][:,0] * param[self.NGLOBAL+i] * gain
-                PEAKSW[i][0:r,1] = PEAKS0[i][:,1] * 1.0
-                PEAKSW[i][0:r,2] = numpy.sqrt(noise + PEAKS0[i][:,1] * fano)
-                #escape
-                if OLDESCAPE:
-                    PEAKSW[i][r:,0] = PEAKSW[i][0:r,0] * PEAKS0[i][:,3]
-                    PEAKSW[i][r:,1] = PEAKS0[i][:,1] - self.config['detector']['detene']
-                    PEAKSW[i][r:,2] = numpy.sqrt(noise + \
-                                        (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
-                else:
-                    ii=0
-                    j=0
-                    for esc_group in PEAKS0ESCAPE[i]:
-                        for esc_line in esc_group:
-                            esc_ene  = esc_line[0] * 1.0
-                            esc_rate = esc_line[1]
-                            PEAKSW[i][j+r,0] =  PEAKSW[i][ii,0] * esc_rate
-                            PEAKSW[i][j+r,1] =  esc_ene
-                            j = j + 1
-                        ii = ii + 1
-                    PEAKSW[i][r:, 2] = numpy.sqrt(noise + \
-                                    (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
-                (rw,cw) = (PEAKSW[i]).shape
-                if 0 and self.PARAMETERS[self.NGLOBAL+i] =='Fe K':
-                  for ii in range(rw):
-                    if ii < r:
-                        print(self.PARAMETERS[self.NGLOBAL+i],"PEAK ",ii,PEAKSW[i][ii])
-                    else:
-                        print(self.PARAMETERS[self.NGLOBAL+i],"PEAKesc ",ii,PEAKSW[i][ii])
-                #print PARAMETERS[self.NGLOBAL+i]
-                #print PEAKSW[i][:,1]
-                #print PEAKS0ESCAPE[i]
-                #for j in range(PEAKSW[i].shape[0]):
-                #    print "H = ", PEAKSW[i][j*r,0],"E = ",PEAKSW[i][j*r,1]
-
-                #if HYPERMET:
-                if hypermet:
-                    PEAKSW[i] [0:r,3] = param[PARAMETERS.index('ST AreaR')]
-                    PEAKSW[i] [:,4] = param[PARAMETERS.index('ST SlopeR')]
-                    PEAKSW[i] [0:r,5] = param[PARAMETERS.index('LT AreaR')]
-                    PEAKSW[i] [:,6] = param[PARAMETERS.index('LT SlopeR')]
-                    PEAKSW[i] [0:r,7] = param[PARAMETERS.index('STEP HeightR')]
-                    #neglect tails in escape peaks
-                    PEAKSW[i] [r:,3] = 0.0
-                    PEAKSW[i] [r:,5] = 0.0
-                    PEAKSW[i] [r:,7] = 0.0
-                else:
-                    PEAKSW[i] [:,3] = param[PARAMETERS.index('Eta Factor')]
-                if not FASTER:
-                    print("not FASTER")
-                    #if HYPERMET:
-                    if hypermet:
-                        if i == 0:
-                            result = SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                        else:
-                            result += SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                    else:
-                        if i == 0:
-                            result = SpecfitFuns.apvoigt(PEAKSW[i],energy)
-                        else:
-                            result += SpecfitFuns.apvoigt(PEAKSW[i],energy)
-            else:
-                PEAKSW[i][:,0] = PEAKS0[i][:,0] * param[self.NGLOBAL+i] * gain
-                PEAKSW[i][:,1] = PEAKS0[i][:,1] * 1.0
-                PEAKSW[i][:,2] = numpy.sqrt(noise + PEAKS0[i][:,1] * fano)
-                if hypermet:
-                    PEAKSW[i] [:,3] = param[PARAMETERS.index('ST AreaR')]
-                    PEAKSW[i] [:,4] = param[PARAMETERS.index('ST SlopeR')]
-                    PEAKSW[i] [:,5] = param[PARAMETERS.index('LT AreaR')]
-                    PEAKSW[i] [:,6] = param[PARAMETERS.index('LT SlopeR')]
-                    PEAKSW[i] [:,7] = param[PARAMETERS.index('STEP HeightR')]
-                else:
-                    PEAKSW[i] [:,3] = param[PARAMETERS.index('Eta Factor')]
-                if not FASTER:
-                    if hypermet:
-                        if i == 0:
-                            result = SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                        else:
-                            result += SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                    else:
-                        if i == 0:
-                            result = SpecfitFuns.apvoigt(PEAKSW[i],energy)
-                        else:
-                            result += SpecfitFuns.apvoigt(PEAKSW[i],energy)
-        #print PARAMETERS[self.NGLOBAL+4]
-        #print self.PEAKS0NAMES[4]
-        #print PEAKSW[4]
-        #print "loop takes ",time.time()-t
-        #loop takes 0.006 seconds
-        #t=time.time()
-        if FASTER:
-            if len(PEAKSW[:]):
-                a=numpy.concatenate(PEAKSW[:])
-                #t=time.time()
-                #result = SpecfitFuns.agauss(a,energy)
-                #if HYPERMET:
-                if hypermet:
-                    result = SpecfitFuns.fastahypermet(a,energy,hypermet)
-                else:
-                    result = SpecfitFuns.apvoigt(a,energy)
+        #the loop over the peak groups is replaced by a single array
+        if len(self._peakGroup):
+            a = self.__getPeakArray(param, hypermet)
+            if hypermet:
+                result = self.__hypermet(a,energy,hypermet)
             else:
-                result = 0.0 * x
-            #print "eval = ",time.time()-t
-        #evaluation takes 0.058 seconds
-        #with less peaks 0.036
-        #with tabulated function 0.018
+                result = SpecfitFuns.apvoigt(a,energy)
+        else:
+            result = 0.0 * x
         if continuum:
             result += self.continuum(param,x)
         if summing:
@@ -1580,6 +1609,12 @@ def linearMcaTheoryDerivative(self, param0, index, t0):
             #print "f1,f2,delta = ",f1,f2,delta
             return (f1-f2) / (2.0 * delta)
 
+    def __hypermet(self, a, energy, hypermet):
+        if self.FASTER:
+            return SpecfitFuns.fastahypermet(a, energy, hypermet)
+        else:
+            return SpecfitFuns.ahypermet(a, energy, hypermet)
+
     def analyticalDerivative(self, param0, index, t0):
         """
         analyticalDerivative(self, parameters, index, x)
@@ -1590,75 +1625,17 @@ def analyticalDerivative(self, param0, index, t0):
         NGLOBAL = self.NGLOBAL
         HYPERMET = self.__HYPERMET
         PARAMETERS = self.PARAMETERS
-        ESCAPE = self.ESCAPE
-        PEAKS0 = self.PEAKS0
         if index > NGLOBAL-1:
          param=numpy.array(param0)
          x=numpy.array(t0)
          zero = param[0]
          gain = param[1] * 1.0
          energy=zero + gain * x
-         #print energy
-         noise= param[2]*param[2]
-         fano = param[3]*2.3548*2.3548*0.00385
          i=index-NGLOBAL
-         #for i in range(len(param[index-4]))):
-         if ESCAPE:
-            (r,c) = (PEAKS0[i]).shape
-            if OLDESCAPE:
-                if HYPERMET:
-                    dummy      = numpy.ones((2*r,3+5*(HYPERMET > 0)), numpy.float)
-                else:
-                    dummy      = numpy.ones((2*r,3+1), numpy.float)
-                dummy[0:r,0] = PEAKS0[i][:,0] * gain
-                dummy[0:r,1] = PEAKS0[i][:,1] * 1.0
-                dummy[0:r,2] = numpy.sqrt(noise+ PEAKS0[i][:,1] * fano)
-                dummy[r:,0] = PEAKS0[i][:,0] * gain * PEAKS0[i][:,3]
-                dummy[r:,1] = PEAKS0[i][:,1] - self.config['detector']['detene']
-                dummy[r:,2] = numpy.sqrt(noise + (dummy[r:,1]>0) * dummy[r:,1] * fano)
-            else:
-                n_escape_lines = self.PEAKSW[i].shape[0] - r
-                #if 1:print "nlines = ",r, "n escape lines =",n_escape_lines
-                if HYPERMET:
-                    dummy    = numpy.ones((r + n_escape_lines, 3+5*(HYPERMET > 0)), numpy.float)
-                else:
-                    dummy    = numpy.ones((r + n_escape_lines, 3+1), numpy.float)
-                dummy[0:r,0] = PEAKS0[i][:,0] * gain
-                dummy[0:r,1] = PEAKS0[i][:,1] * 1.0
-                dummy[0:r,2] = numpy.sqrt(noise+ PEAKS0[i][:,1] * fano)
-                ii=0
-                j=0
-                for esc_group in self.PEAKS0ESCAPE[i]:
-                    for esc_line in esc_group:
-                        esc_ene  = esc_line[0] * 1.0
-                        esc_rate = esc_line[1]
-                        dummy[j+r, 0] =  dummy[ii,0] * esc_rate
-                        dummy[j+r, 1] =  esc_ene
-                        j = j + 1
-                    ii = ii + 1
-                dummy[r:, 2] = numpy.sqrt(noise + (dummy[r:,1]>0) * dummy[r:,1] * fano)
-                #for jj in range(r+n_escape_lines):
-                #    print index, dummy[jj, 1], dummy[jj, 0], dummy[jj, 2]
-         else:
-            (r,c) = (PEAKS0[i]).shape
-            if HYPERMET:
-                dummy      = numpy.ones((r,3+5*(HYPERMET > 0)),numpy.float)
-            else:
-                dummy      = numpy.ones((r,3+1),numpy.float)
-            dummy[0:r,0] = PEAKS0[i][:,0] * gain
-            dummy[0:r,1] = PEAKS0[i][:,1] * 1.0
-            dummy[0:r,2] = numpy.sqrt(noise + PEAKS0[i][:,1] * fano)
-         if HYPERMET:
-                dummy[0:r,3] = param[PARAMETERS.index('ST AreaR')]
-                dummy[r:,3]  = 0.0
-                dummy[:,4] = param[PARAMETERS.index('ST SlopeR')]
-                dummy[0:r,5] = param[PARAMETERS.index('LT AreaR')]
-                dummy[r:,5]  = 0.0
-                dummy[:,6] = param[PARAMETERS.index('LT SlopeR')]
-                dummy[0:r,7] = param[PARAMETERS.index('STEP HeightR')]
-                dummy[r:,7]  = 0.0
-         else:
-                dummy[0:,3] = param[PARAMETERS.index('Eta Factor')]
+         dummy = self.__getPeakArray(param, HYPERMET)[self._peakLimits[i]:
+                                                      self._peakLimits[i+1]]
+         dummy[:, 0] = self._peakRate[self._peakLimits[i]:
+                                      self._peakLimits[i+1]] * gain
          if self.FASTER:
             if HYPERMET:
                 return SpecfitFuns.fastahypermet(dummy,energy,HYPERMET)
@@ -1726,6 +1703,70 @@ def analyticalDerivative(self, param0, index, t0):
             #print "f1,f2,delta = ",f1,f2,delta
             return (f1-f2) / (2.0 * delta)
 
+    def analyticalJacobian(self, param0, free_index, t0):
+        """
+        analyticalJacobian(self, parameters, free_index, x)
+        Internal function returning the derivatives of the fitting function
+        respect to the parameters given by free_index as an array of shape
+        [len(free_index), len(x)].
+        All the peak profiles are obtained from a single array of lines and,
+        when neither the pile-up nor the continuum depend on the calibration,
+        the derivatives respect to zero and gain share the same evaluation.
+        """
+        NGLOBAL = self.NGLOBAL
+        HYPERMET = self.__HYPERMET
+        param = numpy.array(param0, numpy.float)
+        x = numpy.array(t0)
+        zero = param[0]
+        gain = param[1] * 1.0
+        energy = zero + gain * x
+        jacobian = numpy.zeros((len(free_index), x.size), numpy.float)
+        calibration = (not self.__SUM) and \
+            (self.__CONTINUUM < CONTINUUM_LIST.index('Linear Polynomial'))
+        unitArray = None
+        derivative = None
+        for k in range(len(free_index)):
+            index = free_index[k]
+            if index > NGLOBAL-1:
+                if unitArray is None:
+                    unitArray = self.__getPeakArray(param, HYPERMET)
+                    unitArray[:, 0] = self._peakRate * gain
+                i = index - NGLOBAL
+                dummy = unitArray[self._peakLimits[i]:self._peakLimits[i+1]]
+                if HYPERMET:
+                    result = self.__hypermet(dummy,energy,HYPERMET)
+                else:
+                    result = SpecfitFuns.apvoigt(dummy,energy)
+                jacobian[k] = numpy.ravel(result)
+            elif calibration and (index in [0, 1]) and len(self._peakGroup):
+                if derivative is None:
+                    # derivative of the peaks respect to the energy
+                    a = self.__getPeakArray(param, HYPERMET)
+                    # the step is taken on the energy scale as a small
+                    # fraction of the channel width, it cannot collapse
+                    # when the zero is close to 0
+                    delta = (abs(gain) + numpy.equal(gain, 0.0)) * 0.001
+                    if HYPERMET:
+                        peaks = self.__hypermet(a,energy,HYPERMET)
+                        f1 = self.__hypermet(a,energy+delta,HYPERMET)
+                        f2 = self.__hypermet(a,energy-delta,HYPERMET)
+                    else:
+                        peaks = SpecfitFuns.apvoigt(a,energy)
+                        f1 = SpecfitFuns.apvoigt(a,energy+delta)
+                        f2 = SpecfitFuns.apvoigt(a,energy-delta)
+                    peaks = numpy.ravel(peaks)
+                    derivative = numpy.ravel(f1 - f2) / (2.0 * delta)
+                if index == 0:
+                    jacobian[k] = derivative
+                else:
+                    # the heights are proportional to the gain
+                    jacobian[k] = peaks / gain + numpy.ravel(x) * derivative
+            else:
+                jacobian[k] = numpy.ravel(self.analyticalDerivative(param,
+                                                                    index,
+                                                                    x))
+        return jacobian
+
     def estimate(self):
         if self.__toBeConfigured:
             if DEBUG:
@@ -2102,6 +2143,7 @@ def startfit(self,digest=0, linear=None, currentIteration=None):
                                            weightflag=self.config['fit']['fitweight'],
                                            maxiter=self.MAXITER,
                                            model_deriv=self.analyticalDerivative,
+                                           model_jacobian=self.analyticalJacobian,
                                            deltachi=self.config['fit']['deltachi'],
                                            fulloutput=1, linear=linear)
             if self.__SUM and linear:
@@ -2121,6 +2163,7 @@ def startfit(self,digest=0, linear=None, currentIteration=None):
                                            weightflag=self.config['fit']['fitweight'],
                                            maxiter=self.MAXITER,
                                            model_deriv=self.analyticalDerivative,
+                                           model_jacobian=self.analyticalJacobian,
                                            deltachi=self.config['fit']['deltachi'],
                                            fulloutput=1, linear=linear)
         self.fittedpar=fitresult[0]
@@ -2491,64 +2534,12 @@ def getpeaksw(self,param,hypermet=None,continuum=None):
             continuum = self.__CONTINUUM
         if hypermet is None:
             hypermet = self.__HYPERMET
-        # zero = param[0]
-        gain = param[1]
-        #energy=zero + gain * x
-        #print energy
-        noise= param[2] * param[2]
-        fano = param[3] * 2.3548*2.3548*0.00385
-        #t=time.time()
-        PEAKS0 = self.PEAKS0
-        PEAKS0ESCAPE = self.PEAKS0ESCAPE
         PEAKSW = self.PEAKSW
-        PARAMETERS = self.PARAMETERS
-        for i in range(len(param[self.NGLOBAL:])):
-            if self.ESCAPE:
-                #area = param[NGLOBAL+i]
-                (r,c) = (PEAKS0[i]).shape
-                PEAKSW[i][0:r,0] = PEAKS0[i][:,0] * param[self.NGLOBAL+i] * gain
-                PEAKSW[i][0:r,1] = PEAKS0[i][:,1] * 1.0
-                PEAKSW[i][0:r,2] = numpy.sqrt(noise + PEAKS0[i][:,1] * fano)
-                #escape
-                if OLDESCAPE:
-                    PEAKSW[i][r:,0] = PEAKSW[i][0:r,0] * PEAKS0[i][:,3]
-                    PEAKSW[i][r:,1] = PEAKS0[i][:,1] - self.config['detector']['detene']
-                    PEAKSW[i][r:,2] = numpy.sqrt(noise + (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
-                else:
-                    ii=0
-                    j=0
-                    for esc_group in PEAKS0ESCAPE[i]:
-                        for esc_line in esc_group:
-                            esc_ene  = esc_line[0] * 1.0
-                            esc_rate = esc_line[1]
-                            PEAKSW[i][j+r,0] =  PEAKSW[i][ii,0] * esc_rate
-                            PEAKSW[i][j+r,1] =  esc_ene
-                            j = j + 1
-                        ii = ii + 1
-                    PEAKSW[i][r:, 2] = numpy.sqrt(noise + \
-                                    (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
-                #if HYPERMET:
-                if hypermet:
-                    PEAKSW[i] [0:r,3] = param[PARAMETERS.index('ST AreaR')]
-                    PEAKSW[i] [:,4] = param[PARAMETERS.index('ST SlopeR')]
-                    PEAKSW[i] [0:r,5] = param[PARAMETERS.index('LT AreaR')]
-                    PEAKSW[i] [:,6] = param[PARAMETERS.index('LT SlopeR')]
-                    PEAKSW[i] [0:r,7] = param[PARAMETERS.index('STEP HeightR')]
-                    #neglect tails in escape peaks
-                    PEAKSW[i] [r:,3] = 0.0
-                    PEAKSW[i] [r:,5] = 0.0
-                    PEAKSW[i] [r:,7] = 0.0
-            else:
-                # area = param[self.NGLOBAL + i]
-                PEAKSW[i][:,0] = PEAKS0[i][:,0] * param[self.NGLOBAL+i] * gain
-                PEAKSW[i][:,1] = PEAKS0[i][:,1] * 1.0
-                PEAKSW[i][:,2] = numpy.sqrt(noise + PEAKS0[i][:,1] * fano)
-                if hypermet:
-                    PEAKSW[i] [:,3] = param[PARAMETERS.index('ST AreaR')]
-                    PEAKSW[i] [:,4] = param[PARAMETERS.index('ST SlopeR')]
-                    PEAKSW[i] [:,5] = param[PARAMETERS.index('LT AreaR')]
-                    PEAKSW[i] [:,6] = param[PARAMETERS.index('LT SlopeR')]
-                    PEAKSW[i] [:,7] = param[PARAMETERS.index('STEP HeightR')]
+        if len(self._peakGroup):
+            a = self.__getPeakArray(numpy.array(param), hypermet)
+            limits = self._peakLimits
+            for i in range(len(PEAKSW)):
+                PEAKSW[i][:, :] = a[limits[i]:limits[i+1]]
         return PEAKSW
 
     # UTILITIES #
@@ -39,9 +39,11 @@
 from . import ClassMcaTheory
 from PyMca5.PyMcaMath.fitting import Gefit
 from . import ConcentrationsTool
-from PyMca5.PyMcaMath.fitting import SpecfitFuns
+from PyMca5.PyMcaMath import SNIPModule
 from PyMca5.PyMcaIO import ConfigDict
+from PyMca5.PyMcaIO import ArraySave
 import time
+from multiprocessing.pool import ThreadPool
 
 DEBUG = 0
 
@@ -65,7 +67,9 @@ def setFitConfigurationFile(self, ffile):
 
     def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                            configuration=None, concentrations=False,
-                           ysum=None, weight=None, refit=True):
+                           ysum=None, weight=None, refit=True,
+                           nthreads=None, nworkers=None, output=None,
+                           compression=None):
         """
         This method performs the actual fit. The y keyword is the only mandatory input argument.
 
@@ -73,10 +77,14 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
         :param y: 3D array containing the spectra as [nrows, ncolumns, nchannels]
         :param xmin: lower limit of the fitting region
         :param xmax: upper limit of the fitting region
-        :param weight: 0 Means no weight, 1 Use an average weight, 2 Individual weights (slow)
+        :param weight: 0 Means no weight, 1 Use an average weight, 2 Individual weights
         :param concentrations: 0 Means no calculation, 1 Calculate them
         :param refit: if False, no check for negative results. Default is True.
-        :return: A dictionnary with the parameters, uncertainties, concentrations and names as keys.
+        :param nthreads: Number of threads used for the background stripping. Default is 1.
+        :param nworkers: Number of threads sharing the rows of the first fit. Default is 1.
+        :param output: Optional HDF5 group where parameters and uncertainties are written as they are obtained.
+        :param compression: Compression of the datasets written to output (see ArraySave.getCompressionFilters)
+        :return: A dictionnary with the parameters, uncertainties, chisq, concentrations and names as keys.
         """
         if y is None:
             raise RuntimeError("y keyword argument is mandatory!")
@@ -260,13 +268,14 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
         # allocate the output buffer
         results = numpy.zeros((nFree, nRows, nColumns), numpy.float32)
         uncertainties = numpy.zeros((nFree, nRows, nColumns), numpy.float32)
+        chisq = numpy.zeros((nRows, nColumns), numpy.float32)
 
         #perform the initial fit
         if DEBUG:
             print("Configuration elapsed = %f"  % (time.time() - t0))
             t0 = time.time()
         totalSpectra = data.shape[0] * data.shape[1]
-        jStep = min(100, data.shape[1])
+        iStep, jStep = getReadSteps(data)
         if weightPolicy == 2:
             SVD = False
             sigma_b = None
@@ -277,183 +286,185 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
         else:
             SVD = True
             sigma_b = None
-        last_svd = None
-        for i in range(0, data.shape[0]):
-            #print(i)
-            #chunks of nColumns spectra
-            if i == 0:
-                chunk = numpy.zeros((dummySpectrum.shape[0],
-                                     jStep),
-                                     numpy.float)
-            jStart = 0
-            while jStart < data.shape[1]:
-                jEnd = min(jStart + jStep, data.shape[1])
-                chunk[:,:(jEnd - jStart)] = data[i, jStart:jEnd, iXMin:iXMax+1].T
-                if config['fit']['stripflag']:
-                    for k in range(jStep):
-                        # obtain the smoothed spectrum
-                        background=SpecfitFuns.SavitskyGolay(chunk[:, k],
-                                                config['fit']['stripfilterwidth'])
-                        lastAnchor = 0
-                        for anchor in anchorslist:
-                            if (anchor > lastAnchor) and (anchor < background.size):
-                                background[lastAnchor:anchor] =\
-                                        SpecfitFuns.snip1d(background[lastAnchor:anchor],
-                                                           config['fit']['snipwidth'],
-                                                           0)
-                                lastAnchor = anchor
-                        if lastAnchor < background.size:
-                            background[lastAnchor:] =\
-                                    SpecfitFuns.snip1d(background[lastAnchor:],
-                                                       config['fit']['snipwidth'],
-                                                       0)
-                        chunk[:, k] -= background
-
-                # perform the multiple fit to all the spectra in the chunk
-                #print("SHAPES")
-                #print(derivatives.shape)
-                #print(chunk[:,:(jEnd - jStart)].shape)
-                ddict=lstsq(derivatives, chunk[:,:(jEnd - jStart)],
-                            sigma_b=sigma_b,
-                            weight=weight,
-                            digested_output=True,
-                            svd=SVD,
-                            last_svd=last_svd)
-                last_svd = ddict.get('svd', None)
-                parameters = ddict['parameters']
-                results[:, i, jStart:jEnd] = parameters
-                uncertainties[:, i, jStart:jEnd] = ddict['uncertainties']
-                jStart = jEnd
-        if DEBUG:
-            t = time.time() - t0
-            print("First fit elapsed = %f" % t)
-            print("Spectra per second = %f" % (data.shape[0]*data.shape[1]/float(t)))
-            t0 = time.time()
-
-        # cleanup zeros
-        # start with the parameter with the largest amount of negative values
-        if refit:
-            negativePresent = True
-        else:
-            negativePresent = False
-        nFits = 0
-        while negativePresent:
-            zeroList = []
-            #totalNegative = 0
-            for i in range(nFree):
-                #we have to skip the background parameters
-                if i >= nFreeBackgroundParameters:
-                    t = results[i] < 0
-                    tsum = t.sum()
-                    if tsum > 0:
-                        zeroList.append((tsum, i, t))
-                    #totalNegative += tsum
-            #print("totalNegative = ", totalNegative)
-
-            if len(zeroList) == 0:
-                negativePresent = False
-                continue
-
-            if nFits > (2 * (nFree - nFreeBackgroundParameters)):
-                # we are probably in an endless loop
-                # force negative pixels
-                for item in zeroList:
-                    i = item[1]
-                    badMask = item[2]
-                    results[i][badMask] = 0.0
-                    print("WARNING: %d pixels of parameter %s forced to zero" % (item[0], freeNames[i]))
-                continue
-            zeroList.sort()
-            zeroList.reverse()
-
-            badParameters = []
-            badParameters.append(zeroList[0][1])
-            badMask = zeroList[0][2]
-            if 1:
-                # prevent and endless loop if two or more parameters have common pixels where they are
-                # negative and one of them remains negative when forcing other one to zero
-                for i, item in enumerate(zeroList):
-                    if item[1] not in badParameters:
-                        if item[0] > 0:
-                            #check if they have common negative pixels
-                            t = badMask * item[-1]
-                            if t.sum() > 0:
-                                badParameters.append(item[1])
-                                badMask = t
-            if badMask.sum() < (0.0025 * nPixels):
-                # fit not worth
-                for i in badParameters:
-                    results[i][badMask] = 0.0
-                    uncertainties[i][badMask] = 0.0
-                    if DEBUG:
-                        print("WARNING: %d pixels of parameter %s set to zero" % (badMask.sum(),
-                                                                                  freeNames[i]))
+        # the writer is always closed, the data not yet written being written
+        # before leaving and any writing error being raised
+        with ArraySave.HDF5Writer() as writer:
+            if output is not None:
+                # chunks matching the fitted blocks and the writing done by a
+                # background thread while the fit continues
+                outputParameters = ArraySave.createHDF5Dataset(output,
+                                            "parameters",
+                                            results.shape,
+                                            results.dtype,
+                                            chunks=(1, iStep, jStep),
+                                            compression=compression)
+                outputUncertainties = ArraySave.createHDF5Dataset(output,
+                                            "uncertainties",
+                                            uncertainties.shape,
+                                            uncertainties.dtype,
+                                            chunks=(1, iStep, jStep),
+                                            compression=compression)
+                outputChisq = ArraySave.createHDF5Dataset(output,
+                                            "chisq",
+                                            chisq.shape,
+                                            chisq.dtype,
+                                            chunks=(iStep, jStep),
+                                            compression=compression)
+
+            def readBlock(block):
+                iStart, iEnd, jStart, jEnd = block
+                return data[iStart:iEnd, jStart:jEnd, iXMin:iXMax+1]
+
+            def fitRows(rows):
+                # every call has its own SVD cache while the matrix of derivatives
+                # and the output arrays are shared
+                blockList = []
+                for iStart in range(rows[0], rows[-1] + 1, iStep):
+                    iEnd = min(iStart + iStep, rows[-1] + 1)
+                    for jStart in range(0, nColumns, jStep):
+                        jEnd = min(jStart + jStep, nColumns)
+                        blockList.append((iStart, iEnd, jStart, jEnd))
+                if isinstance(data, numpy.ndarray):
+                    reader = None
+                else:
+                    # read the next block from file while the current one is fitted
+                    reader = ThreadPool(1)
+                    nextBlock = reader.apply_async(readBlock, (blockList[0],))
+                last_svd = None
+                try:
+                    for n, block in enumerate(blockList):
+                        iStart, iEnd, jStart, jEnd = block
+                        if reader is None:
+                            chunk = readBlock(block)
+                        else:
+                            chunk = nextBlock.get()
+                            if n + 1 < len(blockList):
+                                nextBlock = reader.apply_async(readBlock,
+                                                        (blockList[n + 1],))
+                        chunk = numpy.array(chunk.reshape(-1, chunk.shape[-1]).T,
+                                            dtype=numpy.float64)
+                        if config['fit']['stripflag']:
+                            # obtain the smoothed and stripped background of all the
+                            # spectra of the chunk at once
+                            chunk -= SNIPModule.getMultipleSpectraBackground(chunk,
+                                        config['fit']['snipwidth'],
+                                        anchorslist=anchorslist,
+                                        filterwidth=config['fit']['stripfilterwidth'],
+                                        mcaIndex=0,
+                                        nthreads=nthreads)
+
+                        # perform the multiple fit to all the spectra in the chunk
+                        ddict=lstsq(derivatives, chunk,
+                                    sigma_b=sigma_b,
+                                    weight=weight,
+                                    digested_output=True,
+                                    svd=SVD,
+                                    last_svd=last_svd,
+                                    chisq=True)
+                        last_svd = ddict.get('svd', None)
+                        shape = nFree, iEnd - iStart, jEnd - jStart
+                        results[:, iStart:iEnd, jStart:jEnd] = \
+                                    ddict['parameters'].reshape(shape)
+                        uncertainties[:, iStart:iEnd, jStart:jEnd] = \
+                                    ddict['uncertainties'].reshape(shape)
+                        chisq[iStart:iEnd, jStart:jEnd] = \
+                                    ddict['chisq'].reshape(shape[1:])
+                        if output is not None:
+                            selection = (slice(iStart, iEnd), slice(jStart, jEnd))
+                            writer.write(outputParameters,
+                                         (slice(None),) + selection,
+                                         results[:, iStart:iEnd, jStart:jEnd])
+                            writer.write(outputUncertainties,
+                                         (slice(None),) + selection,
+                                         uncertainties[:, iStart:iEnd, jStart:jEnd])
+                            writer.write(outputChisq,
+                                         selection,
+                                         chisq[iStart:iEnd, jStart:jEnd])
+                finally:
+                    if reader is not None:
+                        reader.close()
+                        reader.join()
+
+            if (nworkers is None) or (nworkers < 2) or (nRows <= iStep):
+                fitRows(range(nRows))
             else:
-                if DEBUG:
-                    print("Number of secondary fits = %d" % (nFits + 1))
-                nFits += 1
-                A = derivatives[:, [i for i in range(nFree) if i not in badParameters]]
-                #assume we'll not have too many spectra
+                # The heavy work (reading, SNIP and BLAS) is done without holding
+                # the GIL, therefore a pool of threads is enough and it allows to
+                # write the results in place. Several blocks per worker provide
+                # some load balancing.
+                rowStep = max(1, nRows // (4 * nworkers * iStep)) * iStep
+                blocks = [range(i, min(i + rowStep, nRows)) \
+                                        for i in range(0, nRows, rowStep)]
+                pool = ThreadPool(nworkers)
                 try:
-                    spectra = data[badMask, iXMin:iXMax+1]
-                    spectra.shape = badMask.sum(), -1
-                except TypeError:
-                    # in case of dynamic arrays, two dimensional indices are not
-                    # supported by h5py
-                    spectra = numpy.zeros((int(badMask.sum()), 1 + iXMax - iXMin),
-                                          data.dtype)
-                    selectedIndices = numpy.nonzero(badMask > 0)
-                    tmpData = numpy.zeros((1, 1 + iXMax - iXMin), data.dtype)
-                    oldDataRow = -1
-                    j = 0
-                    for i in range(len(selectedIndices[0])):
-                        j = selectedIndices[0][i]
-                        if j != oldDataRow:
-                            tmpData = data[j]
-                            olddataRow = j
-                        spectra[i] = tmpData[selectedIndices[1][i], iXMin:iXMax+1]
-                spectra = spectra.T
-                #
-                if config['fit']['stripflag']:
-                    for k in range(spectra.shape[1]):
-                        # obtain the smoothed spectrum
-                        background=SpecfitFuns.SavitskyGolay(spectra[:, k],
-                                                config['fit']['stripfilterwidth'])
-                        lastAnchor = 0
-                        for anchor in anchorslist:
-                            if (anchor > lastAnchor) and (anchor < background.size):
-                                background[lastAnchor:anchor] =\
-                                        SpecfitFuns.snip1d(background[lastAnchor:anchor],
-                                                           config['fit']['snipwidth'],
-                                                           0)
-                                lastAnchor = anchor
-                        if lastAnchor < background.size:
-                            background[lastAnchor:] =\
-                                    SpecfitFuns.snip1d(background[lastAnchor:],
-                                                       config['fit']['snipwidth'],
-                                                       0)
-                    spectra[:, k] -= background
-                ddict = lstsq(A, spectra,
-                              sigma_b=sigma_b,
-                              weight=weight,
-                              digested_output=True,
-                              svd=SVD)
-                idx = 0
-                for i in range(nFree):
-                    if i in badParameters:
-                        results[i][badMask] = 0.0
-                        uncertainties[i][badMask] = 0.0
-                    else:
-                        results[i][badMask] = ddict['parameters'][idx]
-                        uncertainties[i][badMask] = ddict['uncertainties'][idx]
-                        idx += 1
+                    pool.map(fitRows, blocks, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            if DEBUG:
+                t = time.time() - t0
+                print("First fit elapsed = %f" % t)
+                print("Spectra per second = %f" % (data.shape[0]*data.shape[1]/float(t)))
+                t0 = time.time()
 
-        if DEBUG and refit:
-            t = time.time() - t0
-            print("Fit of negative peaks elapsed = %f" % t)
-            t0 = time.time()
+            # cleanup zeros
+            # Pixels with negative peak contributions are fitted again forcing
+            # those contributions to zero until none of them is negative.
+            if refit:
+                badMask = (results[nFreeBackgroundParameters:] < 0).any(axis=0)
+                badRows = numpy.nonzero(badMask.any(axis=1))[0]
+                # limit the number of spectra to be simultaneously in memory
+                groups = numpy.cumsum(badMask[badRows].sum(axis=1)) // 10000
+                nFits = 0
+                for group in numpy.unique(groups):
+                    mask = numpy.zeros(badMask.shape, numpy.bool_)
+                    rows = badRows[groups == group]
+                    mask[rows] = badMask[rows]
+                    spectra = getSelectedSpectra(data, mask, iXMin, iXMax)
+                    if config['fit']['stripflag']:
+                        spectra -= SNIPModule.getMultipleSpectraBackground(spectra,
+                                    config['fit']['snipwidth'],
+                                    anchorslist=anchorslist,
+                                    filterwidth=config['fit']['stripfilterwidth'],
+                                    mcaIndex=0,
+                                    nthreads=nthreads)
+                    parameters = results[:, mask]
+                    sigmas = uncertainties[:, mask]
+                    chisqValues = chisq[mask]
+                    nFits = max(nFits,
+                                self._fitNonNegative(derivatives, spectra,
+                                                     parameters, sigmas,
+                                                     nFreeBackgroundParameters,
+                                                     chisqValues,
+                                                     sigma_b=sigma_b,
+                                                     weight=weight,
+                                                     svd=SVD))
+                    results[:, mask] = parameters
+                    uncertainties[:, mask] = sigmas
+                    chisq[mask] = chisqValues
+                    if output is not None:
+                        # only the pixels fitted again have to be updated
+                        for row in rows:
+                            columns = numpy.nonzero(mask[row])[0]
+                            writer.write(outputParameters,
+                                         (slice(None), row, columns),
+                                         results[:, row, columns])
+                            writer.write(outputUncertainties,
+                                         (slice(None), row, columns),
+                                         uncertainties[:, row, columns])
+                            writer.write(outputChisq,
+                                         (row, columns),
+                                         chisq[row, columns])
+                if DEBUG:
+                    print("Number of secondary fits = %d" % nFits)
 
-        outputDict = {'parameters':results, 'uncertainties':uncertainties, 'names':freeNames}
+            if DEBUG and refit:
+                t = time.time() - t0
+                print("Fit of negative peaks elapsed = %f" % t)
+                t0 = time.time()
+
+        outputDict = {'parameters':results, 'uncertainties':uncertainties,
+                      'names':freeNames, 'chisq':chisq}
 
         if concentrations:
             # check if an internal reference is used and if it is set to auto
@@ -588,6 +599,83 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
             ####################################################
         return outputDict
 
+    def _fitNonNegative(self, derivatives, spectra, parameters, uncertainties,
+                        nFreeBackgroundParameters, chisq, **kw):
+        """
+        Fit again the spectra whose parameters have negative peak contributions
+        forcing them to zero. The set of zeroed contributions of a pixel only
+        grows, therefore there are at most as many iterations as peak
+        parameters. Pixels sharing the same set are solved in a single call.
+
+        The parameters and uncertainties arrays [nFree, nSpectra] as well as
+        the chisq array [nSpectra] are updated in place and the number of
+        iterations is returned.
+        """
+        fixed = numpy.zeros(parameters.shape, numpy.bool_)
+        nFits = 0
+        while True:
+            negative = parameters < 0
+            negative[:nFreeBackgroundParameters] = False
+            pixels = numpy.nonzero(negative.any(axis=0))[0]
+            if not len(pixels):
+                break
+            nFits += 1
+            fixed |= negative
+            # group the pixels according to their pattern of fixed parameters
+            packed = numpy.ascontiguousarray( \
+                            numpy.packbits(fixed[:, pixels], axis=0).T)
+            keys = packed.view(numpy.dtype((numpy.void, packed.shape[1])))
+            keys, inverse = numpy.unique(keys.ravel(), return_inverse=True)
+            inverse.shape = -1
+            for k in range(len(keys)):
+                selection = pixels[inverse == k]
+                pattern = fixed[:, selection[0]]
+                free = numpy.nonzero(~pattern)[0]
+                if len(free):
+                    ddict = lstsq(derivatives[:, free], spectra[:, selection],
+                                  digested_output=True, chisq=True, **kw)
+                    chisq[selection] = ddict['chisq']
+                    parameters[numpy.ix_(free, selection)] = ddict['parameters']
+                    uncertainties[numpy.ix_(free, selection)] = \
+                                                    ddict['uncertainties']
+                zeroed = numpy.nonzero(pattern)[0]
+                parameters[numpy.ix_(zeroed, selection)] = 0.0
+                uncertainties[numpy.ix_(zeroed, selection)] = 0.0
+        return nFits
+
+def getSelectedSpectra(data, mask, iXMin, iXMax):
+    """
+    Return the spectra of a 3D stack selected by a 2D mask as an array of
+    doubles [nChannels, nSpectra] in the order given by numpy.nonzero(mask).
+    """
+    if isinstance(data, numpy.ndarray):
+        spectra = data[mask, iXMin:iXMax+1]
+    else:
+        # in case of dynamic arrays, two dimensional indices are not
+        # supported by h5py. Read every affected row only once.
+        spectra = numpy.zeros((int(mask.sum()), 1 + iXMax - iXMin),
+                              data.dtype)
+        n = 0
+        for j in numpy.nonzero(mask.any(axis=1))[0]:
+            columns = numpy.nonzero(mask[j])[0]
+            tmpData = data[j, columns[0]:columns[-1] + 1, iXMin:iXMax+1]
+            spectra[n:n + columns.size] = tmpData[columns - columns[0]]
+            n += columns.size
+    return numpy.array(spectra.T, dtype=numpy.float64)
+
+def getReadSteps(data, default=100):
+    """
+    Return the number of rows and of columns of a 3D stack of spectra to be
+    read at once. For chunked HDF5 datasets they are multiples of the chunk
+    size in order to read every chunk from disk only once.
+    """
+    chunks = getattr(data, "chunks", None)
+    if not chunks:
+        return 1, min(default, data.shape[1])
+    iStep = min(chunks[0], data.shape[0])
+    jStep = chunks[1] * max(1, int(default / (iStep * chunks[1])))
+    return iStep, min(jStep, data.shape[1])
+
 def getFileListFromPattern(pattern, begin, end, increment=None):
     if type(begin) == type(1):
         begin = [begin]
@@ -632,7 +720,7 @@ def getFileListFromPattern(pattern, begin, end, increment=None):
     longoptions = ['cfg=', 'outdir=', 'concentrations=', 'weight=', 'refit=',
                    'tif=', #'listfile=',
                    'filepattern=', 'begin=', 'end=', 'increment=',
-                   "outfileroot="]
+                   "outfileroot=", "nworkers=", "h5="]
     try:
         opts, args = getopt.getopt(
                      sys.argv[1:],
@@ -653,6 +741,8 @@ def getFileListFromPattern(pattern, begin, end, increment=None):
     weight=0
     tif=0
     concentrations=0
+    nworkers=None
+    h5=0
     for opt, arg in opts:
         if opt in ('--cfg'):
             configurationFile = arg
@@ -686,6 +776,10 @@ def getFileListFromPattern(pattern, begin, end, increment=None):
             fileRoot = arg
         elif opt in ['--tif', '--tiff']:
             tif = int(arg)
+        elif opt in '--nworkers':
+            nworkers = int(arg)
+        elif opt in '--h5':
+            h5 = int(arg)
     if filepattern is not None:
         if (begin is None) or (end is None):
             raise ValueError(\
@@ -730,14 +824,32 @@ def getFileListFromPattern(pattern, begin, end, increment=None):
         sys.exit(0)
     if outputDir is None:
         print("RESULTS WILL NOT BE SAVED: No output directory specified")
+    if fileRoot in [None, ""]:
+        fileRoot = "images"
+    h5file = None
+    if (outputDir is not None) and h5:
+        # the fit results are written as they are obtained
+        if not os.path.exists(outputDir):
+            os.mkdir(outputDir)
+        fileName = os.path.join(outputDir, fileRoot + ".h5")
+        if os.path.exists(fileName):
+            os.remove(fileName)
+        h5file = ArraySave.openHDF5File(fileName, 'a')
     t0 = time.time()
     fastFit = FastXRFLinearFit()
     fastFit.setFitConfigurationFile(configurationFile)
     print("Main configuring Elapsed = % s " % (time.time() - t0))
-    result = fastFit.fitMultipleSpectra(y=dataStack,
+    try:
+        result = fastFit.fitMultipleSpectra(y=dataStack,
                                          weight=weight,
                                          refit=refit,
-                                         concentrations=concentrations)
+                                         concentrations=concentrations,
+                                         nworkers=nworkers,
+                                         output=h5file,
+                                         compression="gzip")
+    finally:
+        if h5file is not None:
+            h5file.close()
     print("Total Elapsed = % s " % (time.time() - t0))
     if outputDir is not None:
         if 'concentrations' in result:
@@ -749,8 +861,6 @@ def getFileListFromPattern(pattern, begin, end, increment=None):
             imageNames = result['names']
         nImages = images.shape[0]
 
-        if fileRoot in [None, ""]:
-            fileRoot = "images"
         if not os.path.exists(outputDir):
             os.mkdir(outputDir)
         imagesDir = os.path.join(outputDir, "IMAGES")
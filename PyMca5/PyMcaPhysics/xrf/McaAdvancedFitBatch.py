@@ -32,6 +32,7 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import sys
 import os
+import multiprocessing
 import numpy
 from . import ClassMcaTheory
 from PyMca5.PyMcaCore import SpecFileLayer
@@ -50,6 +51,81 @@
 from PyMca5.PyMcaIO import ConfigDict
 from . import ConcentrationsTool
 
+# number of spectra sent to a worker process in one go
+PROCESS_BATCH_SIZE = 16
+
+_WORKER = {}
+
+def _initWorker(config, concentrations):
+    # the fit is configured once per worker process
+    _WORKER['config'] = config
+    _WORKER['mcafit'] = ClassMcaTheory.McaTheory(config)
+    _WORKER['mcafit'].enableOptimizedLinearFit()
+    if concentrations:
+        _WORKER['tool'] = ConcentrationsTool.ConcentrationsTool()
+    else:
+        _WORKER['tool'] = None
+
+def _fitMcaList(taskList):
+    return [_fitOneMca(*task) for task in taskList]
+
+def _fitOneMca(x, y, livetime, fitfile, info):
+    mcafit = _WORKER['mcafit']
+    tool = _WORKER['tool']
+    concentrations = None
+    try:
+        mcafit.config['fit']['use_limit'] = 1
+        mcafit.setData(x, y, time=livetime)
+        mcafit.estimate()
+        fitresult = mcafit.startfit(digest=0)
+        fluorates = None
+        if fitfile is not None:
+            result = mcafit.digestresult(outfile=fitfile, info=info)
+        elif (tool is not None) and (mcafit._fluoRates is None):
+            result = mcafit.digestresult()
+        else:
+            result = mcafit.imagingDigestResult()
+            result['config'] = mcafit.config
+            fluorates = mcafit._fluoRates
+    except:
+        print("Error fitting %s: %s" % (info['Key'], sys.exc_info()[1]))
+        if mcafit.config['fit'].get("strategyflag", False):
+            print("Restoring fitconfiguration")
+            _WORKER['mcafit'] = ClassMcaTheory.McaTheory(_WORKER['config'])
+            _WORKER['mcafit'].enableOptimizedLinearFit()
+        return None, None
+    if tool is not None:
+        try:
+            conf = mcafit.configure()
+            tconf = tool.configure()
+            if 'concentrations' in conf:
+                tconf.update(conf['concentrations'])
+            concentrations = tool.processFitResult(config=tconf,
+                                    fitresult={'fitresult': fitresult,
+                                               'result': result},
+                                    elementsfrommatrix=False,
+                                    fluorates=fluorates)
+        except:
+            print("error in concentrations")
+            print(sys.exc_info()[0:-1])
+        if (fitfile is not None) and (concentrations is not None):
+            try:
+                f = ConfigDict.ConfigDict()
+                f.read(fitfile)
+                f['concentrations'] = concentrations
+                os.remove(fitfile)
+                f.write(fitfile)
+            except:
+                print("Error writing concentrations to fit file")
+                print(sys.exc_info())
+    # only send back what is needed to build the images
+    output = {'groups': result['groups'],
+              'chisq': result['chisq']}
+    for group in result['groups']:
+        output[group] = {'fitarea': result[group]['fitarea'],
+                         'sigmaarea': result[group]['sigmaarea']}
+    return output, concentrations
+
 
 class McaAdvancedFitBatch(object):
     def __init__(self,initdict,filelist=None,outputdir=None,
@@ -58,7 +134,7 @@ def __init__(self,initdict,filelist=None,outputdir=None,
                     concentrations=0, fitfiles=1, fitimages=1,
                     filebeginoffset = 0, fileendoffset=0,
                     mcaoffset=0, chunk = None,
-                    selection=None, lock=None):
+                    selection=None, lock=None, nprocesses=None):
         #for the time being the concentrations are bound to the .fit files
         #that is not necessary, but it will be correctly implemented in
         #future releases
@@ -99,6 +175,11 @@ def __init__(self,initdict,filelist=None,outputdir=None,
         self.mcaOffset = mcaoffset
         self.chunk     = chunk
         self.selection = selection
+        if nprocesses is None:
+            nprocesses = 1
+        self.nProcesses = nprocesses
+        self.__pool = None
+        self.__pendingTask = None
 
 
     def setFileList(self,filelist=None):
@@ -156,6 +237,9 @@ def processList(self):
         self.counter =  0
         self.__row   = self.fileBeginOffset - 1
         self.__stack = None
+        if (self.nProcesses > 1) and (not self.roiFit) and \
+           (len(self.__configList) == 1):
+            self.__startPool()
         for i in range(0+self.fileBeginOffset,
                        len(self._filelist)-self.fileEndOffset,
                        self.fileStep):
@@ -184,6 +268,8 @@ def processList(self):
                     break
             else:
                 self.__processOneFile()
+        if self.__pool is not None:
+            self.__stopPool()
         if self.counter:
             if not self.roiFit:
                 if self.fitFiles:
@@ -222,6 +308,91 @@ def getFileHandle(self,inputfile):
             raise IOError("I do not know what to do with file %s" % inputfile)
 
 
+    def __startPool(self):
+        self.__pool = multiprocessing.Pool(self.nProcesses,
+                            initializer=_initWorker,
+                            initargs=(self.__configList[self.__currentConfig],
+                                      self._concentrations))
+        self.__taskList = []
+        self.__submittedList = []
+
+    def __stopPool(self):
+        if self.pleaseBreak:
+            self.__pool.terminate()
+        else:
+            self.__submitTaskList()
+            while len(self.__submittedList):
+                self.__gatherResults()
+            self.__pool.close()
+        self.__pool.join()
+        self.__pool = None
+
+    def __submitTaskList(self):
+        if not len(self.__taskList):
+            return
+        taskList = self.__taskList
+        self.__taskList = []
+        # the pool hands the batches to the workers as they become free
+        asyncResult = self.__pool.apply_async(_fitMcaList,
+                                    ([task['input'] for task in taskList],))
+        self.__submittedList.append((taskList, asyncResult))
+        while len(self.__submittedList) > (2 * self.nProcesses):
+            self.__gatherResults()
+
+    def __gatherResults(self):
+        taskList, asyncResult = self.__submittedList.pop(0)
+        outputList = asyncResult.get()
+        row, col = self.__row, self.__col
+        for task, output in zip(taskList, outputList):
+            self.__row, self.__col = task['position']
+            self.__storeResult(task, output[0], output[1])
+            self.onMca(*task['onMca'][0], **task['onMca'][1])
+        self.__row, self.__col = row, col
+
+    def __storeResult(self, task, result, concentrations):
+        if result is None:
+            return
+        self.__initConcentrationsFile()
+        filename = task['filename']
+        if self._concentrations and (concentrations is not None):
+            self.__updateConcentrationsFile(concentrations, filename,
+                                            task['key'])
+        if self.fitFiles:
+            self.__updateFitFileList(task['input'][3])
+        if self.fitImages:
+            if not self.__updateImages(result, concentrations, filename):
+                return
+        self.counter += 1
+
+    def __onMca(self, *var, **kw):
+        if self.__pendingTask is None:
+            self.onMca(*var, **kw)
+        else:
+            # the call is delayed until the fit result is available
+            self.__pendingTask['onMca'] = (var, kw)
+            self.__taskList.append(self.__pendingTask)
+            self.__pendingTask = None
+            if len(self.__taskList) >= PROCESS_BATCH_SIZE:
+                self.__submitTaskList()
+
+    def __queueOneMca(self, x, y, filename, key, info):
+        if self.fitFiles:
+            fitfile = self.__getFitFile(filename, key)
+            fitdir = os.path.dirname(fitfile)
+            if not os.path.exists(fitdir):
+                try:
+                    os.makedirs(fitdir)
+                except:
+                    print("I could not create directory %s" % fitdir)
+                    return
+        else:
+            fitfile = None
+        self.__pendingTask = {'input': (x, y, info.get("McaLiveTime", None),
+                                        fitfile, info),
+                              'position': (self.__row, self.__col),
+                              'filename': filename,
+                              'key': key}
+
     def onNewFile(self,ffile, filelist):
         self.__log(ffile)
 
@@ -340,7 +511,7 @@ def __processStack(self):
                 infoDict['SourceName'] = info['SourceName']
                 infoDict['Key']        = key
                 self.__processOneMca(x,y0,filename,key,info=infoDict)
-                self.onMca(mca, numberofmca, filename=filename,
+                self.__onMca(mca, numberofmca, filename=filename,
                                             key=key,
                                             info=infoDict)
 
@@ -378,7 +549,7 @@ def __processOneFile(self):
                         infoDict['Key']        = key
                         infoDict['McaLiveTime'] = info.get('McaLiveTime', None)
                         self.__processOneMca(x,y0,filename,key,info=infoDict)
-                        self.onMca(mca, numberofmca, filename=filename,
+                        self.__onMca(mca, numberofmca, filename=filename,
                                                     key=key,
                                                     info=infoDict)
                 else:
@@ -430,7 +601,7 @@ def __processOneFile(self):
                             infoDict['McaLiveTime'] = info.get('McaLiveTime',
                                                                None)
                             self.__processOneMca(x,y0,filename,key,info=infoDict)
-                            self.onMca(i, info['NbMca'],filename=filename,
+                            self.__onMca(i, info['NbMca'],filename=filename,
                                                     key=key,
                                                     info=infoDict)
                             #print "remaining = ",(time.time()-e0) * (info['NbMca'] - i)
@@ -471,21 +642,11 @@ def __processOneMca(self,x,y,filename,key,info=None):
             concentrations = None
             outfile=self.os_path_join(self._outputdir, filename)
             fitfile = self.__getFitFile(filename,key)
-            if self.chunk is not None:
-                con_extension = "_%06d_partial_concentrations.txt" % self.chunk
-            else:
-                con_extension = "_concentrations.txt"
-            self._concentrationsFile = self.os_path_join(self._outputdir,
-                                    self._rootname+ con_extension)
-            #                        self._rootname+"_concentrationsNEW.txt")
-            if self.counter == 0:
-                if os.path.exists(self._concentrationsFile):
-                    try:
-                        os.remove(self._concentrationsFile)
-                    except:
-                        print("I could not delete existing concentrations file %s" %\
-                              self._concentrationsFile)
-            #print "self._concentrationsFile", self._concentrationsFile
+            if self.__pool is not None:
+                if not (self.useExistingFiles and os.path.exists(fitfile)):
+                    self.__queueOneMca(x, y, filename, key, info)
+                    return
+            self.__initConcentrationsFile()
             if self.useExistingFiles and os.path.exists(fitfile):
                 useExistingResult = 1
                 try:
@@ -585,15 +746,7 @@ def __processOneMca(self,x,y,filename,key,info=None):
                             print("error in concentrations")
                             print(sys.exc_info()[0:-1])
                             #return
-                self._concentrationsAsAscii=self._toolConversion.getConcentrationsAsAscii(concentrations)
-                if len(self._concentrationsAsAscii) > 1:
-                    text  = ""
-                    text += "SOURCE: "+ filename +"\n"
-                    text += "KEY: "+key+"\n"
-                    text += self._concentrationsAsAscii + "\n"
-                    f=open(self._concentrationsFile,"a")
-                    f.write(text)
-                    f.close()
+                self.__updateConcentrationsFile(concentrations, filename, key)
 
             #output options
             # .FIT files
@@ -634,19 +787,7 @@ def __processOneMca(self,x,y,filename,key,info=None):
                         print("Error writing concentrations to fit file")
                         print(sys.exc_info())
 
-                #python like output list
-                if not self.counter:
-                    name = os.path.splitext(self._rootname)[0]+"_fitfilelist.py"
-                    name = self.os_path_join(self._outputdir,name)
-                    try:
-                        os.remove(name)
-                    except:
-                        pass
-                    self.listfile=open(name,"w+")
-                    self.listfile.write("fitfilelist = [")
-                    self.listfile.write('\n'+outfile)
-                else:
-                    self.listfile.write(',\n'+outfile)
+                self.__updateFitFileList(outfile)
             else:
                 if not useExistingResult:
                     if 0:
@@ -659,80 +800,8 @@ def __processOneMca(self,x,y,filename,key,info=None):
 
             #IMAGES
             if self.fitImages:
-                #this only works with EDF
-                if self.__ncols is not None:
-                    if not self.counter:
-                        imgdir = self.os_path_join(self._outputdir,"IMAGES")
-                        if not os.path.exists(imgdir):
-                            try:
-                                os.mkdir(imgdir)
-                            except:
-                                print("I could not create directory %s" %\
-                                      imgdir)
-                                return
-                        elif not os.path.isdir(imgdir):
-                            print("%s does not seem to be a valid directory" %\
-                                  imgdir)
-                        self.imgDir = imgdir
-                        self.__peaks  = []
-                        self.__images = {}
-                        self.__sigmas = {}
-                        if not self.__stack:
-                            self.__nrows   = len(range(0,len(self._filelist),self.fileStep))
-                        for group in result['groups']:
-                            self.__peaks.append(group)
-                            self.__images[group]= numpy.zeros((self.__nrows,
-                                                               self.__ncols),
-                                                               numpy.float)
-                            self.__sigmas[group]= numpy.zeros((self.__nrows,
-                                                               self.__ncols),
-                                                               numpy.float)
-                        self.__images['chisq']  = numpy.zeros((self.__nrows,
-                                                               self.__ncols),
-                                                               numpy.float) - 1.
-                        if self._concentrations:
-                            layerlist = concentrations['layerlist']
-                            if 'mmolar' in concentrations:
-                                self.__conLabel = " mM"
-                                self.__conKey   = "mmolar"
-                            else:
-                                self.__conLabel = " mass fraction"
-                                self.__conKey   = "mass fraction"
-                            for group in concentrations['groups']:
-                                key = group+self.__conLabel
-                                self.__concentrationsKeys.append(key)
-                                self.__images[key] = numpy.zeros((self.__nrows,
-                                                                  self.__ncols),
-                                                                  numpy.float)
-                                if len(layerlist) > 1:
-                                    for layer in layerlist:
-                                        key = group+" "+layer
-                                        self.__concentrationsKeys.append(key)
-                                        self.__images[key] = numpy.zeros((self.__nrows,
-                                                                    self.__ncols),
-                                                                    numpy.float)
-                for peak in self.__peaks:
-                    try:
-                        self.__images[peak][self.__row, self.__col] = result[peak]['fitarea']
-                        self.__sigmas[peak][self.__row, self.__col] = result[peak]['sigmaarea']
-                    except:
-                        pass
-                if self._concentrations:
-                    layerlist = concentrations['layerlist']
-                    for group in concentrations['groups']:
-                        self.__images[group+self.__conLabel][self.__row, self.__col] = \
-                                              concentrations[self.__conKey][group]
-                        if len(layerlist) > 1:
-                            for layer in layerlist:
-                                self.__images[group+" "+layer] [self.__row, self.__col] = \
-                                              concentrations[layer][self.__conKey][group]
-                try:
-                    self.__images['chisq'][self.__row, self.__col] = result['chisq']
-                except:
-                    print("Error on chisq row %d col %d" %\
-                          (self.__row, self.__col))
-                    print("File = %s\n" % filename)
-                    pass
+                if not self.__updateImages(result, concentrations, filename):
+                    return
 
         else:
                 dict=self.mcafit.roifit(x,y,width=self.roiWidth)
@@ -779,6 +848,124 @@ def __processOneMca(self,x,y,filename,key,info=None):
         self.counter += 1
 
 
+    def __updateImages(self, result, concentrations, filename):
+        #this only works with EDF
+        if self.__ncols is not None:
+            if not self.counter:
+                imgdir = self.os_path_join(self._outputdir,"IMAGES")
+                if not os.path.exists(imgdir):
+                    try:
+                        os.mkdir(imgdir)
+                    except:
+                        print("I could not create directory %s" %\
+                              imgdir)
+                        return False
+                elif not os.path.isdir(imgdir):
+                    print("%s does not seem to be a valid directory" %\
+                          imgdir)
+                self.imgDir = imgdir
+                self.__peaks  = []
+                self.__images = {}
+                self.__sigmas = {}
+                if not self.__stack:
+                    self.__nrows   = len(range(0,len(self._filelist),self.fileStep))
+                for group in result['groups']:
+                    self.__peaks.append(group)
+                    self.__images[group]= numpy.zeros((self.__nrows,
+                                                       self.__ncols),
+                                                       numpy.float)
+                    self.__sigmas[group]= numpy.zeros((self.__nrows,
+                                                       self.__ncols),
+                                                       numpy.float)
+                self.__images['chisq']  = numpy.zeros((self.__nrows,
+                                                       self.__ncols),
+                                                       numpy.float) - 1.
+                if self._concentrations:
+                    layerlist = concentrations['layerlist']
+                    if 'mmolar' in concentrations:
+                        self.__conLabel = " mM"
+                        self.__conKey   = "mmolar"
+                    else:
+                        self.__conLabel = " mass fraction"
+                        self.__conKey   = "mass fraction"
+                    for group in concentrations['groups']:
+                        key = group+self.__conLabel
+                        self.__concentrationsKeys.append(key)
+                        self.__images[key] = numpy.zeros((self.__nrows,
+                                                          self.__ncols),
+                                                          numpy.float)
+                        if len(layerlist) > 1:
+                            for layer in layerlist:
+                                key = group+" "+layer
+                                self.__concentrationsKeys.append(key)
+                                self.__images[key] = numpy.zeros((self.__nrows,
+                                                            self.__ncols),
+                                                            numpy.float)
+        for peak in self.__peaks:
+            try:
+                self.__images[peak][self.__row, self.__col] = result[peak]['fitarea']
+                self.__sigmas[peak][self.__row, self.__col] = result[peak]['sigmaarea']
+            except:
+                pass
+        if self._concentrations:
+            layerlist = concentrations['layerlist']
+            for group in concentrations['groups']:
+                self.__images[group+self.__conLabel][self.__row, self.__col] = \
+                                      concentrations[self.__conKey][group]
+                if len(layerlist) > 1:
+                    for layer in layerlist:
+                        self.__images[group+" "+layer] [self.__row, self.__col] = \
+                                      concentrations[layer][self.__conKey][group]
+        try:
+            self.__images['chisq'][self.__row, self.__col] = result['chisq']
+        except:
+            print("Error on chisq row %d col %d" %\
+                  (self.__row, self.__col))
+            print("File = %s\n" % filename)
+            pass
+        return True
+
+    def __initConcentrationsFile(self):
+        if self.chunk is not None:
+            con_extension = "_%06d_partial_concentrations.txt" % self.chunk
+        else:
+            con_extension = "_concentrations.txt"
+        self._concentrationsFile = self.os_path_join(self._outputdir,
+                                self._rootname+ con_extension)
+        if self.counter == 0:
+            if os.path.exists(self._concentrationsFile):
+                try:
+                    os.remove(self._concentrationsFile)
+                except:
+                    print("I could not delete existing concentrations file %s" %\
+                          self._concentrationsFile)
+
+    def __updateConcentrationsFile(self, concentrations, filename, key):
+        self._concentrationsAsAscii=self._toolConversion.getConcentrationsAsAscii(concentrations)
+        if len(self._concentrationsAsAscii) > 1:
+            text  = ""
+            text += "SOURCE: "+ filename +"\n"
+            text += "KEY: "+key+"\n"
+            text += self._concentrationsAsAscii + "\n"
+            f=open(self._concentrationsFile,"a")
+            f.write(text)
+            f.close()
+
+    def __updateFitFileList(self, outfile):
+        #python like output list
+        if not self.counter:
+            name = os.path.splitext(self._rootname)[0]+"_fitfilelist.py"
+            name = self.os_path_join(self._outputdir,name)
+            try:
+                os.remove(name)
+            except:
+                pass
+            self.listfile=open(name,"w+")
+            self.listfile.write("fitfilelist = [")
+            self.listfile.write('\n'+outfile)
+        else:
+            self.listfile.write(',\n'+outfile)
+
     def saveImage(self,ffile=None):
         self.savedImages=[]
         if ffile is None:
@@ -849,24 +1036,25 @@ def saveImage(self,ffile=None):
             #specfile.write('#S 1  %s\n' % (file+trailing))
             #specfile.write('#N %d\n' % (len(self.__peaks)+2))
             specfile.write('%s\n' % speclabel)
-            specline=""
-            for row in range(self.__nrows):
-                for col in range(self.__ncols):
-                    specline += "%d" % row
-                    specline += "  %d" % col
-                    for peak in self.__peaks:
-                        #write area
-                        specline +="  %g" % self.__images[peak][row][col]
-                        #write sigma area
-                        specline +="  %g" % self.__sigmas[peak][row][col]
-                    #write global chisq
-                    specline +="  %g" % self.__images['chisq'][row][col]
-                    if self._concentrations:
-                        for peak in self.__concentrationsKeys:
-                            specline +="  %g" % self.__images[peak][row][col]
-                    specline += "\n"
-                    specfile.write("%s" % specline)
-                    specline =""
+            # one column per quantity and one line per pixel, formatted by
+            # numpy instead of building the lines value by value
+            columns = [numpy.repeat(numpy.arange(self.__nrows), self.__ncols),
+                       numpy.tile(numpy.arange(self.__ncols), self.__nrows)]
+            fmt = ["%d", "%d"]
+            for peak in self.__peaks:
+                #area and sigma area
+                columns.append(self.__images[peak].ravel())
+                columns.append(self.__sigmas[peak].ravel())
+                fmt += ["%g", "%g"]
+            #global chisq
+            columns.append(self.__images['chisq'].ravel())
+            fmt.append("%g")
+            if self._concentrations:
+                for peak in self.__concentrationsKeys:
+                    columns.append(self.__images[peak].ravel())
+                    fmt.append("%g")
+            numpy.savetxt(specfile, numpy.array(columns).T,
+                          fmt=fmt, delimiter="  ")
             specfile.write("\n")
             specfile.close()
         else:
@@ -57,8 +57,6 @@
     stackUpdated
     selectionMaskUpdated
 """
-import numpy
-
 try:
     from PyMca5 import StackPluginBase
     from PyMca5.PyMcaGui import CalculationThread
@@ -135,9 +133,6 @@ def mySlot(self, ddict):
 
     def XASNormalize(self):
         stack = self.getStackDataObject()
-        if not isinstance(stack.data, numpy.ndarray):
-            text = "This method does not work with dynamically loaded stacks"
-            raise TypeError(text)
         activeCurve = self.getActiveCurve()
         if activeCurve in [None, []]:
             return
@@ -247,124 +242,17 @@ def replaceStackByXASNormalizedData(self,
         Performs an in place replacement of a set of spectra by a set of
         normalized spectra.
         """
-        mcaIndex = -1
-        if hasattr(stack, "info") and hasattr(stack, "data"):
-            actualData = stack.data
-            mcaIndex = stack.info.get('McaIndex', -1)
-        else:
-            actualData = stack
-        if not isinstance(actualData, numpy.ndarray):
-            raise TypeError("Currently this method only supports numpy arrays")
-
-        # Take a data view
-        oldShape = actualData.shape
-        data = actualData[:]
-        DONE = 0
-        if mcaIndex in [-1, len(data.shape)-1]:
-            data.shape = -1, oldShape[-1]
-            edges = numpy.zeros(data.shape[0], numpy.float32)
-            jumps = numpy.zeros(data.shape[0], numpy.float32)
-            errors = numpy.zeros(data.shape[0], numpy.float32)
-            total = 0.01 * data.shape[0]
-            for i in range(data.shape[0]):
-                self._progress = i / total
-                try:
-                    ene, spe, ed, jmp = XASNormalization.XASNormalization(data[i,:],
+        return XASNormalization.XASStackNormalization(stack,
                                 energy=energy,
                                 edge=edge,
                                 pre_edge_regions=pre_edge_regions,
                                 post_edge_regions=post_edge_regions,
                                 algorithm=algorithm,
-                                algorithm_parameters=algorithm_parameters)[0:4]
-                except:
-                    # what to do?
-                    # for the data is clear (set to 0)
-                    # for the jump 0 is also a good compromise
-                    # for the edge?
-                    data[i, :] = 0
-                    errors[i] = 1
-                    jumps[i] = 0
-                    edges[i] = 0
-                    continue
-                if not DONE:
-                    c0 = (numpy.nonzero(energy >= (ed + pre_edge_regions[0][0]))[0]).min()
-                    c1 = (numpy.nonzero(energy <= (ed + post_edge_regions[-1][1]))[-1]).max()
-                    c1 += 1
-                    DONE = True
-                if ((spe.max()-spe.min()) > 10.) or (jmp < 0):
-                    data[i, :] = 0.0
-                    # should I give some useless values?
-                    edges[i] = 0.0
-                    # perhaps the case of large jump should be kept ...
-                    jumps[i] = 0.0
-                elif 0:
-                    # this approach removed
-                    data[i,:c0] = spe[c0]
-                    data[i, c0:c1] = spe[c0:c1]
-                    if c1 < data.shape[1]:
-                        data[i, c1:] = spe[c1]
-                    edges[i] = ed
-                    jumps[i] = jmp
-                else:
-                    # it seems more appropriate to set the channels below and
-                    # above limits to 0 than to the corresponding limits of the region
-                    data[i,:c0] = 0.0
-                    data[i, c0:c1] = spe[c0:c1]
-                    data[i, c1:] = 0.0
-                    edges[i] = ed
-                    jumps[i] = jmp
-            self._progress = 100
-            data.shape = oldShape
-        elif mcaIndex == 0:
-            data.shape = oldShape[0], -1
-            edges = numpy.zeros(data.shape[-1], numpy.float32)
-            jumps = numpy.zeros(data.shape[-1], numpy.float32)
-            errors = numpy.zeros(data.shape[-1], numpy.float32)
-            total = 0.01 * data.shape[-1]
-            for i in range(data.shape[-1]):
-                self._progress = i / total
-                try:
-                    ene, spe, ed, jmp = XASNormalization.XASNormalization(data[:, i],
-                              energy=energy,
-                              edge=edge,
-                              pre_edge_regions=pre_edge_regions,
-                              post_edge_regions=post_edge_regions,
-                              algorithm=algorithm,
-                              algorithm_parameters=algorithm_parameters)[0:4]
-                except:
-                    # what to do?
-                    # for the data is clear (set to 0)
-                    # for the jump 0 is also a good compromise
-                    # for the edge?
-                    data[:, i] = 0
-                    jumps[i] = 0
-                    edges[i] = 0
-                    errors[i] = 1
-                    continue
-                if not DONE:
-                    c0 = (numpy.nonzero(energy >= (ed + pre_edge_regions[0][0]))[0]).min()
-                    c1 = (numpy.nonzero(energy <= (ed + post_edge_regions[-1][1]))[-1]).max()
-                    c1 += 1
-                    DONE = True
-                if ((spe.max()-spe.min()) > 10.) or (jmp < 0):
-                    data[:, i] = 0.0
-                    # should I give some useless values?
-                    edges[i] = 0.0
-                    jumps[i] = 0.0
-                else:
-                    # it seems more appropriate to set the channels below and
-                    # above limits to 0 than to the corresponding limits of the region
-                    data[:c0, i] = 0.0
-                    data[c0:c1, i] = spe[c0:c1]
-                    if c1 < data.shape[0]:
-                        data[c1:, i] = 0.0
-                    edges[i] = ed
-                    jumps[i] = jmp
-            self._progress = 100
-            data.shape = oldShape
-        else:
-            raise ValueError("Unsupported 1D index %d" % mcaIndex)
-        return edges, jumps, errors
+                                algorithm_parameters=algorithm_parameters,
+                                progress_callback=self._setProgress)
+
+    def _setProgress(self, value):
+        self._progress = value
 
 
 MENU_TEXT = "XAS Stack Normalization"
@@ -0,0 +1,285 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import gc
+import shutil
+import tempfile
+import numpy
+try:
+    import h5py
+    HAS_H5PY = True
+except:
+    HAS_H5PY = False
+
+class testArraySave(unittest.TestCase):
+    def setUp(self):
+        """
+        import the module
+        """
+        try:
+            from PyMca5.PyMcaIO import ArraySave
+            self.arraySave = ArraySave
+        except:
+            self.arraySave = None
+        self.tmpDir = tempfile.mkdtemp(prefix="pymcatest_")
+
+    def tearDown(self):
+        gc.collect()
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def testArraySaveImport(self):
+        self.assertTrue(self.arraySave is not None)
+
+    def testArraySaveChunkShape(self):
+        self.assertTrue(self.arraySave is not None)
+        getChunkShape = self.arraySave.getChunkShape
+        chunksize = self.arraySave.CHUNK_SIZE
+        self.assertEqual(chunksize, 1024 * 1024)
+        # large images are split keeping the chunk below chunksize
+        self.assertEqual(getChunkShape((100, 2048, 2048), numpy.float32),
+                         (1, 512, 512))
+        # spectra are kept whole and grouped
+        self.assertEqual(getChunkShape((100, 200, 2048), numpy.float64,
+                                       interpretation="spectrum"),
+                         (1, 64, 2048))
+        self.assertEqual(getChunkShape((100, 200, 2048), numpy.float64,
+                                       interpretation=b"spectrum"),
+                         (1, 64, 2048))
+        # small images are grouped up to the size of the dataset
+        self.assertEqual(getChunkShape((1000, 10, 10), numpy.float32),
+                         (1000, 10, 10))
+        self.assertEqual(getChunkShape((10, 100), numpy.float64,
+                                       interpretation="spectrum",
+                                       chunksize=100),
+                         (1, 7))
+        # empty dimensions and one dimensional datasets
+        self.assertEqual(getChunkShape((0, 5), numpy.float32,
+                                       interpretation="spectrum"),
+                         (1, 5))
+        self.assertEqual(getChunkShape((10000000,), numpy.float64),
+                         (78125,))
+        randomState = numpy.random.RandomState(9)
+        for i in range(200):
+            ndim = randomState.randint(1, 5)
+            shape = tuple(randomState.randint(1, 3000, ndim))
+            dtype = [numpy.uint8, numpy.float32, numpy.float64][i % 3]
+            for interpretation in ["image", "spectrum"]:
+                chunks = getChunkShape(shape, dtype,
+                                       interpretation=interpretation)
+                self.assertEqual(len(chunks), ndim)
+                nbytes = numpy.dtype(dtype).itemsize * \
+                         numpy.prod(chunks, dtype=numpy.int64)
+                self.assertTrue(nbytes <= chunksize)
+                for j in range(ndim):
+                    self.assertTrue(1 <= chunks[j] <= shape[j])
+
+    def testArraySaveCompressionFilters(self):
+        self.assertTrue(self.arraySave is not None)
+        getCompressionFilters = self.arraySave.getCompressionFilters
+        for compression in [None, False, 0]:
+            self.assertEqual(getCompressionFilters(compression), {})
+        self.assertEqual(getCompressionFilters(True),
+                         {"compression": "gzip", "shuffle": True})
+        self.assertEqual(getCompressionFilters(4),
+                         {"compression": "gzip",
+                          "compression_opts": 4,
+                          "shuffle": True})
+        self.assertEqual(getCompressionFilters("lzf"),
+                         {"compression": "lzf", "shuffle": True})
+
+    def testArraySaveCreateHDF5Dataset(self):
+        self.assertTrue(self.arraySave is not None)
+        if not HAS_H5PY:
+            print("skipping HDF5 dataset test, h5py not available")
+            return
+        createHDF5Dataset = self.arraySave.createHDF5Dataset
+        fname = os.path.join(self.tmpDir, "datasets.h5")
+        h5 = h5py.File(fname, "w")
+        try:
+            # neither compressed nor growing, contiguous
+            dataset = createHDF5Dataset(h5, "contiguous", (10, 20, 30),
+                                        numpy.float32)
+            self.assertTrue(dataset.chunks is None)
+            self.assertTrue(dataset.compression is None)
+            self.assertTrue(createHDF5Dataset(h5, "contiguous", (1,),
+                                              numpy.float32) == dataset)
+
+            dataset = createHDF5Dataset(h5, "images", (100, 2048, 2048),
+                                        numpy.float32, compression=True)
+            self.assertEqual(dataset.chunks, (1, 512, 512))
+            self.assertEqual(dataset.compression, "gzip")
+            self.assertTrue(dataset.shuffle)
+
+            dataset = createHDF5Dataset(h5, "spectra", (100, 200, 2048),
+                                        numpy.float64,
+                                        interpretation="spectrum",
+                                        compression=2)
+            self.assertEqual(dataset.chunks, (1, 64, 2048))
+            self.assertEqual(dataset.compression_opts, 2)
+
+            # the chunks of a growing dataset are not limited by its
+            # initial size
+            dataset = createHDF5Dataset(h5, "rows", (0, 2048),
+                                        numpy.float64,
+                                        interpretation="spectrum",
+                                        maxshape=(None, 2048))
+            self.assertEqual(dataset.chunks, (64, 2048))
+            self.assertEqual(dataset.maxshape, (None, 2048))
+            self.assertTrue(dataset.compression is None)
+
+            # explicit chunks
+            dataset = createHDF5Dataset(h5, "explicit", (10, 20),
+                                        numpy.float32, compression="gzip",
+                                        chunks=(5, 5))
+            self.assertEqual(dataset.chunks, (5, 5))
+        finally:
+            h5.close()
+
+        fname = os.path.join(self.tmpDir, "buffer.h5")
+        h5, dataset = self.arraySave.getHDF5FileInstanceAndBuffer(fname,
+                                        (100, 200, 2048),
+                                        interpretation="spectrum",
+                                        compression=True)
+        try:
+            self.assertEqual(dataset.chunks, (1, 128, 2048))
+            self.assertEqual(dataset.compression, "gzip")
+        finally:
+            h5.close()
+
+    def testArraySaveHDF5Writer(self):
+        self.assertTrue(self.arraySave is not None)
+        if not HAS_H5PY:
+            print("skipping HDF5 writer test, h5py not available")
+            return
+        data = numpy.arange(12 * 7, dtype=numpy.float64).reshape(12, 7)
+        fname = os.path.join(self.tmpDir, "writer.h5")
+        h5 = h5py.File(fname, "w")
+        try:
+            rows = self.arraySave.createHDF5Dataset(h5, "rows", (0, 7),
+                                        numpy.float64,
+                                        interpretation="spectrum",
+                                        maxshape=(None, 7))
+            columns = self.arraySave.createHDF5Dataset(h5, "columns",
+                                        (12, 0), numpy.float64,
+                                        maxshape=(12, None))
+            image = h5.create_dataset("image", (12, 7), numpy.float64)
+            with self.arraySave.HDF5Writer(maxqueue=2) as writer:
+                for i in range(5):
+                    row = data[i].copy()
+                    writer.append(rows, row)
+                    # the writer keeps its own copy
+                    row[:] = -1
+                writer.append(rows, data[5:9])
+                writer.append(rows, data[9:])
+                for j in range(7):
+                    writer.append(columns, data[:, j], axis=1)
+                for i in range(12):
+                    writer.write(image, i, data[i])
+                writer.flush()
+                self.assertEqual(rows.shape, (12, 7))
+                writer.write(image, None, data[::-1])
+            self.assertTrue(numpy.array_equal(rows[()], data))
+            self.assertTrue(numpy.array_equal(columns[()], data))
+            self.assertTrue(numpy.array_equal(image[()], data[::-1]))
+        finally:
+            h5.close()
+
+    def testArraySaveHDF5WriterError(self):
+        self.assertTrue(self.arraySave is not None)
+        if not HAS_H5PY:
+            print("skipping HDF5 writer test, h5py not available")
+            return
+        data = numpy.arange(5 * 7, dtype=numpy.float64).reshape(5, 7)
+        fname = os.path.join(self.tmpDir, "error.h5")
+        h5 = h5py.File(fname, "w")
+        try:
+            image = h5.create_dataset("image", (5, 7), numpy.float64)
+            writer = self.arraySave.HDF5Writer()
+            writer.write(image, 0, data[0])
+            writer.write(image, 10, data[0])
+            # a failing write does not prevent the following ones
+            writer.write(image, 1, data[1])
+            self.assertRaises(IndexError, writer.flush)
+            self.assertTrue(numpy.array_equal(image[:2], data[:2]))
+            # the error is only raised once
+            writer.flush()
+            writer.write(image, 2, data[2])
+            writer.write(image, 2, data[:2])
+            self.assertRaises(TypeError, writer.close)
+            self.assertTrue(numpy.array_equal(image[2], data[2]))
+
+            # on leaving a with block
+            def writeAll(rows):
+                with self.arraySave.HDF5Writer() as writer:
+                    for i in rows:
+                        writer.write(image, i, data[i])
+            writeAll([3, 4])
+            self.assertTrue(numpy.array_equal(image[()], data))
+            self.assertRaises(IndexError, writeAll, [3, 12, 4])
+
+            # an error of the caller is not hidden by the writer ones
+            # and the pending data are written
+            image[()] = 0
+            try:
+                with self.arraySave.HDF5Writer() as writer:
+                    writer.write(image, 0, data[0])
+                    writer.write(image, 10, data[0])
+                    writer.write(image, 1, data[1])
+                    raise ValueError("Caller error")
+            except ValueError:
+                pass
+            self.assertTrue(numpy.array_equal(image[:2], data[:2]))
+        finally:
+            h5.close()
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testArraySave))
+    else:
+        # use a predefined order
+        testSuite.addTest(testArraySave("testArraySaveImport"))
+        testSuite.addTest(testArraySave("testArraySaveChunkShape"))
+        testSuite.addTest(testArraySave("testArraySaveCompressionFilters"))
+        testSuite.addTest(testArraySave("testArraySaveCreateHDF5Dataset"))
+        testSuite.addTest(testArraySave("testArraySaveHDF5Writer"))
+        testSuite.addTest(testArraySave("testArraySaveHDF5WriterError"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
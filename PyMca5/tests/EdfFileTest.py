@@ -57,6 +57,8 @@ def tearDown(self):
         if self.fileClass is not None:
             if os.path.exists(self.fname):
                 os.remove(self.fname)
+            if os.path.exists(self.fname + ".pymcaidx"):
+                os.remove(self.fname + ".pymcaidx")
 
     def testEdfFileImport(self):
         #"""Test successful import"""
@@ -116,6 +118,111 @@ def testEdfFileReadWrite(self):
         edf =None
         gc.collect()
 
+    def testEdfFileMemoryMapped(self):
+        self.assertTrue(self.fileClass is not None)
+        data = numpy.arange(10000).astype(numpy.int32)
+        data.shape = 100, 100
+        edf = self.fileClass(self.fname, 'wb+')
+        edf.WriteImage({'Title': "title"}, data)
+        edf.WriteImage({'Title': "title2"}, data.astype(numpy.float32),
+                       Append=1)
+        edf = None
+
+        edf = self.fileClass(self.fname, 'rb', mmap=True)
+        self.assertEqual(edf.GetNumImages(), 2)
+        readData = edf.GetData(1)
+        self.assertTrue(isinstance(readData, numpy.memmap))
+        self.assertFalse(readData.flags.writeable)
+        self.assertEqual(readData.dtype, numpy.float32)
+        self.assertTrue(numpy.allclose(readData, data))
+
+        # a region given as (x, y) position and size
+        readData = edf.GetData(0, Pos=(10, 20), Size=(30, 0))
+        self.assertEqual(readData.shape, (80, 30))
+        self.assertTrue((readData == data[20:, 10:40]).all())
+        readData = None
+        edf = None
+        gc.collect()
+
+    def testEdfFileIndex(self):
+        from PyMca5.PyMcaIO import EdfFile
+        self.assertTrue(self.fileClass is not None)
+        nImages = EdfFile.INDEX_MIN_IMAGES
+        data = numpy.arange(20).astype(numpy.int16)
+        data.shape = 4, 5
+        edf = self.fileClass(self.fname, 'wb+')
+        for i in range(nImages):
+            edf.WriteImage({'Title': "title %d" % i}, data + i, Append=1)
+        edf = None
+
+        indexFile = self.fname + ".pymcaidx"
+        # no index is written unless requested
+        edf = self.fileClass(self.fname, 'rb')
+        self.assertEqual(edf.GetNumImages(), nImages)
+        self.assertFalse(os.path.exists(indexFile))
+        edf = None
+
+        edf = self.fileClass(self.fname, 'rb', index=True)
+        self.assertEqual(edf.GetNumImages(), nImages)
+        self.assertTrue(os.path.exists(indexFile))
+        edf = None
+
+        # the index is used
+        edf = self.fileClass(self.fname, 'rb', index=True)
+        self.assertEqual(edf.GetNumImages(), nImages)
+        self.assertEqual(edf.GetHeader(nImages - 1)['Title'],
+                         "title %d" % (nImages - 1))
+        readData = edf.GetData(nImages - 1)
+        self.assertTrue((readData == (data + nImages - 1)).all())
+        edf = None
+
+        # the index is ignored when the file changes
+        edf = self.fileClass(self.fname, 'rb+')
+        edf.WriteImage({'Title': "last"}, data, Append=1)
+        edf = None
+        edf = self.fileClass(self.fname, 'rb', index=True)
+        self.assertEqual(edf.GetNumImages(), nImages + 1)
+        self.assertEqual(edf.GetHeader(nImages)['Title'], "last")
+        edf = None
+        gc.collect()
+
+    def testEdfFileLazyStack(self):
+        from PyMca5.PyMcaIO import EDFStack
+        from PyMca5.PyMcaIO import LazyArray
+        self.assertTrue(self.fileClass is not None)
+        data = numpy.arange(12 * 20 * 30).astype(numpy.float32)
+        data.shape = 12, 20, 30
+        fileList = []
+        try:
+            for i in range(data.shape[0]):
+                fname = self.fname + "_%02d.edf" % i
+                fileList.append(fname)
+                edf = self.fileClass(fname, 'wb+')
+                edf.WriteImage({'Title': "title %d" % i}, data[i])
+                edf = None
+
+            stack = EDFStack.EDFStack(imagestack=True)
+            stack.loadFileList(fileList, dynamic=True)
+            self.assertTrue(isinstance(stack.data, LazyArray.LazyArray))
+            self.assertEqual(stack.data.shape, data.shape)
+            self.assertEqual(stack.info["McaIndex"], 0)
+            self.assertTrue((stack.data[3] == data[3]).all())
+            self.assertTrue((stack.data[-1, 5] == data[-1, 5]).all())
+            self.assertTrue((stack.data[2:9:3, 4:6, 7] == \
+                             data[2:9:3, 4:6, 7]).all())
+            # each index applies to its own axis
+            readData = stack.data[[1, 4], :, [0, 2, 4]]
+            self.assertEqual(readData.shape, (2, 20, 3))
+            self.assertTrue((readData == data[[1, 4]][:, :, [0, 2, 4]]).all())
+            self.assertTrue((stack.data[...] == data).all())
+            stack.data.close()
+            stack = None
+        finally:
+            gc.collect()
+            for fname in fileList:
+                if os.path.exists(fname):
+                    os.remove(fname)
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -125,6 +232,9 @@ def getSuite(auto=True):
         # use a predefined order
         testSuite.addTest(testEdfFile("testEdfFileImport"))
         testSuite.addTest(testEdfFile("testEdfFileReadWrite"))
+        testSuite.addTest(testEdfFile("testEdfFileMemoryMapped"))
+        testSuite.addTest(testEdfFile("testEdfFileIndex"))
+        testSuite.addTest(testEdfFile("testEdfFileLazyStack"))
     return testSuite
 
 def test(auto=False):
@@ -0,0 +1,386 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+try:
+    import h5py
+    HAS_H5PY = True
+except:
+    HAS_H5PY = False
+
+class testFastXRFLinearFit(unittest.TestCase):
+    def setUp(self):
+        """
+        import the module
+        """
+        try:
+            from PyMca5.PyMcaPhysics.xrf import FastXRFLinearFit
+            from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+            from PyMca5.PyMcaMath.fitting import SpecfitFuns
+            self.fastXRFLinearFit = FastXRFLinearFit
+            self.classMcaTheory = ClassMcaTheory
+            self.specfitFuns = SpecfitFuns
+        except:
+            self.fastXRFLinearFit = None
+        self.tmpDir = tempfile.mkdtemp(prefix="pymcatest_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def getConfiguration(self):
+        config = self.classMcaTheory.McaTheory().configure()
+        config['peaks'] = {'Co': 'K', 'Cu': 'K', 'Fe': 'K'}
+        config['fit']['stripflag'] = 1
+        config['fit']['stripalgorithm'] = 1
+        config['fit']['snipwidth'] = 30
+        config['fit']['stripfilterwidth'] = 5
+        config['fit']['stripanchorsflag'] = 1
+        config['fit']['stripanchorslist'] = [350, 0, 0, 0]
+        config['fit']['xmin'] = 200
+        config['fit']['xmax'] = 600
+        config['fit']['use_limit'] = 1
+        config['fit']['continuum'] = 0
+        config['fit']['fitweight'] = 0
+        config['detector']['zero'] = 0.0
+        config['detector']['gain'] = 0.02
+        return config
+
+    def getStack(self, nRows, nColumns):
+        energy = numpy.arange(1024.) * 0.02
+        def peak(position):
+            return numpy.exp(-0.5 * ((energy - position) / 0.07) ** 2)
+        iron = peak(6.40) + 0.13 * peak(7.06)
+        copper = peak(8.04) + 0.13 * peak(8.90)
+        cobalt = peak(6.93) + 0.13 * peak(7.65)
+        data = numpy.zeros((nRows, nColumns, energy.size), numpy.float64)
+        for row in range(nRows):
+            for column in range(nColumns):
+                if (row + column) % 3:
+                    copperHeight = 50. * (1 + row)
+                else:
+                    copperHeight = 0.0
+                # the cobalt overlapping the iron is sometimes absent
+                cobaltHeight = 200. * ((row * nColumns + column) % 2)
+                data[row, column] = 20. + 30. * numpy.exp(-energy / 5.) + \
+                                    (200. + 20. * column) * iron + \
+                                    copperHeight * copper + \
+                                    cobaltHeight * cobalt
+        randomState = numpy.random.RandomState(1)
+        return numpy.arange(1024.), \
+               randomState.poisson(data).astype(numpy.float64)
+
+    def getBackground(self, spectrum, config, anchors):
+        # one spectrum after the other as the fit used to do
+        background = self.specfitFuns.SavitskyGolay(spectrum,
+                                        config['fit']['stripfilterwidth'])
+        width = config['fit']['snipwidth']
+        lastAnchor = 0
+        for anchor in anchors:
+            if (anchor > lastAnchor) and (anchor < background.size):
+                background[lastAnchor:anchor] = \
+                    self.specfitFuns.snip1d(background[lastAnchor:anchor],
+                                            width, 0)
+                lastAnchor = anchor
+        if lastAnchor < background.size:
+            background[lastAnchor:] = \
+                self.specfitFuns.snip1d(background[lastAnchor:], width, 0)
+        return background
+
+    def fitPixels(self, fastFit, config, x, data, nonnegative=False,
+                  weight=False, chisq=None):
+        """
+        Fit the stack one pixel after the other with the matrix of
+        derivatives of the fast fit and numpy.linalg.lstsq. If nonnegative,
+        the negative contributions are fixed to zero and the pixel fitted
+        again until none is negative. If weight, the uncertainties are the
+        square root of the stripped spectrum. The reduced chi-square is
+        stored in the chisq array if given.
+        """
+        mcaTheory = fastFit._mcaTheory
+        columns = []
+        for i in range(len(mcaTheory.PARAMETERS)):
+            if mcaTheory.codes[0][i] != self.classMcaTheory.Gefit.CFIXED:
+                columns.append(mcaTheory.linearMcaTheoryDerivative( \
+                    mcaTheory.parameters, i, mcaTheory.xdata).ravel())
+        derivatives = numpy.array(columns).T
+        xdata = mcaTheory.xdata.ravel()
+        iXMin = numpy.nonzero(x <= xdata[0])[0][-1]
+        iXMax = numpy.nonzero(x >= xdata[-1])[0][0]
+        anchors = []
+        for channel in config['fit']['stripanchorslist']:
+            if channel > xdata[0]:
+                anchors.append(numpy.nonzero(xdata >= channel)[0].min())
+        nRows, nColumns = data.shape[:2]
+        parameters = numpy.zeros((derivatives.shape[1], nRows, nColumns))
+        for row in range(nRows):
+            for column in range(nColumns):
+                spectrum = data[row, column, iXMin:iXMax + 1]
+                spectrum = spectrum - self.getBackground(spectrum, config,
+                                                         anchors)
+                if weight:
+                    sigma = numpy.sqrt(numpy.abs(spectrum))
+                    sigma[sigma == 0] = 1
+                else:
+                    sigma = numpy.ones(spectrum.shape)
+                model = derivatives / sigma[:, None]
+                values = numpy.linalg.lstsq(model, spectrum / sigma,
+                                            rcond=None)[0]
+                # without continuum all the parameters are peak areas
+                fixed = numpy.zeros(values.shape, numpy.bool_)
+                while nonnegative and (values < 0).any():
+                    fixed |= values < 0
+                    values = numpy.zeros(values.shape)
+                    free = numpy.nonzero(~fixed)[0]
+                    if len(free):
+                        values[free] = numpy.linalg.lstsq(model[:, free],
+                                        spectrum / sigma, rcond=None)[0]
+                parameters[:, row, column] = values
+                if chisq is not None:
+                    residuals = (spectrum - numpy.dot(derivatives, values)) / \
+                                sigma
+                    chisq[row, column] = (residuals * residuals).sum() / \
+                                         (spectrum.size - (~fixed).sum())
+        return parameters
+
+    def assertParameters(self, values, expected):
+        atol = 1.0e-5 * abs(expected).max()
+        self.assertTrue(numpy.allclose(values, expected, rtol=1.0e-4,
+                                       atol=atol),
+                        "Maximum difference %g" % abs(values - expected).max())
+
+    def testFastXRFLinearFitImport(self):
+        self.assertTrue(self.fastXRFLinearFit is not None)
+
+    def testFastXRFLinearFitBackground(self):
+        self.assertTrue(self.fastXRFLinearFit is not None)
+        config = self.getConfiguration()
+        x, data = self.getStack(4, 6)
+        fastFit = self.fastXRFLinearFit.FastXRFLinearFit()
+        for nthreads in [None, 3]:
+            result = fastFit.fitMultipleSpectra(x=x, y=data,
+                                                configuration=config,
+                                                refit=False,
+                                                nthreads=nthreads)
+            self.assertEqual(sorted(result['names']),
+                             ['Co K', 'Cu K', 'Fe K'])
+            expected = self.fitPixels(fastFit, config, x, data)
+            self.assertParameters(result['parameters'], expected)
+        # the copper is found where present
+        copper = result['parameters'][result['names'].index('Cu K')]
+        self.assertTrue(copper[0, 1] > 3 * abs(copper[0, 0]))
+
+    def testFastXRFLinearFitWorkers(self):
+        self.assertTrue(self.fastXRFLinearFit is not None)
+        config = self.getConfiguration()
+        x, data = self.getStack(12, 5)
+        fastFit = self.fastXRFLinearFit.FastXRFLinearFit()
+        serial = fastFit.fitMultipleSpectra(x=x, y=data,
+                                            configuration=config,
+                                            refit=False)
+        expected = self.fitPixels(fastFit, config, x, data)
+        self.assertParameters(serial['parameters'], expected)
+        for nworkers in [2, 3, 20]:
+            # the rows are shared among the workers
+            result = fastFit.fitMultipleSpectra(x=x, y=data,
+                                                configuration=config,
+                                                refit=False,
+                                                nworkers=nworkers)
+            self.assertEqual(result['names'], serial['names'])
+            for key in ['parameters', 'uncertainties']:
+                self.assertTrue(numpy.allclose(result[key], serial[key],
+                                               rtol=1.0e-6),
+                                "Different %s using %d workers" % \
+                                (key, nworkers))
+
+    def testFastXRFLinearFitHDF5(self):
+        self.assertTrue(self.fastXRFLinearFit is not None)
+        if not HAS_H5PY:
+            print("skipping HDF5 streaming test, h5py not available")
+            return
+        config = self.getConfiguration()
+        x, data = self.getStack(5, 7)
+        fastFit = self.fastXRFLinearFit.FastXRFLinearFit()
+        fname = os.path.join(self.tmpDir, "stack.h5")
+        h5 = h5py.File(fname, "w")
+        try:
+            dataset = h5.create_dataset("data", data=data,
+                                        chunks=(2, 3, data.shape[-1]))
+            # whole chunks are read at once
+            getReadSteps = self.fastXRFLinearFit.getReadSteps
+            self.assertEqual(getReadSteps(dataset, default=12), (2, 6))
+            self.assertEqual(getReadSteps(dataset), (2, 7))
+            self.assertEqual(getReadSteps(data), (1, 7))
+            self.assertEqual(getReadSteps(data, default=4), (1, 4))
+
+            # streamed from file compared to the fit of every pixel
+            result = fastFit.fitMultipleSpectra(x=x, y=dataset,
+                                                configuration=config,
+                                                refit=False)
+            expected = self.fitPixels(fastFit, config, x, data)
+            self.assertParameters(result['parameters'], expected)
+
+            # some pixels are refitted and the results written to file
+            # after the refit too
+            inMemory = fastFit.fitMultipleSpectra(x=x, y=data,
+                                                  configuration=config)
+            cobalt = inMemory['names'].index('Co K')
+            self.assertTrue((inMemory['parameters'][cobalt] == 0).any())
+            self.assertTrue((inMemory['parameters'][cobalt] > 0).any())
+            output = h5.require_group("output")
+            result = fastFit.fitMultipleSpectra(x=x, y=dataset,
+                                                configuration=config,
+                                                output=output,
+                                                compression="gzip")
+            for key in ['parameters', 'uncertainties', 'chisq']:
+                self.assertTrue(numpy.allclose(result[key], inMemory[key],
+                                               rtol=1.0e-6),
+                                "Different %s from file" % key)
+                self.assertTrue((output[key][()] == result[key]).all(),
+                                "Different %s written to file" % key)
+                self.assertEqual(output[key].compression, "gzip")
+            self.assertEqual(output['parameters'].chunks, (1, 2, 7))
+            self.assertEqual(output['chisq'].chunks, (2, 7))
+        finally:
+            h5.close()
+
+    def testFastXRFLinearFitNonNegative(self):
+        self.assertTrue(self.fastXRFLinearFit is not None)
+        config = self.getConfiguration()
+        x, data = self.getStack(6, 7)
+        fastFit = self.fastXRFLinearFit.FastXRFLinearFit()
+        first = fastFit.fitMultipleSpectra(x=x, y=data,
+                                           configuration=config,
+                                           refit=False)
+        # enough pixels to be refitted
+        negative = (first['parameters'] < 0).any(axis=0)
+        self.assertTrue(negative.sum() > 5)
+        self.assertTrue((~negative).sum() > 5)
+        result = fastFit.fitMultipleSpectra(x=x, y=data,
+                                            configuration=config)
+        self.assertTrue((result['parameters'] >= 0).all())
+        # only the pixels with negative contributions are fitted again
+        self.assertTrue((result['parameters'][:, ~negative] == \
+                         first['parameters'][:, ~negative]).all())
+        self.assertTrue((result['uncertainties'][:, ~negative] == \
+                         first['uncertainties'][:, ~negative]).all())
+        expected = self.fitPixels(fastFit, config, x, data, nonnegative=True)
+        self.assertParameters(result['parameters'], expected)
+        # the zeroed contributions have no uncertainty
+        zeroed = result['parameters'] == 0
+        self.assertTrue(zeroed.any())
+        self.assertTrue((result['uncertainties'][zeroed] == 0).all())
+
+        # several patterns of zeroed contributions and a background
+        # parameter allowed to be negative
+        from PyMca5.PyMcaMath.linalg import lstsq
+        channels = numpy.arange(100.)
+        columns = [numpy.ones(channels.shape)]
+        for position in [30., 40., 50., 60.]:
+            columns.append(numpy.exp(-0.5 * ((channels - position) / 8.) ** 2))
+        derivatives = numpy.array(columns).T
+        randomState = numpy.random.RandomState(2)
+        values = randomState.uniform(-1.0, 2.0, (5, 300))
+        spectra = numpy.dot(derivatives, values) + \
+                  randomState.normal(0.0, 0.05, (channels.size, 300))
+        ddict = lstsq(derivatives, spectra, digested_output=True, chisq=True)
+        parameters = ddict['parameters']
+        uncertainties = ddict['uncertainties']
+        chisq = ddict['chisq']
+        nFits = fastFit._fitNonNegative(derivatives, spectra, parameters,
+                                        uncertainties, 1, chisq)
+        self.assertTrue(nFits > 1)
+        self.assertTrue((parameters[0] < 0).any())
+        self.assertTrue((parameters[1:] >= 0).all())
+        for k in range(spectra.shape[1]):
+            expected = numpy.linalg.lstsq(derivatives, spectra[:, k],
+                                          rcond=None)[0]
+            fixed = numpy.zeros(expected.shape, numpy.bool_)
+            free = numpy.arange(expected.size)
+            while (expected[1:] < 0).any():
+                fixed[1:] |= expected[1:] < 0
+                free = numpy.nonzero(~fixed)[0]
+                expected = numpy.zeros(expected.shape)
+                expected[free] = numpy.linalg.lstsq(derivatives[:, free],
+                                                    spectra[:, k],
+                                                    rcond=None)[0]
+            self.assertTrue(numpy.allclose(parameters[:, k], expected))
+            residuals = spectra[:, k] - numpy.dot(derivatives, expected)
+            self.assertTrue(numpy.allclose(chisq[k],
+                (residuals * residuals).sum() / (channels.size - free.size)))
+
+    def testFastXRFLinearFitWeight(self):
+        self.assertTrue(self.fastXRFLinearFit is not None)
+        config = self.getConfiguration()
+        x, data = self.getStack(4, 5)
+        fastFit = self.fastXRFLinearFit.FastXRFLinearFit()
+        for weight in [0, 2]:
+            for refit in [False, True]:
+                result = fastFit.fitMultipleSpectra(x=x, y=data,
+                                                    configuration=config,
+                                                    weight=weight,
+                                                    refit=refit)
+                chisq = numpy.zeros(data.shape[:2])
+                expected = self.fitPixels(fastFit, config, x, data,
+                                          nonnegative=refit,
+                                          weight=weight, chisq=chisq)
+                self.assertParameters(result['parameters'], expected)
+                self.assertEqual(result['chisq'].shape, data.shape[:2])
+                self.assertTrue(numpy.allclose(result['chisq'], chisq,
+                                               rtol=1.0e-4))
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testFastXRFLinearFit))
+    else:
+        # use a predefined order
+        testSuite.addTest(testFastXRFLinearFit("testFastXRFLinearFitImport"))
+        testSuite.addTest(\
+            testFastXRFLinearFit("testFastXRFLinearFitBackground"))
+        testSuite.addTest(\
+            testFastXRFLinearFit("testFastXRFLinearFitWorkers"))
+        testSuite.addTest(testFastXRFLinearFit("testFastXRFLinearFitHDF5"))
+        testSuite.addTest(\
+            testFastXRFLinearFit("testFastXRFLinearFitNonNegative"))
+        testSuite.addTest(testFastXRFLinearFit("testFastXRFLinearFitWeight"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,176 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import gc
+import shutil
+import tempfile
+import numpy
+
+class testHDF5Stack1D(unittest.TestCase):
+    def setUp(self):
+        """
+        import the module and write a few files with spectra
+        """
+        self.tmpDir = tempfile.mkdtemp()
+        try:
+            from PyMca5.PyMcaIO import HDF5Stack1D
+            import h5py
+            self.stackModule = HDF5Stack1D
+            self._nProcesses = HDF5Stack1D.NUMBER_OF_PROCESSES
+        except:
+            self.stackModule = None
+            return
+        self.nFiles = 3
+        self.nSpectra = 5
+        self.mcaDim = 64
+        self.fileList = []
+        self.spectra = []
+        self.monitors = []
+        for i in range(self.nFiles):
+            spectra = numpy.arange(self.nSpectra * self.mcaDim,
+                                   dtype=numpy.float64)
+            spectra.shape = self.nSpectra, self.mcaDim
+            spectra += 1000. * i
+            monitor = 1.0 + numpy.arange(self.nSpectra) + 10. * i
+            fname = os.path.join(self.tmpDir, "file_%02d.h5" % i)
+            h5 = h5py.File(fname, "w")
+            h5["/entry/data"] = spectra
+            h5["/entry/monitor"] = monitor
+            h5.close()
+            self.fileList.append(fname)
+            self.spectra.append(spectra)
+            self.monitors.append(monitor)
+
+    def tearDown(self):
+        """clean up the files"""
+        if self.stackModule is not None:
+            self.stackModule.NUMBER_OF_PROCESSES = self._nProcesses
+        gc.collect()
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def loadStack(self, nProcesses, monitor):
+        self.stackModule.NUMBER_OF_PROCESSES = nProcesses
+        selection = {"x": None, "y": "/data", "m": monitor}
+        stack = self.stackModule.HDF5Stack1D(self.fileList, selection,
+                                             scanlist=["/entry"],
+                                             dtype=numpy.float64)
+        return stack
+
+    def testHDF5Stack1DImport(self):
+        self.assertTrue(self.stackModule is not None)
+
+    def testHDF5Stack1DParallelReading(self):
+        self.assertTrue(self.stackModule is not None)
+        for monitor in [None, "/monitor"]:
+            expected = []
+            for i in range(self.nFiles):
+                if monitor is None:
+                    expected.append(self.spectra[i])
+                else:
+                    expected.append(self.spectra[i] / \
+                                    self.monitors[i][:, numpy.newaxis])
+            expected = numpy.array(expected)
+            sequential = self.loadStack(1, monitor)
+            parallel = self.loadStack(2, monitor)
+            self.assertEqual(sequential.data.shape,
+                             (self.nFiles, self.nSpectra, self.mcaDim))
+            self.assertEqual(parallel.data.shape, sequential.data.shape)
+            self.assertEqual(parallel.info["McaIndex"],
+                             sequential.info["McaIndex"])
+            self.assertTrue(numpy.allclose(sequential.data, expected))
+            self.assertTrue(numpy.allclose(parallel.data, sequential.data))
+
+    def testHDF5Stack1DVirtual(self):
+        self.assertTrue(self.stackModule is not None)
+        from PyMca5.PyMcaCore import StackBase
+        import h5py
+        selection = {"x": None, "y": "/data", "m": None}
+        expected = self.loadStack(1, None)
+        fname = os.path.join(self.tmpDir, "virtual.h5")
+        for virtual in [True, fname]:
+            stack = self.stackModule.HDF5Stack1D(self.fileList, selection,
+                                                 scanlist=["/entry"],
+                                                 virtual=virtual)
+            self.assertTrue(isinstance(stack.data, h5py.Dataset))
+            self.assertEqual(stack.data.shape, expected.data.shape)
+            self.assertEqual(stack.info["McaIndex"], 2)
+            self.assertTrue(numpy.allclose(stack.data[()], expected.data))
+
+            # usable as dynamic stack data
+            stackBase = StackBase.StackBase()
+            stackBase.setStack(stack, mcaindex=2)
+            channels, counts = stackBase.getActiveCurve()[0:2]
+            self.assertTrue(numpy.allclose(counts,
+                                           expected.data.sum(axis=(0, 1))))
+            stackBase = None
+            stack = None
+            gc.collect()
+
+        # the descriptor file can be opened alone
+        h5 = h5py.File(fname, "r")
+        try:
+            self.assertTrue(numpy.allclose(h5["/entry/data"][()],
+                                           expected.data))
+        finally:
+            h5.close()
+
+        # the data cannot be normalized by the monitor
+        selection["m"] = "/monitor"
+        self.assertRaises(ValueError, self.stackModule.HDF5Stack1D,
+                          self.fileList, selection, scanlist=["/entry"],
+                          virtual=True)
+
+        # the spectra have to be in the last dimension
+        selection = {"x": None, "y": "/data", "m": None, "index": 0}
+        self.assertRaises(ValueError, self.stackModule.HDF5Stack1D,
+                          self.fileList, selection, scanlist=["/entry"],
+                          virtual=True)
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testHDF5Stack1D))
+    else:
+        # use a predefined order
+        testSuite.addTest(testHDF5Stack1D("testHDF5Stack1DImport"))
+        testSuite.addTest(testHDF5Stack1D("testHDF5Stack1DParallelReading"))
+        testSuite.addTest(testHDF5Stack1D("testHDF5Stack1DVirtual"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
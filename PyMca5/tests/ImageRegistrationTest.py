@@ -0,0 +1,145 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import numpy
+
+class testImageRegistration(unittest.TestCase):
+    def setUp(self):
+        """
+        import the module and generate a stack of shifted frames
+        """
+        try:
+            from PyMca5.PyMcaMath import ImageRegistration
+            self.imageRegistration = ImageRegistration
+        except:
+            self.imageRegistration = None
+        randomState = numpy.random.RandomState(0)
+        d0, d1, nFrames = 64, 60, 12
+        texture = randomState.random_sample((d0 + 20, d1 + 20))
+        self.shifts = randomState.randint(-4, 5, (nFrames, 2)).astype( \
+                                                            numpy.float64)
+        self.reference = texture[10:(10 + d0), 10:(10 + d1)]
+        self.stack = numpy.zeros((nFrames, d0, d1), numpy.float64)
+        for i in range(nFrames):
+            i0 = 10 - int(self.shifts[i, 0])
+            i1 = 10 - int(self.shifts[i, 1])
+            self.stack[i] = texture[i0:(i0 + d0), i1:(i1 + d1)]
+
+    def testImageRegistrationImport(self):
+        self.assertTrue(self.imageRegistration is not None)
+
+    def testImageRegistrationCalculateShifts(self):
+        self.assertTrue(self.imageRegistration is not None)
+        registration = self.imageRegistration.StackRegistration( \
+                                                            self.reference)
+        shifts = registration.calculate_shifts(self.stack, index=0)
+        self.assertTrue(numpy.allclose(shifts, self.shifts))
+
+        # the same as measuring each frame separately
+        window = registration.window
+        referenceFFT = numpy.fft.fft2(self.reference * window)
+        for i in range(self.stack.shape[0]):
+            offset = self.imageRegistration.measure_offset_from_ffts( \
+                            referenceFFT, numpy.fft.fft2(self.stack[i] * window))
+            self.assertTrue(numpy.allclose(offset, shifts[i], atol=1.0e-5))
+
+        # several blocks, several threads and frames as last dimension
+        stack2 = numpy.ascontiguousarray(numpy.transpose(self.stack,
+                                                         (1, 2, 0)))
+        frameSize = self.stack.shape[1] * self.stack.shape[2] * 8
+        shifts2 = registration.calculate_shifts(stack2, index=-1,
+                                                nthreads=2,
+                                                chunksize=3 * frameSize)
+        self.assertTrue(numpy.allclose(shifts2, shifts))
+
+    def testImageRegistrationShiftStack(self):
+        self.assertTrue(self.imageRegistration is not None)
+        shape = self.reference.shape
+        # integer shifts as shiftBilinear away from the borders
+        shifted = self.stack.copy()
+        self.imageRegistration.shift_stack(shifted, self.shifts,
+                                           crop_window=False)
+        for i in range(self.stack.shape[0]):
+            expected = self.imageRegistration.shiftBilinear(self.stack[i],
+                                                            self.shifts[i])
+            self.assertTrue(numpy.allclose(shifted[i, 5:-5, 5:-5],
+                                           expected[5:-5, 5:-5]))
+            # and aligned onto the reference
+            self.assertTrue(numpy.allclose(shifted[i, 5:-5, 5:-5],
+                                           self.reference[5:-5, 5:-5]))
+
+        # the crop window is the one used by the stack alignment plugin
+        aligned = self.stack.copy()
+        self.imageRegistration.shift_stack(aligned, self.shifts, index=0)
+        d0Start, d0End, d1Start, d1End = [int(x) for x in \
+                    self.imageRegistration.get_crop_indices(shape,
+                                                    self.shifts[:, 0],
+                                                    self.shifts[:, 1])]
+        window = numpy.zeros(shape, numpy.float64)
+        window[d0Start:d0End, d1Start:d1End] = 1.0
+        self.assertTrue(numpy.allclose(aligned, shifted * window))
+
+        # frames as last dimension, several blocks and an output array
+        stack2 = numpy.ascontiguousarray(numpy.transpose(self.stack,
+                                                         (1, 2, 0)))
+        output = numpy.zeros(self.stack.shape, numpy.float32)
+        frameSize = shape[0] * shape[1] * 8
+        result = self.imageRegistration.shift_stack(stack2, self.shifts,
+                                                    index=2,
+                                                    output=output,
+                                                    nthreads=2,
+                                                    chunksize=5 * frameSize)
+        self.assertTrue(result is output)
+        self.assertTrue(numpy.allclose(output, aligned, atol=1.0e-5))
+        self.assertTrue(numpy.allclose(stack2,
+                                numpy.transpose(self.stack, (1, 2, 0))))
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testImageRegistration))
+    else:
+        # use a predefined order
+        testSuite.addTest(testImageRegistration("testImageRegistrationImport"))
+        testSuite.addTest(\
+            testImageRegistration("testImageRegistrationCalculateShifts"))
+        testSuite.addTest(\
+            testImageRegistration("testImageRegistrationShiftStack"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
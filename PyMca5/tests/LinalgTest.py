@@ -0,0 +1,182 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import numpy
+
+class testLinalg(unittest.TestCase):
+    def setUp(self):
+        """
+        import the module
+        """
+        try:
+            from PyMca5.PyMcaMath import linalg
+            self.linalg = linalg
+        except:
+            self.linalg = None
+
+    def getData(self, nPoints=200, nParameters=6, nSpectra=50):
+        # overlapping gaussians and a constant
+        x = numpy.arange(float(nPoints))
+        columns = [numpy.ones(x.shape)]
+        for position in numpy.linspace(0.2, 0.8, nParameters - 1) * nPoints:
+            columns.append(numpy.exp(-0.5 * ((x - position) / 10.) ** 2))
+        a = numpy.array(columns).T
+        randomState = numpy.random.RandomState(3)
+        values = randomState.uniform(1.0, 100.0, (nParameters, nSpectra))
+        b = randomState.poisson(numpy.dot(a, values) + 10.).astype(numpy.float64)
+        return a, b
+
+    def getExpected(self, a, b, w):
+        # weighted fit of one column after the other
+        n = a.shape[1]
+        parameters = numpy.zeros((n, b.shape[1]))
+        uncertainties = numpy.zeros((n, b.shape[1]))
+        chisq = numpy.zeros((b.shape[1],))
+        for k in range(b.shape[1]):
+            A = a / w[:, k:k+1]
+            y = b[:, k] / w[:, k]
+            parameters[:, k] = numpy.linalg.lstsq(A, y, rcond=None)[0]
+            covariance = numpy.linalg.inv(numpy.dot(A.T, A))
+            uncertainties[:, k] = numpy.sqrt(numpy.diag(covariance))
+            residuals = y - numpy.dot(A, parameters[:, k])
+            chisq[k] = (residuals * residuals).sum() / (a.shape[0] - n)
+        return parameters, uncertainties, chisq
+
+    def assertResult(self, ddict, expected):
+        parameters, uncertainties, chisq = expected
+        self.assertTrue(numpy.allclose(ddict['parameters'], parameters))
+        self.assertTrue(numpy.allclose(ddict['uncertainties'], uncertainties))
+        self.assertTrue(numpy.allclose(ddict['chisq'], chisq))
+
+    def testLinalgImport(self):
+        self.assertTrue(self.linalg is not None)
+
+    def testLinalgLstsq(self):
+        self.assertTrue(self.linalg is not None)
+        lstsq = self.linalg.lstsq
+        a, b = self.getData()
+
+        # no weight
+        ddict = lstsq(a, b, digested_output=True, chisq=True)
+        self.assertResult(ddict, self.getExpected(a, b, numpy.ones(b.shape)))
+        parameters = lstsq(a, b[:, 0], uncertainties=False)[0]
+        self.assertEqual(parameters.shape, (a.shape[1],))
+        self.assertTrue(numpy.allclose(parameters, ddict['parameters'][:, 0]))
+
+        # same uncertainties for all the spectra
+        sigma = 1.0 + numpy.sqrt(b.mean(axis=1))
+        ddict = lstsq(a, b, sigma_b=sigma, weight=1,
+                      digested_output=True, chisq=True)
+        w = numpy.outer(sigma, numpy.ones(b.shape[1]))
+        self.assertResult(ddict, self.getExpected(a, b, w))
+
+        # individual weights from the data themselves
+        w = numpy.sqrt(b)
+        w[w == 0] = 1
+        expected = self.getExpected(a, b, w)
+        for svd in [True, False]:
+            ddict = lstsq(a, b, weight=1, svd=svd,
+                          digested_output=True, chisq=True)
+            self.assertResult(ddict, expected)
+            parameters, uncertainties, covariances = lstsq(a, b, weight=1,
+                                                svd=svd, covariances=True)
+            self.assertEqual(covariances.shape,
+                             (b.shape[1], a.shape[1], a.shape[1]))
+            self.assertTrue(numpy.allclose(uncertainties, expected[1]))
+            for k in [0, b.shape[1] - 1]:
+                self.assertTrue(numpy.allclose(numpy.diag(covariances[k]),
+                                               expected[1][:, k] ** 2))
+
+    def testLinalgLstsqBlocks(self):
+        self.assertTrue(self.linalg is not None)
+        lstsq = self.linalg.lstsq
+        # the normal equations of several blocks of spectra
+        a, b = self.getData(nPoints=2000, nParameters=20, nSpectra=250)
+        w = numpy.sqrt(b)
+        w[w == 0] = 1
+        expected = self.getExpected(a, b, w)
+        ddict = lstsq(a, b, weight=1, svd=False,
+                      digested_output=True, chisq=True)
+        self.assertResult(ddict, expected)
+
+        # a spectrum without information gives a singular system, only its
+        # parameters are set to zero
+        sigma = numpy.array(w)
+        sigma[:, 111] = numpy.inf
+        ddict = lstsq(a, b, sigma_b=sigma, weight=1, svd=False,
+                      digested_output=True, chisq=True)
+        good = numpy.arange(b.shape[1]) != 111
+        self.assertTrue((ddict['parameters'][:, 111] == 0).all())
+        self.assertTrue(numpy.allclose(ddict['parameters'][:, good],
+                                       expected[0][:, good]))
+        self.assertTrue(numpy.allclose(ddict['chisq'][good],
+                                       expected[2][good]))
+
+    def testLinalgLstsqSingular(self):
+        self.assertTrue(self.linalg is not None)
+        lstsq = self.linalg.lstsq
+        a, b = self.getData()
+        # two identical columns
+        a = numpy.hstack((a, a[:, 1:2]))
+        ddict = lstsq(a, b, digested_output=True, chisq=True)
+        for k in range(b.shape[1]):
+            # the same minimum norm solution
+            expected, residuals, rank, s = numpy.linalg.lstsq(a, b[:, k],
+                                                              rcond=None)
+            self.assertEqual(rank, a.shape[1] - 1)
+            self.assertTrue(numpy.allclose(ddict['parameters'][:, k],
+                                           expected))
+            residuals = b[:, k] - numpy.dot(a, expected)
+            self.assertTrue(numpy.allclose(ddict['chisq'][k],
+                    (residuals * residuals).sum() / (a.shape[0] - a.shape[1])))
+        self.assertTrue(numpy.allclose(ddict['parameters'][1],
+                                       ddict['parameters'][-1]))
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testLinalg))
+    else:
+        # use a predefined order
+        testSuite.addTest(testLinalg("testLinalgImport"))
+        testSuite.addTest(testLinalg("testLinalgLstsq"))
+        testSuite.addTest(testLinalg("testLinalgLstsqBlocks"))
+        testSuite.addTest(testLinalg("testLinalgLstsqSingular"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,164 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+
+class testMcaAdvancedFitBatch(unittest.TestCase):
+    def setUp(self):
+        """
+        import the module
+        """
+        try:
+            from PyMca5.PyMcaPhysics.xrf import McaAdvancedFitBatch
+            from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+            from PyMca5.PyMcaIO import ConfigDict
+            from PyMca5.PyMcaIO import EdfFile
+            self.batchModule = McaAdvancedFitBatch
+            self.classMcaTheory = ClassMcaTheory
+            self.configDict = ConfigDict
+            self.edfFile = EdfFile
+        except:
+            self.batchModule = None
+        self.tmpDir = tempfile.mkdtemp(prefix="pymcatest_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def writeInput(self):
+        # a fit configuration with a matrix to calculate concentrations
+        config = self.classMcaTheory.McaTheory().configure()
+        config['peaks'] = {'Cu': 'K', 'Fe': 'K'}
+        config['attenuators']['Matrix'] = [1, 'Fe', 7.874, 0.01, 45., 45.]
+        config['fit']['energy'] = [20.0]
+        config['fit']['energyweight'] = [1.0]
+        config['fit']['energyflag'] = [1]
+        config['fit']['energyscatter'] = [1]
+        config['fit']['xmin'] = 200
+        config['fit']['xmax'] = 600
+        config['fit']['use_limit'] = 1
+        config['detector']['zero'] = 0.0
+        config['detector']['gain'] = 0.02
+        configFile = os.path.join(self.tmpDir, "fit.cfg")
+        ddict = self.configDict.ConfigDict()
+        ddict.update(config)
+        ddict.write(configFile)
+
+        # one file per row of the images, four spectra per file
+        energy = numpy.arange(1024.) * 0.02
+        fileList = []
+        for row in range(3):
+            data = numpy.zeros((4, energy.size), numpy.float32)
+            for column in range(4):
+                data[column] = 10. + \
+                    (1000. + 100 * row) * \
+                        numpy.exp(-0.5 * ((energy - 8.04) / 0.07) ** 2) + \
+                    (500. + 50 * column) * \
+                        numpy.exp(-0.5 * ((energy - 6.40) / 0.065) ** 2)
+            fname = os.path.join(self.tmpDir, "data_%04d.edf" % row)
+            edf = self.edfFile.EdfFile(fname, access="wb")
+            edf.WriteImage({}, data)
+            edf = None
+            fileList.append(fname)
+        return configFile, fileList
+
+    def readImage(self, fname):
+        edf = self.edfFile.EdfFile(fname, access="rb")
+        return edf.GetData(0)
+
+    def testMcaAdvancedFitBatchImport(self):
+        self.assertTrue(self.batchModule is not None)
+
+    def testMcaAdvancedFitBatchProcesses(self):
+        self.assertTrue(self.batchModule is not None)
+        configFile, fileList = self.writeInput()
+        savedImages = {}
+        for nProcesses in [1, 2]:
+            outputDir = os.path.join(self.tmpDir, "output%d" % nProcesses)
+            os.mkdir(outputDir)
+            batch = self.batchModule.McaAdvancedFitBatch(configFile,
+                                                filelist=fileList,
+                                                outputdir=outputDir,
+                                                concentrations=1,
+                                                fitfiles=0,
+                                                nprocesses=nProcesses)
+            batch.processList()
+            savedImages[nProcesses] = [os.path.basename(fname) \
+                                       for fname in batch.savedImages]
+        self.assertEqual(savedImages[1], savedImages[2])
+        names = [name for name in savedImages[1] \
+                 if name.endswith("_mass_fraction.edf")]
+        self.assertEqual(len(names), 2)
+        for name in savedImages[1]:
+            serial = self.readImage(os.path.join(self.tmpDir, "output1",
+                                                 "IMAGES", name))
+            pool = self.readImage(os.path.join(self.tmpDir, "output2",
+                                               "IMAGES", name))
+            self.assertEqual(serial.shape, (3, 4))
+            self.assertTrue(numpy.allclose(serial, pool),
+                            "Different %s images" % name)
+            if name.endswith("_Cu_K.edf"):
+                # the copper area follows the row
+                self.assertTrue((serial[1:, 0] > serial[:-1, 0]).all())
+            elif name.endswith("_Fe_K.edf"):
+                # the iron area follows the column
+                self.assertTrue((serial[0, 1:] > serial[0, :-1]).all())
+        # same concentrations in the text output
+        serial = numpy.loadtxt(os.path.join(self.tmpDir, "output1", "IMAGES",
+                               "data_0000_to_0002.dat"), skiprows=1)
+        pool = numpy.loadtxt(os.path.join(self.tmpDir, "output2", "IMAGES",
+                             "data_0000_to_0002.dat"), skiprows=1)
+        self.assertEqual(serial.shape, (12, 9))
+        self.assertTrue(numpy.allclose(serial, pool))
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(\
+                testMcaAdvancedFitBatch))
+    else:
+        # use a predefined order
+        testSuite.addTest(\
+            testMcaAdvancedFitBatch("testMcaAdvancedFitBatchImport"))
+        testSuite.addTest(\
+            testMcaAdvancedFitBatch("testMcaAdvancedFitBatchProcesses"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
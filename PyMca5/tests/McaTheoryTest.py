@@ -0,0 +1,192 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+
+DEBUG = 0
+
+class testMcaTheory(unittest.TestCase):
+    def setUp(self):
+        """
+        import the module
+        """
+        try:
+            from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+            self.classMcaTheory = ClassMcaTheory
+            self.mcaTheory = ClassMcaTheory.McaTheory()
+        except:
+            self.mcaTheory = None
+
+    def testMcaTheoryImport(self):
+        self.assertTrue(self.mcaTheory is not None)
+
+    def testAnalyticalJacobian(self):
+        self.testMcaTheoryImport()
+        mcaFit = self.mcaTheory
+        gain = 0.02
+        x = numpy.arange(1024.)
+        y = 1.0 + 1000. * numpy.exp(-0.5 * ((x * gain - 8.04) / 0.07) ** 2) +\
+                  500. * numpy.exp(-0.5 * ((x * gain - 6.40) / 0.065) ** 2)
+        for zero in [1.0e-12, 1.0e-9, 0.0, 0.1]:
+            config = mcaFit.configure()
+            config['peaks'] = {'Cu': 'K', 'Fe': 'K'}
+            config['fit']['hypermetflag'] = 1
+            config['fit']['sumflag'] = 0
+            config['fit']['continuum'] = 0
+            config['fit']['stripflag'] = 0
+            config['fit']['use_limit'] = 0
+            config['detector']['zero'] = zero
+            config['detector']['gain'] = gain
+            mcaFit.configure(config)
+            mcaFit.setData(x, y)
+            mcaFit.estimate()
+            parameters = numpy.array(mcaFit.parameters, numpy.float64)
+            xdata = mcaFit.xdata
+            nGlobal = mcaFit.NGLOBAL
+            freeIndex = [0, 1, nGlobal, nGlobal + 1]
+            jacobian = mcaFit.analyticalJacobian(parameters, freeIndex, xdata)
+            self.checkJacobian(mcaFit, parameters, freeIndex, xdata, jacobian,
+                               zero, gain)
+            # the exact peak profiles are used unless FASTER
+            mcaFit.FASTER = 0
+            try:
+                exact = mcaFit.analyticalJacobian(parameters, freeIndex,
+                                                  xdata)
+                self.checkJacobian(mcaFit, parameters, freeIndex, xdata,
+                                   exact, zero, gain)
+                for k in [2, 3]:
+                    self.assertTrue((exact[k] == \
+                        mcaFit.analyticalDerivative(parameters, freeIndex[k],
+                                                    xdata).ravel()).all())
+            finally:
+                mcaFit.FASTER = 1
+            for k in [2, 3]:
+                self.assertTrue(numpy.allclose(exact[k], jacobian[k],
+                                rtol=1.0e-3,
+                                atol=1.0e-4 * abs(jacobian[k]).max()))
+
+    def checkJacobian(self, mcaFit, parameters, freeIndex, xdata, jacobian,
+                      zero, gain):
+        for k, index in enumerate(freeIndex):
+            if index == 0:
+                delta = 1.0e-4 * gain
+            else:
+                delta = 1.0e-6 * abs(parameters[index])
+            newpar = parameters.copy()
+            newpar[index] = parameters[index] + delta
+            f1 = numpy.ravel(mcaFit.mcatheory(newpar, xdata))
+            newpar[index] = parameters[index] - delta
+            f2 = numpy.ravel(mcaFit.mcatheory(newpar, xdata))
+            numerical = (f1 - f2) / (2.0 * delta)
+            idx = abs(numerical) > 1.0e-3 * abs(numerical).max()
+            error = abs(jacobian[k][idx] - numerical[idx]) / \
+                    abs(numerical[idx])
+            if DEBUG:
+                print("zero = %g index = %d median relative error = %g" % \
+                      (zero, index, numpy.median(error)))
+            self.assertTrue(numpy.median(error) < 1.0e-3,
+                "Wrong derivative respect to parameter %d for zero = %g" % \
+                (index, zero))
+
+    def testConfigurationCache(self):
+        self.testMcaTheoryImport()
+        ClassMcaTheory = self.classMcaTheory
+        config = self.mcaTheory.configure()
+        config['peaks'] = {'Cu': 'K', 'Fe': 'K'}
+        config['attenuators']['Matrix'] = [1, 'Fe', 7.874, 0.01, 45., 45.]
+        config['fit']['energy'] = [20.0]
+        config['fit']['energyweight'] = [1.0]
+        config['fit']['energyflag'] = [1]
+        config['fit']['energyscatter'] = [1]
+        tmpDir = tempfile.mkdtemp(prefix="pymcatest_")
+        cacheDirectory = ClassMcaTheory.CACHE_DIRECTORY
+        getPeaksDescription = \
+                ClassMcaTheory.McaTheory._McaTheory__getPeaksDescription
+        def notCached(*var, **kw):
+            raise RuntimeError("Peaks description not taken from the cache")
+        try:
+            ClassMcaTheory.CACHE_DIRECTORY = tmpDir
+            ClassMcaTheory.clearConfigurationCache()
+            first = ClassMcaTheory.McaTheory(config=config)
+            self.assertEqual(len(os.listdir(tmpDir)), 1)
+            # the second instance reads the description written on disk
+            ClassMcaTheory.clearConfigurationCache()
+            ClassMcaTheory.McaTheory._McaTheory__getPeaksDescription = \
+                                                                notCached
+            second = ClassMcaTheory.McaTheory(config=config)
+            self.assertEqual(len(os.listdir(tmpDir)), 1)
+
+            # descriptions obtained with other versions are not used
+            key = ClassMcaTheory._getConfigurationKey(second.config,
+                                                      second.attflag)
+            dataVersion = ClassMcaTheory._getDataVersion()
+            ClassMcaTheory._DATA_VERSION = ("0.0.0", dataVersion[1])
+            try:
+                self.assertTrue(key != \
+                    ClassMcaTheory._getConfigurationKey(second.config,
+                                                        second.attflag))
+            finally:
+                ClassMcaTheory._DATA_VERSION = dataVersion
+        finally:
+            ClassMcaTheory.McaTheory._McaTheory__getPeaksDescription = \
+                                                        getPeaksDescription
+            ClassMcaTheory.CACHE_DIRECTORY = cacheDirectory
+            ClassMcaTheory.clearConfigurationCache()
+            shutil.rmtree(tmpDir, ignore_errors=True)
+        self.assertEqual(len(first.PEAKS0), len(second.PEAKS0))
+        for i in range(len(first.PEAKS0)):
+            self.assertTrue((first.PEAKS0[i] == second.PEAKS0[i]).all())
+        self.assertTrue(first._fluoRates is not None)
+        self.assertEqual(ClassMcaTheory._toHashable(first._fluoRates),
+                         ClassMcaTheory._toHashable(second._fluoRates))
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testMcaTheory))
+    else:
+        # use a predefined order
+        testSuite.addTest(testMcaTheory("testMcaTheoryImport"))
+        testSuite.addTest(testMcaTheory("testAnalyticalJacobian"))
+        testSuite.addTest(testMcaTheory("testConfigurationCache"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
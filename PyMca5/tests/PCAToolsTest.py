@@ -131,6 +131,66 @@ def testPCAToolsPCA(self):
             self.assertTrue(numpy.allclose(eigenvalues, numpyEigenvalues))
             self.assertTrue(numpy.allclose(eigenvectors, numpyEigenvectors))
 
+    def testPCAModuleRandomizedPCA(self):
+        from PyMca5.PyMcaMath.mva.PCAModule import randomizedPCA
+        # 200 spectra of 50 channels built from 3 components
+        x = numpy.arange(50.)
+        components = numpy.array([numpy.exp(-0.5 * ((x - 10) / 2.) ** 2),
+                                  numpy.exp(-0.5 * ((x - 25) / 3.) ** 2),
+                                  numpy.exp(-0.5 * ((x - 40) / 2.) ** 2)])
+        weights = numpy.outer(numpy.sin(numpy.arange(200.)), [100., 10., 1.])
+        data = numpy.dot(weights, components) + \
+               numpy.cos(numpy.arange(200. * 50)).reshape(200, 50) * 0.01
+
+        # reference eigenvalues and eigenvectors
+        numpyEigenvalues, numpyEigenvectors = numpy.linalg.eigh(\
+                                                        numpy.cov(data.T))
+        numpyEigenvalues = numpyEigenvalues[::-1]
+        numpyEigenvectors = numpyEigenvectors[:, ::-1].T
+
+        data.shape = 20, 10, 50
+        for nthreads in [1, 2]:
+            images, eigenvalues, eigenvectors = randomizedPCA(data,
+                                                    ncomponents=3,
+                                                    memory_limit=0.01,
+                                                    nthreads=nthreads)
+            self.assertTrue(images.shape == (3, 20, 10))
+            self.assertTrue(numpy.allclose(eigenvalues,
+                                           numpyEigenvalues[:3],
+                                           rtol=1.0e-4))
+            # the eigenvectors can be multiplied by -1
+            for i in range(3):
+                self.assertTrue(abs(abs(numpy.dot(eigenvectors[i],
+                                           numpyEigenvectors[i])) - 1) < 1.0e-4)
+
+    def testPCAModuleRandomizedPCABinning(self):
+        from PyMca5.PyMcaMath.mva.PCAModule import randomizedPCA
+        # 200 spectra of 51 channels, not a multiple of the binning
+        x = numpy.arange(51.)
+        components = numpy.array([numpy.exp(-0.5 * ((x - 10) / 2.) ** 2),
+                                  numpy.exp(-0.5 * ((x - 25) / 3.) ** 2),
+                                  numpy.exp(-0.5 * ((x - 40) / 2.) ** 2)])
+        weights = numpy.outer(numpy.sin(numpy.arange(200.)), [100., 10., 1.])
+        data = numpy.dot(weights, components) + \
+               numpy.cos(numpy.arange(200. * 51)).reshape(200, 51) * 0.01
+        spectralMask = numpy.ones(51)
+        spectralMask[30:35] = 0
+
+        # reference from the masked and binned data
+        binned = (data * spectralMask)[:, :50].reshape(200, 25, 2).sum(axis=-1)
+        numpyEigenvalues = numpy.linalg.eigh(numpy.cov(binned.T))[0][::-1]
+
+        data.shape = 20, 10, 51
+        images, eigenvalues, eigenvectors = randomizedPCA(data,
+                                                    ncomponents=3,
+                                                    binning=2,
+                                                    spectral_mask=spectralMask)
+        self.assertTrue(images.shape == (3, 20, 10))
+        self.assertTrue(eigenvectors.shape[1] == 25)
+        self.assertTrue(numpy.allclose(eigenvalues,
+                                       numpyEigenvalues[:3],
+                                       rtol=1.0e-4))
+
     if MDP:
         def testPCAToolsMDP(self):
             from PyMca5.PyMcaMath.mva.PCATools import getCovarianceMatrix, numpyPCA
@@ -176,6 +236,8 @@ def getSuite(auto=True):
         testSuite.addTest(testPCATools("testPCAToolsImport"))
         testSuite.addTest(testPCATools("testPCAToolsCovariance"))
         testSuite.addTest(testPCATools("testPCAToolsPCA"))
+        testSuite.addTest(testPCATools("testPCAModuleRandomizedPCA"))
+        testSuite.addTest(testPCATools("testPCAModuleRandomizedPCABinning"))
         if MDP:
             testSuite.addTest(testPCATools("testPCAToolsMDP"))
     return testSuite
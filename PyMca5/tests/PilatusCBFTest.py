@@ -0,0 +1,191 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import shutil
+import struct
+import tempfile
+import numpy
+
+def compressByteOffset(values):
+    """
+    Reference x-CBF_BYTE_OFFSET encoder, one value after the other
+    """
+    output = []
+    last = 0
+    for value in values:
+        delta = int(value) - last
+        last = int(value)
+        if -127 <= delta <= 127:
+            output.append(struct.pack("<b", delta))
+        elif -32767 <= delta <= 32767:
+            output.append(struct.pack("<Bh", 0x80, delta))
+        elif -2147483647 <= delta <= 2147483647:
+            output.append(struct.pack("<Bhi", 0x80, -32768, delta))
+        else:
+            output.append(struct.pack("<Bhiq", 0x80, -32768,
+                                      -2147483648, delta))
+    return "".encode("latin-1").join(output)
+
+def writeCBF(fname, image):
+    binary = compressByteOffset(image.ravel())
+    header = ["###CBF: VERSION 1.5",
+              "",
+              "data_test",
+              "",
+              "_array_data.data",
+              ";",
+              "--CIF-BINARY-FORMAT-SECTION--",
+              "Content-Type: application/octet-stream;",
+              "     conversions=\"x-CBF_BYTE_OFFSET\"",
+              "Content-Transfer-Encoding: BINARY",
+              "X-Binary-Size: %d" % len(binary),
+              "X-Binary-ID: 1",
+              "X-Binary-Element-Type: \"signed 32-bit integer\"",
+              "X-Binary-Element-Byte-Order: LITTLE_ENDIAN",
+              "X-Binary-Number-of-Elements: %d" % image.size,
+              "X-Binary-Size-Fastest-Dimension: %d" % image.shape[1],
+              "X-Binary-Size-Second-Dimension: %d" % image.shape[0],
+              "X-Binary-Size-Padding: 4095",
+              "",
+              ""]
+    f = open(fname, "wb")
+    f.write("\r\n".join(header).encode("latin-1"))
+    f.write("\x0c\x1a\x04\xd5".encode("latin-1"))
+    f.write(binary)
+    f.write(("\x00" * 4095).encode("latin-1"))
+    f.write("\r\n--CIF-BINARY-FORMAT-SECTION----\r\n;\r\n\r\n".encode("latin-1"))
+    f.close()
+
+class testPilatusCBF(unittest.TestCase):
+    def setUp(self):
+        """
+        import the module
+        """
+        try:
+            from PyMca5.PyMcaIO import PilatusCBF
+            self.pilatusCBF = PilatusCBF
+        except:
+            self.pilatusCBF = None
+        self.tmpDir = tempfile.mkdtemp(prefix="pymcatest_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def getValues(self, n):
+        # differences needing the 1, 2, 4 and 8 bytes encodings
+        randomState = numpy.random.RandomState(5)
+        limits = [127, 32767, 2147483647, 2 ** 40]
+        deltas = numpy.zeros((n,), numpy.int64)
+        for i in range(n):
+            limit = limits[randomState.randint(0, 4)]
+            deltas[i] = randomState.randint(-limit, limit + 1, dtype=numpy.int64)
+        return deltas.cumsum()
+
+    def testPilatusCBFImport(self):
+        self.assertTrue(self.pilatusCBF is not None)
+
+    def testPilatusCBFByteOffset(self):
+        self.assertTrue(self.pilatusCBF is not None)
+        decompress = self.pilatusCBF.decompressByteOffset
+        values = self.getValues(5000)
+        result = decompress(compressByteOffset(values))
+        self.assertEqual(result.dtype, numpy.int64)
+        self.assertTrue((result == values).all())
+
+        # differences whose encodings contain runs of 0x80 bytes
+        special = [-128, -128, -128, 128, -32640, -32640, 32767, -32767,
+                   -32768, -2139062144, -2139062144, -2147483647,
+                   -2147483648, 2147483647, 2147483648,
+                   -9187201950435737472, 9187201950435737472,
+                   -128, 0, -128, -32640, 0x80, 0x8080, 0x808080, -0x808080]
+        for deltas in [special, special[::-1]]:
+            values = numpy.array(deltas, numpy.int64).cumsum()
+            stream = compressByteOffset(values)
+            self.assertTrue(b"\x80\x80\x80\x80" in stream)
+            result = decompress(stream)
+            self.assertTrue((result == values).all())
+            # also mixed with ordinary values
+            values = numpy.concatenate((self.getValues(50),
+                                        values,
+                                        self.getValues(50)))
+            result = decompress(compressByteOffset(values))
+            self.assertTrue((result == values).all())
+
+        # a stream without any exception
+        values = numpy.arange(-50, 50)
+        result = decompress(compressByteOffset(values))
+        self.assertTrue((result == values).all())
+
+    def testPilatusCBFReadFileList(self):
+        self.assertTrue(self.pilatusCBF is not None)
+        randomState = numpy.random.RandomState(6)
+        fileList = []
+        images = []
+        for i in range(4):
+            image = randomState.poisson(5, (13, 17)).astype(numpy.int32)
+            # a few high and negative values
+            image[i, i] = 100000 * (i + 1)
+            image[12 - i, 3] = 2 ** 31 - 1
+            image[5, 16 - i] = -1
+            fname = os.path.join(self.tmpDir, "image_%04d.cbf" % i)
+            writeCBF(fname, image)
+            fileList.append(fname)
+            images.append(image)
+        cbf = self.pilatusCBF.PilatusCBF(fileList[0])
+        data = cbf.getData()
+        self.assertEqual(data.dtype, numpy.int32)
+        self.assertTrue((data == images[0]).all())
+        for nthreads in [1, 3]:
+            stack = self.pilatusCBF.readFileList(fileList, nthreads=nthreads)
+            self.assertEqual(stack.shape, (4, 13, 17))
+            for i in range(4):
+                self.assertTrue((stack[i] == images[i]).all())
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testPilatusCBF))
+    else:
+        # use a predefined order
+        testSuite.addTest(testPilatusCBF("testPilatusCBFImport"))
+        testSuite.addTest(testPilatusCBF("testPilatusCBFByteOffset"))
+        testSuite.addTest(testPilatusCBF("testPilatusCBFReadFileList"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,223 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import numpy
+
+class testSNIPModule(unittest.TestCase):
+    def setUp(self):
+        """
+        import the module
+        """
+        try:
+            from PyMca5.PyMcaMath import SNIPModule
+            from PyMca5.PyMcaCore import DataObject
+            self.snipModule = SNIPModule
+            self.dataObject = DataObject
+        except:
+            self.snipModule = None
+
+    def getStack(self):
+        # spectra with a peak over a background changing from pixel to pixel
+        x = numpy.arange(300.)
+        stack = numpy.zeros((3, 4, x.size), numpy.float64)
+        for i in range(3):
+            for j in range(4):
+                stack[i, j] = 100. * numpy.exp(-0.5 * ((x - 150.) / 5.) ** 2) + \
+                              (10. + i + j) * numpy.exp(-x / (100. + 20 * j))
+        return stack
+
+    def getExpected(self, stack, width, roi_min, roi_max, replace):
+        expected = numpy.zeros(stack.shape, numpy.float64)
+        for i in range(stack.shape[0]):
+            for j in range(stack.shape[1]):
+                spectrum = stack[i, j]
+                background = self.snipModule.getSpectrumBackground(spectrum,
+                                                width, roi_min, roi_max)
+                if replace:
+                    expected[i, j, roi_min:roi_max] = \
+                                        background[roi_min:roi_max]
+                else:
+                    expected[i, j, roi_min:roi_max] = \
+                        spectrum[roi_min:roi_max] - background[roi_min:roi_max]
+        return expected
+
+    def testSNIPModuleImport(self):
+        self.assertTrue(self.snipModule is not None)
+
+    def testSNIPModuleStack(self):
+        self.assertTrue(self.snipModule is not None)
+        stack = self.getStack()
+        width, roi_min, roi_max = 20, 10, 280
+        for replace in [False, True]:
+            expected = self.getExpected(stack, width, roi_min, roi_max,
+                                        replace)
+            if replace:
+                function = self.snipModule.replaceStackWithSnip1DBackground
+            else:
+                function = self.snipModule.subtractSnip1DBackgroundFromStack
+            # in place, spectra as last dimension
+            data = stack.copy()
+            function(data, width, roi_min, roi_max, nthreads=2)
+            self.assertTrue(numpy.allclose(data, expected))
+
+            # spectra as first dimension of a DataObject
+            dataObject = self.dataObject.DataObject()
+            dataObject.data = numpy.ascontiguousarray( \
+                                    numpy.transpose(stack, (2, 0, 1)))
+            dataObject.info = {"McaIndex": 0}
+            function(dataObject, width, roi_min, roi_max)
+            self.assertTrue(numpy.allclose( \
+                    numpy.transpose(dataObject.data, (1, 2, 0)), expected))
+
+            # several blocks written into an output array
+            output = numpy.zeros(stack.shape, numpy.float32)
+            result = self.snipModule._processSnip1DStack(stack, width,
+                                    roi_min, roi_max, 1, replace,
+                                    output=output,
+                                    chunksize=stack.shape[-1] * 8 * 5)
+            self.assertTrue(result is output)
+            self.assertTrue(numpy.allclose(output, expected, atol=1.0e-3))
+
+    def testSNIPModuleIntegerStack(self):
+        self.assertTrue(self.snipModule is not None)
+        stack = numpy.round(10 * self.getStack()).astype(numpy.int32)
+        width, roi_min, roi_max = 20, 0, stack.shape[-1]
+        expected = self.getExpected(stack.astype(numpy.float64),
+                                    width, roi_min, roi_max, False)
+        # the result does not fit into an integer array
+        data = stack.copy()
+        self.assertRaises(TypeError,
+                          self.snipModule.subtractSnip1DBackgroundFromStack,
+                          data, width)
+        self.assertTrue((data == stack).all())
+
+        # unless an output is given
+        output = numpy.zeros(stack.shape, numpy.float64)
+        self.snipModule.subtractSnip1DBackgroundFromStack(stack, width,
+                                                          output=output)
+        self.assertTrue(numpy.allclose(output, expected))
+
+        # the data of a DataObject are replaced
+        dataObject = self.dataObject.DataObject()
+        dataObject.data = stack.copy()
+        dataObject.info = {"McaIndex": 2}
+        self.snipModule.subtractSnip1DBackgroundFromStack(dataObject, width)
+        self.assertTrue(dataObject.data.dtype != stack.dtype)
+        self.assertTrue(numpy.allclose(dataObject.data, expected))
+
+    def testSNIPModuleBlocks(self):
+        self.assertTrue(self.snipModule is not None)
+        stack = self.getStack()
+        width, roi_min, roi_max = 20, 10, 280
+        expected = self.getExpected(stack, width, roi_min, roi_max, False)
+        # room for two rows of four spectra per block
+        chunksize = stack.shape[-1] * 8 * stack.shape[1] * 2
+        for mcaIndex in [-1, 0]:
+            if mcaIndex == 0:
+                data = numpy.ascontiguousarray( \
+                                numpy.transpose(stack, (2, 0, 1)))
+            else:
+                data = stack.copy()
+            recorder = _RecordingArray(data)
+            output = numpy.zeros(data.shape, numpy.float64)
+            dataObject = self.dataObject.DataObject()
+            dataObject.data = recorder
+            dataObject.info = {"McaIndex": mcaIndex}
+            self.snipModule._processSnip1DStack(dataObject, width,
+                                    roi_min, roi_max, 1, False,
+                                    output=output, chunksize=chunksize)
+            # three rows of four spectra read as blocks of two rows
+            self.assertEqual(len(recorder.keys), 2)
+            if mcaIndex == 0:
+                output = numpy.transpose(output, (1, 2, 0))
+            self.assertTrue(numpy.allclose(output, expected))
+
+    def testSNIPModuleMultipleSpectra(self):
+        self.assertTrue(self.snipModule is not None)
+        from PyMca5.PyMcaMath.fitting import SpecfitFuns
+        spectra = self.getStack().reshape(-1, 300)
+        width, filterWidth, anchors = 20, 5, [100, 200]
+        expected = numpy.zeros(spectra.shape, numpy.float64)
+        for i in range(spectra.shape[0]):
+            # smoothing and stripping of one spectrum after the other
+            background = SpecfitFuns.SavitskyGolay(spectra[i], filterWidth)
+            lastAnchor = 0
+            for anchor in anchors + [spectra.shape[1]]:
+                background[lastAnchor:anchor] = \
+                    SpecfitFuns.snip1d(background[lastAnchor:anchor],
+                                       width, 0)
+                lastAnchor = anchor
+            expected[i] = background
+        for nthreads in [None, 3]:
+            background = self.snipModule.getMultipleSpectraBackground( \
+                            spectra, width, anchorslist=anchors,
+                            filterwidth=filterWidth, nthreads=nthreads)
+            self.assertTrue(numpy.allclose(background, expected))
+            # spectra as columns
+            background = self.snipModule.getMultipleSpectraBackground( \
+                            spectra.T, width, anchorslist=anchors,
+                            filterwidth=filterWidth, mcaIndex=0,
+                            nthreads=nthreads)
+            self.assertEqual(background.shape, spectra.T.shape)
+            self.assertTrue(numpy.allclose(background.T, expected))
+
+class _RecordingArray(object):
+    def __init__(self, data):
+        self._data = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.keys = []
+
+    def __getitem__(self, key):
+        self.keys.append(key)
+        return self._data[key]
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testSNIPModule))
+    else:
+        # use a predefined order
+        testSuite.addTest(testSNIPModule("testSNIPModuleImport"))
+        testSuite.addTest(testSNIPModule("testSNIPModuleStack"))
+        testSuite.addTest(testSNIPModule("testSNIPModuleIntegerStack"))
+        testSuite.addTest(testSNIPModule("testSNIPModuleBlocks"))
+        testSuite.addTest(testSNIPModule("testSNIPModuleMultipleSpectra"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -79,8 +79,9 @@ def tearDown(self):
         # this should free the handle
         gc.collect()
         if self.specfileClass is not None:
-            if os.path.exists(self.fname):
-                os.remove(self.fname)
+            for fname in [self.fname, self.fname + ".sfI"]:
+                if os.path.exists(fname):
+                    os.remove(fname)
 
     def testSpecfileImport(self):
         #"""Test successful import"""
@@ -143,6 +144,85 @@ def testSpecfileReadingCompatibleWithUserLocale(self):
                     (datacol[1], data[0][1]))
         gc.collect()
 
+    def testSpecfileIndexFile(self):
+        #"""Test persistent index file and incremental update"""
+        self.testSpecfileImport()
+        oldValue = os.environ.get("SPECFILE_INDEX_MINSIZE", None)
+        # force the use of the index file whatever the file size
+        os.environ["SPECFILE_INDEX_MINSIZE"] = "0"
+        try:
+            self._sf = self.specfileClass.Specfile(self.fname)
+            self.assertTrue(os.path.exists(self.fname + ".sfI"),
+                            "Index file not written")
+            # add a scan with an already used number
+            text  = "#S 20  Undefined command 2\n"
+            text += "#N 2\n"
+            text += "#L First  Second\n"
+            text += "5  25\n"
+            f = open(self.fname, "a")
+            f.write(text)
+            f.close()
+            self._sf.update()
+            self.assertEqual(len(self._sf), 3,
+                             'Expected 3 scans, read %s' % len(self._sf))
+            self._scan = self._sf.select('20.2')
+            self.assertEqual(self._scan.datacol(2)[0], 25,
+                             'Wrong data read from updated scan')
+            # a new instance is built from the updated index
+            self._sf = None
+            self._scan = None
+            gc.collect()
+            self._sf = self.specfileClass.Specfile(self.fname)
+            self.assertEqual(len(self._sf), 3,
+                             'Expected 3 scans, read %s' % len(self._sf))
+            self.assertEqual(self._sf.list(), '10,20,20',
+                             'Unexpected scan list %s' % self._sf.list())
+            self._scan = self._sf.select('20.2')
+            self.assertEqual(self._scan.lines(), 1,
+                             'Expected 1 line, got %s' % self._scan.lines())
+        finally:
+            if oldValue is None:
+                del os.environ["SPECFILE_INDEX_MINSIZE"]
+            else:
+                os.environ["SPECFILE_INDEX_MINSIZE"] = oldValue
+        gc.collect()
+
+    def testSpecfileMcaBlock(self):
+        #"""Test the conversion of several mca spectra in one call"""
+        self.testSpecfileImport()
+        import numpy
+        text  = "#S 30  Undefined command 3\n"
+        text += "#N 1\n"
+        text += "#L First\n"
+        for i in range(5):
+            text += "%d\n" % i
+            text += "@A %d 2.5 -3e2 %d\\\n" % (i, 10 * i)
+            # spectra of different lengths
+            text += " 1.25e-1" + " 7" * i + "\n"
+        f = open(self.fname, "a")
+        f.write(text)
+        f.close()
+        self._sf = self.specfileClass.Specfile(self.fname)
+        self._scan = self._sf[2]
+        for dtype in [numpy.float64, numpy.float32]:
+            data = numpy.zeros((4, 8), dtype=dtype) - 1
+            n = self._scan.mcablock(data, 2, 1, 2)
+            self.assertEqual(n, 4, "Expected 4 spectra, got %d" % n)
+            for i in range(4):
+                mca = self._scan.mca(i + 2)
+                nChannels = min(mca.size, 8)
+                self.assertTrue(numpy.allclose(data[i, :nChannels],
+                                               mca[:nChannels]),
+                                "Wrong data in spectrum %d" % (i + 2))
+                self.assertTrue(numpy.all(data[i, nChannels:] == 0),
+                                "Missing channels not set to zero")
+        # last spectrum of a list of scans
+        data = numpy.zeros((1, 10))
+        n = self._sf.mcablock(data, [2], -1)
+        self.assertEqual(n, 1, "Expected 1 spectrum, got %d" % n)
+        self.assertTrue(numpy.allclose(data[0, :9], self._scan.mca(5)),
+                        "Wrong data in last spectrum")
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -154,6 +234,8 @@ def getSuite(auto=True):
         testSuite.addTest(testSpecfile("testSpecfileReading"))
         testSuite.addTest(\
             testSpecfile("testSpecfileReadingCompatibleWithUserLocale"))
+        testSuite.addTest(testSpecfile("testSpecfileIndexFile"))
+        testSuite.addTest(testSpecfile("testSpecfileMcaBlock"))
     return testSuite
 
 def test(auto=False):
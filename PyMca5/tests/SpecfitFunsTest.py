@@ -0,0 +1,166 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import numpy
+
+class testSpecfitFuns(unittest.TestCase):
+    def setUp(self):
+        """
+        import the module
+        """
+        try:
+            from PyMca5.PyMcaMath.fitting import SpecfitFuns
+            self.specfitFuns = SpecfitFuns
+        except:
+            self.specfitFuns = None
+        # more threads than rows included
+        self.nThreadsList = [2, 3, 8, 100]
+
+    def getSpectra(self, nSpectra=37, nChannels=1024):
+        randomState = numpy.random.RandomState(10)
+        x = numpy.arange(nChannels, dtype=numpy.float64)
+        spectra = numpy.zeros((nSpectra, nChannels), numpy.float64)
+        for i in range(nSpectra):
+            spectra[i] = 50. * numpy.exp(-x / (200. + 10 * i)) + \
+                         (1000. + 10 * i) * \
+                         numpy.exp(-0.5 * ((x - 300. - i) / 8.) ** 2) + \
+                         500. * numpy.exp(-0.5 * ((x - 700.) / 12.) ** 2)
+        return randomState.poisson(spectra).astype(numpy.float64)
+
+    def assertSameOutput(self, function, args, serial):
+        for nThreads in self.nThreadsList:
+            result = function(*(args + [nThreads]))
+            self.assertEqual(result.shape, serial.shape)
+            self.assertTrue(numpy.array_equal(result, serial),
+                            "%s differs with %d threads" % \
+                            (function.__name__, nThreads))
+
+    def testSpecfitFunsImport(self):
+        self.assertTrue(self.specfitFuns is not None)
+
+    def testSpecfitFunsSnip1d(self):
+        self.assertTrue(self.specfitFuns is not None)
+        spectra = self.getSpectra()
+        for width, smoothing, llsflag in [(20, 0, 0), (35, 2, 1)]:
+            serial = self.specfitFuns.snip1d(spectra, width, smoothing,
+                                             llsflag, 1)
+            for i in range(spectra.shape[0]):
+                self.assertTrue(numpy.array_equal(serial[i],
+                    self.specfitFuns.snip1d(spectra[i], width, smoothing,
+                                            llsflag)))
+            self.assertTrue(numpy.array_equal(serial,
+                    self.specfitFuns.snip1d(spectra, width, smoothing,
+                                            llsflag)))
+            self.assertSameOutput(self.specfitFuns.snip1d,
+                                  [spectra, width, smoothing, llsflag],
+                                  serial)
+
+    def testSpecfitFunsSavitskyGolay(self):
+        self.assertTrue(self.specfitFuns is not None)
+        spectra = self.getSpectra()
+        for points in [3, 11]:
+            serial = self.specfitFuns.SavitskyGolay(spectra, points, 1)
+            for i in range(spectra.shape[0]):
+                self.assertTrue(numpy.array_equal(serial[i],
+                    self.specfitFuns.SavitskyGolay(spectra[i], points)))
+            self.assertSameOutput(self.specfitFuns.SavitskyGolay,
+                                  [spectra, points], serial)
+
+    def testSpecfitFunsPeaks(self):
+        self.assertTrue(self.specfitFuns is not None)
+        x = numpy.linspace(0., 2000., 37 * 101).reshape(37, 101)
+        # area, position, fwhm and eta
+        voigt = [100., 500., 30., 0.3,
+                 50., 1200., 40., 0.7,
+                 20., 1210., 10., 0.0]
+        serial = self.specfitFuns.apvoigt(voigt, x, 0, 1)
+        self.assertEqual(serial.shape, x.shape)
+        self.assertTrue(numpy.array_equal(serial,
+                            self.specfitFuns.apvoigt(voigt, x)))
+        self.assertTrue(numpy.array_equal(serial[3],
+                            self.specfitFuns.apvoigt(voigt, x[3])))
+        self.assertSameOutput(self.specfitFuns.apvoigt, [voigt, x, 0],
+                              serial)
+
+        # area, position, fwhm, short tail area and slope,
+        # long tail area and slope, step height
+        hypermet = [100., 500., 30., 0.1, 0.5, 0.05, 20., 0.01,
+                    50., 1200., 40., 0.2, 0.8, 0.01, 30., 0.001]
+        for tails in [15, 1, 0]:
+            serial = self.specfitFuns.fastahypermet(hypermet, x, tails, 0, 1)
+            self.assertEqual(serial.shape, x.shape)
+            self.assertTrue(numpy.array_equal(serial,
+                        self.specfitFuns.fastahypermet(hypermet, x, tails)))
+            self.assertTrue(numpy.array_equal(serial[3],
+                        self.specfitFuns.fastahypermet(hypermet, x[3],
+                                                       tails)))
+            self.assertSameOutput(self.specfitFuns.fastahypermet,
+                                  [hypermet, x, tails, 0], serial)
+
+    def testSpecfitFunsInterpol(self):
+        self.assertTrue(self.specfitFuns is not None)
+        randomState = numpy.random.RandomState(11)
+        x0 = numpy.arange(20.)
+        x1 = numpy.linspace(-1., 1., 31)
+        y = numpy.sin(x0)[:, numpy.newaxis] * numpy.exp(x1)[numpy.newaxis, :]
+        # a few points outside the data range
+        points = numpy.zeros((5000, 2), numpy.float64)
+        points[:, 0] = randomState.uniform(-1., 20., 5000)
+        points[:, 1] = randomState.uniform(-1., 1.1, 5000)
+        serial = self.specfitFuns.interpol([x0, x1], y, points, -1., 1)
+        self.assertEqual(serial.shape, (5000,))
+        self.assertTrue(numpy.array_equal(serial,
+                        self.specfitFuns.interpol([x0, x1], y, points, -1.)))
+        self.assertTrue((serial == -1.).any())
+        self.assertSameOutput(self.specfitFuns.interpol,
+                              [[x0, x1], y, points, -1.], serial)
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testSpecfitFuns))
+    else:
+        # use a predefined order
+        testSuite.addTest(testSpecfitFuns("testSpecfitFunsImport"))
+        testSuite.addTest(testSpecfitFuns("testSpecfitFunsSnip1d"))
+        testSuite.addTest(testSpecfitFuns("testSpecfitFunsSavitskyGolay"))
+        testSuite.addTest(testSpecfitFuns("testSpecfitFunsPeaks"))
+        testSuite.addTest(testSpecfitFuns("testSpecfitFunsInterpol"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -95,13 +95,17 @@ def testStackBaseStack1DDataHandling(self):
             #usually only one file index case is used but
             #we test both to have a better coverage
             j = 0
-            for data in [referenceData, dummyArray]:
+            for data in [referenceData, dummyArray, dummyArray]:
                 if j == 0:
                     dynamic = ""
-                    j = 1
-                else:
+                elif j == 1:
                     dynamic = "dynamic "
+                else:
+                    dynamic = "cached dynamic "
                 stackBase = StackBase.StackBase()
+                if j == 2:
+                    stackBase.enableROIImagesCache()
+                j += 1
                 stackBase.setStack(data, mcaindex=2, fileindex=fileindex)
                 channels, counts = stackBase.getActiveCurve()[0:2]
                 self.assertTrue(numpy.allclose(defaultMca, counts),
@@ -159,13 +163,17 @@ def testStackBaseStack2DDataHandling(self):
             #usually only one file index case is used but
             #we test both to have a better coverage
             j = 0
-            for data in [referenceData, dummyArray]:
+            for data in [referenceData, dummyArray, dummyArray]:
                 if j == 0:
                     dynamic = ""
-                    j = 1
-                else:
+                elif j == 1:
                     dynamic = "dynamic "
+                else:
+                    dynamic = "cached dynamic "
                 stackBase = StackBase.StackBase()
+                if j == 2:
+                    stackBase.enableROIImagesCache()
+                j += 1
                 stackBase.setStack(data, mcaindex=0, fileindex=fileindex)
                 channels, counts = stackBase.getActiveCurve()[0:2]
                 self.assertTrue(numpy.allclose(defaultMca, counts),
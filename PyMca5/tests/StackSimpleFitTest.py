@@ -0,0 +1,133 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import gc
+import shutil
+import tempfile
+import numpy
+
+class testStackSimpleFit(unittest.TestCase):
+    def setUp(self):
+        """
+        import the modules
+        """
+        self.tmpDir = tempfile.mkdtemp()
+        try:
+            from PyMca5.PyMcaMath.fitting import StackSimpleFit
+            from PyMca5.PyMcaMath.fitting import SimpleFitModule
+            from PyMca5.PyMcaMath.fitting import SpecfitFunctions
+            from PyMca5.PyMcaMath.fitting import SpecfitFuns
+            self.stackSimpleFit = StackSimpleFit
+            self.simpleFitModule = SimpleFitModule
+            self.specfitFunctions = SpecfitFunctions
+            self.specfitFuns = SpecfitFuns
+        except:
+            self.stackSimpleFit = None
+
+    def tearDown(self):
+        """clean up the output files"""
+        gc.collect()
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def getStack(self, nRows, nColumns):
+        # one gaussian per spectrum, its position and height changing
+        x = numpy.arange(200.)
+        data = numpy.zeros((nRows, nColumns, x.size), numpy.float64)
+        for row in range(nRows):
+            for column in range(nColumns):
+                data[row, column] = self.specfitFuns.gauss( \
+                            [100. + row + column, 80. + 2 * column + row, 20.],
+                            x)
+        return x, data
+
+    def fitStack(self, x, data, nProcesses, name, warmStart=False):
+        fit = self.simpleFitModule.SimpleFit()
+        fit.importFunctions(self.specfitFunctions)
+        fit.setFitFunction('Gaussians')
+        configuration = fit.getConfiguration()
+        configuration['fit']['strip_flag'] = 0
+        fit.setConfiguration(configuration)
+        stackFit = self.stackSimpleFit.StackSimpleFit(fit=fit,
+                                                     nprocesses=nProcesses)
+        # not used unless requested
+        self.assertFalse(stackFit.warmStart)
+        stackFit.warmStart = warmStart
+        stackFit.setOutputDirectory(self.tmpDir)
+        stackFit.setOutputFileBaseName(name)
+        stackFit.setData(x, data)
+        stackFit.processStack()
+        return stackFit
+
+    def testStackSimpleFitImport(self):
+        self.assertTrue(self.stackSimpleFit is not None)
+
+    def testStackSimpleFitProcesses(self):
+        self.assertTrue(self.stackSimpleFit is not None)
+        # a single process unless requested
+        self.assertEqual(self.stackSimpleFit.NUMBER_OF_PROCESSES, 1)
+        x, data = self.getStack(4, 5)
+        # a first spectrum that cannot be fitted is skipped
+        data[0, 0] = 0.0
+        for warmStart in [False, True]:
+            serial = self.fitStack(x, data, 1, "serial%d" % warmStart,
+                                   warmStart=warmStart)
+            pool = self.fitStack(x, data, 2, "pool%d" % warmStart,
+                                 warmStart=warmStart)
+            self.assertEqual(pool._parameters, serial._parameters)
+            for parameter in serial._parameters + ['chisq']:
+                self.assertTrue(numpy.allclose(pool._images[parameter],
+                                               serial._images[parameter]),
+                                "Different %s values" % parameter)
+            for parameter in serial._parameters:
+                self.assertTrue(numpy.allclose(pool._sigmas[parameter],
+                                               serial._sigmas[parameter]))
+            position = serial._images['Position']
+            self.assertEqual(position[0, 0], 0.0)
+            self.assertTrue(abs(position[3, 4] - 91.) < 0.01)
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testStackSimpleFit))
+    else:
+        # use a predefined order
+        testSuite.addTest(testStackSimpleFit("testStackSimpleFitImport"))
+        testSuite.addTest(testStackSimpleFit("testStackSimpleFitProcesses"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
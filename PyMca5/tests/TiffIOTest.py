@@ -0,0 +1,330 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import gc
+import shutil
+import struct
+import tempfile
+import zlib
+import numpy
+
+# the example of the TIFF 6.0 specification: the pixels 7 7 7 8 8 7 7 6 6
+# are coded as 256 7 258 8 8 258 6 6 257 using 9 bits per code
+LZW_FIXTURE = "8001e0408044080c068080"
+LZW_FIXTURE_VALUES = [7, 7, 7, 8, 8, 7, 7, 6, 6]
+
+def encodeLZW(data):
+    """
+    Reference TIFF LZW encoder (most significant bit first, early change)
+    """
+    def newTable():
+        return dict((struct.pack('B', i), i) for i in range(256))
+    output = bytearray()
+    # pending bits
+    accumulator = [0, 0]
+    def put(code, nBits):
+        value = (accumulator[0] << nBits) | code
+        n = accumulator[1] + nBits
+        while n >= 8:
+            n -= 8
+            output.append((value >> n) & 0xFF)
+        accumulator[0] = value & ((1 << n) - 1)
+        accumulator[1] = n
+    table = newTable()
+    nextCode = 258
+    nBits = 9
+    put(256, nBits)
+    omega = data[0:0]
+    for i in range(len(data) + 1):
+        if i < len(data):
+            k = data[i:i + 1]
+            if (omega + k) in table:
+                omega = omega + k
+                continue
+        elif not len(omega):
+            break
+        put(table[omega], nBits)
+        if i < len(data):
+            table[omega + k] = nextCode
+            omega = k
+        nextCode += 1
+        if nextCode == 4094:
+            # table full
+            put(256, nBits)
+            table = newTable()
+            nextCode = 258
+            nBits = 9
+        elif nextCode > ((1 << nBits) - 1):
+            nBits += 1
+    put(257, nBits)
+    if accumulator[1]:
+        put(0, 8 - accumulator[1])
+    return bytes(output)
+
+def encodeBlock(block, compression, predictor, byteOrder):
+    dtype = block.dtype.newbyteorder(byteOrder)
+    if predictor == 2:
+        # horizontal differencing
+        difference = block.copy()
+        difference[:, 1:] = block[:, 1:] - block[:, :-1]
+        raw = difference.astype(dtype).tobytes()
+    elif predictor == 3:
+        # bytes of each row grouped by significance and differenced
+        readout = block.astype(block.dtype.newbyteorder(">"))
+        readout = readout.view(numpy.uint8).reshape(block.shape[0],
+                                                    block.shape[1], -1)
+        readout = readout.transpose(0, 2, 1).reshape(block.shape[0], -1)
+        difference = readout.copy()
+        difference[:, 1:] = readout[:, 1:] - readout[:, :-1]
+        raw = difference.tobytes()
+    else:
+        raw = block.astype(dtype).tobytes()
+    if compression == 5:
+        return encodeLZW(raw)
+    elif compression in [8, 32946]:
+        return zlib.compress(raw)
+    return raw
+
+def writeTiff(fname, image, compression=1, predictor=1, rowsPerStrip=None,
+              tileShape=None, byteOrder="<"):
+    """
+    Write a single image TIFF file splitting it in strips or tiles
+    """
+    nRows, nColumns = image.shape
+    blockList = []
+    if tileShape is None:
+        if rowsPerStrip is None:
+            rowsPerStrip = nRows
+        for rowStart in range(0, nRows, rowsPerStrip):
+            blockList.append(image[rowStart:rowStart + rowsPerStrip])
+    else:
+        tileLength, tileWidth = tileShape
+        for rowStart in range(0, nRows, tileLength):
+            for colStart in range(0, nColumns, tileWidth):
+                # the tiles at the borders are padded
+                block = numpy.zeros(tileShape, image.dtype)
+                tile = image[rowStart:rowStart + tileLength,
+                             colStart:colStart + tileWidth]
+                block[:tile.shape[0], :tile.shape[1]] = tile
+                blockList.append(block)
+    blockList = [encodeBlock(block, compression, predictor, byteOrder)
+                 for block in blockList]
+    offsets = []
+    position = 8
+    for block in blockList:
+        offsets.append(position)
+        position += len(block)
+    byteCounts = [len(block) for block in blockList]
+    sampleFormat = {"u": 1, "i": 2, "f": 3}[image.dtype.kind]
+    # SHORT entries are type 3 and LONG entries are type 4
+    entries = [(256, 4, [nColumns]),
+               (257, 4, [nRows]),
+               (258, 3, [8 * image.dtype.itemsize]),
+               (259, 3, [compression]),
+               (262, 3, [1]),
+               (277, 3, [1]),
+               (339, 3, [sampleFormat])]
+    if predictor != 1:
+        entries.append((317, 3, [predictor]))
+    if tileShape is None:
+        entries.append((273, 4, offsets))
+        entries.append((278, 4, [rowsPerStrip]))
+        entries.append((279, 4, byteCounts))
+    else:
+        entries.append((322, 4, [tileShape[1]]))
+        entries.append((323, 4, [tileShape[0]]))
+        entries.append((324, 4, offsets))
+        entries.append((325, 4, byteCounts))
+    entries.sort()
+    extra = []
+    ifd = [struct.pack(byteOrder + "H", len(entries))]
+    for tag, fieldType, values in entries:
+        fmt = byteOrder + "%d%s" % (len(values), {3: "H", 4: "I"}[fieldType])
+        packed = struct.pack(fmt, *values)
+        if len(packed) > 4:
+            ifd.append(struct.pack(byteOrder + "HHII", tag, fieldType,
+                                   len(values), position))
+            extra.append(packed)
+            position += len(packed)
+        else:
+            ifd.append(struct.pack(byteOrder + "HHI", tag, fieldType,
+                                   len(values)) + \
+                       packed + (4 - len(packed)) * b"\x00")
+    ifd.append(struct.pack(byteOrder + "I", 0))
+    if byteOrder == "<":
+        header = b"II" + struct.pack("<HI", 42, position)
+    else:
+        header = b"MM" + struct.pack(">HI", 42, position)
+    f = open(fname, "wb")
+    f.write(header)
+    for block in blockList + extra + ifd:
+        f.write(block)
+    f.close()
+
+class testTiffIO(unittest.TestCase):
+    def setUp(self):
+        """
+        import the module
+        """
+        try:
+            from PyMca5.PyMcaIO import TiffIO
+            self.tiffIO = TiffIO
+        except:
+            self.tiffIO = None
+        self.tmpDir = tempfile.mkdtemp(prefix="pymcatest_")
+
+    def tearDown(self):
+        gc.collect()
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def getImage(self, dtype, shape=(37, 45)):
+        # smooth enough to be compressed, with some noise
+        randomState = numpy.random.RandomState(7)
+        y, x = numpy.indices(shape)
+        image = 1000. * numpy.sin(0.1 * x) * numpy.cos(0.07 * y) + \
+                randomState.randint(0, 4, shape)
+        if numpy.dtype(dtype).kind == "u":
+            image = image - image.min()
+        return image.astype(dtype)
+
+    def readAndCheck(self, fname, image):
+        tif = self.tiffIO.TiffIO(fname, cache_length=0)
+        try:
+            data = tif.getData(0)
+            self.assertEqual(data.dtype, image.dtype)
+            self.assertTrue(numpy.array_equal(data, image))
+            nRows = image.shape[0]
+            for rowMin, rowMax in [(0, 0), (5, 12), (nRows - 3, nRows - 1)]:
+                data = tif.getData(0, rowMin=rowMin, rowMax=rowMax)
+                self.assertTrue(numpy.array_equal(data[rowMin:rowMax + 1],
+                                                  image[rowMin:rowMax + 1]))
+        finally:
+            tif.close()
+
+    def testTiffIOImport(self):
+        self.assertTrue(self.tiffIO is not None)
+
+    def testTiffIOLZWDecoder(self):
+        self.assertTrue(self.tiffIO is not None)
+        fixture = bytes(bytearray.fromhex(LZW_FIXTURE))
+        self.assertEqual(encodeLZW(bytes(bytearray(LZW_FIXTURE_VALUES))),
+                         fixture)
+        # data long enough to fill the code table several times
+        randomState = numpy.random.RandomState(8)
+        data = numpy.repeat(randomState.randint(0, 256, 40000),
+                            randomState.randint(1, 4, 40000))
+        data = data.astype(numpy.uint8).tobytes()
+        stream = encodeLZW(data)
+        helper = self.tiffIO.PyMcaIOHelper
+        decoderList = [None]
+        if helper is not None:
+            self.assertTrue(hasattr(helper, "decodeLZW"))
+            decoderList.append(helper)
+        try:
+            for decoder in decoderList:
+                # the compiled decoder and the python one
+                self.tiffIO.PyMcaIOHelper = decoder
+                readout = self.tiffIO._decodeLZW(fixture, 100)
+                self.assertEqual(readout.dtype, numpy.uint8)
+                self.assertEqual(readout.tolist(), LZW_FIXTURE_VALUES)
+                readout = self.tiffIO._decodeLZW(fixture, 4)
+                self.assertEqual(readout.tolist(), LZW_FIXTURE_VALUES[:4])
+                readout = self.tiffIO._decodeLZW(stream, len(data))
+                self.assertEqual(readout.tobytes(), data)
+                readout = self.tiffIO._decodeLZW(stream, 1000)
+                self.assertEqual(readout.tobytes(), data[:1000])
+        finally:
+            self.tiffIO.PyMcaIOHelper = helper
+
+    def testTiffIOLZW(self):
+        self.assertTrue(self.tiffIO is not None)
+        i = 0
+        for dtype in [numpy.uint8, numpy.uint16, numpy.int32, numpy.float32]:
+            image = self.getImage(dtype)
+            for byteOrder in ["<", ">"]:
+                for predictor in [1, 2, 3]:
+                    if (predictor == 2) and (image.dtype.kind == "f"):
+                        continue
+                    if (predictor == 3) and (image.dtype.kind != "f"):
+                        continue
+                    for rowsPerStrip in [None, 8]:
+                        fname = os.path.join(self.tmpDir, "lzw%d.tif" % i)
+                        i += 1
+                        writeTiff(fname, image, compression=5,
+                                  predictor=predictor,
+                                  rowsPerStrip=rowsPerStrip,
+                                  byteOrder=byteOrder)
+                        self.readAndCheck(fname, image)
+
+    def testTiffIODeflatePredictor(self):
+        self.assertTrue(self.tiffIO is not None)
+        i = 0
+        for dtype, predictor in [(numpy.uint16, 2),
+                                 (numpy.int16, 2),
+                                 (numpy.float32, 3),
+                                 (numpy.float64, 3),
+                                 (numpy.float32, 1)]:
+            image = self.getImage(dtype)
+            for compression in [8, 32946]:
+                for byteOrder in ["<", ">"]:
+                    for rowsPerStrip, tileShape in [(None, None),
+                                                    (5, None),
+                                                    (None, (16, 16))]:
+                        fname = os.path.join(self.tmpDir, "zip%d.tif" % i)
+                        i += 1
+                        writeTiff(fname, image, compression=compression,
+                                  predictor=predictor,
+                                  rowsPerStrip=rowsPerStrip,
+                                  tileShape=tileShape,
+                                  byteOrder=byteOrder)
+                        self.readAndCheck(fname, image)
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testTiffIO))
+    else:
+        # use a predefined order
+        testSuite.addTest(testTiffIO("testTiffIOImport"))
+        testSuite.addTest(testTiffIO("testTiffIOLZWDecoder"))
+        testSuite.addTest(testTiffIO("testTiffIOLZW"))
+        testSuite.addTest(testTiffIO("testTiffIODeflatePredictor"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,128 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import gc
+import tempfile
+import numpy
+
+class testTiffStack(unittest.TestCase):
+    def setUp(self):
+        """
+        import the modules and write a few multi-image TIFF files
+        """
+        try:
+            from PyMca5.PyMcaIO import TiffIO
+            from PyMca5.PyMcaIO import TiffStack
+            self.tiffStack = TiffStack
+        except:
+            self.tiffStack = None
+        self.fileList = []
+        self.data = numpy.arange(6 * 20 * 30).astype(numpy.float32)
+        self.data.shape = 6, 20, 30
+        if self.tiffStack is None:
+            return
+        for i in range(3):
+            tmpFile = tempfile.mkstemp(suffix=".tif", text=False)
+            os.close(tmpFile[0])
+            self.fileList.append(tmpFile[1])
+            tif = TiffIO.TiffIO(tmpFile[1], mode='wb+')
+            tif.writeImage(self.data[2 * i],
+                           info={"Title": "image %d" % (2 * i)})
+            tif = None
+            tif = TiffIO.TiffIO(tmpFile[1], mode='rb+')
+            tif.writeImage(self.data[2 * i + 1],
+                           info={"Title": "image %d" % (2 * i + 1)})
+            tif = None
+
+    def tearDown(self):
+        """clean up any possible files"""
+        gc.collect()
+        for fname in self.fileList:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    def testTiffStackImport(self):
+        self.assertTrue(self.tiffStack is not None)
+
+    def testTiffStackLazyArray(self):
+        self.assertTrue(self.tiffStack is not None)
+        data = self.data
+        stack = self.tiffStack.TiffStack(imagestack=True)
+        stack.loadFileList(self.fileList, dynamic=True)
+        self.assertEqual(stack.data.shape, data.shape)
+
+        # partial reads do not fill the cache
+        self.assertTrue((stack.data[:, 5] == data[:, 5]).all())
+        self.assertTrue((stack.data[1:5, 3:9:2, 4] == \
+                         data[1:5, 3:9:2, 4]).all())
+        self.assertTrue((stack.data[4, [12, 7], :] == \
+                         data[4, [12, 7], :]).all())
+        self.assertEqual(len(stack.data._cache), 0)
+
+        # complete images are cached and rows taken from them
+        self.assertTrue((stack.data[2] == data[2]).all())
+        self.assertTrue((stack.data[1:3, 10:12] == data[1:3, 10:12]).all())
+        self.assertTrue((stack.data[...] == data).all())
+        stack.data.close()
+
+        # still readable after closing the files
+        self.assertTrue((stack.data[5, -2] == data[5, -2]).all())
+        stack.data.close()
+
+        # frames as last dimension
+        stack = self.tiffStack.TiffStack(imagestack=False)
+        stack.loadFileList(self.fileList, dynamic=True)
+        data = numpy.transpose(data, (1, 2, 0))
+        self.assertEqual(stack.data.shape, data.shape)
+        self.assertTrue((stack.data[3:6, :, 1:4] == data[3:6, :, 1:4]).all())
+        self.assertTrue((stack.data[...] == data).all())
+        stack.data.close()
+        stack = None
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testTiffStack))
+    else:
+        # use a predefined order
+        testSuite.addTest(testTiffStack("testTiffStackImport"))
+        testSuite.addTest(testTiffStack("testTiffStackLazyArray"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
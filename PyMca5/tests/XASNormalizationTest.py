@@ -0,0 +1,156 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import numpy
+
+class testXASNormalization(unittest.TestCase):
+    def setUp(self):
+        """
+        import the module
+        """
+        try:
+            from PyMca5.PyMcaPhysics.xas import XASNormalization
+            self.xasNormalization = XASNormalization
+        except:
+            self.xasNormalization = None
+
+    def getSpectra(self, nSpectra):
+        # XANES like spectra with slightly different edges and jumps
+        energy = numpy.linspace(8600., 9600., 400)
+        edges = 9000. + numpy.linspace(-4.0, 4.0, nSpectra)
+        spectra = numpy.zeros((nSpectra, energy.size), numpy.float64)
+        for i in range(nSpectra):
+            spectra[i] = 0.1 + 1.0e-5 * (energy - 8600.) + \
+                         (1.0 + 0.3 * i / nSpectra) * \
+                         (0.5 + numpy.arctan((energy - edges[i]) / 3.) / numpy.pi)
+        return energy, spectra
+
+    def testXASNormalizationImport(self):
+        self.assertTrue(self.xasNormalization is not None)
+
+    def testXASSpectraNormalization(self):
+        self.testXASNormalizationImport()
+        energy, spectra = self.getSpectra(6)
+        preRegions = [[-300., -50.]]
+        postRegions = [[30., 500.]]
+        parameters = {'pre_edge_order': 1, 'post_edge_order': 2}
+        result = self.xasNormalization.XASSpectraNormalization(spectra,
+                                    energy=energy,
+                                    edge=9000.,
+                                    pre_edge_regions=preRegions,
+                                    post_edge_regions=postRegions,
+                                    algorithm_parameters=parameters)
+        normalized, edges, jumps, errors = result
+        self.assertFalse(errors.any())
+        for i in range(spectra.shape[0]):
+            ene, spe, ed, jmp = self.xasNormalization.XASNormalization( \
+                                    spectra[i],
+                                    energy=energy,
+                                    edge=9000.,
+                                    pre_edge_regions=preRegions,
+                                    post_edge_regions=postRegions,
+                                    algorithm_parameters=parameters)[0:4]
+            self.assertTrue(numpy.allclose(spe, normalized[i], atol=1.0e-6))
+            self.assertTrue(abs(jmp - jumps[i]) < 1.0e-6)
+
+    def testXASStackNormalization(self):
+        self.testXASNormalizationImport()
+        energy, spectra = self.getSpectra(20)
+        stack = spectra.reshape(4, 5, -1)
+        for algorithm in ['polynomial', 'victoreen']:
+            if algorithm == 'victoreen':
+                preRegions = [[8700., 8950.]]
+                postRegions = [[9050., 9500.]]
+            else:
+                preRegions = [[-300., -50.]]
+                postRegions = [[30., 500.]]
+            data = stack.copy()
+            edges, jumps, errors = \
+                    self.xasNormalization.XASStackNormalization(data,
+                                    energy=energy,
+                                    pre_edge_regions=preRegions,
+                                    post_edge_regions=postRegions,
+                                    algorithm=algorithm,
+                                    mcaIndex=-1)
+            self.assertEqual(edges.shape, (4, 5))
+            self.assertFalse(errors.any())
+            self.assertTrue(abs(edges - 9000.).max() < 10.)
+            self.assertTrue(data.max() > 0.5)
+
+            # the same result with the energy as first dimension
+            data0 = numpy.ascontiguousarray(numpy.transpose(stack, (2, 0, 1)))
+            edges0, jumps0, errors0 = \
+                    self.xasNormalization.XASStackNormalization(data0,
+                                    energy=energy,
+                                    pre_edge_regions=preRegions,
+                                    post_edge_regions=postRegions,
+                                    algorithm=algorithm,
+                                    mcaIndex=0)
+            self.assertTrue(numpy.allclose(edges0, edges))
+            self.assertTrue(numpy.allclose(jumps0, jumps))
+            self.assertTrue(numpy.allclose(numpy.transpose(data0, (1, 2, 0)),
+                                           data))
+
+        # integer stacks cannot be normalized in place
+        data = numpy.round(1000 * stack).astype(numpy.int32)
+        self.assertRaises(TypeError,
+                          self.xasNormalization.XASStackNormalization,
+                          data, energy=energy)
+        output = numpy.zeros(data.shape, numpy.float64)
+        edges, jumps, errors = \
+                self.xasNormalization.XASStackNormalization(data,
+                                    energy=energy,
+                                    pre_edge_regions=preRegions,
+                                    post_edge_regions=postRegions,
+                                    algorithm=algorithm,
+                                    output=output)
+        self.assertFalse(errors.any())
+        self.assertTrue(abs(output.max() - 1.) < 0.5)
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testXASNormalization))
+    else:
+        # use a predefined order
+        testSuite.addTest(testXASNormalization("testXASNormalizationImport"))
+        testSuite.addTest(testXASNormalization("testXASSpectraNormalization"))
+        testSuite.addTest(testXASNormalization("testXASStackNormalization"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()